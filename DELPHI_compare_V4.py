@@ -9,6 +9,7 @@ import numpy as np
 from scipy.optimize import minimize
 from datetime import datetime, timedelta
 from DELPHI_utils_V4_dynamic import DELPHIModelComparison
+from DELPHI_utils_V4_static import load_case_history_store
 
 
 ## Initializing Global Variables ##########################################################################
@@ -68,78 +69,80 @@ if __name__ == "__main__":
 
     ## Run annealing and tnc
     if RUN_MODEL:
-        logger.info('Running TNC and Annealing')
+        # The race mode fits TNC and Annealing in the same run and selects the best one per area in memory, saving the
+        # best parameters under the default Parameters_Global_V4 file name and the comparison file itself
+        logger.info('Running TNC and Annealing in race mode')
         os.system(
-            f'python3 DELPHI_model_V4.py -rc tnc-run-config.yml'
+            f'python3 DELPHI_model_V4.py -rc run_configs/race-run-config.yml'
         )
-        os.system(
-            f'python3 DELPHI_model_V4.py -rc annealing-run-config.yml'
+        today_date_str = "".join(str(datetime.now().date()).split("-"))
+        df_comparison = pd.read_csv(
+            CONFIG_FILEPATHS['data_sandbox'][USER_RUNNING] + f'comparison/model_comparison_{today_date_str}.csv'
+        )
+        annealing_count = np.sum(df_comparison['annealing_selected'])
+    else:
+        today_date_str = "".join(str(datetime.now().date()).split("-"))
+        #today_date_str = '20201004'
+        ## Read parameter files
+        global_parameters_tnc = pd.read_csv(
+            PATH_TO_FOLDER_DANGER_MAP + f"/predicted/Parameters_Global_V4_{today_date_str}.csv"
+        )
+        global_parameters_annealing = pd.read_csv(
+            PATH_TO_FOLDER_DANGER_MAP + f"/predicted/Parameters_Global_V4_annealing_{today_date_str}.csv"
         )
 
-    today_date_str = "".join(str(datetime.now().date()).split("-"))
-    #today_date_str = '20201004'
-    ## Read parameter files
-    global_parameters_tnc = pd.read_csv(
-        PATH_TO_FOLDER_DANGER_MAP + f"/predicted/Parameters_Global_V4_{today_date_str}.csv"
-    )
-    global_parameters_annealing = pd.read_csv(
-        PATH_TO_FOLDER_DANGER_MAP + f"/predicted/Parameters_Global_V4_annealing_{today_date_str}.csv"
-    )
-    global_parameters_best = pd.DataFrame(columns=global_parameters_tnc.columns)
+        ## Compare metrics
+        global_annealing_predictions_since_100days = pd.read_csv(
+            PATH_TO_FOLDER_DANGER_MAP + f'predicted/Global_V4_annealing_since100_{today_date_str}.csv'
+        )
+        total_tnc_predictions_since_100days = pd.read_csv(
+            PATH_TO_FOLDER_DANGER_MAP + f'predicted/Global_V4_since100_{today_date_str}.csv'
+        )
 
-    ## Compare metrics
-    global_annealing_predictions_since_100days = pd.read_csv(
-        PATH_TO_FOLDER_DANGER_MAP + f'predicted/Global_V4_annealing_since100_{today_date_str}.csv'
-    )
-    total_tnc_predictions_since_100days = pd.read_csv(
-        PATH_TO_FOLDER_DANGER_MAP + f'predicted/Global_V4_since100_{today_date_str}.csv'
-    )
+        global_annealing_predictions_since_100days['Day'] = global_annealing_predictions_since_100days['Day'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
+        total_tnc_predictions_since_100days['Day'] = total_tnc_predictions_since_100days['Day'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
+        # Provinces "None" are read as missing values, they are restored for the areas to match the parameters
+        for df_predictions in [global_annealing_predictions_since_100days, total_tnc_predictions_since_100days]:
+            df_predictions["Province"] = df_predictions["Province"].fillna("None")
+
+        model_compare = DELPHIModelComparison(
+            PATH_TO_FOLDER_DANGER_MAP,
+            CONFIG_FILEPATHS['data_sandbox'][USER_RUNNING],
+            global_annealing_predictions_since_100days,
+            total_tnc_predictions_since_100days,
+            logger=logger,
+            case_history_store=load_case_history_store(PATH_TO_FOLDER_DANGER_MAP + "processed/Global/"),
+        )
 
-    global_annealing_predictions_since_100days['Day'] = global_annealing_predictions_since_100days['Day'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
-    total_tnc_predictions_since_100days['Day'] = total_tnc_predictions_since_100days['Day'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
+        # Provinces "None" are read as missing values, they are restored so that the best parameters are saved with
+        # the same areas as the model runs
+        global_parameters_tnc["Province"] = global_parameters_tnc["Province"].fillna("None")
+        global_parameters_annealing["Province"] = global_parameters_annealing["Province"].fillna("None")
+        # Areas are compared all at once, except the ones without annealing parameters which are skipped
+        list_province_tuples = DELPHIModelComparison.get_areas_to_compare(
+            global_parameters_tnc, global_parameters_annealing, logger
+        )
 
-    model_compare = DELPHIModelComparison(
-        PATH_TO_FOLDER_DANGER_MAP,
-        CONFIG_FILEPATHS['data_sandbox'][USER_RUNNING],
-        global_annealing_predictions_since_100days,
-        total_tnc_predictions_since_100days,
-        logger=logger
-    )
+        df_comparison = model_compare.compare_metric_all_areas(list_province_tuples)
+        for continent, country, province in df_comparison.loc[~df_comparison.annealing_selected, "region"]:
+            logger.warning(f'Annealing performs worse in {country} - {province}')
+        if PLOT_OPTION:
+            for province_tuple in list_province_tuples:
+                model_compare.compare_metric(province_tuple, plot=True)
+        global_parameters_best = DELPHIModelComparison.select_best_parameters(
+            global_parameters_tnc, global_parameters_annealing, df_comparison
+        )
 
-    comparison_results = {'region': [], 'annealing_selected': [], 'annealing_metric': [], 'tnc_metric': [], 'annealing_max_ape': []}
-    for i in range(global_parameters_tnc.shape[0]):
-        tnc_params = global_parameters_tnc.iloc[i]
-        continent = tnc_params.Continent
-        country = tnc_params.Country
-        province = tnc_params.Province
-        annealing_params = global_parameters_annealing.query('Continent == @continent').query('Country == @country').query('Province == @province')
-
-        if annealing_params.shape[0] == 0:
-            logger.warning(f'Annealing parameters not present for {country} - {province}')
-        else:
-            annealing_select, annnealing_metric, tnc_metric, annealing_max_ape = model_compare.compare_metric((continent, country, province), plot=PLOT_OPTION)
-            comparison_results['region'].append((continent, country, province))
-            comparison_results['annealing_selected'].append(annealing_select)
-            comparison_results['annealing_metric'].append(annnealing_metric)
-            comparison_results['tnc_metric'].append(tnc_metric)
-            comparison_results['annealing_max_ape'].append(annealing_max_ape)
-            if (not annealing_select):
-                logger.warning(f'Annealing performs worse in {country} - {province}')
-                global_parameters_best = global_parameters_best.append(tnc_params, ignore_index=True)
-            else:
-                global_parameters_best = global_parameters_best.append(annealing_params, ignore_index=True)
-
-    global_parameters_best.to_csv(
-            PATH_TO_FOLDER_DANGER_MAP + f"/predicted/Parameters_Global_V4_{today_date_str}.csv",
-            index=False,
-    )
+        global_parameters_best.to_csv(
+                PATH_TO_FOLDER_DANGER_MAP + f"/predicted/Parameters_Global_V4_{today_date_str}.csv",
+                index=False,
+        )
 
-    df_comparison = pd.DataFrame.from_dict(comparison_results)
-    annealing_count = np.sum(df_comparison['annealing_selected'])
-    df_comparison.to_csv(
-        CONFIG_FILEPATHS['data_sandbox'][USER_RUNNING] + f'comparison/model_comparison_{today_date_str}.csv',
-        index=False
-    )
+        annealing_count = np.sum(df_comparison['annealing_selected'])
+        df_comparison.to_csv(
+            CONFIG_FILEPATHS['data_sandbox'][USER_RUNNING] + f'comparison/model_comparison_{today_date_str}.csv',
+            index=False
+        )
 
     logger.info(
         f"Checked Annealing v/s TNC. Annealing performs better {annealing_count}/{df_comparison.shape[0]} \n"
@@ -0,0 +1,96 @@
+# Inspection and eviction of the fit cache of DELPHI_model_V4.py (run configs with fit_cache: 1)
+# To run: python3 DELPHI_fit_cache_V4.py --user <USER_RUNNING> list
+import yaml
+import argparse
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+from DELPHI_utils_V4_static import DELPHIFitCache
+
+
+with open("config.yml", "r") as ymlfile:
+    CONFIG = yaml.load(ymlfile, Loader=yaml.BaseLoader)
+CONFIG_FILEPATHS = CONFIG["filepaths"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--user', '-u', type=str, required=True, choices=list(CONFIG_FILEPATHS["data_sandbox"].keys()),
+    help="Who is the user running? The fit cache is in the data_sandbox folder of that user in config.yml"
+)
+subparsers = parser.add_subparsers(dest="command", required=True)
+for command, help_command in [
+    ("list", "List the entries of the fit cache, optionally filtered"),
+    ("evict", "Remove the entries of the fit cache matching the filters (or all of them with --all)"),
+]:
+    parser_command = subparsers.add_parser(command, help=help_command)
+    parser_command.add_argument('--key', '-k', type=str, help="Prefix of the key of the entries")
+    parser_command.add_argument('--country', '-c', type=str, help="Country of the entries")
+    parser_command.add_argument('--province', '-p', type=str, help="Province of the entries")
+    parser_command.add_argument('--optimizer', '-o', type=str, help="Optimizer of the run of the entries")
+    parser_command.add_argument(
+        '--older_than', '-d', type=float, help="Only the entries created more than this number of days ago"
+    )
+    if command == "evict":
+        parser_command.add_argument('--all', action="store_true", help="Remove all the entries of the fit cache")
+parser_show = subparsers.add_parser("show", help="Show the outputs of the fit of an entry")
+parser_show.add_argument('key', type=str, help="Key of the entry (or a prefix of it)")
+arguments = parser.parse_args()
+PATH_TO_DATA_SANDBOX = CONFIG_FILEPATHS["data_sandbox"][arguments.user]
+
+
+def filter_entries(df_entries: pd.DataFrame, arguments: argparse.Namespace) -> pd.DataFrame:
+    """
+    :param df_entries: a DataFrame with the metadata of the entries of the cache, see DELPHIFitCache.get_entries
+    :param arguments: arguments of the command line with the filters on the entries
+    :return: the rows of the entries matching all the filters
+    """
+    if df_entries.shape[0] == 0:
+        return df_entries
+    is_selected = np.ones(df_entries.shape[0], dtype=bool)
+    if arguments.key is not None:
+        is_selected &= df_entries.key.str.startswith(arguments.key).values
+    for column in ["country", "province", "optimizer"]:
+        if getattr(arguments, column) is not None:
+            is_selected &= (df_entries[column] == getattr(arguments, column)).values
+    if arguments.older_than is not None:
+        date_limit = datetime.now() - timedelta(days=arguments.older_than)
+        is_selected &= (pd.to_datetime(df_entries.created) < date_limit).values
+    return df_entries[is_selected]
+
+
+if __name__ == "__main__":
+    fit_cache = DELPHIFitCache(PATH_TO_DATA_SANDBOX)
+    if arguments.command == "show":
+        list_keys = [key for key in fit_cache.get_list_keys() if key.startswith(arguments.key)]
+        if len(list_keys) != 1:
+            raise ValueError(f"{len(list_keys)} entries of the fit cache match the key {arguments.key}, expected 1")
+        output, x_sol = fit_cache.get(list_keys[0])
+        metadata = fit_cache.get_metadata(list_keys[0])
+        for name, value in metadata.items():
+            print(f"{name}: {value}")
+        for name, value in output.items():
+            if name != "fit_cached" and name not in metadata:
+                print(f"{name}: {value}")
+        print(f"trajectory: {'none' if x_sol is None else f'{x_sol.shape[0]} states over {x_sol.shape[1]} days'}")
+    else:
+        df_entries = fit_cache.get_entries()
+        df_entries_selected = filter_entries(df_entries, arguments)
+        if arguments.command == "list":
+            columns_displayed = [
+                "key", "continent", "country", "province", "optimizer", "created", "fun", "mape", "success", "size"
+            ]
+            if df_entries_selected.shape[0] > 0:
+                with pd.option_context("display.max_rows", None, "display.width", None):
+                    print(df_entries_selected.reindex(columns=columns_displayed).to_string(index=False))
+            print(
+                f"{df_entries_selected.shape[0]}/{df_entries.shape[0]} entries of the fit cache taking "
+                + f"{round(df_entries_selected.get('size', pd.Series(dtype=float)).sum() / 1024 ** 2, 2)} MB"
+            )
+        else:
+            no_filter = all(
+                getattr(arguments, name) is None for name in ["key", "country", "province", "optimizer", "older_than"]
+            )
+            if no_filter and not arguments.all:
+                parser.error("evict needs at least one filter, or --all to remove all the entries")
+            n_evicted = fit_cache.evict(df_entries_selected.get("key", pd.Series(dtype=str)).tolist())
+            print(f"Removed {n_evicted}/{df_entries.shape[0]} entries of the fit cache")
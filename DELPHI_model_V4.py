@@ -12,17 +12,23 @@ import argparse
 import pandas as pd
 import numpy as np
 import multiprocessing as mp
-from scipy.integrate import solve_ivp
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
 from datetime import datetime, timedelta
 from functools import partial
 from tqdm import tqdm
 from scipy.optimize import dual_annealing
 from DELPHI_utils_V4_static import (
     DELPHIAggregations, DELPHIDataSaver, DELPHIDataCreator, get_initial_conditions,
-    get_mape_data_fitting, create_fitting_data_from_validcases, get_residuals_value
+    get_mape_data_fitting, create_fitting_data_from_validcases, get_residuals_value,
+    get_initial_conditions_derivatives, get_residuals_gradient, DELPHILossCache,
+    DELPHIAreaScheduler, DELPHIAreaDataStore, DELPHICaseHistoryStore, run_timed_on_area,
+    DELPHIPredictionsBlock, DELPHIFitCache, DELPHIAreaFitTracker, get_carried_forward_fit,
+)
+from DELPHI_utils_V4_dynamic import get_bounds_params_from_pastparams, DELPHIModelComparison
+from DELPHI_utils_V4_ode import (
+    DELPHIODEModel, DELPHIODEModelReduced, ode_solvers, ode_solvers_fixed_step, default_n_substeps,
+    get_fixed_step_accuracy_report
 )
-from DELPHI_utils_V4_dynamic import get_bounds_params_from_pastparams
 from DELPHI_params_V4 import (
     fitting_start_date,
     default_parameter_list,
@@ -45,16 +51,15 @@ from DELPHI_params_V4 import (
     default_upper_bound_std_normal,
     default_bounds_params,
     validcases_threshold,
-    IncubeD,
-    RecoverID,
-    RecoverHD,
-    DetectD,
-    VentilatedD,
     default_maxT,
     p_v,
     p_d,
     p_h,
     max_iter,
+    skip_refit_window,
+    skip_refit_mape_threshold,
+    skip_refit_mape_drift_threshold,
+    race_annealing_mape_threshold,
 )
 
 ## Initializing Global Variables ##########################################################################
@@ -81,17 +86,28 @@ OPTIMIZER = RUN_CONFIG["arguments"]["optimizer"]
 GET_CONFIDENCE_INTERVALS = bool(int(RUN_CONFIG["arguments"]["confidence_intervals"]))
 SAVE_TO_WEBSITE = bool(int(RUN_CONFIG["arguments"]["website"]))
 SAVE_SINCE100_CASES = bool(int(RUN_CONFIG["arguments"]["since100case"]))
+ODE_SOLVER = RUN_CONFIG["arguments"].get("ode_solver", "RK45")
+ODE_SUBSTEPS = int(RUN_CONFIG["arguments"].get("ode_substeps", default_n_substeps))
+ODE_ACCURACY_REPORT = bool(int(RUN_CONFIG["arguments"].get("ode_accuracy_report", 0)))
+REDUCED_STATE_FITTING = bool(int(RUN_CONFIG["arguments"].get("reduced_state_fitting", 0)))
+SKIP_REFIT = bool(int(RUN_CONFIG["arguments"].get("skip_refit", 0)))
+USE_FIT_CACHE = bool(int(RUN_CONFIG["arguments"].get("fit_cache", 0)))
+RACE_ANNEALING_MAPE_THRESHOLD = float(
+    RUN_CONFIG["arguments"].get("race_annealing_mape_threshold", race_annealing_mape_threshold)
+)
 PATH_TO_FOLDER_DANGER_MAP = CONFIG_FILEPATHS["danger_map"][USER_RUNNING]
 PATH_TO_DATA_SANDBOX = CONFIG_FILEPATHS["data_sandbox"][USER_RUNNING]
 PATH_TO_WEBSITE_PREDICTED = CONFIG_FILEPATHS["website"][USER_RUNNING]
 past_prediction_date = "".join(str(datetime.now().date() - timedelta(days=14)).split("-"))
+# Version of the model code in the keys of the fit cache, any change of these files invalidates the cached fits
+FIT_CACHE_CODE_VERSION = DELPHIFitCache.get_code_version([
+    __file__, "DELPHI_utils_V4_static.py", "DELPHI_utils_V4_dynamic.py", "DELPHI_utils_V4_ode.py", "DELPHI_params_V4.py"
+]) if USE_FIT_CACHE else None
 #############################################################################################################
 
 def solve_and_predict_area(
-        tuple_area_state_: tuple,
+        tuple_area_: tuple,
         yesterday_: str,
-        past_parameters_: pd.DataFrame,
-        popcountries: pd.DataFrame,
         startT: str = None, # added to change optimmization start date
 ):
     """
@@ -99,8 +115,8 @@ def solve_and_predict_area(
     :param tuple_area_: tuple corresponding to (continent, country, province)
     :param yesterday_: string corresponding to the date from which the model will read the previous parameters. The
     format has to be 'YYYYMMDD'
-    :param past_parameters_: Parameters from yesterday_ used as a starting point for the fitting process
-    :param popcountries: DataFrame containing population information for all countries and provinces
+    The population, past parameters (from yesterday_, used as a starting point for the fitting process), initial
+    states and past predictions of the area are read from the DELPHIAreaDataStore loaded by the pool initializer
     :startT: string for the date from when the pandemic will be modelled (format should be 'YYYY-MM-DD')
     :return: either None if can't optimize (either less than 100 cases or less than 7 days with 100 cases) or a tuple
     with 3 dataframes related to that tuple_area_ (parameters df, predictions since yesterday_+1, predictions since
@@ -109,31 +125,35 @@ def solve_and_predict_area(
     
     """
     time_entering = time.time()
-    continent, country, province, initial_state = tuple_area_state_
+    continent, country, province = tuple_area_
+    data_store = DELPHIAreaDataStore.instance
+    initial_state = data_store.get_initial_state(continent, country, province)
     #province = str(province)
     country_sub = country.replace(" ", "_")
     province_sub = province #.replace(" ", "_")
     print(f"starting to predict for {continent}, {country}, {province}")
-    if os.path.exists(PATH_TO_FOLDER_DANGER_MAP + f"processed/Cases_{country_sub}_{province_sub}.csv"):
-        totalcases = pd.read_csv(
-            PATH_TO_FOLDER_DANGER_MAP + f"processed/Cases_{country_sub}_{province_sub}.csv"
-        )
+    totalcases = data_store.get_cases(country_sub, province_sub)
+    if totalcases is not None:
         if totalcases.day_since100.max() < 0:
             logging.warning(
                 f"Not enough cases (less than 100) for Continent={continent}, Country={country} and Province={province}"
             )
             return None
 
-        if past_parameters_ is not None:
-            parameter_list_total = past_parameters_[
-                (past_parameters_.Country == country)
-                & (past_parameters_.Province == province)
-            ].reset_index(drop=True)
-            if len(parameter_list_total) > 0:
-                parameter_list_line = parameter_list_total.iloc[-1, :].values.tolist()
+        parameter_list_line = data_store.get_past_parameters(country, province)
+        past_mape = parameter_list_line[4] if parameter_list_line is not None else None
+
+        def get_parameter_list_and_bounds(optimizer: str) -> (list, tuple, pd.Timestamp):
+            """
+            Generates the warm start and the bounds of the parameters for a given optimizer, from the past parameters
+            of the area if any
+            :param optimizer: optimizer used for the fitting, the bounds depend on it
+            :return: a tuple with the initial values of the parameters, their bounds and the start date of the fitting
+            """
+            if parameter_list_line is not None:
                 parameter_list = parameter_list_line[5:]
                 parameter_list, bounds_params = get_bounds_params_from_pastparams(
-                    optimizer=OPTIMIZER,
+                    optimizer=optimizer,
                     parameter_list=parameter_list,
                     dict_default_reinit_parameters=dict_default_reinit_parameters,
                     percentage_drift_lower_bound=percentage_drift_lower_bound,
@@ -157,24 +177,29 @@ def solve_and_predict_area(
                 bounds_params = tuple(bounds_params)
             else:
                 # Otherwise use established lower/upper bounds
-                parameter_list = default_parameter_list
+                parameter_list = list(default_parameter_list)
                 bounds_params = default_bounds_params
                 start_date = pd.to_datetime(totalcases.loc[totalcases.day_since100 == 0, "date"].iloc[-1])
-        else:
-            # Otherwise use established lower/upper bounds
-            parameter_list = default_parameter_list
-            bounds_params = default_bounds_params
-            start_date = pd.to_datetime(totalcases.loc[totalcases.day_since100 == 0, "date"].iloc[-1])
 
-        if startT is not None:
-            input_start_date = pd.to_datetime(startT)
-            if input_start_date > start_date:
-                delta_days = (input_start_date - start_date).days
-                parameter_list[9] = parameter_list[9] - delta_days
+            if startT is not None:
+                input_start_date = pd.to_datetime(startT)
+                if input_start_date > start_date:
+                    delta_days = (input_start_date - start_date).days
+                    parameter_list[9] = parameter_list[9] - delta_days
+                    bounds_params_list = list(bounds_params)
+                    bounds_params_list[9] = (bounds_params_list[9][0]-delta_days, bounds_params_list[9][1]-delta_days)
+                    bounds_params = tuple(bounds_params_list)
+                    start_date = input_start_date
+            if initial_state is None:
                 bounds_params_list = list(bounds_params)
-                bounds_params_list[9] = (bounds_params_list[9][0]-delta_days, bounds_params_list[9][1]-delta_days)
+                bounds_params_list[-1] = (0.999,1)
                 bounds_params = tuple(bounds_params_list)
-                start_date = input_start_date
+            return parameter_list, bounds_params, start_date
+
+        # In race mode, TNC is fitted first and annealing is raced against it
+        optimizer_area = "tnc" if OPTIMIZER == "race" else OPTIMIZER
+        parameter_list, bounds_params, start_date = get_parameter_list_and_bounds(optimizer_area)
+        if startT is not None:
             validcases = totalcases[
                 (totalcases.date >= str(start_date.date()))
                 & (totalcases.date <= str((pd.to_datetime(yesterday_) + timedelta(days=1)).date()))
@@ -192,19 +217,13 @@ def solve_and_predict_area(
             )
             return None
         else:
-            PopulationT = popcountries[
-                (popcountries.Country == country) & (popcountries.Province == province)
-            ].pop2016.iloc[-1]
-            N = PopulationT
+            N = data_store.get_population(country, province)
             PopulationI = validcases.loc[0, "case_cnt"]
             PopulationD = validcases.loc[0, "death_cnt"]
             if initial_state is not None:
                 R_0 = initial_state[9]
             else:
                 R_0 = validcases.loc[0, "death_cnt"] * 5 if validcases.loc[0, "case_cnt"] - validcases.loc[0, "death_cnt"]> validcases.loc[0, "death_cnt"] * 5 else 0
-                bounds_params_list = list(bounds_params)
-                bounds_params_list[-1] = (0.999,1)
-                bounds_params = tuple(bounds_params_list)
             cases_t_14days = totalcases[totalcases.date >= str(start_date- pd.Timedelta(14, 'D'))]['case_cnt'].values[0]
             deaths_t_9days = totalcases[totalcases.date >= str(start_date - pd.Timedelta(9, 'D'))]['death_cnt'].values[0]
             R_upperbound = validcases.loc[0, "case_cnt"] - validcases.loc[0, "death_cnt"]
@@ -226,78 +245,18 @@ def solve_and_predict_area(
             balance, balance_total_difference, cases_data_fit, deaths_data_fit, weights = create_fitting_data_from_validcases(validcases)
             GLOBAL_PARAMS_FIXED = (N, R_upperbound, R_heuristic, R_0, PopulationD, PopulationI, p_d, p_h, p_v)
 
-            def model_covid(
-                t, x, alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3
-            ) -> list:
-                """
-                SEIR based model with 16 distinct states, taking into account undetected, deaths, hospitalized and
-                recovered, and using an ArcTan government response curve, corrected with a Gaussian jump in case of
-                a resurgence in cases
-                :param t: time step
-                :param x: set of all the states in the model (here, 16 of them)
-                :param alpha: Infection rate
-                :param days: Median day of action (used in the arctan governmental response)
-                :param r_s: Median rate of action (used in the arctan governmental response)
-                :param r_dth: Rate of death
-                :param p_dth: Initial mortality percentage
-                :param r_dthdecay: Rate of decay of mortality percentage
-                :param k1: Internal parameter 1 (used for initial conditions)
-                :param k2: Internal parameter 2 (used for initial conditions)
-                :param jump: Amplitude of the Gaussian jump modeling the resurgence in cases
-                :param t_jump: Time where the Gaussian jump will reach its maximum value
-                :param std_normal: Standard Deviation of the Gaussian jump (~ time span of the resurgence in cases)
-                :param k3: Internal parameter 2 (used for initial conditions)
-                :return: predictions for all 16 states, which are the following
-                [0 S, 1 E, 2 I, 3 UR, 4 DHR, 5 DQR, 6 UD, 7 DHD, 8 DQD, 9 R, 10 D, 11 TH, 12 DVR,13 DVD, 14 DD, 15 DT]
-                """
-                r_i = np.log(2) / IncubeD  # Rate of infection leaving incubation phase
-                r_d = np.log(2) / DetectD  # Rate of detection
-                r_ri = np.log(2) / RecoverID  # Rate of recovery not under infection
-                r_rh = np.log(2) / RecoverHD  # Rate of recovery under hospitalization
-                r_rv = np.log(2) / VentilatedD  # Rate of recovery under ventilation
-                gamma_t = (
-                    (2 / np.pi) * np.arctan(-(t - days) / 20 * r_s) + 1
-                    + jump * np.exp(-(t - t_jump) ** 2 / (2 * std_normal ** 2))
-                )
-                p_dth_mod = (2 / np.pi) * (p_dth - 0.001) * (np.arctan(-t / 20 * r_dthdecay) + np.pi / 2) + 0.001
-                assert (
-                    len(x) == 16
-                ), f"Too many input variables, got {len(x)}, expected 16"
-                S, E, I, AR, DHR, DQR, AD, DHD, DQD, R, D, TH, DVR, DVD, DD, DT = x
-                # Equations on main variables
-                dSdt = -alpha * gamma_t * S * I / N
-                dEdt = alpha * gamma_t * S * I / N - r_i * E
-                dIdt = r_i * E - r_d * I
-                dARdt = r_d * (1 - p_dth_mod) * (1 - p_d) * I - r_ri * AR
-                dDHRdt = r_d * (1 - p_dth_mod) * p_d * p_h * I - r_rh * DHR
-                dDQRdt = r_d * (1 - p_dth_mod) * p_d * (1 - p_h) * I - r_ri * DQR
-                dADdt = r_d * p_dth_mod * (1 - p_d) * I - r_dth * AD
-                dDHDdt = r_d * p_dth_mod * p_d * p_h * I - r_dth * DHD
-                dDQDdt = r_d * p_dth_mod * p_d * (1 - p_h) * I - r_dth * DQD
-                dRdt = r_ri * (AR + DQR) + r_rh * DHR
-                dDdt = r_dth * (AD + DQD + DHD)
-                # Helper states (usually important for some kind of output)
-                dTHdt = r_d * p_d * p_h * I
-                dDVRdt = r_d * (1 - p_dth_mod) * p_d * p_h * p_v * I - r_rv * DVR
-                dDVDdt = r_d * p_dth_mod * p_d * p_h * p_v * I - r_dth * DVD
-                dDDdt = r_dth * (DHD + DQD)
-                dDTdt = r_d * p_d * I
-                return [
-                    dSdt, dEdt, dIdt, dARdt, dDHRdt, dDQRdt, dADdt, dDHDdt,
-                    dDQDdt, dRdt, dDdt, dTHdt, dDVRdt, dDVDdt, dDDdt, dDTdt,
-                ]
-
-            def residuals_totalcases(params) -> float:
+            if REDUCED_STATE_FITTING:
+                delphi_model = DELPHIODEModelReduced(N=N, p_d=p_d, p_h=p_h, p_v=p_v)
+            else:
+                delphi_model = DELPHIODEModel(N=N, p_d=p_d, p_h=p_h, p_v=p_v)
+            def reinitialize_params(params) -> tuple:
                 """
-                Function that makes sure the parameters are in the right range during the fitting process and computes
-                the loss function depending on the optimizer that has been chosen for this run as a global variable
+                Forces params values to stay in a certain range during the optimization process with re-initializations
                 :param params: currently fitted values of the parameters during the fitting process
-                :return: the value of the loss function as a float that is optimized against (in our case, minimized)
+                :return: the parameters, clipped to their re-initialization values
                 """
-                # Variables Initialization for the ODE system
                 alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3 = params
-                # Force params values to stay in a certain range during the optimization process with re-initializations
-                params = (
+                return (
                     max(alpha, dict_default_reinit_parameters["alpha"]),
                     days,
                     max(r_s, dict_default_reinit_parameters["r_s"]),
@@ -312,85 +271,300 @@ def solve_and_predict_area(
                     max(k3, dict_default_reinit_lower_bounds["k3"]),
                 )
 
-                x_0_cases = get_initial_conditions(
-                    params_fitted=params, global_params_fixed=GLOBAL_PARAMS_FIXED
-                )
-                x_sol_total = solve_ivp(
-                    fun=model_covid,
-                    y0=x_0_cases,
-                    t_span=[t_cases[0], t_cases[-1]],
-                    t_eval=t_cases,
-                    args=tuple(params),
-                )
-                x_sol = x_sol_total.y
-                # weights = list(range(1, len(cases_data_fit) + 1))
-                # weights = [(x/len(cases_data_fit))**2 for x in weights]
-                if x_sol_total.status == 0:
-                    residuals_value = get_residuals_value(
-                        optimizer=OPTIMIZER,
-                        balance=balance,
-                        x_sol=x_sol,
-                        cases_data_fit=cases_data_fit,
-                        deaths_data_fit=deaths_data_fit,
-                        weights=weights,
-                        balance_total_difference=balance_total_difference 
+            # Memoization of the loss function (and of its gradient) keyed on the re-initialized parameters, shared by
+            # all the fits of the area
+            loss_cache = DELPHILossCache()
+
+            def fit_area(optimizer: str, parameter_list: list, bounds_params: tuple) -> OptimizeResult:
+                """
+                Fits the parameters of the area with a given optimizer
+                :param optimizer: optimizer used for the fitting, either tnc, trust-constr or annealing (the loss
+                function depends on it)
+                :param parameter_list: initial values of the parameters
+                :param bounds_params: bounds of the parameters
+                :return: the OptimizeResult of the optimizer
+                """
+                # tnc and annealing minimize the same loss function (see get_residuals_value), so that the race fits
+                # share their entries
+                loss_name = "trust-constr" if optimizer == "trust-constr" else "tnc"
+
+                def residuals_totalcases(params) -> float:
+                    """
+                    Function that makes sure the parameters are in the right range during the fitting process and
+                    computes the loss function depending on the optimizer used for this fit
+                    :param params: currently fitted values of the parameters during the fitting process
+                    :return: the value of the loss function as a float that is optimized against (in our case,
+                    minimized)
+                    """
+                    # Variables Initialization for the ODE system
+                    params = reinitialize_params(params)
+                    cached_loss = loss_cache.get(params, loss_name)
+                    if cached_loss is not None:
+                        return cached_loss[0]
+                    x_0_cases = get_initial_conditions(
+                        params_fitted=params, global_params_fixed=GLOBAL_PARAMS_FIXED
                     )
-                else:
-                    residuals_value = 1e16
-                return residuals_value
+                    x_sol_total = delphi_model.solve(
+                        params, x_0=x_0_cases, t_eval=t_cases, method=ODE_SOLVER, n_substeps=ODE_SUBSTEPS
+                    )
+                    x_sol = x_sol_total.y
+                    # weights = list(range(1, len(cases_data_fit) + 1))
+                    # weights = [(x/len(cases_data_fit))**2 for x in weights]
+                    if x_sol_total.status == 0:
+                        residuals_value = get_residuals_value(
+                            optimizer=optimizer,
+                            balance=balance,
+                            x_sol=x_sol,
+                            cases_data_fit=cases_data_fit,
+                            deaths_data_fit=deaths_data_fit,
+                            weights=weights,
+                            balance_total_difference=balance_total_difference 
+                        )
+                    else:
+                        residuals_value = 1e16
+                    loss_cache.set(params, loss_name, residuals_value)
+                    return residuals_value
+
+                def residuals_and_gradient_totalcases(params) -> (float, np.ndarray):
+                    """
+                    Same loss function as residuals_totalcases, also returning its exact gradient with respect to the
+                    parameters, obtained by integrating the forward sensitivity equations along with the ODE system
+                    :param params: currently fitted values of the parameters during the fitting process
+                    :return: the value of the loss function and its gradient (zero for the parameters currently clipped
+                    to their re-initialization values)
+                    """
+                    params_reinitialized = reinitialize_params(params)
+                    # Gradient with respect to the parameters without re-initialization, zero for the clipped ones
+                    mask_not_reinitialized = np.array(params_reinitialized) == np.array(params)
+                    cached_loss_and_gradient = loss_cache.get(params_reinitialized, loss_name, with_gradient=True)
+                    if cached_loss_and_gradient is not None:
+                        residuals_value, residuals_gradient = cached_loss_and_gradient
+                        return residuals_value, residuals_gradient * mask_not_reinitialized
+                    x_0_cases = get_initial_conditions(
+                        params_fitted=params_reinitialized, global_params_fixed=GLOBAL_PARAMS_FIXED
+                    )
+                    dx_0_dparams = get_initial_conditions_derivatives(
+                        params_fitted=params_reinitialized, global_params_fixed=GLOBAL_PARAMS_FIXED
+                    )
+                    x_sol_total = delphi_model.solve_with_sensitivities(
+                        params_reinitialized, x_0=x_0_cases, dx_0_dparams=dx_0_dparams, t_eval=t_cases,
+                        method=ODE_SOLVER, n_substeps=ODE_SUBSTEPS,
+                    )
+                    if x_sol_total.status == 0:
+                        residuals_value = get_residuals_value(
+                            optimizer=optimizer,
+                            balance=balance,
+                            x_sol=x_sol_total.y,
+                            cases_data_fit=cases_data_fit,
+                            deaths_data_fit=deaths_data_fit,
+                            weights=weights,
+                            balance_total_difference=balance_total_difference
+                        )
+                        residuals_gradient = get_residuals_gradient(
+                            optimizer=optimizer,
+                            balance=balance,
+                            x_sol=x_sol_total.y,
+                            x_sensitivities=x_sol_total.sensitivities,
+                            cases_data_fit=cases_data_fit,
+                            deaths_data_fit=deaths_data_fit,
+                            weights=weights,
+                            balance_total_difference=balance_total_difference
+                        )
+                    else:
+                        residuals_value = 1e16
+                        residuals_gradient = np.zeros(len(params))
+                    loss_cache.set(params_reinitialized, loss_name, residuals_value, residuals_gradient)
+                    return residuals_value, residuals_gradient * mask_not_reinitialized
 
-            if OPTIMIZER in ["tnc", "trust-constr"]:
-                output = minimize(
-                    residuals_totalcases,
-                    parameter_list,
-                    method=OPTIMIZER,
-                    bounds=bounds_params,
-                    options={"maxiter": max_iter},
+                if optimizer in ["tnc", "trust-constr"]:
+                    output = minimize(
+                        residuals_and_gradient_totalcases,
+                        parameter_list,
+                        method=optimizer,
+                        jac=True,
+                        bounds=bounds_params,
+                        options={"maxiter": max_iter},
+                    )
+                elif optimizer == "annealing":
+                    output = dual_annealing(
+                        residuals_totalcases, x0=parameter_list, bounds=bounds_params
+                    )
+                    print(f"Parameter bounds are {bounds_params}")
+                    print(f"Parameter list is {parameter_list}")
+                else:
+                    raise ValueError("Optimizer not in 'tnc', 'trust-constr', 'annealing' or 'race' so not supported")
+                logging.info(
+                    f"Loss cache for {country, province} after the {optimizer} fit: {loss_cache.get_summary()}"
                 )
-            elif OPTIMIZER == "annealing":
-                output = dual_annealing(
-                    residuals_totalcases, x0=parameter_list, bounds=bounds_params
+                return output
+
+            # The outputs of this exact fit are read from the fit cache if it was already run, e.g. when rerunning a day
+            fit_cache = DELPHIFitCache(PATH_TO_DATA_SANDBOX) if USE_FIT_CACHE else None
+            cached_fit = None
+            if fit_cache is not None:
+                dict_inputs_fit = {
+                    "area": tuple_area_,
+                    "validcases": validcases,
+                    "start_date": str(start_date),
+                    "maxT": maxT,
+                    "global_params_fixed": GLOBAL_PARAMS_FIXED,
+                    "parameter_list_line": parameter_list_line,
+                    "parameter_list": parameter_list,
+                    "bounds_params": bounds_params,
+                    "optimizer": OPTIMIZER,
+                    "ode_solver": ODE_SOLVER,
+                    "ode_substeps": ODE_SUBSTEPS,
+                    "reduced_state_fitting": REDUCED_STATE_FITTING,
+                    "skip_refit": SKIP_REFIT,
+                    "race_annealing_mape_threshold": RACE_ANNEALING_MAPE_THRESHOLD,
+                    "code_version": FIT_CACHE_CODE_VERSION,
+                }
+                if OPTIMIZER == "race":
+                    # The race compares both fits on the whole case history of the area
+                    dict_inputs_fit["case_history"] = totalcases[["day_since100", "case_cnt", "death_cnt"]]
+                fit_cache_key = DELPHIFitCache.get_key(dict_inputs_fit)
+                metadata_fit_cache = dict(continent=continent, country=country, province=province, optimizer=OPTIMIZER)
+                cached_fit = fit_cache.get(fit_cache_key)
+                if cached_fit is not None:
+                    logging.info(f"Fit of {country, province} read from the fit cache (entry {fit_cache_key})")
+
+            # In skip-refit mode, yesterday's parameters are first evaluated on the extended window of data
+            carried_forward_fit = None
+            if SKIP_REFIT and past_mape is not None and cached_fit is None:
+                carried_forward_fit, mape_recent_window, mape_drift = get_carried_forward_fit(
+                    delphi_model,
+                    parameter_list_line,
+                    start_date_fitting=startT,
+                    t_cases=t_cases,
+                    global_params_fixed=GLOBAL_PARAMS_FIXED,
+                    optimizer=optimizer_area,
+                    balance=balance,
+                    cases_data_fit=cases_data_fit,
+                    deaths_data_fit=deaths_data_fit,
+                    weights=weights,
+                    balance_total_difference=balance_total_difference,
+                    ode_solver=ODE_SOLVER,
+                    n_substeps=ODE_SUBSTEPS,
+                    reinitialize_params=reinitialize_params,
+                    window=skip_refit_window,
+                    mape_threshold=skip_refit_mape_threshold,
+                    mape_drift_threshold=skip_refit_mape_drift_threshold,
                 )
-                print(f"Parameter bounds are {bounds_params}")
-                print(f"Parameter list is {parameter_list}")
+                if mape_recent_window is not None:
+                    logging.info(
+                        f"Yesterday's parameters for {country, province}: MAPE on the last {skip_refit_window} days "
+                        + f"{round(mape_recent_window, 3)} %, in-sample MAPE drift {round(mape_drift, 3)} %, "
+                        + ("carried forward" if carried_forward_fit is not None else "refitting")
+                    )
+            if cached_fit is not None:
+                output = cached_fit[0]
+            elif carried_forward_fit is not None:
+                output = carried_forward_fit
             else:
-                raise ValueError("Optimizer not in 'tnc', 'trust-constr' or 'annealing' so not supported")
+                output = fit_area(optimizer_area, parameter_list, bounds_params)
 
-            if (OPTIMIZER in ["tnc", "trust-constr"]) or (OPTIMIZER == "annealing" and output.success):
+            if (optimizer_area in ["tnc", "trust-constr"]) or output.success:
                 best_params = output.x
                 t_predictions = [i for i in range(maxT)]
     
-                def solve_best_params_and_predict(optimal_params):
+                def solve_best_params_and_predict(optimal_params, accuracy_report: bool = ODE_ACCURACY_REPORT):
                     # Variables Initialization for the ODE system
-                    alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3 = optimal_params
-                    optimal_params = [
-                        max(alpha, dict_default_reinit_parameters["alpha"]),
-                        days,
-                        max(r_s, dict_default_reinit_parameters["r_s"]),
-                        max(min(r_dth, 1), dict_default_reinit_parameters["r_dth"]),
-                        max(min(p_dth, 1), dict_default_reinit_parameters["p_dth"]),
-                        max(r_dthdecay, dict_default_reinit_parameters["r_dthdecay"]),
-                        max(k1, dict_default_reinit_parameters["k1"]),
-                        max(k2, dict_default_reinit_parameters["k2"]),
-                        max(jump, dict_default_reinit_parameters["jump"]),
-                        max(t_jump, dict_default_reinit_parameters["t_jump"]),
-                        max(std_normal, dict_default_reinit_parameters["std_normal"]),
-                        max(k3, dict_default_reinit_lower_bounds["k3"]),
-                    ]
+                    optimal_params = list(reinitialize_params(optimal_params))
                     x_0_cases = get_initial_conditions(
                         params_fitted=optimal_params,
                         global_params_fixed=GLOBAL_PARAMS_FIXED,
                     )
-                    x_sol_best = solve_ivp(
-                        fun=model_covid,
-                        y0=x_0_cases,
-                        t_span=[t_predictions[0], t_predictions[-1]],
-                        t_eval=t_predictions,
-                        args=tuple(optimal_params),
-                    ).y
+                    x_sol_best = None
+                    if REDUCED_STATE_FITTING:
+                        # Derived compartments are reconstructed from the core states for the final predictions
+                        x_sol_best = delphi_model.solve(
+                            optimal_params, x_0=x_0_cases, t_eval=t_predictions, method=ODE_SOLVER,
+                            n_substeps=ODE_SUBSTEPS, reconstruct=True
+                        ).y
+                        if x_sol_best.shape[1] != len(t_predictions) or not np.all(np.isfinite(x_sol_best)):
+                            # Derived states left to NaN would be cast to garbage integers in the predictions
+                            logging.warning(
+                                f"Reconstruction of the derived states failed for {country, province}, solving the "
+                                + "full system for the final predictions"
+                            )
+                            x_sol_best = None
+                    if x_sol_best is None:
+                        delphi_model_full = (
+                            DELPHIODEModel(N=N, p_d=p_d, p_h=p_h, p_v=p_v) if REDUCED_STATE_FITTING else delphi_model
+                        )
+                        x_sol_best = delphi_model_full.solve(
+                            optimal_params, x_0=x_0_cases, t_eval=t_predictions, method=ODE_SOLVER,
+                            n_substeps=ODE_SUBSTEPS
+                        ).y
+                    if accuracy_report and ODE_SOLVER in ode_solvers_fixed_step:
+                        # Accuracy of the fixed-step engine against the solve_ivp reference for the final parameters,
+                        # only on demand as it costs more than the fixed-step solves themselves
+                        for accuracy in get_fixed_step_accuracy_report(
+                                delphi_model, optimal_params, x_0=x_0_cases, t_eval=t_predictions,
+                                list_n_substeps=[ODE_SUBSTEPS],
+                        ):
+                            logging.info(
+                                f"Accuracy of {accuracy['method']} (sub-steps: {accuracy['n_substeps']}) for "
+                                + f"{country, province}: max relative error on cases "
+                                + f"{accuracy['max_relative_error_cases']:.2e}, on deaths "
+                                + f"{accuracy['max_relative_error_deaths']:.2e}, on all states "
+                                + f"{accuracy['max_relative_error_states']:.2e}, in {accuracy['runtime']:.4f} seconds"
+                            )
                     return x_sol_best
 
-                x_sol_final = solve_best_params_and_predict(best_params)
+                if cached_fit is not None:
+                    x_sol_final = cached_fit[1]
+                else:
+                    x_sol_final = solve_best_params_and_predict(best_params)
+                mape_data = get_mape_data_fitting(
+                    cases_data_fit=cases_data_fit, deaths_data_fit=deaths_data_fit, x_sol_final=x_sol_final
+                )
+                if OPTIMIZER == "race" and cached_fit is None and not output.get("carried_forward", False):
+                    output["optimizer"] = "tnc"
+                    if mape_data > RACE_ANNEALING_MAPE_THRESHOLD:
+                        parameter_list_annealing, bounds_params_annealing, _ = get_parameter_list_and_bounds(
+                            "annealing"
+                        )
+                        output_annealing = fit_area("annealing", parameter_list_annealing, bounds_params_annealing)
+                        if output_annealing.success:
+                            x_sol_annealing = solve_best_params_and_predict(
+                                output_annealing.x, accuracy_report=False
+                            )
+
+                            def get_predictions_since_100_cases(x_sol) -> pd.DataFrame:
+                                return pd.DataFrame({
+                                    "Day": pd.date_range(start_date, periods=x_sol.shape[1]),
+                                    "Total Detected": np.round(x_sol[15, :]).astype(int),
+                                })
+
+                            # Same selection as DELPHI_compare_V4, on the predictions of both fits in memory
+                            model_compare = DELPHIModelComparison(
+                                PATH_TO_FOLDER_DANGER_MAP, PATH_TO_DATA_SANDBOX, None, None,
+                                logger=logging.getLogger(),
+                            )
+                            comparison_area = model_compare.compare_predictions(
+                                tuple_area_,
+                                true_df=DELPHIModelComparison.get_true_cases(totalcases),
+                                annealing_df=get_predictions_since_100_cases(x_sol_annealing),
+                                tnc_df=get_predictions_since_100_cases(x_sol_final),
+                            )
+                            output["race"] = comparison_area
+                            logging.info(
+                                f"Race for {country, province}: "
+                                + ("annealing" if comparison_area[0] else "tnc") + " selected"
+                            )
+                            if comparison_area[0]:
+                                output = output_annealing
+                                output["optimizer"] = "annealing"
+                                output["race"] = comparison_area
+                                best_params = output.x
+                                x_sol_final = x_sol_annealing
+                                mape_data = get_mape_data_fitting(
+                                    cases_data_fit=cases_data_fit, deaths_data_fit=deaths_data_fit,
+                                    x_sol_final=x_sol_final,
+                                )
+                if fit_cache is not None and cached_fit is None:
+                    fit_cache.set(fit_cache_key, output, x_sol_final, metadata=dict(metadata_fit_cache, mape=mape_data))
                 data_creator = DELPHIDataCreator(
                     x_sol_final=x_sol_final,
                     date_day_since100=start_date,
@@ -400,23 +574,18 @@ def solve_and_predict_area(
                     province=province,
                     testing_data_included=False,
                 )
-                mape_data = get_mape_data_fitting(
-                    cases_data_fit=cases_data_fit, deaths_data_fit=deaths_data_fit, x_sol_final=x_sol_final
-                )
-                
+
                 logging.info(f"In-Sample MAPE Last 15 Days {country, province}: {round(mape_data, 3)} %")
                 logging.debug(f"Best fitted parameters for {country, province}: {best_params}")
                 df_parameters_area = data_creator.create_dataset_parameters(mape_data)
-                # Creating the datasets for predictions of this area
+                # Creating the block of predictions of this area, turned into dataframes with all the areas at the end
                 if GET_CONFIDENCE_INTERVALS:
-                   df_predictions_since_today_area, df_predictions_since_100_area = (
-                       data_creator.create_datasets_with_confidence_intervals(
-                           cases_data_fit, deaths_data_fit,
-                           past_prediction_file=PATH_TO_FOLDER_DANGER_MAP + f"predicted/Global_V4_{past_prediction_date}.csv",
-                           past_prediction_date=str(pd.to_datetime(past_prediction_date).date()))
-                   )
+                    block_predictions_area = data_creator.create_block_with_confidence_intervals(
+                        cases_data_fit, deaths_data_fit,
+                        past_predictions=data_store.get_past_predictions(country, province),
+                    )
                 else:
-                    df_predictions_since_today_area, df_predictions_since_100_area = data_creator.create_datasets_predictions()
+                    block_predictions_area = data_creator.create_block_predictions()
                 logging.info(
                     f"Finished predicting for Continent={continent}, Country={country} and Province={province} in "
                     + f"{round(time.time() - time_entering, 2)} seconds"
@@ -424,11 +593,12 @@ def solve_and_predict_area(
                 logging.info("--------------------------------------------------------------------------------------------")
                 return (
                     df_parameters_area,
-                    df_predictions_since_today_area,
-                    df_predictions_since_100_area,
+                    block_predictions_area,
                     output,
                 )
             else:
+                if fit_cache is not None and cached_fit is None:
+                    fit_cache.set(fit_cache_key, output, None, metadata=metadata_fit_cache)
                 return None
     else:  # file for that tuple (continent, country, province) doesn't exist in processed files
         logging.info(
@@ -456,75 +626,125 @@ if __name__ == "__main__":
         f"The user is {USER_RUNNING}, the chosen optimizer for this run was {OPTIMIZER} and " +
         f"generation of Confidence Intervals' flag is {GET_CONFIDENCE_INTERVALS}"
     )
-    popcountries = pd.read_csv(
-        PATH_TO_FOLDER_DANGER_MAP + f"processed/Population_Global.csv"
-    )
-    popcountries["tuple_area"] = list(zip(popcountries.Continent, popcountries.Country, popcountries.Province))
-
+    if ODE_SOLVER not in ode_solvers:
+        raise ValueError(f"ODE solver {ODE_SOLVER} not supported, should be one of {ode_solvers}")
+    logging.info(f"The ODE solver used for this run is {ODE_SOLVER}, reduced state fitting is {REDUCED_STATE_FITTING}")
     if not os.path.exists(PATH_TO_DATA_SANDBOX + f"predicted/raw_predictions/Predicted_model_state_V4_{fitting_start_date}.csv"):
         logging.error(f"Initial model state file not found, can not train from {fitting_start_date}. Use model_V3 to train on entire data.")
         raise FileNotFoundError
-    df_initial_states = pd.read_csv(
-        PATH_TO_DATA_SANDBOX + f"predicted/raw_predictions/Predicted_model_state_V4_{fitting_start_date}.csv"
+    # Case histories of all areas are read from the columnar store, rebuilt if some processed file was updated
+    if not DELPHICaseHistoryStore.is_up_to_date(PATH_TO_FOLDER_DANGER_MAP + "processed/"):
+        DELPHICaseHistoryStore.build(PATH_TO_FOLDER_DANGER_MAP + "processed/")
+    # Inputs of the areas, loaded once in each worker by the pool initializer and indexed by area, the tasks only
+    # carry the area key
+    dict_kwargs_data_store = dict(
+        path_to_population=PATH_TO_FOLDER_DANGER_MAP + "processed/Population_Global.csv",
+        path_to_initial_states=(
+            PATH_TO_DATA_SANDBOX + f"predicted/raw_predictions/Predicted_model_state_V4_{fitting_start_date}.csv"
+        ),
+        path_to_past_parameters=PATH_TO_FOLDER_DANGER_MAP + f"predicted/Parameters_Global_V4_{yesterday}.csv",
+        path_to_past_predictions=(
+            PATH_TO_FOLDER_DANGER_MAP + f"predicted/Global_V4_{past_prediction_date}.csv"
+            if GET_CONFIDENCE_INTERVALS else None
+        ),
+        past_prediction_date=str(pd.to_datetime(past_prediction_date).date()),
+        path_to_case_history_store=PATH_TO_FOLDER_DANGER_MAP + "processed/",
     )
-
-    try:
-        past_parameters = pd.read_csv(
-            PATH_TO_FOLDER_DANGER_MAP
-            + f"predicted/Parameters_Global_V4_{yesterday}.csv"
-        )
-        print(PATH_TO_FOLDER_DANGER_MAP+ f"predicted/Parameters_Global_V4_{yesterday}.csv")
-    except:
-        past_parameters = None
+    DELPHIAreaDataStore.initialize(**dict_kwargs_data_store)
 
     ### Fitting the Model ###
     # Initalizing lists of the different dataframes that will be concatenated in the end
-    list_df_global_predictions_since_today = []
-    list_df_global_predictions_since_100_cases = []
+    list_blocks_global_predictions = []
     list_df_global_parameters = []
     obj_value = 0
+    # Areas read from the fit cache, carried forward from yesterday or refit
+    area_fit_tracker = DELPHIAreaFitTracker()
+    # Outcome of the race between TNC and annealing in each area, in race mode
+    list_race_results = []
     solve_and_predict_area_partial = partial(
         solve_and_predict_area,
         yesterday_=yesterday,
-        past_parameters_=past_parameters,
-        popcountries=popcountries,
         startT=fitting_start_date
     )
     n_cpu = psutil.cpu_count(logical = False) - 2
     logging.info(f"Number of CPUs found and used in this run: {n_cpu}")
-    list_tuples = [(
-        r.continent, 
-        r.country, 
-        r.province, 
-        r.values[:16] if not pd.isna(r.S) else None
-        ) for _, r in df_initial_states.iterrows()]
+    list_tuples = list(DELPHIAreaDataStore.instance.list_areas)
 
     # list_tuples = [t for t in list_tuples if t[1] in ["Germany", "Poland"]]
     # , "Poland", "Belgium", "France", "Greece"]]
 
     logging.info(f"Number of areas to be fitted in this run: {len(list_tuples)}")
-    with mp.Pool(n_cpu) as pool:
-        for result_area in tqdm(
-            pool.map_async(solve_and_predict_area_partial, list_tuples).get(),
+    # Longest areas to fit (based on the runtimes of the previous runs) are dispatched first, results are streamed
+    area_scheduler = DELPHIAreaScheduler(
+        path_to_runtimes=CONFIG_FILEPATHS["logs"][USER_RUNNING] + f"model_fitting/area_runtimes_{OPTIMIZER}.csv"
+    )
+    dict_position_area = {tuple_area: i for i, tuple_area in enumerate(list_tuples)}
+    list_tuples = area_scheduler.sort_longest_first(list_tuples)
+    list_positions_areas_fitted = []
+    with mp.Pool(
+            n_cpu, initializer=partial(DELPHIAreaDataStore.initialize, **dict_kwargs_data_store)
+    ) as pool:
+        for tuple_area, runtime_area, result_area in tqdm(
+            pool.imap_unordered(partial(run_timed_on_area, solve_and_predict_area_partial), list_tuples),
             total=len(list_tuples),
         ):
+            if result_area is None or not result_area[2].get("fit_cached", False):
+                # Runtimes of the areas read from the fit cache don't reflect their fitting time
+                area_scheduler.update(tuple_area, runtime_area)
             if result_area is not None:
                 (
                     df_parameters_area,
-                    df_predictions_since_today_area,
-                    df_predictions_since_100_area,
+                    block_predictions_area,
                     output,
                 ) = result_area
                 obj_value = obj_value + output.fun
+                area_fit_tracker.update(tuple_area[1:], output)
                 # Then we add it to the list of df to be concatenated to update the tracking df
+                if "race" in output:
+                    list_race_results.append((dict_position_area[tuple_area], tuple_area, output.race))
+                list_positions_areas_fitted.append(dict_position_area[tuple_area])
                 list_df_global_parameters.append(df_parameters_area)
-                list_df_global_predictions_since_today.append(df_predictions_since_today_area)
-                list_df_global_predictions_since_100_cases.append(df_predictions_since_100_area)
+                list_blocks_global_predictions.append(block_predictions_area)
             else:
                 continue
         logging.info("Finished the Multiprocessing for all areas")
         pool.close()
         pool.join()
+    area_scheduler.save()
+    # Restoring the order of the areas in the initial states file, so that the outputs don't depend on the scheduling
+    order_areas_fitted = np.argsort(list_positions_areas_fitted)
+    list_df_global_parameters = [list_df_global_parameters[i] for i in order_areas_fitted]
+    list_blocks_global_predictions = [list_blocks_global_predictions[i] for i in order_areas_fitted]
+    if SKIP_REFIT:
+        logging.info(
+            f"Skip-refit mode: {len(area_fit_tracker.get_areas('refit'))} areas refit and "
+            + f"{len(area_fit_tracker.get_areas('carried_forward'))} areas with parameters carried forward from yesterday"
+        )
+        logging.info(f"Areas refit: {sorted(area_fit_tracker.get_areas('refit'))}")
+        logging.info(f"Areas carried forward: {sorted(area_fit_tracker.get_areas('carried_forward'))}")
+    if USE_FIT_CACHE:
+        logging.info(
+            f"Fit cache: {len(area_fit_tracker.get_areas('fit_cached'))} areas read from the cache out of "
+            + f"{len(list_positions_areas_fitted)} areas fitted"
+        )
+    if OPTIMIZER == "race":
+        # Same comparison file as DELPHI_compare_V4, for the areas where annealing was raced against TNC
+        today_date_str = "".join(str(datetime.now().date()).split("-"))
+        if not os.path.exists(PATH_TO_DATA_SANDBOX + "comparison/"):
+            os.mkdir(PATH_TO_DATA_SANDBOX + "comparison/")
+        list_race_results = sorted(list_race_results, key=lambda race_result: race_result[0])
+        df_comparison = pd.DataFrame({
+            "region": [tuple_area for _, tuple_area, _ in list_race_results],
+            "annealing_selected": [race_area[0] for _, _, race_area in list_race_results],
+            "annealing_metric": [race_area[1] for _, _, race_area in list_race_results],
+            "tnc_metric": [race_area[2] for _, _, race_area in list_race_results],
+            "annealing_max_ape": [race_area[3] for _, _, race_area in list_race_results],
+        })
+        df_comparison.to_csv(PATH_TO_DATA_SANDBOX + f"comparison/model_comparison_{today_date_str}.csv", index=False)
+        logging.info(
+            f"Race mode: annealing raced against TNC in {df_comparison.shape[0]} areas, and selected in "
+            + f"{np.sum(df_comparison['annealing_selected'])} of them"
+        )
 
     # Appending parameters, aggregations per country, per continent, and for the world
     # for predictions today & since 100
@@ -532,16 +752,21 @@ if __name__ == "__main__":
     df_global_parameters = pd.concat(list_df_global_parameters).sort_values(
         ["Country", "Province"]
     ).reset_index(drop=True)
-    df_global_predictions_since_today = pd.concat(list_df_global_predictions_since_today)
+    df_global_predictions_since_today = DELPHIPredictionsBlock.concatenate(
+        list_blocks_global_predictions, since_today=True
+    )
     df_global_predictions_since_today = DELPHIAggregations.append_all_aggregations(
         df_global_predictions_since_today
     )
-    df_global_predictions_since_100_cases = pd.concat(list_df_global_predictions_since_100_cases)
+    df_global_predictions_since_100_cases = DELPHIPredictionsBlock.concatenate(
+        list_blocks_global_predictions, since_today=False
+    )
     if GET_CONFIDENCE_INTERVALS:
         df_global_predictions_since_today, df_global_predictions_since_100_cases = DELPHIAggregations.append_all_aggregations_cf(
             df_global_predictions_since_100_cases,
             past_prediction_file=PATH_TO_FOLDER_DANGER_MAP + f"predicted/Global_V4_{past_prediction_date}.csv",
-            past_prediction_date=str(pd.to_datetime(past_prediction_date).date())
+            past_prediction_date=str(pd.to_datetime(past_prediction_date).date()),
+            past_predictions=DELPHIAreaDataStore.instance.past_predictions,
         )
     else:
         df_global_predictions_since_100_cases = DELPHIAggregations.append_all_aggregations(
@@ -9,9 +9,7 @@ import time
 import psutil
 import argparse
 import pandas as pd
-import numpy as np
 import multiprocessing as mp
-from scipy.integrate import solve_ivp
 from scipy.optimize import minimize
 from datetime import datetime, timedelta
 from functools import partial
@@ -19,8 +17,10 @@ from tqdm import tqdm
 from scipy.optimize import dual_annealing
 from DELPHI_utils_V4_static import (
     DELPHIAggregations, DELPHIDataSaver, DELPHIDataCreator, get_initial_conditions,
-    get_mape_data_fitting, create_fitting_data_from_validcases, get_residuals_value
+    get_mape_data_fitting, create_fitting_data_from_validcases, get_residuals_value, DELPHICaseHistoryStore,
+    DELPHIAreaDataStore
 )
+from DELPHI_utils_V4_ode import DELPHIODEModel, ode_solvers, default_n_substeps
 from DELPHI_params_V4 import (
     fitting_start_date,
     default_parameter_list,
@@ -28,11 +28,6 @@ from DELPHI_params_V4 import (
     dict_default_reinit_lower_bounds,
     dict_default_reinit_upper_bounds,
     validcases_threshold,
-    IncubeD,
-    RecoverID,
-    RecoverHD,
-    DetectD,
-    VentilatedD,
     default_maxT,
     p_v,
     p_d,
@@ -63,6 +58,8 @@ USER_RUNNING = RUN_CONFIG["arguments"]["user"]
 end_date = RUN_CONFIG["arguments"]["end_date"]
 # full_raw is TRUE if we want all the states up till that date, if False just take the last date
 full_raw = bool(int(RUN_CONFIG["arguments"]["full_raw"]))
+ODE_SOLVER = RUN_CONFIG["arguments"].get("ode_solver", "RK45")
+ODE_SUBSTEPS = int(RUN_CONFIG["arguments"].get("ode_substeps", default_n_substeps))
 
 PATH_TO_FOLDER_DANGER_MAP = CONFIG_FILEPATHS["danger_map"][USER_RUNNING]
 PATH_TO_DATA_SANDBOX = CONFIG_FILEPATHS["data_sandbox"][USER_RUNNING]
@@ -71,10 +68,8 @@ past_prediction_date = "".join(str(datetime.now().date() - timedelta(days=14)).s
 #############################################################################################################
 
 def predict_area(
-        tuple_area_state_: tuple,
+        tuple_area_: tuple,
         yesterday_: str,
-        past_parameters_: pd.DataFrame,
-        popcountries: pd.DataFrame,
         startT: str = None, # added to change optimmization start date
         endT: str = None, # added to change prediction date
 ):
@@ -83,43 +78,33 @@ def predict_area(
     :param tuple_area_: tuple corresponding to (continent, country, province)
     :param yesterday_: string corresponding to the date from which the model will read the previous parameters. The
     format has to be 'YYYYMMDD'
-    :param past_parameters_: Parameters from yesterday_ used as a starting point for the fitting process
-    :param popcountries: DataFrame containing population information for all countries and provinces
+    The population, past parameters (from yesterday_) and initial states of the area are read from the
+    DELPHIAreaDataStore loaded by the pool initializer
     :startT: string for the date from when the pandemic will be modelled (format should be 'YYYY-MM-DD')
     :endT: string for the date for which model state will be returned (format should be 'YYYY-MM-DD')
     :return: final_model_state: dict capturing the 16 delphi model states at date endT
     """
     time_entering = time.time()
-    continent, country, province, initial_state = tuple_area_state_
+    continent, country, province = tuple_area_
+    data_store = DELPHIAreaDataStore.instance
+    initial_state = data_store.get_initial_state(continent, country, province)
     #province = str(province)
     country_sub = country.replace(" ", "_")
-    province = province.astype(str)
     province_sub = province.replace(" ", "_") 
 
     print(f"starting to predict for {continent}, {country}, {province}")
-    if os.path.exists(PATH_TO_FOLDER_DANGER_MAP + f"processed/Cases_{country_sub}_{province_sub}.csv"):
-        totalcases = pd.read_csv(
-            PATH_TO_FOLDER_DANGER_MAP + f"processed/Cases_{country_sub}_{province_sub}.csv"
-        )
+    totalcases = data_store.get_cases(country_sub, province_sub)
+    if totalcases is not None:
         if totalcases.day_since100.max() < 0:
             logging.warning(
                 f"Not enough cases (less than 100) for Continent={continent}, Country={country} and Province={province}"
             )
             return None
 
-        if past_parameters_ is not None:
-            parameter_list_total = past_parameters_[
-                (past_parameters_.Country == country)
-                & (past_parameters_.Province == province)
-            ].reset_index(drop=True)
-            if len(parameter_list_total) > 0:
-                parameter_list_line = parameter_list_total.iloc[-1, :].values.tolist()
-                parameter_list = parameter_list_line[5:]
-                start_date = pd.to_datetime(parameter_list_line[3])
-            else:
-                # Otherwise use established lower/upper bounds
-                parameter_list = default_parameter_list
-                start_date = pd.to_datetime(totalcases.loc[totalcases.day_since100 == 0, "date"].iloc[-1])
+        parameter_list_line = data_store.get_past_parameters(country, province)
+        if parameter_list_line is not None:
+            parameter_list = parameter_list_line[5:]
+            start_date = pd.to_datetime(parameter_list_line[3])
         else:
             # Otherwise use established lower/upper bounds
             parameter_list = default_parameter_list
@@ -154,10 +139,7 @@ def predict_area(
             )
             return None
         else:
-            PopulationT = popcountries[
-                (popcountries.Country == country) & (popcountries.Province == province)
-            ].pop2016.iloc[-1]
-            N = PopulationT
+            N = data_store.get_population(country, province)
             PopulationI = validcases.loc[0, "case_cnt"]
             PopulationD = validcases.loc[0, "death_cnt"]
             if initial_state is not None:
@@ -187,66 +169,7 @@ def predict_area(
             balance, _,  cases_data_fit, deaths_data_fit, _ = create_fitting_data_from_validcases(validcases)
             GLOBAL_PARAMS_FIXED = (N, R_upperbound, R_heuristic, R_0, PopulationD, PopulationI, p_d, p_h, p_v)
 
-            def model_covid(
-                t, x, alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3
-            ) -> list:
-                """
-                SEIR based model with 16 distinct states, taking into account undetected, deaths, hospitalized and
-                recovered, and using an ArcTan government response curve, corrected with a Gaussian jump in case of
-                a resurgence in cases
-                :param t: time step
-                :param x: set of all the states in the model (here, 16 of them)
-                :param alpha: Infection rate
-                :param days: Median day of action (used in the arctan governmental response)
-                :param r_s: Median rate of action (used in the arctan governmental response)
-                :param r_dth: Rate of death
-                :param p_dth: Initial mortality percentage
-                :param r_dthdecay: Rate of decay of mortality percentage
-                :param k1: Internal parameter 1 (used for initial conditions)
-                :param k2: Internal parameter 2 (used for initial conditions)
-                :param jump: Amplitude of the Gaussian jump modeling the resurgence in cases
-                :param t_jump: Time where the Gaussian jump will reach its maximum value
-                :param std_normal: Standard Deviation of the Gaussian jump (~ time span of the resurgence in cases)
-                :return: predictions for all 16 states, which are the following
-                [0 S, 1 E, 2 I, 3 UR, 4 DHR, 5 DQR, 6 UD, 7 DHD, 8 DQD, 9 R, 10 D, 11 TH, 12 DVR,13 DVD, 14 DD, 15 DT]
-                """
-                r_i = np.log(2) / IncubeD  # Rate of infection leaving incubation phase
-                r_d = np.log(2) / DetectD  # Rate of detection
-                r_ri = np.log(2) / RecoverID  # Rate of recovery not under infection
-                r_rh = np.log(2) / RecoverHD  # Rate of recovery under hospitalization
-                r_rv = np.log(2) / VentilatedD  # Rate of recovery under ventilation
-                gamma_t = (
-                    (2 / np.pi) * np.arctan(-(t - days) / 20 * r_s) + 1
-                    + jump * np.exp(-(t - t_jump) ** 2 / (2 * std_normal ** 2))
-                )
-                p_dth_mod = (2 / np.pi) * (p_dth - 0.001) * (np.arctan(-t / 20 * r_dthdecay) + np.pi / 2) + 0.001
-                assert (
-                    len(x) == 16
-                ), f"Too many input variables, got {len(x)}, expected 16"
-                S, E, I, AR, DHR, DQR, AD, DHD, DQD, R, D, TH, DVR, DVD, DD, DT = x
-                # Equations on main variables
-                dSdt = -alpha * gamma_t * S * I / N
-                dEdt = alpha * gamma_t * S * I / N - r_i * E
-                dIdt = r_i * E - r_d * I
-                dARdt = r_d * (1 - p_dth_mod) * (1 - p_d) * I - r_ri * AR
-                dDHRdt = r_d * (1 - p_dth_mod) * p_d * p_h * I - r_rh * DHR
-                dDQRdt = r_d * (1 - p_dth_mod) * p_d * (1 - p_h) * I - r_ri * DQR
-                dADdt = r_d * p_dth_mod * (1 - p_d) * I - r_dth * AD
-                dDHDdt = r_d * p_dth_mod * p_d * p_h * I - r_dth * DHD
-                dDQDdt = r_d * p_dth_mod * p_d * (1 - p_h) * I - r_dth * DQD
-                dRdt = r_ri * (AR + DQR) + r_rh * DHR
-                dDdt = r_dth * (AD + DQD + DHD)
-                # Helper states (usually important for some kind of output)
-                dTHdt = r_d * p_d * p_h * I
-                dDVRdt = r_d * (1 - p_dth_mod) * p_d * p_h * p_v * I - r_rv * DVR
-                dDVDdt = r_d * p_dth_mod * p_d * p_h * p_v * I - r_dth * DVD
-                dDDdt = r_dth * (DHD + DQD)
-                dDTdt = r_d * p_d * I
-                return [
-                    dSdt, dEdt, dIdt, dARdt, dDHRdt, dDQRdt, dADdt, dDHDdt,
-                    dDQDdt, dRdt, dDdt, dTHdt, dDVRdt, dDVDdt, dDDdt, dDTdt,
-                ]
-
+            delphi_model = DELPHIODEModel(N=N, p_d=p_d, p_h=p_h, p_v=p_v)
             t_predictions = [i for i in range(maxT)]
 
             def solve_best_params_and_predict(optimal_params):
@@ -270,12 +193,9 @@ def predict_area(
                     params_fitted=optimal_params,
                     global_params_fixed=GLOBAL_PARAMS_FIXED,
                 )
-                x_sol_best = solve_ivp(
-                    fun=model_covid,
-                    y0=x_0_cases,
-                    t_span=[t_predictions[0], t_predictions[-1]],
-                    t_eval=t_predictions,
-                    args=tuple(optimal_params),
+                x_sol_best = delphi_model.solve(
+                    optimal_params, x_0=x_0_cases, t_eval=t_predictions, method=ODE_SOLVER,
+                    n_substeps=ODE_SUBSTEPS
                 ).y
                 return x_sol_best
 
@@ -341,25 +261,26 @@ if __name__ == "__main__":
     logging.info(
         f"The user is {USER_RUNNING}"
     )
-    popcountries = pd.read_csv(
-        PATH_TO_FOLDER_DANGER_MAP + f"processed/Population_Global.csv"
-    )
-    popcountries["tuple_area"] = list(zip(popcountries.Continent, popcountries.Country, popcountries.Province))
-
+    if ODE_SOLVER not in ode_solvers:
+        raise ValueError(f"ODE solver {ODE_SOLVER} not supported, should be one of {ode_solvers}")
     if not os.path.exists(PATH_TO_DATA_SANDBOX + f"predicted/raw_predictions/Predicted_model_state_V4_{fitting_start_date}.csv"):
         logging.error(f"Initial model state file not found, can not train from {fitting_start_date}. Use model_V4 to train on entire data.")
         raise FileNotFoundError
-    df_initial_states = pd.read_csv(
-        PATH_TO_DATA_SANDBOX + f"predicted/raw_predictions/Predicted_model_state_V4_{fitting_start_date}.csv"
-    )
 
-    try:
-        past_parameters = pd.read_csv(
-            PATH_TO_FOLDER_DANGER_MAP
-            + f"predicted/Parameters_Global_V4_{yesterday}.csv"
-        )
-    except:
-        past_parameters = None
+    if not DELPHICaseHistoryStore.is_up_to_date(PATH_TO_FOLDER_DANGER_MAP + "processed/"):
+        DELPHICaseHistoryStore.build(PATH_TO_FOLDER_DANGER_MAP + "processed/")
+    # Inputs of the areas, loaded once in each worker by the pool initializer and indexed by area, the tasks only
+    # carry the area key
+    dict_kwargs_data_store = dict(
+        path_to_population=PATH_TO_FOLDER_DANGER_MAP + "processed/Population_Global.csv",
+        path_to_initial_states=(
+            PATH_TO_DATA_SANDBOX + f"predicted/raw_predictions/Predicted_model_state_V4_{fitting_start_date}.csv"
+        ),
+        path_to_past_parameters=PATH_TO_FOLDER_DANGER_MAP + f"predicted/Parameters_Global_V4_{yesterday}.csv",
+        path_to_case_history_store=PATH_TO_FOLDER_DANGER_MAP + "processed/",
+    )
+    DELPHIAreaDataStore.initialize(**dict_kwargs_data_store)
+    list_tuples = list(DELPHIAreaDataStore.instance.list_areas)
 
     ### Fitting the Model ###
     # Initalizing lists of the different dataframes that will be concatenated in the end
@@ -370,21 +291,15 @@ if __name__ == "__main__":
         predict_area_partial = partial(
             predict_area,
             yesterday_=yesterday,
-            past_parameters_=past_parameters,
-            popcountries=popcountries,
             startT=fitting_start_date,
             endT=end_date
         )
         n_cpu = psutil.cpu_count(logical = False) 
         logging.info(f"Number of CPUs found and used in this run: {n_cpu}")
-        list_tuples = [(
-            r.continent, 
-            r.country, 
-            r.province, 
-            r.values[:16] if not pd.isna(r.S) else None
-            ) for _, r in df_initial_states.iterrows()]
         logging.info(f"Number of areas to be fitted in this run: {len(list_tuples)}")
-        with mp.Pool(n_cpu) as pool:
+        with mp.Pool(
+                n_cpu, initializer=partial(DELPHIAreaDataStore.initialize, **dict_kwargs_data_store)
+        ) as pool:
             for result_area in tqdm(
                 pool.map_async(predict_area_partial, list_tuples).get(),
                 total=len(list_tuples),
@@ -416,16 +331,15 @@ if __name__ == "__main__":
         predict_area_partial = partial(
             predict_area,
             yesterday_=yesterday,
-            past_parameters_=past_parameters,
-            popcountries=popcountries,
             startT=fitting_start_date,
             endT=end_date
         )
         n_cpu = psutil.cpu_count(logical = False) - 2
         logging.info(f"Number of CPUs found and used in this run: {n_cpu}")
-        list_tuples = [(r.continent ,r.country, r.province, r.values[:16]) for _, r in df_initial_states.iterrows()]
         logging.info(f"Number of areas to be fitted in this run: {len(list_tuples)}")
-        with mp.Pool(n_cpu) as pool:
+        with mp.Pool(
+                n_cpu, initializer=partial(DELPHIAreaDataStore.initialize, **dict_kwargs_data_store)
+        ) as pool:
             for result_area in tqdm(
                 pool.map_async(predict_area_partial, list_tuples).get(),
                 total=len(list_tuples),
@@ -28,6 +28,14 @@ default_bounds_params = (
 validcases_threshold = 7  # Minimum number of cases to fit the base-DELPHI
 validcases_threshold_policy = 15  # Minimum number of cases to train the country-level policy predictions
 max_iter = 500  # Maximum number of iterations for the algorithm
+loss_cache_relative_tolerance = 1e-12  # Relative quantization step of the (re-initialized) parameters keying the loss cache
+loss_cache_max_memory = 16 * 1024 ** 2  # Memory cap in bytes of the loss cache of each area, LRU entries evicted above
+skip_refit_window = 7  # Number of most recent days on which yesterday's parameters are evaluated in skip-refit mode
+skip_refit_mape_threshold = 5  # Maximum MAPE (%) on that recent window to carry yesterday's parameters forward
+skip_refit_mape_drift_threshold = 1  # Maximum increase of the in-sample MAPE (% points) to carry them forward
+# In race mode, annealing is only run for the areas where TNC isn't good enough, i.e. where the in-sample MAPE (%) of TNC
+# is above this threshold (default of the optional race_annealing_mape_threshold run config parameter)
+race_annealing_mape_threshold = 5
 
 # Default parameters - Annealing
 percentage_drift_upper_bound_annealing = 1
@@ -1,12 +1,23 @@
 # Authors: Hamza Tazi Bouardi (htazi@mit.edu), Michael L. Li (mlli@mit.edu), Omar Skali Lami (oskali@mit.edu)
 import os
+import hashlib
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from typing import Union
 from copy import deepcopy
-from itertools import compress
-from DELPHI_params_V4 import MAPPING_STATE_CODE_TO_STATE_NAME, future_policies
+import multiprocessing as mp
+from functools import partial
+from tqdm import tqdm
+from DELPHI_params_V4 import (
+    MAPPING_STATE_CODE_TO_STATE_NAME, future_policies, future_times, TIME_DICT, fitting_start_date,
+    validcases_threshold_policy, default_maxT_policies, p_v, p_d, p_h
+)
+from DELPHI_utils_V4_static import (
+    DELPHIDataCreator, DELPHIAreaDataStore, DELPHIScenarioCube, get_initial_conditions,
+    create_fitting_data_from_validcases, run_timed_on_area
+)
+from DELPHI_utils_V4_ode import DELPHIODEPolicyScenarios, default_n_substeps
 from matplotlib import pyplot as plt
 from logging import Logger
 from scipy.spatial import distance
@@ -172,6 +183,60 @@ def get_bounds_params_from_pastparams(
     return parameter_list, bounds_params
 
 
+class DELPHIPolicyFeaturesCache:
+    """
+    Cache on disk of the policy features processed from a raw policy data file, stored in a policy_features_cache/
+    subfolder next to that file. Entries are keyed by the content hash of the raw file (and by any other input of the
+    processing, e.g. the cutoff date), so that they are invalidated as soon as the raw file is updated
+    """
+    folder_name = "policy_features_cache/"
+
+    def __init__(self, path_to_source_file: str, name_features: str, key: str = ""):
+        """
+        :param path_to_source_file: path to the raw policy data file the features are processed from
+        :param name_features: name of the features, used as prefix of the cache files
+        :param key: string with the other inputs of the processing the features depend on
+        """
+        self.path_to_cache_folder = os.path.join(os.path.dirname(path_to_source_file), self.folder_name)
+        self.name_features = name_features
+        hash_source = hashlib.sha256()
+        with open(path_to_source_file, "rb") as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b""):
+                hash_source.update(chunk)
+        self.hash_source = hash_source.hexdigest()[:16]
+        self.path_to_cache_file = (
+            self.path_to_cache_folder + f"{name_features}_{self.hash_source}" + (f"_{key}" if key else "") + ".csv"
+        )
+
+    def load(self, dtype: dict = None) -> Union[pd.DataFrame, None]:
+        """
+        :param dtype: dictionary {column: type} of the columns that shouldn't be read with the type inferred from the
+        csv file
+        :return: the cached features, or None if they were never processed for this version of the raw file
+        """
+        if not os.path.exists(self.path_to_cache_file):
+            return None
+        # Province "None" and country codes such as "NA" must not be read as missing values
+        return pd.read_csv(self.path_to_cache_file, keep_default_na=False, parse_dates=["date"], dtype=dtype)
+
+    def save(self, df_features: pd.DataFrame) -> None:
+        """
+        Saves the features in the cache, and removes the entries of the previous versions of the raw file
+        :param df_features: processed features, with a date column
+        """
+        if not os.path.exists(self.path_to_cache_folder):
+            os.makedirs(self.path_to_cache_folder, exist_ok=True)
+        for filename in os.listdir(self.path_to_cache_folder):
+            if filename.startswith(f"{self.name_features}_") and not filename.startswith(
+                    f"{self.name_features}_{self.hash_source}"
+            ):
+                os.remove(self.path_to_cache_folder + filename)
+        # Written under a temporary name first, so that concurrent runs never read a partially written entry
+        path_to_tmp_file = self.path_to_cache_file + f".{os.getpid()}.tmp"
+        df_features.to_csv(path_to_tmp_file, index=False)
+        os.replace(path_to_tmp_file, self.path_to_cache_file)
+
+
 def convert_dates_us_policies(raw_date: str) -> Union[float, datetime]:
     """
     Converts dates from the dataframe with raw policies implemented in the US
@@ -206,136 +271,106 @@ def check_us_policy_data_consistency(policies: list, df_policy_raw_us: pd.DataFr
         ), f"Problem in data, policy {policy} has no start date but has an end date"
 
 
-def create_intermediary_policy_features_us(
-    df_policy_raw_us: pd.DataFrame, dict_state_to_policy_dates: dict, policies: list
-) -> pd.DataFrame:
+def create_intermediary_policy_tensor_us(
+    dict_state_to_policy_dates: dict, policies: list, date_range: np.ndarray
+) -> np.ndarray:
     """
-    Processes the IHME policy data in the US to create the right intermediary features with the right names
-    :param df_policy_raw_us: raw dataframe with policies implemented in the US
+    Processes the IHME policy data in the US into binary variables as to whether or not a policy is implemented in a
+    given state at a given date, computed for all states, dates and policies at once from the policy intervals
     :param dict_state_to_policy_dates: dictionary of the format {state: {policy: [start_date, end_date]}}
     :param policies: list of policies under consideration
-    :return: an intermediary dataframe with processed columns containing binary variables as to whether or not a
-    policy is implemented in a given state at a given date
+    :param date_range: array of datetime64 with the dates on which the policies are evaluated
+    :return: a boolean array of shape (number of states, number of dates, number of policies), in the order of the
+    states of dict_state_to_policy_dates and of the policies
     """
-    list_df_concat = []
-    n_dates = (datetime.now() - datetime(2020, 3, 1)).days + 1
-    date_range = [datetime(2020, 3, 1) + timedelta(days=i) for i in range(n_dates)]
-    for location in df_policy_raw_us.location_name.unique():
-        df_temp = pd.DataFrame(
-            {
-                "continent": ["North America" for _ in range(len(date_range))],
-                "country": ["US" for _ in range(len(date_range))],
-                "province": [location for _ in range(len(date_range))],
-                "date": date_range,
-            }
-        )
-        for policy in policies:
-            start_date_policy_location = dict_state_to_policy_dates[location][policy][0]
-            start_date_policy_location = (
-                start_date_policy_location
-                if start_date_policy_location is not np.nan
-                else "2030-01-02"
-            )
-            end_date_policy_location = dict_state_to_policy_dates[location][policy][1]
-            end_date_policy_location = (
-                end_date_policy_location
-                if end_date_policy_location is not np.nan
-                else "2030-01-01"
-            )
-            df_temp[policy] = 0
-            df_temp.loc[
-                (
-                    (df_temp.date >= start_date_policy_location)
-                    & (df_temp.date <= end_date_policy_location)
-                ),
-                policy,
-            ] = 1
-
-        list_df_concat.append(df_temp)
-
-    df_policies_US = pd.concat(list_df_concat).reset_index(drop=True)
-    df_policies_US.rename(
-        columns={
-            "travel_limit": "Travel_severely_limited",
-            "stay_home": "Stay_at_home_order",
-            "educational_fac": "Educational_Facilities_Closed",
-            "any_gathering_restrict": "Mass_Gathering_Restrictions",
-            "any_business": "Initial_Business_Closure",
-            "all_non-ess_business": "Non_Essential_Services_Closed",
-        },
-        inplace=True,
-    )
-    return df_policies_US
-
-
-def create_final_policy_features_us(df_policies_US: pd.DataFrame) -> pd.DataFrame:
+    # Missing start dates mean the policy was never implemented, missing end dates that it is still in place
+    start_dates = pd.to_datetime(pd.Series([
+        dict_state_to_policy_dates[state][policy][0] for state in dict_state_to_policy_dates for policy in policies
+    ])).fillna(pd.Timestamp(2030, 1, 2)).values.reshape(len(dict_state_to_policy_dates), 1, len(policies))
+    end_dates = pd.to_datetime(pd.Series([
+        dict_state_to_policy_dates[state][policy][1] for state in dict_state_to_policy_dates for policy in policies
+    ])).fillna(pd.Timestamp(2030, 1, 1)).values.reshape(len(dict_state_to_policy_dates), 1, len(policies))
+    dates = date_range.reshape(1, -1, 1)
+    return (dates >= start_dates) & (dates <= end_dates)
+
+
+def get_mapping_table_final_policies_us() -> np.ndarray:
+    """
+    Creates the lookup table from the combinations of the intermediary policies in the US to the final MECE policies.
+    Intermediary policies are, in order: travel severely limited, stay at home order, educational facilities closed,
+    mass gathering restrictions, initial business closure and non essential services closed, and a combination is
+    encoded as the integer whose i-th bit is the i-th intermediary policy
+    :return: an integer array of shape (2 ** 6, number of final policies) with the value of each final policy for each
+    combination of intermediary policies
     """
-    Creates the final MECE policies in the US from the intermediary policies dataframe
-    :param df_policies_US: intermediary dataframe with processed columns containing binary variables as to whether or 
-    not a policy is implemented in a given state at a given date
+    combinations = (np.arange(2 ** 6).reshape(-1, 1) >> np.arange(6)) & 1
+    stay_at_home = combinations[:, 1]
+    educational_facilities_closed = combinations[:, 2]
+    mass_gathering_restrictions = combinations[:, 3]
+    any_not_in_place = (combinations == 0).any(axis=1)
+    # Comparisons of the boolean any_not_in_place with 1 and 2 are kept as in the original feature definitions
+    table_final_policies = np.stack([
+        any_not_in_place,
+        any_not_in_place & (mass_gathering_restrictions == 1),
+        (any_not_in_place > 0) & (mass_gathering_restrictions == 0) & (stay_at_home == 0),
+        (any_not_in_place == 2) & (educational_facilities_closed == 1) & (mass_gathering_restrictions == 1),
+        (any_not_in_place > 1) & (educational_facilities_closed == 0) & (mass_gathering_restrictions == 1)
+        & (stay_at_home == 0),
+        (any_not_in_place > 2) & (educational_facilities_closed == 1) & (mass_gathering_restrictions == 1)
+        & (stay_at_home == 0),
+        stay_at_home == 1,
+    ], axis=1)
+    return table_final_policies.astype(int)
+
+
+def create_final_policy_features_us(states: list, date_range: np.ndarray, policy_tensor: np.ndarray) -> pd.DataFrame:
+    """
+    Creates the final MECE policies in the US from the intermediary policies, through a table lookup of the
+    combination of intermediary policies of each state and date
+    :param states: list of the states of the US, in the order of the first axis of policy_tensor
+    :param date_range: array of datetime64 with the dates of the second axis of policy_tensor
+    :param policy_tensor: boolean array of shape (number of states, number of dates, 6) with the intermediary policies,
+    as returned by create_intermediary_policy_tensor_us
     :return: dataframe with the final MECE policies in the US used for DELPHI policy predictions
     """
-    df_policies_US_final = deepcopy(df_policies_US)
-    msr = future_policies
-    df_policies_US_final[msr[0]] = (df_policies_US.eq(0).any(axis=1)).astype(str)
-    df_policies_US_final[msr[1]] = [
-        int(a and b)
-        for a, b in zip(
-            df_policies_US.eq(0).any(axis=1),
-            df_policies_US["Mass_Gathering_Restrictions"] == 1,
-        )
-    ]
-    df_policies_US_final[msr[2]] = [
-        int(a and b and c)
-        for a, b, c in zip(
-            df_policies_US.eq(0).any(axis=1) > 0,
-            df_policies_US["Mass_Gathering_Restrictions"] == 0,
-            df_policies_US["Stay_at_home_order"] == 0,
-        )
-    ]
-    df_policies_US_final[msr[3]] = [
-        int(a and b and c)
-        for a, b, c in zip(
-            df_policies_US.eq(0).any(axis=1) == 2,
-            df_policies_US["Educational_Facilities_Closed"] == 1,
-            df_policies_US["Mass_Gathering_Restrictions"] == 1,
-        )
-    ]
-    df_policies_US_final[msr[4]] = [
-        int(a and b and c and d)
-        for a, b, c, d in zip(
-            df_policies_US.eq(0).any(axis=1) > 1,
-            df_policies_US["Educational_Facilities_Closed"] == 0,
-            df_policies_US["Mass_Gathering_Restrictions"] == 1,
-            df_policies_US["Stay_at_home_order"] == 0,
-        )
-    ]
-    df_policies_US_final[msr[5]] = [
-        int(a and b and c and d)
-        for a, b, c, d in zip(
-            df_policies_US.eq(0).any(axis=1) > 2,
-            df_policies_US["Educational_Facilities_Closed"] == 1,
-            df_policies_US["Mass_Gathering_Restrictions"] == 1,
-            df_policies_US["Stay_at_home_order"] == 0,
-        )
-    ]
-    df_policies_US_final[msr[6]] = (df_policies_US["Stay_at_home_order"] == 1).apply(
-        lambda x: int(x)
-    )
-    df_policies_US_final["country"] = "US"
-    df_policies_US_final = df_policies_US_final.loc[
-        :, ["country", "province", "date"] + msr
-    ]
+    codes_combinations = (policy_tensor.astype(int) << np.arange(policy_tensor.shape[2])).sum(axis=2).flatten()
+    values_final_policies = get_mapping_table_final_policies_us()[codes_combinations]
+    df_policies_US_final = pd.DataFrame({
+        "country": "US",
+        "province": np.repeat(states, len(date_range)),
+        "date": np.tile(date_range, len(states)),
+    })
+    for i, policy in enumerate(future_policies):
+        df_policies_US_final[policy] = values_final_policies[:, i]
+    # The first policy is stored as the strings "True"/"False", as in the original feature definitions
+    df_policies_US_final[future_policies[0]] = df_policies_US_final[future_policies[0]].astype(bool).astype(str)
     return df_policies_US_final
 
 
-def read_policy_data_us_only(filepath_data_sandbox: str) -> pd.DataFrame:
+def read_policy_data_us_only(
+        filepath_data_sandbox: str, filename_policy_data: str = "12062020_raw_policy_data_us_only.csv",
+        use_cache: bool = True
+) -> pd.DataFrame:
     """
-    Reads and processes the policy data from IHME to obtain the MECE policies defined for DELPHI Policy Predictions
+    Reads and processes the policy data from IHME to obtain the MECE policies defined for DELPHI Policy Predictions.
+    The processed policies are cached by content of the IHME file and current date, so that repeated runs on the same
+    data don't reprocess them
     :param filepath_data_sandbox: string, path to the data sandbox drawn from the config.yml file in the main script
+    :param filename_policy_data: name of the IHME policy data file in the data sandbox
+    :param use_cache: boolean, whether to read and write the processed policies from and to the cache
     :return: fully processed dataframe containing the MECE policies implemented in each state of the US for the full 
     time period necessary until the day when this function is called
     """
+    n_dates = (datetime.now() - datetime(2020, 3, 1)).days + 1
+    if use_cache:
+        policy_features_cache = DELPHIPolicyFeaturesCache(
+            path_to_source_file=filepath_data_sandbox + filename_policy_data,
+            name_features=f"policies_us_{filename_policy_data[:-len('.csv')]}",
+            key=str((datetime(2020, 3, 1) + timedelta(days=n_dates - 1)).date()),
+        )
+        df_policies_US_final = policy_features_cache.load(dtype={future_policies[0]: str})
+        if df_policies_US_final is not None:
+            return df_policies_US_final
     policies = [
         "travel_limit", "stay_home", "educational_fac", "any_gathering_restrict",
         "any_business", "all_non-ess_business",
@@ -349,7 +384,7 @@ def read_policy_data_us_only(filepath_data_sandbox: str) -> pd.DataFrame:
         "Rhode Island", "South Carolina", "South Dakota", "Tennessee", "Texas", "Utah", "Vermont", "Virginia",
         "Washington", "West Virginia", "Wisconsin", "Wyoming",
     ]
-    df = pd.read_csv(filepath_data_sandbox + "12062020_raw_policy_data_us_only.csv")
+    df = pd.read_csv(filepath_data_sandbox + filename_policy_data)
     df = df[df.location_name.isin(list_US_states)][
         [
             "location_name", "travel_limit_start_date", "travel_limit_end_date", "stay_home_start_date",
@@ -358,164 +393,67 @@ def read_policy_data_us_only(filepath_data_sandbox: str) -> pd.DataFrame:
             "any_business_end_date", "all_non-ess_business_start_date", "all_non-ess_business_end_date",
         ]
     ]
-    dict_state_to_policy_dates = {}
-    for location in df.location_name.unique():
-        df_temp = df[df.location_name == location].reset_index(drop=True)
-        dict_state_to_policy_dates[location] = {
-            policy: [
-                df_temp.loc[0, f"{policy}_start_date"],
-                df_temp.loc[0, f"{policy}_end_date"],
-            ]
-            for policy in policies
-        }
     check_us_policy_data_consistency(policies=policies, df_policy_raw_us=df)
-    df_policies_US = create_intermediary_policy_features_us(
-        df_policy_raw_us=df,
-        dict_state_to_policy_dates=dict_state_to_policy_dates,
-        policies=policies,
+    df_first_rows = df.drop_duplicates("location_name")
+    dict_state_to_policy_dates = {
+        location: {
+            policy: [start_date, end_date]
+            for policy, start_date, end_date in zip(
+                policies, values_location[0::2], values_location[1::2]
+            )
+        }
+        for location, *values_location in df_first_rows.itertuples(index=False)
+    }
+    date_range = np.datetime64("2020-03-01", "us") + np.arange(n_dates).astype("timedelta64[D]")
+    policy_tensor = create_intermediary_policy_tensor_us(
+        dict_state_to_policy_dates=dict_state_to_policy_dates, policies=policies, date_range=date_range,
     )
     df_policies_US_final = create_final_policy_features_us(
-        df_policies_US=df_policies_US
+        states=list(dict_state_to_policy_dates), date_range=date_range, policy_tensor=policy_tensor
     )
+    if use_cache:
+        policy_features_cache.save(df_policies_US_final)
     return df_policies_US_final
 
 
-def read_oxford_international_policy_data(yesterday: str) -> pd.DataFrame:
+def create_final_policy_features_international(measures: pd.DataFrame) -> pd.DataFrame:
     """
-    Reads the policy data from the Oxford dataset online and processes it to obtain the MECE policies for all other
-    countries than the US
-    :param yesterday: string date used in the main script as the day for which we read past parameters used as warm 
-    starts for the optimization
-    :return: processed dataframe with MECE policies in each country of the world, used for policy predictions
+    Creates the final MECE policies for all countries from the raw Oxford measures, all features being computed as
+    vectorized operations on the whole table
+    :param measures: raw dataframe read from the Oxford dataset
+    :return: dataframe with the final MECE policies in each country of the world, for all the dates of the dataset
     """
-    measures = pd.read_csv("./data/OxCGRT_nat_latest.csv")
     filtr = ["CountryName", "CountryCode", "Date"]
     target = ["ConfirmedCases", "ConfirmedDeaths"]
-    msr = [
-        "C1M_School closing",
-        "C2M_Workplace closing",
-        "C3M_Cancel public events",
-        "C4M_Restrictions on gatherings",
-        "C5M_Close public transport",
-        "C6M_Stay at home requirements",
-        "C7M_Restrictions on internal movement",
-        "C8M_International travel controls",
-        "H1_Public information campaigns",
-    ]
-
-    flags = ["C" + str(i) +"M"+ "_Flag" for i in range(1, 8)] + ["H1_Flag"]
-    measures = measures.loc[:, filtr + msr + flags + target]
-    measures["Date"] = measures["Date"].apply(
-        lambda x: datetime.strptime(str(x), "%Y%m%d")
-    )
-    for col in target:
-        # measures[col] = measures[col].fillna(0)
-        measures[col] = measures.groupby("CountryName")[col].ffill()
-
-    measures["C1M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(measures["C1M_School closing"], measures["C1M_Flag"])
-    ]
-    measures["C2M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(measures["C2M_Workplace closing"], measures["C2M_Flag"])
-    ]
-    measures["C3M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(measures["C3M_Cancel public events"], measures["C3M_Flag"])
-    ]
-    measures["C4M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(
-            measures["C4M_Restrictions on gatherings"], measures["C4M_Flag"]
-        )
-    ]
-    measures["C5M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(measures["C5M_Close public transport"], measures["C5M_Flag"])
-    ]
-    measures["C6M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(measures["C6M_Stay at home requirements"], measures["C6M_Flag"])
-    ]
-    measures["C7M_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(
-            measures["C7M_Restrictions on internal movement"], measures["C7M_Flag"]
-        )
-    ]
-    measures["H1_Flag"] = [
-        0 if x <= 0 else y
-        for (x, y) in zip(
-            measures["H1_Public information campaigns"], measures["H1_Flag"]
-        )
+    # Raw measure, its flag (if any) and the minimum level of the measure for the policy to be considered in place
+    msr_flags_thresholds = [
+        ("C1M_School closing", "C1M_Flag", 2),
+        ("C2M_Workplace closing", "C2M_Flag", 2),
+        ("C3M_Cancel public events", "C3M_Flag", 2),
+        ("C4M_Restrictions on gatherings", "C4M_Flag", 1),
+        ("C5M_Close public transport", "C5M_Flag", 2),
+        ("C6M_Stay at home requirements", "C6M_Flag", 2),
+        ("C7M_Restrictions on internal movement", "C7M_Flag", 2),
+        ("C8M_International travel controls", None, 3),
+        ("H1_Public information campaigns", "H1_Flag", 1),
     ]
+    msr = [measure for measure, _, _ in msr_flags_thresholds]
+    flags = [flag for _, flag, _ in msr_flags_thresholds if flag is not None]
+    measures = measures.loc[:, filtr + msr + flags + target].copy()
+    measures["Date"] = pd.to_datetime(measures["Date"].astype(str), format="%Y%m%d")
+    measures[target] = measures.groupby("CountryName")[target].ffill()
+    for measure, flag, threshold in msr_flags_thresholds:
+        values_measure = measures[measure].values
+        if flag is not None:
+            # Flag is reset when the measure is not in place, and kept missing otherwise so that the row is dropped
+            values_flag = np.where(values_measure <= 0, 0, measures[flag].values)
+            measures[flag] = values_flag
+            measures[measure] = ((values_measure >= threshold) & (values_flag == 1)).astype(int)
+        else:
+            measures[measure] = (values_measure >= threshold).astype(int)
 
-    measures["C1M_School closing"] = [
-        int(a and b)
-        for a, b in zip(measures["C1M_School closing"] >= 2, measures["C1M_Flag"] == 1)
-    ]
-
-    measures["C2M_Workplace closing"] = [
-        int(a and b)
-        for a, b in zip(measures["C2M_Workplace closing"] >= 2, measures["C2M_Flag"] == 1)
-    ]
-
-    measures["C3M_Cancel public events"] = [
-        int(a and b)
-        for a, b in zip(
-            measures["C3M_Cancel public events"] >= 2, measures["C3M_Flag"] == 1
-        )
-    ]
-
-    measures["C4M_Restrictions on gatherings"] = [
-        int(a and b)
-        for a, b in zip(
-            measures["C4M_Restrictions on gatherings"] >= 1, measures["C4M_Flag"] == 1
-        )
-    ]
-
-    measures["C5M_Close public transport"] = [
-        int(a and b)
-        for a, b in zip(
-            measures["C5M_Close public transport"] >= 2, measures["C5M_Flag"] == 1
-        )
-    ]
-
-    measures["C6M_Stay at home requirements"] = [
-        int(a and b)
-        for a, b in zip(
-            measures["C6M_Stay at home requirements"] >= 2, measures["C6M_Flag"] == 1
-        )
-    ]
-
-    measures["C7M_Restrictions on internal movement"] = [
-        int(a and b)
-        for a, b in zip(
-            measures["C7M_Restrictions on internal movement"] >= 2,
-            measures["C7M_Flag"] == 1,
-        )
-    ]
-
-    measures["C8M_International travel controls"] = [
-        int(a) for a in (measures["C8M_International travel controls"] >= 3)
-    ]
-
-    measures["H1_Public information campaigns"] = [
-        int(a and b)
-        for a, b in zip(
-            measures["H1_Public information campaigns"] >= 1, measures["H1_Flag"] == 1
-        )
-    ]
-
-    # measures = measures.loc[:, measures.isnull().mean() < 0.1]
-    msr = set(measures.columns).intersection(set(msr))
-
-    # measures = measures.fillna(0)
     measures = measures.dropna()
-    for col in msr:
-        measures[col] = measures[col].apply(lambda x: int(x > 0))
-    measures = measures[["CountryName", "Date"] + list(sorted(msr))]
+    measures = measures[["CountryName", "Date"] + sorted(msr)]
     measures["CountryName"] = measures.CountryName.replace(
         {
             "United States": "US",
@@ -525,84 +463,69 @@ def read_oxford_international_policy_data(yesterday: str) -> pd.DataFrame:
             "Slovak Republic": "Slovakia",
         }
     )
+    restrict_mass_gatherings = (
+        measures["C3M_Cancel public events"].values
+        | measures["C4M_Restrictions on gatherings"].values
+        | measures["C5M_Close public transport"].values
+    )
+    others = (
+        measures["C2M_Workplace closing"].values
+        | measures["C7M_Restrictions on internal movement"].values
+        | measures["C8M_International travel controls"].values
+    )
+    school_closing = measures["C1M_School closing"].values
+    stay_at_home = measures["C6M_Stay at home requirements"].values
+    # Whether at least one of the remaining features (schools, stay at home, public information campaigns, mass
+    # gatherings and others) is not in place; comparisons of this boolean with 1 and 2 are kept as in the original
+    # feature definitions
+    any_not_in_place = (
+        (school_closing == 0) | (stay_at_home == 0) | (measures["H1_Public information campaigns"].values == 0)
+        | (restrict_mass_gatherings == 0) | (others == 0)
+    )
+    output = pd.DataFrame({"country": measures["CountryName"].values, "province": "None", "date": measures["Date"].values})
+    output[future_policies[0]] = (~any_not_in_place).astype(int)
+    output[future_policies[1]] = (any_not_in_place & (restrict_mass_gatherings == 1)).astype(int)
+    output[future_policies[2]] = (
+        (any_not_in_place > 0) & (restrict_mass_gatherings == 0) & (stay_at_home == 0)
+    ).astype(int)
+    output[future_policies[3]] = (
+        (any_not_in_place == 2) & (school_closing == 1) & (restrict_mass_gatherings == 1)
+    ).astype(int)
+    output[future_policies[4]] = (
+        (any_not_in_place > 1) & (school_closing == 0) & (restrict_mass_gatherings == 1) & (stay_at_home == 0)
+    ).astype(int)
+    output[future_policies[5]] = (
+        (any_not_in_place > 2) & (school_closing == 1) & (restrict_mass_gatherings == 1) & (stay_at_home == 0)
+    ).astype(int)
+    output[future_policies[6]] = (stay_at_home == 1).astype(int)
+    return output
 
-    measures = measures.fillna(0)
-    msr = future_policies
 
-    measures["Restrict_Mass_Gatherings"] = [
-        int(a or b or c)
-        for a, b, c in zip(
-            measures["C3M_Cancel public events"],
-            measures["C4M_Restrictions on gatherings"],
-            measures["C5M_Close public transport"],
-        )
-    ]
-    measures["Others"] = [
-        int(a or b or c)
-        for a, b, c in zip(
-            measures["C2M_Workplace closing"],
-            measures["C7M_Restrictions on internal movement"],
-            measures["C8M_International travel controls"],
-        )
-    ]
-
-    del measures["C2M_Workplace closing"]
-    del measures["C3M_Cancel public events"]
-    del measures["C4M_Restrictions on gatherings"]
-    del measures["C5M_Close public transport"]
-    del measures["C7M_Restrictions on internal movement"]
-    del measures["C8M_International travel controls"]
-
-    output = deepcopy(measures)
-    output[msr[0]] = (measures.iloc[:, 2:].eq(0).any(axis=1) == 0).apply(lambda x: int(x))
-    output[msr[1]] = [
-        int(a and b)
-        for a, b in zip(
-            measures.iloc[:, 2:].eq(0).any(axis=1) == 1,
-            measures["Restrict_Mass_Gatherings"] == 1,
-        )
-    ]
-    output[msr[2]] = [
-        int(a and b and c)
-        for a, b, c in zip(
-            measures.iloc[:, 2:].eq(0).any(axis=1) > 0,
-            measures["Restrict_Mass_Gatherings"] == 0,
-            measures["C6M_Stay at home requirements"] == 0,
-        )
-    ]
-    output[msr[3]] = [
-        int(a and b and c)
-        for a, b, c in zip(
-            measures.iloc[:, 2:].eq(0).any(axis=1) == 2,
-            measures["C1M_School closing"] == 1,
-            measures["Restrict_Mass_Gatherings"] == 1,
-        )
-    ]
-    output[msr[4]] = [
-        int(a and b and c and d)
-        for a, b, c, d in zip(
-            measures.iloc[:, 2:].eq(0).any(axis=1) > 1,
-            measures["C1M_School closing"] == 0,
-            measures["Restrict_Mass_Gatherings"] == 1,
-            measures["C6M_Stay at home requirements"] == 0,
-        )
-    ]
-    output[msr[5]] = [
-        int(a and b and c and d)
-        for a, b, c, d in zip(
-            measures.iloc[:, 2:].eq(0).any(axis=1) > 2,
-            measures["C1M_School closing"] == 1,
-            measures["Restrict_Mass_Gatherings"] == 1,
-            measures["C6M_Stay at home requirements"] == 0,
+def read_oxford_international_policy_data(
+        yesterday: str, path_to_oxford_data: str = "./data/OxCGRT_nat_latest.csv", use_cache: bool = True
+) -> pd.DataFrame:
+    """
+    Reads the policy data from the Oxford dataset online and processes it to obtain the MECE policies for all other
+    countries than the US. The processed policies are cached by content of the Oxford file and cutoff date, so that
+    repeated runs on the same data don't reprocess the full table
+    :param yesterday: string date used in the main script as the day for which we read past parameters used as warm 
+    starts for the optimization
+    :param path_to_oxford_data: path to the csv file of the Oxford dataset
+    :param use_cache: boolean, whether to read and write the processed policies from and to the cache
+    :return: processed dataframe with MECE policies in each country of the world, used for policy predictions
+    """
+    if use_cache:
+        policy_features_cache = DELPHIPolicyFeaturesCache(
+            path_to_source_file=path_to_oxford_data, name_features="policies_international", key=yesterday
         )
-    ]
-    output[msr[6]] = (measures["C6M_Stay at home requirements"] == 1).apply(
-        lambda x: int(x)
-    )
-    output.rename(columns={"CountryName": "country", "Date": "date"}, inplace=True)
-    output["province"] = "None"
-    output = output.loc[:, ["country", "province", "date"] + msr]
+        output = policy_features_cache.load()
+        if output is not None:
+            return output
+    measures = pd.read_csv(path_to_oxford_data)
+    output = create_final_policy_features_international(measures)
     output = output[output.date <= yesterday].reset_index(drop=True)
+    if use_cache:
+        policy_features_cache.save(output)
     return output
 
 
@@ -634,6 +557,69 @@ def make_increasing(sequence: list) -> list:
     return sequence
 
 
+def get_gamma_t_areas(dates: np.ndarray, areas: np.ndarray, params_areas: pd.DataFrame) -> np.ndarray:
+    """
+    Computes values of the gamma(t) function of gamma_t for many areas and days at once
+    :param dates: array of datetime64, days on which we want to compute the values of gamma(t)
+    :param areas: array of the same length with the area of each day, as in the index of params_areas
+    :param params_areas: dataframe indexed by area with the columns "Data Start Date", "Median Day of Action" and
+    "Rate of Action" used for each area
+    :return: array with the values of gamma(t) for each area and day
+    """
+    missing_areas = set(areas).difference(params_areas.index)
+    if len(missing_areas) > 0:
+        raise KeyError(f"No past parameters for the areas {sorted(missing_areas)}")
+    params_rows = params_areas.reindex(areas)
+    t = (
+        dates.astype("datetime64[ns]") - pd.to_datetime(params_rows["Data Start Date"]).values.astype("datetime64[ns]")
+    ) // np.timedelta64(1, "D")
+    gamma = (2 / np.pi) * np.arctan(
+        -(t - params_rows["Median Day of Action"].values) / 20 * params_rows["Rate of Action"].values
+    ) + 1
+    return gamma
+
+
+def get_normalized_policy_gamma(values_policies: np.ndarray, gamma: np.ndarray) -> dict:
+    """
+    Computes the average value of gamma(t) under each policy, normalized by its value under the first policy
+    (No_Measure)
+    :param values_policies: array of shape (number of rows, number of policies) with the values of the MECE policies
+    :param gamma: array with the value of gamma(t) of each row
+    :return: a dictionary {policy: normalized_shift_float}, the shifts are NaN for policies never in place
+    """
+    in_place_policies = values_policies == 1
+    n_rows_policies = in_place_policies.sum(axis=0)
+    dict_normalized_policy_gamma = {
+        policy: gamma[in_place_policies[:, i]].mean() if n_rows_policies[i] > 0 else np.nan
+        for i, policy in enumerate(future_policies)
+    }
+    normalize_val = dict_normalized_policy_gamma[future_policies[0]]
+    for policy in dict_normalized_policy_gamma.keys():
+        dict_normalized_policy_gamma[policy] = (
+            dict_normalized_policy_gamma[policy] / normalize_val
+        )
+    return dict_normalized_policy_gamma
+
+
+def get_current_policy_areas(areas: np.ndarray, values_policies: np.ndarray) -> dict:
+    """
+    Finds the policy currently in place in each area, i.e. the first policy in place in its rows of the last date
+    :param areas: array with the area of each row of the last date
+    :param values_policies: array of shape (number of rows, number of policies) with the values of the MECE policies
+    on the last date
+    :return: a dictionary {area: current_policy}
+    """
+    in_place_policies = values_policies == 1
+    rows_with_policy = in_place_policies.any(axis=1)
+    areas_with_policy = pd.Series(areas[rows_with_policy])
+    first_rows_areas = ~areas_with_policy.duplicated().values
+    policies_areas = in_place_policies[rows_with_policy][first_rows_areas].argmax(axis=1)
+    return {
+        area: future_policies[i_policy]
+        for area, i_policy in zip(areas_with_policy[first_rows_areas], policies_areas)
+    }
+
+
 def get_normalized_policy_shifts_and_current_policy_us_only(
     policy_data_us_only: pd.DataFrame, past_parameters: pd.DataFrame
 ) -> (dict, dict):
@@ -644,59 +630,29 @@ def get_normalized_policy_shifts_and_current_policy_us_only(
     values in the process
     :return: a tuple of two dictionaries, {policy: normalized_shift_float_US} and {US_state: current_policy}
     """
-    dict_current_policy = {}
     policy_list = future_policies
-    policy_data_us_only["province_cl"] = policy_data_us_only["province"].apply(
-        lambda x: x.replace(",", "").strip().lower()
-    )
-    states_upper_set = set(policy_data_us_only["province"])
-    for state in states_upper_set:
-        dict_current_policy[("US", state)] = list(
-            compress(
-                policy_list,
-                (
-                    policy_data_us_only.query("province == @state")[
-                        policy_data_us_only.query("province == @state")["date"]
-                        == policy_data_us_only.date.max()
-                    ][policy_list]
-                    == 1
-                )
-                .values.flatten()
-                .tolist(),
-            )
-        )[0]
-    states_set = set(policy_data_us_only["province_cl"])
+    policy_data_us_only["province_cl"] = policy_data_us_only["province"].str.replace(",", "").str.strip().str.lower()
+    is_last_date = (policy_data_us_only["date"] == policy_data_us_only.date.max()).values
+    dict_current_policy = {
+        ("US", state): current_policy
+        for state, current_policy in get_current_policy_areas(
+            areas=policy_data_us_only["province"].values[is_last_date],
+            values_policies=policy_data_us_only[policy_list].values[is_last_date],
+        ).items()
+    }
     past_parameters_copy = deepcopy(past_parameters)
-    past_parameters_copy["Province"] = past_parameters_copy["Province"].apply(
-        lambda x: str(x).replace(",", "").strip().lower()
-    )
-    params_dic = {}
-    for state in states_set:
-        params_dic[state] = past_parameters_copy[past_parameters_copy["Province"] == state][
-            ["Data Start Date", "Median Day of Action", "Rate of Action"]
-        ].iloc[0]
-
-    policy_data_us_only["Gamma"] = [
-        gamma_t(day, state, params_dic)
-        for day, state in zip(
-            policy_data_us_only["date"], policy_data_us_only["province_cl"]
-        )
+    past_parameters_copy["Province"] = past_parameters_copy["Province"].astype(str).str.replace(",", "").str.strip().str.lower()
+    params_states = past_parameters_copy.drop_duplicates("Province").set_index("Province")[
+        ["Data Start Date", "Median Day of Action", "Rate of Action"]
     ]
-    n_measures = policy_data_us_only.iloc[:, 3:-2].shape[1]
-    dict_normalized_policy_gamma = {
-        policy_data_us_only.columns[3 + i]: policy_data_us_only[
-            policy_data_us_only.iloc[:, 3 + i] == 1
-        ]
-        .iloc[:, -1]
-        .mean()
-        for i in range(n_measures)
-    }
-    normalize_val = dict_normalized_policy_gamma[policy_list[0]]
-    for policy in dict_normalized_policy_gamma.keys():
-        dict_normalized_policy_gamma[policy] = (
-            dict_normalized_policy_gamma[policy] / normalize_val
-        )
-
+    policy_data_us_only["Gamma"] = get_gamma_t_areas(
+        dates=policy_data_us_only["date"].values,
+        areas=policy_data_us_only["province_cl"].values,
+        params_areas=params_states,
+    )
+    dict_normalized_policy_gamma = get_normalized_policy_gamma(
+        values_policies=policy_data_us_only[policy_list].values, gamma=policy_data_us_only["Gamma"].values
+    )
     return dict_normalized_policy_gamma, dict_current_policy
 
 
@@ -711,86 +667,262 @@ def get_normalized_policy_shifts_and_current_policy_all_countries(
     values in the process
     :return: a tuple of two dictionaries, {policy: normalized_shift_float_international} and {area: current_policy}
     """
-    dict_current_policy = {}
     policy_list = future_policies
-    policy_data_countries["country_cl"] = policy_data_countries["country"].apply(
-        lambda x: x.replace(",", "").strip().lower()
-    )
+    policy_data_countries["country_cl"] = policy_data_countries["country"].str.replace(",", "").str.strip().str.lower()
     past_parameters_copy = deepcopy(past_parameters)
-    past_parameters_copy["Country"] = past_parameters_copy["Country"].apply(
-        lambda x: str(x).replace(",", "").strip().lower()
-    )
-    params_countries = past_parameters_copy["Country"]
-    params_countries = set(params_countries)
-    policy_data_countries_bis = policy_data_countries.query(
-        "country_cl in @params_countries"
-    )
-    countries_upper_set = set(
-        policy_data_countries[policy_data_countries.country != "US"]["country"]
-    )
-    # countries_in_oxford_and_params = params_countries.intersection(countries_upper_set)
-    for country in countries_upper_set:
-        dict_current_policy[(country, "None")] = list(
-            compress(
-                policy_list,
-                (
-                    policy_data_countries.query("country == @country")[
-                        policy_data_countries.query("country == @country")["date"]
-                        == policy_data_countries.query("country == @country").date.max()
-                    ][policy_list]
-                    == 1
-                )
-                .values.flatten()
-                .tolist(),
-            )
-        )[0]
-    countries_common = sorted([x.lower() for x in countries_upper_set])
+    past_parameters_copy["Country"] = past_parameters_copy["Country"].astype(str).str.replace(",", "").str.strip().str.lower()
+    params_countries = set(past_parameters_copy["Country"])
+    is_not_us = (policy_data_countries["country"] != "US").values
+    is_last_date = (
+        policy_data_countries["date"] == policy_data_countries.groupby("country")["date"].transform("max")
+    ).values
+    dict_current_policy = {
+        (country, "None"): current_policy
+        for country, current_policy in get_current_policy_areas(
+            areas=policy_data_countries["country"].values[is_not_us & is_last_date],
+            values_policies=policy_data_countries[policy_list].values[is_not_us & is_last_date],
+        ).items()
+    }
+    # Provinces of the countries in the Oxford dataset follow the current policy of their country, the names of the
+    # countries are mapped back from lower case to the Oxford names
+    dict_countries_common = {x.lower(): x for x in set(policy_data_countries["country"].values[is_not_us])}
     pastparam_tuples_in_oxford = past_parameters_copy[
-        (past_parameters_copy.Country.isin(countries_common))
+        (past_parameters_copy.Country.isin(list(dict_countries_common)))
         & (past_parameters_copy.Province != "None")
-    ].reset_index(drop=True)
-    pastparam_tuples_in_oxford["tuple_name"] = list(
-        zip(pastparam_tuples_in_oxford.Country, pastparam_tuples_in_oxford.Province)
-    )
-    for tuple in pastparam_tuples_in_oxford.tuple_name.unique():
-        country, province = tuple
-        country = country[0].upper() + country[1:]
+    ].drop_duplicates(["Country", "Province"])
+    for country, province in zip(pastparam_tuples_in_oxford.Country, pastparam_tuples_in_oxford.Province):
+        country = dict_countries_common[country]
         dict_current_policy[(country, province)] = dict_current_policy[
             (country, "None")
         ]
 
-    countries_set = set(policy_data_countries["country_cl"])
-
-    params_dic = {}
-    countries_set = countries_set.intersection(params_countries)
-    for country in countries_set:
-        params_dic[country] = past_parameters_copy.query("Country == @country")[
-            ["Data Start Date", "Median Day of Action", "Rate of Action"]
-        ].iloc[0]
-    policy_data_countries_bis["Gamma"] = [gamma_t(day, country, params_dic) for day, country in zip(policy_data_countries_bis["date"].values, policy_data_countries_bis["country_cl"].values)]
-    policy_data_countries_bis = policy_data_countries_bis.copy()
-
-    #policy_data_countries_bis.loc[:, "Gamma"] = [gamma_t(day, country, params_dic) for day, country in zip(policy_data_countries_bis["date"].values, policy_data_countries_bis["country_cl"].values)]    
-    #policy_data_countries_bis["Gamma"] = [gamma_t(day, country, params_dic) for day, country in zip(policy_data_countries_bis["date"].values, policy_data_countries_bis["country_cl"].values)]
-    #policy_data_countries_bis.loc[:, "Gamma"] = [gamma_t(day, country, params_dic)for day, country in zip(policy_data_countries_bis["date"], policy_data_countries_bis["country_cl"])]
-    n_measures = policy_data_countries_bis.iloc[:, 3:-2].shape[1]
-    dict_normalized_policy_gamma = {
-        policy_data_countries_bis.columns[3 + i]: policy_data_countries_bis[
-            policy_data_countries_bis.iloc[:, 3 + i] == 1
-        ]
-        .iloc[:, -1]
-        .mean()
-        for i in range(n_measures)
-    }
-    normalize_val = dict_normalized_policy_gamma[policy_list[0]]
-    for policy in dict_normalized_policy_gamma.keys():
-        dict_normalized_policy_gamma[policy] = (
-            dict_normalized_policy_gamma[policy] / normalize_val
-        )
-
+    # Policy shifts are computed on the days of the countries with past parameters
+    has_params = policy_data_countries["country_cl"].isin(params_countries).values
+    params_countries = past_parameters_copy.drop_duplicates("Country").set_index("Country")[
+        ["Data Start Date", "Median Day of Action", "Rate of Action"]
+    ]
+    gamma = get_gamma_t_areas(
+        dates=policy_data_countries["date"].values[has_params],
+        areas=policy_data_countries["country_cl"].values[has_params],
+        params_areas=params_countries,
+    )
+    dict_normalized_policy_gamma = get_normalized_policy_gamma(
+        values_policies=policy_data_countries[policy_list].values[has_params], gamma=gamma
+    )
     return dict_normalized_policy_gamma, dict_current_policy
 
 
+def solve_and_predict_area_policies(
+        tuple_area_: tuple,
+        yesterday_: str,
+        dict_normalized_policy_gamma_countries_: dict,
+        dict_normalized_policy_gamma_us_only_: dict,
+        dict_current_policy_international_: dict,
+        param_MATHEMATICA: bool,
+        ode_solver: str = "RK45",
+        n_substeps: int = default_n_substeps,
+        startT: str = fitting_start_date,
+):
+    """
+    Parallelizable version of the policy predictions for DELPHI V4, this function is called with multiprocessing by
+    predict_scenario_cube_policies
+    :param tuple_area_: tuple corresponding to (continent, country, province)
+    :param yesterday_: string corresponding to the date of the past parameters used for the predictions, with format
+    'YYYYMMDD'
+    :param dict_normalized_policy_gamma_countries_: normalized gamma shift of each policy outside of the US
+    :param dict_normalized_policy_gamma_us_only_: normalized gamma shift of each policy in the US
+    :param dict_current_policy_international_: policy currently in place in each (country, province)
+    :param param_MATHEMATICA: True if the past parameters come from the Mathematica runs, whose columns are not in the
+    same order as those of the Python runs
+    :param ode_solver: method used to integrate the ODE system of the scenarios, one of ode_solvers
+    :param n_substeps: number of substeps per day of the fixed-step solvers
+    :param startT: string for the date from when the pandemic is modelled (format should be 'YYYY-MM-DD')
+    The population, past parameters, initial states and case histories of the area are read from the
+    DELPHIAreaDataStore loaded by the pool initializer
+    :return: either None if there are no predictions for that area or a tuple with the first day of the predictions
+    (day with 100 cases), the predictions of all the (future policy, enaction time) scenarios of that area as an
+    array of shape (n_policies, n_times, n_days, 2) for cases and deaths, and the historical cases and deaths on the
+    same days as an array of shape (n_days, 2), to be put in the DELPHIScenarioCube
+    """
+    continent, country, province = tuple_area_
+    if isinstance(province, float):
+        province = str(province)
+    data_store = DELPHIAreaDataStore.instance
+    initial_state = data_store.get_initial_state(continent, country, province)
+    if country == "US":  # This line is necessary because the keys are the same in both cases
+        dict_normalized_policy_gamma_international = dict_normalized_policy_gamma_us_only_
+    else:
+        dict_normalized_policy_gamma_international = dict_normalized_policy_gamma_countries_
+
+    country_sub = country.replace(" ", "_")
+
+    province_sub = province.replace(" ", "_")
+    totalcases = data_store.get_cases(country_sub, province_sub)
+    if (
+            (totalcases is not None)
+            and ((country, province) in dict_current_policy_international_.keys())
+    ):
+        if totalcases.day_since100.max() < 0:
+            print(f"Not enough cases for Continent={continent}, Country={country} and Province={province}")
+            return None
+        print(country + " " + province)
+        parameter_list_line = data_store.get_past_parameters(country, province)
+        if len(data_store.dict_past_parameters) > 0:
+            if parameter_list_line is not None:
+                if param_MATHEMATICA:
+                    parameter_list = parameter_list_line[4:]
+                    parameter_list[3] = np.log(2) / parameter_list[3]
+                else:
+                    parameter_list = parameter_list_line[5:]
+                date_day_since100 = pd.to_datetime(parameter_list_line[3])
+                # Allowing a 5% drift for states with past predictions, starting in the 5th position are the parameters
+                start_date = max(pd.to_datetime(startT), date_day_since100)
+                validcases = totalcases[
+                    (totalcases.date >= str(start_date))
+                    & (totalcases.date <= str((pd.to_datetime(yesterday_) + timedelta(days=1)).date()))
+                ][["day_since100", "case_cnt", "death_cnt"]].reset_index(drop=True)
+            else:
+                print(f"Must have past parameters for {country} and {province}")
+                return None
+        else:
+            print("Must have past parameters")
+            return None
+
+        # Now we start the modeling part:
+        if len(validcases) > validcases_threshold_policy:
+            PopulationT = data_store.get_population(country, province)
+            N = PopulationT
+            PopulationI = validcases.loc[0, "case_cnt"]
+            PopulationD = validcases.loc[0, "death_cnt"]
+            if initial_state is not None:
+                R_0 = initial_state[9]
+            else:
+                R_0 = validcases.loc[0, "death_cnt"] * 5 if validcases.loc[0, "case_cnt"] - validcases.loc[0, "death_cnt"]> validcases.loc[0, "death_cnt"] * 5 else 0
+            cases_t_14days = totalcases[totalcases.date >= str(start_date- pd.Timedelta(14, 'D'))]['case_cnt'].values[0]
+            deaths_t_9days = totalcases[totalcases.date >= str(start_date - pd.Timedelta(9, 'D'))]['death_cnt'].values[0]
+            R_upperbound = validcases.loc[0, "case_cnt"] - validcases.loc[0, "death_cnt"]
+            R_heuristic = cases_t_14days - deaths_t_9days
+
+            """
+            Fixed Parameters based on meta-analysis:
+            p_h: Hospitalization Percentage
+            RecoverHD: Average Days until Recovery
+            VentilationD: Number of Days on Ventilation for Ventilated Patients
+            maxT: Maximum # of Days Modeled
+            p_d: Percentage of True Cases Detected
+            p_v: Percentage of Hospitalized Patients Ventilated,
+            balance: Regularization coefficient between cases and deaths
+            """
+            maxT = (default_maxT_policies - date_day_since100).days + 1
+            t_cases = validcases["day_since100"].tolist() - validcases.loc[0, "day_since100"]
+            balance, balance_total_difference, cases_data_fit, deaths_data_fit, weights = (
+                create_fitting_data_from_validcases(validcases)
+            )
+            GLOBAL_PARAMS_FIXED = (N, R_upperbound, R_heuristic, R_0, PopulationD, PopulationI, p_d, p_h, p_v)
+            best_params = parameter_list
+            t_predictions = [i for i in range(maxT)]
+            # All the (future policy, enaction time) scenarios share the trajectory up to their enaction time, which
+            # is integrated once, the scenarios branching from it at their enaction time
+            list_scenarios = [
+                (future_policy, future_time) for future_policy in future_policies for future_time in future_times
+            ]
+            delphi_scenarios = DELPHIODEPolicyScenarios(
+                N=N,
+                t_future_policy=[t_cases[-1] + future_time for _, future_time in list_scenarios],
+                normalized_gamma_future_policy=[
+                    dict_normalized_policy_gamma_international[future_policy] for future_policy, _ in list_scenarios
+                ],
+                normalized_gamma_current_policy=dict_normalized_policy_gamma_international[
+                    dict_current_policy_international_[(country, province)]
+                ],
+                p_d=p_d,
+                p_h=p_h,
+                p_v=p_v,
+            )
+            x_0_cases = get_initial_conditions(
+                params_fitted=best_params,
+                global_params_fixed=GLOBAL_PARAMS_FIXED
+            )
+            try:
+                x_sol_scenarios = delphi_scenarios.solve(
+                    best_params, x_0=x_0_cases, t_eval=t_predictions,
+                    method=ode_solver, n_substeps=n_substeps
+                )
+            except ValueError as error:
+                # A stiff or diverging area is skipped instead of stopping the predictions of all the other areas
+                print(f"Policy scenarios failed for Continent={continent}, Country={country} and Province={province}: "
+                      + f"{error}")
+                return None
+            # Creating the block of the scenario cube for this (Continent, Country, Province): rounded predictions of
+            # shape (policy, enaction time, day, metric), and historical values on the same days
+            values_area_scenarios = np.round(x_sol_scenarios[:, [15, 14], :]).astype(int).transpose(0, 2, 1).reshape(
+                len(future_policies), len(future_times), len(t_predictions), 2
+            )
+            data_creator = DELPHIDataCreator(
+                x_sol_final=x_sol_scenarios[0], date_day_since100=date_day_since100, best_params=best_params,
+                continent=continent, country=country, province=province,
+            )
+            values_true_area = data_creator.create_historical_values_scenario(totalcases)
+            print(f"Finished predicting for Continent={continent}, Country={country} and Province={province}")
+            print("--------------------------------------------------------------------------")
+            return np.datetime64(date_day_since100.date(), "D"), values_area_scenarios, values_true_area
+        else:  # len(validcases) <= 7
+            print(f"Not enough historical data (less than a week)" +
+                  f"for Continent={continent}, Country={country} and Province={province}")
+            return None
+    else:  # file for that tuple (country, province) doesn't exist in processed files
+        return None
+
+
+def predict_scenario_cube_policies(
+        solve_and_predict_area_policies_partial, dict_kwargs_data_store: dict, n_cpu: int
+) -> DELPHIScenarioCube:
+    """
+    Runs the policy predictions of all the areas in parallel and assembles their blocks in the scenario cube
+    :param solve_and_predict_area_policies_partial: solve_and_predict_area_policies with all its arguments but the
+    area set
+    :param dict_kwargs_data_store: paths to the input files of the DELPHIAreaDataStore loaded by the pool initializer
+    :param n_cpu: number of worker processes
+    :return: cube with the predictions of all the (future policy, enaction time) scenarios of the areas predicted,
+    in the order of the initial states file
+    """
+    DELPHIAreaDataStore.initialize(**dict_kwargs_data_store)
+    list_tuples = list(DELPHIAreaDataStore.instance.list_areas)
+    dict_position_area = {tuple_area: i for i, tuple_area in enumerate(list_tuples)}
+    # Initalizing lists of the blocks of the areas that will be put in the scenario cube in the end
+    list_positions_areas_predicted = []
+    list_areas_predicted = []
+    list_first_days_predicted = []
+    list_values_scenarios = []
+    list_values_true = []
+    # Results are collected as soon as each area is done, and put back in the order of the initial states file
+    with mp.Pool(
+            n_cpu, initializer=partial(DELPHIAreaDataStore.initialize, **dict_kwargs_data_store)
+    ) as pool:
+        for tuple_area, _, result_area in tqdm(
+                pool.imap_unordered(partial(run_timed_on_area, solve_and_predict_area_policies_partial), list_tuples),
+                total=len(list_tuples),
+        ):
+            if result_area is not None:
+                first_day_area, values_area_scenarios, values_true_area = result_area
+                list_positions_areas_predicted.append(dict_position_area[tuple_area])
+                list_areas_predicted.append(tuple_area)
+                list_first_days_predicted.append(first_day_area)
+                list_values_scenarios.append(values_area_scenarios)
+                list_values_true.append(values_true_area)
+        pool.close()
+        pool.join()
+    order_areas_predicted = np.argsort(list_positions_areas_predicted)
+    return DELPHIScenarioCube.from_area_blocks(
+        list_areas=[list_areas_predicted[i] for i in order_areas_predicted],
+        list_first_days=[list_first_days_predicted[i] for i in order_areas_predicted],
+        list_values=[list_values_scenarios[i] for i in order_areas_predicted],
+        list_values_true=[list_values_true[i] for i in order_areas_predicted],
+        policies=future_policies,
+        times=[TIME_DICT[future_time] for future_time in future_times],
+    )
+
+
 def get_testing_data_us() -> pd.DataFrame:
     """
     Function that retrieves testing data in the US from the CovidTracking website
@@ -828,13 +960,16 @@ class DELPHIModelComparison:
         path_to_folder_data_sandbox: str,
         global_annealing_since_100days: pd.DataFrame,
         total_tnc_since_100days: pd.DataFrame,
-        logger: Logger
+        logger: Logger,
+        case_history_store=None,
     ):
         self.DANGER_MAP = path_to_folder_danger_map
         self.DATA_SANDBOX = path_to_folder_data_sandbox
         self.global_annealing_since_100days = global_annealing_since_100days
         self.total_tnc_since_100days = total_tnc_since_100days
         self.logger = logger
+        # DELPHICaseHistoryStore of processed/Global/ serving the actual cases, read from the csv files if None
+        self.case_history_store = case_history_store
 
     @staticmethod
     def kl_divergence(y_true: list, y_pred: list) -> float:
@@ -844,8 +979,8 @@ class DELPHIModelComparison:
         :param y_pred: list of predicted values
         :return: a float, corresponding to the KL divergence
         """
-        y_true = np.asarray(y_true, dtype=np.float)
-        y_pred = np.asarray(y_pred, dtype=np.float)
+        y_true = np.asarray(y_true, dtype=float)
+        y_pred = np.asarray(y_pred, dtype=float)
         
         return np.sum(np.where(y_true != 0, y_true * np.log(y_true / y_pred), 0))
 
@@ -892,9 +1027,21 @@ class DELPHIModelComparison:
         """
         province = '_'.join(province.split())
         country = '_'.join(country.split())
-        true_df = pd.read_csv(self.DANGER_MAP + f'processed/Global/Cases_{country}_{province}.csv')
-        true_df = true_df.query('case_cnt >= @min_case_count').sort_values('date').groupby('date').min().reset_index()
-        return(true_df)
+        if self.case_history_store is not None:
+            true_df = self.case_history_store.get_cases(country, province)
+        else:
+            true_df = pd.read_csv(self.DANGER_MAP + f'processed/Global/Cases_{country}_{province}.csv')
+        return DELPHIModelComparison.get_true_cases(true_df, min_case_count=min_case_count)
+
+    @staticmethod
+    def get_true_cases(true_df: pd.DataFrame, min_case_count=100) -> pd.DataFrame:
+        """
+        Selects the actual cases data used for the comparison from the case history of an area
+        :param true_df: a pandas dataframe with the case history of the area, as in the processed Cases_*.csv files
+        :param min_case_count: int, the minimum number of cases since when data is selected
+        :return: a pandas dataframe for date wise cases where cases > min_case_count
+        """
+        return true_df.query('case_cnt >= @min_case_count').sort_values('date').groupby('date').min().reset_index()
 
     def compare_metric(self,
                     province_tuple,
@@ -914,12 +1061,44 @@ class DELPHIModelComparison:
         :return: a 4 tuple of (if annealing is better, metric for annealing, metric for tnc,
         Max APE for annealing)
         """
+        continent, country, province = province_tuple
+        true_df = self.get_province(country, province, min_case_count=min_case_count)
+        annealing_df = self.global_annealing_since_100days.query('Continent == @continent').query('Country == @country').query('Province == @province')
+        tnc_df = self.total_tnc_since_100days.query('Continent == @continent').query('Country == @country').query('Province == @province')
+        return self.compare_predictions(
+            province_tuple, true_df, annealing_df, tnc_df, metric=metric, threshold=threshold, plot=plot, eps=eps
+        )
+
+    def compare_predictions(self,
+                    province_tuple,
+                    true_df,
+                    annealing_df,
+                    tnc_df,
+                    metric="Canberra",
+                    threshold=10.0,
+                    plot=False,
+                    eps=0.02):
+        """
+        Computes the given metric for the given predictions with annealing and tnc of an area and the MAPE for
+        annealing, used by compare_metric and directly on the predictions in memory by the race optimizer mode.
+        Returns the metrics along with a flag showing whether annealing did better than tnc.
+        :param province_tuple: a 3 tuple of str, tuple of (continent, country, province)
+        :param true_df: a pandas dataframe with the actual cases of the area, as returned by get_true_cases
+        :param annealing_df: a pandas dataframe with the predictions since 100 cases with annealing of the area, with
+        the columns Day (datetime) and Total Detected
+        :param tnc_df: a pandas dataframe with the predictions since 100 cases with tnc of the area, same format
+        :param metric: function, the primary metric that is used, KL divergence by default
+        :param threshold: float, the threshold on Max APE score for annealing to be selected
+        :param plot: boolean, to save plots of predictions or not, default = False
+        :return: a 4 tuple of (if annealing is better, metric for annealing, metric for tnc,
+        Max APE for annealing)
+        """
         today_date_str = "".join(str(datetime.now().date()).split("-"))
 
         continent, country, province = province_tuple
-        true_df = self.get_province(country, province, min_case_count=min_case_count)
-        annealing_df = self.global_annealing_since_100days.query('Continent == @continent').query('Country == @country').query('Province == @province').sort_values('Day').groupby('Day').min().reset_index()
-        tnc_df = self.total_tnc_since_100days.query('Continent == @continent').query('Country == @country').query('Province == @province').sort_values('Day').groupby('Day').min().reset_index()
+        true_df = true_df.copy()
+        annealing_df = annealing_df.sort_values('Day').groupby('Day').min().reset_index()
+        tnc_df = tnc_df.sort_values('Day').groupby('Day').min().reset_index()
 
         annealing_df['Annealing Prediction'] = annealing_df['Total Detected'].diff().apply(lambda x: x if x > 1 else 1)
         tnc_df['TNC Prediction'] = tnc_df['Total Detected'].diff().apply(lambda x: x if x > 1 else 1)
@@ -970,3 +1149,209 @@ class DELPHIModelComparison:
         else:
             self.logger.debug('TNC better than Annealing. Retrain.')
             return (False, metric_annealing, metric_tnc, max_ape)
+
+    def get_daily_increments_matrix(
+            self, df: pd.DataFrame, columns_area: list, column_date: str, column_value: str, list_areas: list,
+            dates: np.ndarray
+    ) -> np.ndarray:
+        """
+        Computes the daily increments of a cumulative value for all areas at once, aligned on a common grid of dates
+        :param df: a pandas dataframe with the cumulative value of each area and date, possibly with duplicate dates
+        (the minimum is then used, as in compare_metric)
+        :param columns_area: list of the columns identifying the area in df
+        :param column_date: str, the column with the dates in df
+        :param column_value: str, the column with the cumulative value in df
+        :param list_areas: list of the areas (tuples of the values of columns_area) in the rows of the output
+        :param dates: array of datetime64[D], the dates in the columns of the output
+        :return: a float array of shape (number of areas, number of dates) with the increment of the value since the
+        previous date available for the area, floored at 1 as in compare_metric, and NaN where the area has no value
+        """
+        df_values = df.groupby(columns_area + [column_date], sort=True, dropna=False)[column_value].min().reset_index()
+        increments = df_values.groupby(columns_area, sort=False, dropna=False)[column_value].diff().values
+        # First day of each area has no increment and is floored at 1 as the others
+        increments = np.where(increments > 1, increments, 1)
+        dict_position_area = {area: i for i, area in enumerate(list_areas)}
+        positions_areas = np.array([
+            dict_position_area.get(area, -1) for area in zip(*[df_values[column].values for column in columns_area])
+        ], dtype=int)
+        positions_dates = np.searchsorted(
+            dates, pd.to_datetime(df_values[column_date]).values.astype("datetime64[D]")
+        )
+        matrix_increments = np.full((len(list_areas), len(dates)), np.nan)
+        in_areas = positions_areas >= 0
+        matrix_increments[positions_areas[in_areas], positions_dates[in_areas]] = increments[in_areas]
+        return matrix_increments
+
+    def compare_metric_all_areas(self,
+                    list_province_tuples,
+                    min_case_count=100,
+                    metric="Canberra",
+                    threshold=10.0,
+                    eps=0.02):
+        """
+        Batch version of compare_metric for many areas at once: the daily increments of the actual cases and of the
+        predictions with annealing and tnc are aligned as matrices (areas x dates) in one pass, and the metrics are
+        computed row-wise on the dates where the three are available. Missing provinces are considered as "None".
+        :param list_province_tuples: list of 3 tuples of str, tuples of (continent, country, province)
+        :param min_case_count: int, the minimum number of cases since when data is selected
+        :param metric: str, the primary metric that is used, either Canberra (by default) or KL
+        :param threshold: float, the threshold on Max APE score for annealing to be selected
+        :param eps: float, relative margin by which the metric for annealing has to be better than the one for tnc
+        :return: a pandas dataframe with one row per area and the columns region, annealing_selected, annealing_metric,
+        tnc_metric and annealing_max_ape, i.e. the outputs of compare_metric
+        """
+        columns_area = ["Continent", "Country", "Province"]
+        list_areas = [
+            (continent, country, province if isinstance(province, str) else "None")
+            for continent, country, province in list_province_tuples
+        ]
+        list_df_predictions = []
+        for df_predictions in [self.global_annealing_since_100days, self.total_tnc_since_100days]:
+            df_predictions = df_predictions[columns_area + ["Day", "Total Detected"]].copy()
+            df_predictions["Province"] = df_predictions["Province"].fillna("None")
+            df_predictions["Day"] = pd.to_datetime(df_predictions["Day"]).values.astype("datetime64[D]")
+            list_df_predictions.append(df_predictions)
+        list_df_true = []
+        for continent, country, province in list_areas:
+            true_df = self.get_province(country, province, min_case_count=min_case_count)[["date", "case_cnt"]]
+            list_df_true.append(true_df.assign(Continent=continent, Country=country, Province=province))
+        df_true = pd.concat(list_df_true) if len(list_df_true) > 0 else pd.DataFrame(
+            columns=columns_area + ["date", "case_cnt"]
+        )
+        df_true["date"] = pd.to_datetime(df_true["date"]).values.astype("datetime64[D]")
+        dates = np.unique(np.concatenate(
+            [df_true["date"].values] + [df_predictions["Day"].values for df_predictions in list_df_predictions]
+        ).astype("datetime64[D]"))
+
+        true_values = self.get_daily_increments_matrix(
+            df_true, columns_area, "date", "case_cnt", list_areas, dates
+        )
+        annealing_values, tnc_values = [
+            self.get_daily_increments_matrix(
+                df_predictions, columns_area, "Day", "Total Detected", list_areas, dates
+            )
+            for df_predictions in list_df_predictions
+        ]
+        # Dates where the three are available are moved first in each row, in chronological order, so that the
+        # metrics are computed on the same sequences as the inner merge of compare_metric
+        is_merged = ~(np.isnan(true_values) | np.isnan(annealing_values) | np.isnan(tnc_values))
+        n_merged = is_merged.sum(axis=1)
+        order_dates = np.argsort(~is_merged, axis=1, kind="stable")
+        is_merged = np.take_along_axis(is_merged, order_dates, axis=1)
+        true_values, annealing_values, tnc_values = [
+            np.where(is_merged, np.take_along_axis(values, order_dates, axis=1), 0)
+            for values in [true_values, annealing_values, tnc_values]
+        ]
+        # Weights of compare_metric, i.e. the rank of the date among the merged dates
+        weights = np.where(is_merged, np.arange(len(dates)), 0)
+
+        if metric == "KL":
+            self.logger.info("Using KL divergence metric")
+
+            def get_metric(predicted_values: np.ndarray) -> np.ndarray:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    return np.where(
+                        is_merged & (true_values != 0), true_values * np.log(true_values / predicted_values), 0
+                    ).sum(axis=1)
+        elif metric == "Canberra":
+            def get_metric(predicted_values: np.ndarray) -> np.ndarray:
+                denominator = np.abs(true_values) + np.abs(predicted_values)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    return np.where(
+                        is_merged & (denominator != 0),
+                        weights * np.abs(true_values - predicted_values) / denominator,
+                        0,
+                    ).sum(axis=1)
+        else:
+            self.logger.error(f"Metric {metric} has not been implemented. Only KL divergence is implemented so far")
+            raise NotImplementedError("Only KL divergence is implemented as a comparison metric")
+        metric_annealing = get_metric(annealing_values)
+        metric_tnc = get_metric(tnc_values)
+
+        # Max APE of the moving sums over 10 days of the merged sequences, as in max_ape_ma
+        n_ma = 10
+        true_cumsum = np.cumsum(true_values, axis=1)
+        annealing_cumsum = np.cumsum(annealing_values, axis=1)
+        true_ma = true_cumsum[:, n_ma:] - true_cumsum[:, :-n_ma]
+        annealing_ma = annealing_cumsum[:, n_ma:] - annealing_cumsum[:, :-n_ma]
+        is_valid_ma = (np.arange(len(dates) - n_ma) < (n_merged - n_ma)[:, None]) & (true_ma > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ape = np.where(is_valid_ma, np.abs(true_ma - annealing_ma) / true_ma, -np.inf)
+        max_ape = np.where(is_valid_ma.any(axis=1), ape.max(axis=1, initial=-np.inf), 10.0)
+
+        annealing_selected = (metric_annealing < metric_tnc - eps * np.abs(metric_tnc)) & (max_ape < threshold)
+        self.logger.info(
+            f"Annealing better than TNC in {int(np.sum(metric_annealing < metric_tnc))}/{len(list_areas)} areas, "
+            + f"selected in {int(np.sum(annealing_selected))} areas with the Max APE threshold {threshold}"
+        )
+        return pd.DataFrame({
+            "region": list_province_tuples,
+            "annealing_selected": annealing_selected,
+            "annealing_metric": metric_annealing,
+            "tnc_metric": metric_tnc,
+            "annealing_max_ape": max_ape,
+        })
+
+    @staticmethod
+    def get_areas_to_compare(
+            global_parameters_tnc: pd.DataFrame, global_parameters_annealing: pd.DataFrame, logger: Logger
+    ) -> list:
+        """
+        Lists the areas with parameters for both tnc and annealing, in the order of the tnc parameters, the areas
+        without annealing parameters being skipped with a warning. Provinces "None" read as missing values are restored
+        so that the areas match those of the predictions
+        :param global_parameters_tnc: a pandas dataframe with the parameters with tnc of all areas
+        :param global_parameters_annealing: a pandas dataframe with the parameters with annealing of all areas
+        :param logger: logger in which the areas skipped are reported
+        :return: list of 3 tuples of str, tuples of (continent, country, province) to be compared
+        """
+        areas_annealing = set(zip(
+            global_parameters_annealing.Continent, global_parameters_annealing.Country,
+            global_parameters_annealing.Province.fillna("None"),
+        ))
+        list_province_tuples = []
+        for continent, country, province in zip(
+                global_parameters_tnc.Continent, global_parameters_tnc.Country,
+                global_parameters_tnc.Province.fillna("None"),
+        ):
+            if (continent, country, province) not in areas_annealing:
+                logger.warning(f'Annealing parameters not present for {country} - {province}')
+            else:
+                list_province_tuples.append((continent, country, province))
+        return list_province_tuples
+
+    @staticmethod
+    def select_best_parameters(
+            global_parameters_tnc: pd.DataFrame, global_parameters_annealing: pd.DataFrame,
+            df_comparison: pd.DataFrame
+    ) -> pd.DataFrame:
+        """
+        Builds the table of the best parameters, i.e. the parameters with annealing in the areas where it was selected
+        and with tnc in the others, in the order of the tnc parameters
+        :param global_parameters_tnc: a pandas dataframe with the parameters with tnc of all areas
+        :param global_parameters_annealing: a pandas dataframe with the parameters with annealing of all areas
+        :param df_comparison: a pandas dataframe with the comparison of the areas, as returned by
+        compare_metric_all_areas, the areas missing from it are dropped
+        :return: a pandas dataframe with the best parameters
+        """
+        columns_area = ["Continent", "Country", "Province"]
+        df_selection = pd.DataFrame(
+            df_comparison["region"].tolist(), columns=columns_area
+        ).assign(annealing_selected=df_comparison["annealing_selected"].values)
+        df_selection["Province"] = df_selection["Province"].fillna("None")
+        df_selection = df_selection.drop_duplicates(columns_area)
+        df_tnc = global_parameters_tnc.assign(
+            Province_key=global_parameters_tnc["Province"].fillna("None"), position=np.arange(len(global_parameters_tnc))
+        )
+        df_annealing = global_parameters_annealing.assign(
+            Province_key=global_parameters_annealing["Province"].fillna("None")
+        )
+        keys_area = ["Continent", "Country", "Province_key"]
+        df_selection = df_selection.rename(columns={"Province": "Province_key"})
+        df_tnc = df_tnc.merge(df_selection, on=keys_area, how="inner")
+        df_annealing = df_annealing.merge(
+            df_tnc.loc[df_tnc.annealing_selected, keys_area + ["position"]], on=keys_area, how="inner"
+        )
+        global_parameters_best = pd.concat([df_tnc[~df_tnc.annealing_selected], df_annealing])
+        global_parameters_best = global_parameters_best.sort_values("position", kind="stable")
+        return global_parameters_best[global_parameters_tnc.columns].reset_index(drop=True)
@@ -0,0 +1,1120 @@
+# Authors: Hamza Tazi Bouardi (htazi@mit.edu), Michael L. Li (mlli@mit.edu), Omar Skali Lami (oskali@mit.edu)
+import math
+import time
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from scipy.optimize import OptimizeResult
+from scipy.sparse import csc_matrix
+from DELPHI_params_V4 import (
+    IncubeD,
+    RecoverID,
+    RecoverHD,
+    DetectD,
+    VentilatedD,
+    p_v,
+    p_d,
+    p_h,
+)
+
+# Constant rates of the DELPHI model, derived from the fixed durations in DELPHI_params_V4
+r_i = np.log(2) / IncubeD  # Rate of infection leaving incubation phase
+r_d = np.log(2) / DetectD  # Rate of detection
+r_ri = np.log(2) / RecoverID  # Rate of recovery not under infection
+r_rh = np.log(2) / RecoverHD  # Rate of recovery under hospitalization
+r_rv = np.log(2) / VentilatedD  # Rate of recovery under ventilation
+n_states = 16
+n_params = 12
+ode_solvers_solve_ivp = ["RK45", "RK23", "DOP853", "Radau", "BDF", "LSODA"]  # Methods supported by scipy's solve_ivp
+ode_solvers_with_jacobian = ["Radau", "BDF", "LSODA"]  # Implicit methods that make use of the Jacobian
+ode_solvers_fixed_step = ["RK4"]  # Fixed-step methods integrating directly on the time grid of t_eval
+ode_solvers = ode_solvers_solve_ivp + ode_solvers_fixed_step
+default_n_substeps = 1  # Number of fixed steps per time step of t_eval (i.e. per day)
+(
+    S_, E_, I_, AR_, DHR_, DQR_, AD_, DHD_, DQD_, R_, D_, TH_, DVR_, DVD_, DD_, DT_
+) = range(n_states)  # Indices of the 16 states in the model's state vector
+
+
+def integrate_fixed_step_rk4(fun, y0, t_eval: list, n_substeps: int = default_n_substeps) -> OptimizeResult:
+    """
+    Integrates an ODE system with the classical 4th order Runge-Kutta scheme and a fixed step size, directly on the
+    time grid of t_eval (no step size control and no dense output interpolation), the state being any numpy array
+    :param fun: right-hand side of the system, called as fun(t, y)
+    :param y0: initial conditions
+    :param t_eval: time steps at which the solution is stored, the integration goes from the first to the last one
+    :param n_substeps: number of fixed steps in between two consecutive time steps of t_eval
+    :return: an OptimizeResult with the same main fields as the OdeResult returned by solve_ivp (t, y, nfev, status,
+    message and success), status being -1 if the solution diverged (in which case t and y are truncated)
+    """
+    t_eval = np.asarray(t_eval, dtype=float)
+    y = np.array(y0, dtype=float)
+    ys = np.zeros(y.shape + (len(t_eval),))
+    ys[..., 0] = y
+    status, message = 0, "The solver successfully reached the end of the integration interval."
+    for n in range(len(t_eval) - 1):
+        h = (t_eval[n + 1] - t_eval[n]) / n_substeps
+        t = t_eval[n]
+        for _ in range(n_substeps):
+            k1 = fun(t, y)
+            k2 = fun(t + h / 2, y + h / 2 * k1)
+            k3 = fun(t + h / 2, y + h / 2 * k2)
+            k4 = fun(t + h, y + h * k3)
+            y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            t = t + h
+        if not np.all(np.isfinite(y)):
+            status, message = -1, f"The solution diverged at t={t_eval[n + 1]}, the step size is too large."
+            t_eval, ys = t_eval[:n + 1], ys[..., :n + 1]
+            break
+        ys[..., n + 1] = y
+    return OptimizeResult(
+        t=t_eval, y=ys, nfev=4 * n_substeps * (len(t_eval) - 1), status=status, message=message, success=status >= 0
+    )
+
+
+def get_rk4_propagators(A: np.ndarray, h: float) -> (np.ndarray, np.ndarray):
+    """
+    Writes one step of the classical RK4 scheme on the linear system dx/dt = A x + f(t) as the linear recurrence
+    x(t + h) = P x(t) + G [f_1; f_2; f_3; f_4], where f_1, ..., f_4 are the forcings evaluated at the 4 stages
+    :param A: constant matrix of the linear system, of shape (n, n)
+    :param h: step size
+    :return: the propagators P of shape (n, n) and G of shape (n, 4 * n)
+    """
+    identity = np.eye(len(A))
+    zero = np.zeros_like(identity)
+    stage_steps = [0, h / 2, h / 2, h]
+    weights = np.array([1, 2, 2, 1]) * h / 6
+    # Each stage derivative k_i as the list of its linear maps applied to x and to f_1, ..., f_4
+    stage_derivatives = []
+    for i in range(4):
+        stage_states = [identity] + [zero] * 4
+        if i > 0:
+            stage_states = [stage_states[m] + stage_steps[i] * stage_derivatives[i - 1][m] for m in range(5)]
+        stage_derivative = [A @ stage_state for stage_state in stage_states]
+        stage_derivative[i + 1] = stage_derivative[i + 1] + identity
+        stage_derivatives.append(stage_derivative)
+    propagators = [
+        (identity if m == 0 else zero) + sum(weights[i] * stage_derivatives[i][m] for i in range(4)) for m in range(5)
+    ]
+    return propagators[0], np.hstack(propagators[1:])
+
+def solve_linear_recurrence(
+        propagators: list, propagator_index: np.ndarray, forcings: np.ndarray, x_0: np.ndarray, block_size: int = 16
+) -> np.ndarray:
+    """
+    Solves the linear recurrence x_{n+1} = P_n x_n + g_n. When all the steps share the same propagator P, it is
+    solved by blocks of steps instead of step by step: within a block starting from x_b,
+    x_{b+j+1} = P^{j+1} x_b + sum_{k <= j} P^{j-k} g_{b+k}, which is a single product with a block lower-triangular
+    matrix of the powers of P
+    :param propagators: list of the distinct propagators P, of shape (n, n)
+    :param propagator_index: index in propagators of the propagator of each step, of shape (N,)
+    :param forcings: forcings g_n of shape (N, n)
+    :param x_0: initial value of shape (n,)
+    :param block_size: number of steps per block
+    :return: array of shape (N + 1, n) with x_0, ..., x_N
+    """
+    n_steps, n = forcings.shape
+    xs = np.zeros((n_steps + 1, n))
+    xs[0] = x_0
+    if len(propagators) == 1 and np.all(np.isfinite(forcings)):
+        block_size = max(min(block_size, n_steps), 1)
+        powers = [np.eye(n)]
+        for _ in range(block_size):
+            powers.append(propagators[0] @ powers[-1])
+        powers = np.array(powers)
+        lags = np.subtract.outer(np.arange(block_size), np.arange(block_size))
+        kernel = np.where((lags >= 0)[:, :, None, None], powers[np.maximum(lags, 0)], 0)
+        kernel = kernel.transpose(0, 2, 1, 3).reshape(block_size * n, block_size * n)
+        if np.all(np.isfinite(kernel)):
+            for b in range(0, n_steps, block_size):
+                m = min(block_size, n_steps - b)
+                xs[b + 1:b + m + 1] = powers[1:m + 1] @ xs[b] + (
+                    kernel[:m * n, :m * n] @ forcings[b:b + m].ravel()
+                ).reshape(m, n)
+            return xs
+    # Step by step otherwise, e.g. when the powers of P overflow with a step size far too large
+    for i, index in enumerate(propagator_index.tolist()):
+        xs[i + 1] = propagators[index] @ xs[i] + forcings[i]
+    return xs
+
+class DELPHIODEModel:
+    """
+    SEIR based model with 16 distinct states, taking into account undetected, deaths, hospitalized and recovered, and
+    using an ArcTan government response curve, corrected with a Gaussian jump in case of a resurgence in cases.
+    The states are the following
+    [0 S, 1 E, 2 I, 3 UR, 4 DHR, 5 DQR, 6 UD, 7 DHD, 8 DQD, 9 R, 10 D, 11 TH, 12 DVR,13 DVD, 14 DD, 15 DT]
+    Apart from the infection term alpha * gamma(t) * S * I / N, the system is linear in the states, so the right-hand
+    side is written as dx/dt = (M_0 + p_dth_mod(t) * M_1) x + alpha * gamma(t) * S * I / N * (-e_S + e_E), where M_0
+    and M_1 only depend on the area (population, fixed rates) and on r_dth. The fixed part is built once per area in
+    the constructor, the parameter-dependent part once per parameter vector in set_params, so that each RHS call is
+    reduced to one small matrix product and a couple of scalar transcendental functions.
+    """
+    def __init__(
+            self, N: float, p_d: float = p_d, p_h: float = p_h, p_v: float = p_v, p_dth_floor: float = 0.001,
+    ):
+        """
+        :param N: population of the area
+        :param p_d: percentage of infection cases detected
+        :param p_h: percentage of detected cases hospitalized
+        :param p_v: percentage of hospitalized patients ventilated
+        :param p_dth_floor: asymptotic value of the mortality percentage p_dth_mod(t) (0.001 for the fitting
+        process, 0.01 for the policy predictions)
+        """
+        self.N = N
+        self.p_d = p_d
+        self.p_h = p_h
+        self.p_v = p_v
+        self.p_dth_floor = p_dth_floor
+        # Linear part that doesn't depend on the fitted parameters
+        M_fixed = np.zeros((n_states, n_states))
+        M_fixed[E_, E_] = -r_i
+        M_fixed[I_, E_] = r_i
+        M_fixed[I_, I_] = -r_d
+        M_fixed[AR_, AR_] = -r_ri
+        M_fixed[DHR_, DHR_] = -r_rh
+        M_fixed[DQR_, DQR_] = -r_ri
+        M_fixed[R_, [AR_, DQR_]] = r_ri
+        M_fixed[R_, DHR_] = r_rh
+        M_fixed[DVR_, DVR_] = -r_rv
+        M_fixed[AR_, I_] = r_d * (1 - p_d)
+        M_fixed[DHR_, I_] = r_d * p_d * p_h
+        M_fixed[DQR_, I_] = r_d * p_d * (1 - p_h)
+        M_fixed[TH_, I_] = r_d * p_d * p_h
+        M_fixed[DVR_, I_] = r_d * p_d * p_h * p_v
+        M_fixed[DT_, I_] = r_d * p_d
+        # Linear part proportional to the rate of death r_dth
+        M_dth = np.zeros((n_states, n_states))
+        M_dth[[AD_, DHD_, DQD_, DVD_], [AD_, DHD_, DQD_, DVD_]] = -1
+        M_dth[D_, [AD_, DQD_, DHD_]] = 1
+        M_dth[DD_, [DHD_, DQD_]] = 1
+        # Linear part proportional to the mortality percentage p_dth_mod(t), only acting through I
+        M_pdth = np.zeros((n_states, n_states))
+        M_pdth[[AR_, AD_], I_] = -r_d * (1 - p_d), r_d * (1 - p_d)
+        M_pdth[[DHR_, DHD_], I_] = -r_d * p_d * p_h, r_d * p_d * p_h
+        M_pdth[[DQR_, DQD_], I_] = -r_d * p_d * (1 - p_h), r_d * p_d * (1 - p_h)
+        M_pdth[[DVR_, DVD_], I_] = -r_d * p_d * p_h * p_v, r_d * p_d * p_h * p_v
+        self.M_fixed = M_fixed
+        self.M_dth = M_dth
+        self.M_pdth = M_pdth
+        self.n_model_states = n_states
+        # Sparsity structure of the Jacobian: linear part, plus the infection term depending on S and I
+        jac_sparsity = (M_fixed != 0) | (M_dth != 0) | (M_pdth != 0)
+        jac_sparsity[np.ix_([S_, E_], [S_, I_])] = True
+        self.jac_sparsity = csc_matrix(jac_sparsity.astype(float))
+        self.params = None
+
+    def set_params(self, params) -> "DELPHIODEModel":
+        """
+        Binds a parameter vector to the model and precomputes everything in the right-hand side that only depends on
+        the parameters, to be called once before each integration
+        :param params: the 12 DELPHI parameters (alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump,
+        std_normal, k3)
+        :return: the model itself, so that calls can be chained
+        """
+        alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3 = params
+        self.params = tuple(params)
+        self.alpha_over_N = alpha / self.N
+        self.days = days
+        self.r_s = r_s
+        self.r_s_20 = r_s / 20
+        self.jump = jump
+        self.t_jump = t_jump
+        self.std_normal = std_normal
+        self.two_var_normal = 2 * std_normal ** 2
+        self.r_dthdecay_20 = r_dthdecay / 20
+        self.p_dth_amplitude = (2 / np.pi) * (p_dth - self.p_dth_floor)
+        self.r_dth = r_dth
+        M_0 = self.M_fixed + r_dth * self.M_dth + (self.p_dth_floor + self.p_dth_amplitude * np.pi / 2) * self.M_pdth
+        # Stacked so that a single matrix product gives both the constant part and the part scaled by p_dth_mod(t)
+        self.M_stacked = np.vstack([M_0, self.p_dth_amplitude * self.M_pdth])
+        return self
+
+    def gamma_t(self, t: float) -> float:
+        """
+        Government response curve (arctan) with the Gaussian jump modeling the resurgence in cases
+        :param t: time step
+        :return: value of gamma(t)
+        """
+        return (
+            (2 / np.pi) * math.atan(-(t - self.days) * self.r_s_20) + 1
+            + self.jump * math.exp(-(t - self.t_jump) ** 2 / self.two_var_normal)
+        )
+
+    def gamma_t_grid(self, t: np.ndarray) -> np.ndarray:
+        """
+        Vectorized version of gamma_t on a grid of time steps, to be overridden along with gamma_t
+        :param t: array of time steps
+        :return: array with the values of gamma(t) on the time steps
+        """
+        return (
+            (2 / np.pi) * np.arctan(-(t - self.days) * self.r_s_20) + 1
+            + self.jump * np.exp(-(t - self.t_jump) ** 2 / self.two_var_normal)
+        )
+
+    def rhs(self, t: float, x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Right-hand side of the DELPHI ODE system, works with a single state vector of shape (16,) or a stack of state
+        vectors of shape (16, K) (as used by solve_ivp with vectorized=True)
+        :param t: time step
+        :param x: set of all the states in the model (here, 16 of them)
+        :param out: optional preallocated array with the same shape as x in which the derivatives are written. It is
+        left to None for solve_ivp, whose steppers keep references to the derivatives returned at previous steps
+        :return: derivatives for all 16 states
+        """
+        stacked = self.M_stacked @ x
+        out = np.multiply(math.atan(-t * self.r_dthdecay_20), stacked[self.n_model_states:], out=out)
+        out += stacked[:self.n_model_states]
+        infection = self.alpha_over_N * self.gamma_t(t) * x[S_] * x[I_]
+        out[S_] -= infection
+        out[E_] += infection
+        return out
+
+    def __call__(self, t: float, x: np.ndarray) -> np.ndarray:
+        return self.rhs(t, x)
+
+    def p_dth_mod(self, t: float) -> float:
+        """
+        Mortality percentage, decaying from p_dth to p_dth_floor with an arctan curve
+        :param t: time step
+        :return: value of p_dth_mod(t)
+        """
+        return self.p_dth_amplitude * (math.atan(-t * self.r_dthdecay_20) + np.pi / 2) + self.p_dth_floor
+
+    def jac(self, t: float, x: np.ndarray) -> np.ndarray:
+        """
+        Analytic Jacobian of the right-hand side with respect to the 16 states, with gamma(t) (arctan response and
+        Gaussian jump) and p_dth_mod(t) evaluated at time t
+        :param t: time step
+        :param x: set of all the states in the model (here, 16 of them)
+        :return: dense array of shape (16, 16) with d(dx_i/dt)/dx_j in position (i, j)
+        """
+        jac = (
+            self.M_stacked[:self.n_model_states]
+            + math.atan(-t * self.r_dthdecay_20) * self.M_stacked[self.n_model_states:]
+        )
+        infection_rate = self.alpha_over_N * self.gamma_t(t)
+        d_infection_dS = infection_rate * x[I_]
+        d_infection_dI = infection_rate * x[S_]
+        jac[S_, S_] -= d_infection_dS
+        jac[S_, I_] -= d_infection_dI
+        jac[E_, S_] += d_infection_dS
+        jac[E_, I_] += d_infection_dI
+        return jac
+
+    def jac_sparse(self, t: float, x: np.ndarray) -> csc_matrix:
+        """
+        Sparse variant of the analytic Jacobian, only keeping the entries in the sparsity structure of the system
+        :param t: time step
+        :param x: set of all the states in the model (here, 16 of them)
+        :return: sparse CSC matrix of shape (16, 16)
+        """
+        return self.jac_sparsity.multiply(self.jac(t, x)).tocsc()
+
+    def jac_params(self, t: float, x: np.ndarray) -> np.ndarray:
+        """
+        Analytic derivatives of the right-hand side with respect to the 12 DELPHI parameters (k1, k2 and k3 only
+        enter the initial conditions, so their columns are zero)
+        :param t: time step
+        :param x: set of all the states in the model (here, 16 of them)
+        :return: dense array of shape (16, 12) with d(dx_i/dt)/dparam_j in position (i, j)
+        """
+        jac_params = np.zeros((self.n_model_states, n_params))
+        # Derivatives of gamma(t) with respect to days, r_s, jump, t_jump and std_normal
+        arctan_argument = -(t - self.days) * self.r_s_20
+        d_arctan = (2 / np.pi) / (1 + arctan_argument ** 2)
+        gaussian_jump = math.exp(-(t - self.t_jump) ** 2 / self.two_var_normal)
+        d_gamma = np.array([
+            d_arctan * self.r_s_20,
+            -d_arctan * (t - self.days) / 20,
+            gaussian_jump,
+            self.jump * gaussian_jump * (t - self.t_jump) / self.std_normal ** 2,
+            self.jump * gaussian_jump * (t - self.t_jump) ** 2 / self.std_normal ** 3,
+        ])
+        S_times_I_over_N = x[S_] * x[I_] / self.N
+        d_infection = np.zeros(n_params)
+        d_infection[0] = self.gamma_t(t) * S_times_I_over_N
+        d_infection[[1, 2, 8, 9, 10]] = self.alpha_over_N * x[S_] * x[I_] * d_gamma
+        jac_params[S_] -= d_infection
+        jac_params[E_] += d_infection
+        # Derivatives of the linear part with respect to r_dth, and to p_dth and r_dthdecay through p_dth_mod(t)
+        decay_argument = -t * self.r_dthdecay_20
+        M_pdth_x = self.M_pdth @ x
+        jac_params[:, 3] = self.M_dth @ x
+        jac_params[:, 4] = (2 / np.pi) * (math.atan(decay_argument) + np.pi / 2) * M_pdth_x
+        jac_params[:, 5] = self.p_dth_amplitude * (-t / 20) / (1 + decay_argument ** 2) * M_pdth_x
+        return jac_params
+
+    def rhs_with_sensitivities(self, t: float, z: np.ndarray) -> np.ndarray:
+        """
+        Right-hand side of the forward sensitivity system, i.e. the DELPHI ODE system augmented with the derivatives
+        of the 16 states with respect to the 12 parameters: d(dx/dparams)/dt = J_x(t, x) dx/dparams + J_params(t, x)
+        :param t: time step
+        :param z: the 16 states followed by the flattened (16, 12) matrix of their sensitivities
+        :return: derivatives for the 16 + 16 * 12 augmented states
+        """
+        x = z[:self.n_model_states]
+        sensitivities = z[self.n_model_states:].reshape(self.n_model_states, n_params)
+        d_sensitivities = self.jac(t, x) @ sensitivities + self.jac_params(t, x)
+        return np.concatenate([self.rhs(t, x), d_sensitivities.ravel()])
+
+    def integrate_fixed_step_rk4(
+            self, x_0: list, t_eval: list, n_substeps: int = default_n_substeps
+    ) -> OptimizeResult:
+        """
+        Same fixed-step RK4 scheme as integrate_fixed_step_rk4, taking advantage of the structure of the system to
+        avoid the overhead of 4 calls to the right-hand side per step: S, E and I are the only states in the
+        nonlinear infection term and they don't depend on the other states, which follow linear ODEs with a constant
+        matrix forced by S, E and I. The stages of S, E and I are integrated with scalar arithmetic, then the RK4
+        steps of the other states reduce to the linear recurrence of get_rk4_propagators, whose forcings at all the
+        stages are computed at once. Systems without this structure fall back to integrate_fixed_step_rk4
+        :param x_0: initial conditions for all the states of the model
+        :param t_eval: time steps at which the solution is stored, the integration goes from the first to the last one
+        :param n_substeps: number of fixed steps in between two consecutive time steps of t_eval
+        :return: an OptimizeResult with the same fields as the one returned by integrate_fixed_step_rk4
+        """
+        t_eval = np.asarray(t_eval, dtype=float)
+        x_0 = np.asarray(x_0, dtype=float)
+        nonlinear_states = [S_, E_, I_]
+        linear_states = list(range(I_ + 1, self.n_model_states))
+        M_0 = self.M_stacked[:self.n_model_states]
+        M_1 = self.M_stacked[self.n_model_states:]
+        # Apart from the infection term, E decays into I which decays, and the other states don't feed back into them
+        M_0_nonlinear = M_0[nonlinear_states].copy()
+        r_EE, r_IE, r_II = M_0_nonlinear[[E_, I_, I_], [E_, E_, I_]]
+        M_0_nonlinear[[E_, I_, I_], [E_, E_, I_]] = 0
+        if np.any(M_0_nonlinear) or np.any(M_1[nonlinear_states]) or np.any(M_1[np.ix_(linear_states, linear_states)]):
+            return integrate_fixed_step_rk4(fun=self.rhs, y0=x_0, t_eval=t_eval, n_substeps=n_substeps)
+        n_days = len(t_eval) - 1
+        n_steps = n_days * n_substeps
+        h_steps = np.repeat(np.diff(t_eval) / n_substeps, n_substeps)
+        t_steps = np.append(
+            np.repeat(t_eval[:-1], n_substeps) + np.tile(np.arange(n_substeps), n_days) * h_steps, t_eval[-1]
+        )
+        t_middle = t_steps[:-1] + h_steps / 2
+        infection_rates = self.alpha_over_N * self.gamma_t_grid(np.concatenate([t_steps, t_middle]))
+        infection_rates_start = infection_rates[:n_steps + 1].tolist()
+        infection_rates_middle = infection_rates[n_steps + 1:].tolist()
+
+        # Stages of S, E and I, with scalar arithmetic
+        S, E, I = x_0[nonlinear_states].tolist()
+        list_stages = []
+        list_states = [S, E, I]
+        for h, rate_start, rate_middle, rate_end in zip(
+                h_steps.tolist(), infection_rates_start, infection_rates_middle, infection_rates_start[1:]
+        ):
+            infection = rate_start * S * I
+            k1_S, k1_E, k1_I = -infection, infection + r_EE * E, r_IE * E + r_II * I
+            S_2, E_2, I_2 = S + h / 2 * k1_S, E + h / 2 * k1_E, I + h / 2 * k1_I
+            infection = rate_middle * S_2 * I_2
+            k2_S, k2_E, k2_I = -infection, infection + r_EE * E_2, r_IE * E_2 + r_II * I_2
+            S_3, E_3, I_3 = S + h / 2 * k2_S, E + h / 2 * k2_E, I + h / 2 * k2_I
+            infection = rate_middle * S_3 * I_3
+            k3_S, k3_E, k3_I = -infection, infection + r_EE * E_3, r_IE * E_3 + r_II * I_3
+            S_4, E_4, I_4 = S + h * k3_S, E + h * k3_E, I + h * k3_I
+            infection = rate_end * S_4 * I_4
+            k4_S, k4_E, k4_I = -infection, infection + r_EE * E_4, r_IE * E_4 + r_II * I_4
+            list_stages.extend((S, E, I, S_2, E_2, I_2, S_3, E_3, I_3, S_4, E_4, I_4))
+            S = S + h / 6 * (k1_S + 2 * k2_S + 2 * k3_S + k4_S)
+            E = E + h / 6 * (k1_E + 2 * k2_E + 2 * k3_E + k4_E)
+            I = I + h / 6 * (k1_I + 2 * k2_I + 2 * k3_I + k4_I)
+            list_states.extend((S, E, I))
+
+        # Steps of the other states, forced by the stages of S, E and I
+        stages = np.array(list_stages).reshape(n_steps, 4, len(nonlinear_states))
+        t_stages = np.stack([t_steps[:-1], t_middle, t_middle, t_steps[1:]], axis=1)
+        forcings = (
+            stages @ M_0[np.ix_(linear_states, nonlinear_states)].T
+            + np.arctan(-t_stages * self.r_dthdecay_20)[:, :, None]
+            * (stages @ M_1[np.ix_(linear_states, nonlinear_states)].T)
+        ).reshape(n_steps, -1)
+        A = M_0[np.ix_(linear_states, linear_states)]
+        # Steps equal up to rounding errors (e.g. sub-steps of a day) share their propagators
+        h_unique, h_index = np.unique(np.round(h_steps, 12), return_inverse=True)
+        list_propagators = [get_rk4_propagators(A, h) for h in h_unique]
+        forcings_steps = np.zeros((n_steps, len(linear_states)))
+        for i, (_, propagator_forcing) in enumerate(list_propagators):
+            forcings_steps[h_index == i] = forcings[h_index == i] @ propagator_forcing.T
+        x_linear = solve_linear_recurrence(
+            [propagator_state for propagator_state, _ in list_propagators], h_index, forcings_steps,
+            x_0[linear_states]
+        )
+        ys = np.zeros((self.n_model_states, n_days + 1))
+        ys[linear_states] = x_linear[::n_substeps].T
+        ys[nonlinear_states] = np.array(list_states).reshape(n_steps + 1, len(nonlinear_states))[::n_substeps].T
+
+        status, message = 0, "The solver successfully reached the end of the integration interval."
+        is_diverged = ~np.all(np.isfinite(ys), axis=0)
+        if np.any(is_diverged):
+            n_diverged = np.argmax(is_diverged)
+            status, message = -1, f"The solution diverged at t={t_eval[n_diverged]}, the step size is too large."
+            t_eval, ys = t_eval[:n_diverged], ys[:, :n_diverged]
+        return OptimizeResult(
+            t=t_eval, y=ys, nfev=4 * n_steps, status=status, message=message, success=status >= 0
+        )
+
+    def solve(
+            self, params, x_0: list, t_eval: list, method: str = "RK45", sparse_jacobian: bool = False,
+            n_substeps: int = default_n_substeps, **kwargs_solve_ivp
+    ):
+        """
+        Integrates the DELPHI ODE system with a given parameter vector on a daily time grid
+        :param params: the 12 DELPHI parameters
+        :param x_0: initial conditions for all 16 states
+        :param t_eval: time steps (days) at which the solution is stored, the integration goes from the first to the
+        last one
+        :param method: integration method, either one of solve_ivp (the analytic Jacobian is passed along to the
+        implicit ones: Radau, BDF and LSODA) or the fixed-step RK4 on the grid of t_eval
+        :param sparse_jacobian: whether to use the sparse variant of the Jacobian (only for Radau and BDF, LSODA
+        requires a dense Jacobian)
+        :param n_substeps: number of fixed steps per time step of t_eval (only for RK4)
+        :param kwargs_solve_ivp: additional keyword arguments passed to scipy's solve_ivp
+        :return: the scipy OdeResult object returned by solve_ivp (or an equivalent OptimizeResult for RK4)
+        """
+        if method not in ode_solvers:
+            raise ValueError(f"ODE solver {method} not supported, should be one of {ode_solvers}")
+        self.set_params(params)
+        if method in ode_solvers_fixed_step:
+            return self.integrate_fixed_step_rk4(x_0=x_0, t_eval=t_eval, n_substeps=n_substeps)
+        if method in ode_solvers_with_jacobian:
+            if sparse_jacobian and method != "LSODA":
+                kwargs_solve_ivp["jac"] = self.jac_sparse
+            else:
+                kwargs_solve_ivp["jac"] = self.jac
+        return solve_ivp(
+            fun=self.rhs,
+            y0=x_0,
+            t_span=[t_eval[0], t_eval[-1]],
+            t_eval=t_eval,
+            method=method,
+            **kwargs_solve_ivp,
+        )
+
+    def solve_with_sensitivities(
+            self, params, x_0: list, dx_0_dparams: np.ndarray, t_eval: list, method: str = "RK45",
+            n_substeps: int = default_n_substeps, **kwargs_solve_ivp
+    ):
+        """
+        Integrates the DELPHI ODE system together with its forward sensitivity equations, which gives the exact
+        derivatives of the trajectories with respect to the parameters in a single integration (instead of one
+        additional integration per parameter with finite differences)
+        :param params: the 12 DELPHI parameters
+        :param x_0: initial conditions for all 16 states
+        :param dx_0_dparams: derivatives of the initial conditions with respect to the 12 parameters, shape (16, 12)
+        :param t_eval: time steps (days) at which the solution is stored, the integration goes from the first to the
+        last one
+        :param method: integration method, either one of solve_ivp (the Jacobian of the augmented system is not
+        provided to the implicit methods) or the fixed-step RK4 on the grid of t_eval
+        :param n_substeps: number of fixed steps per time step of t_eval (only for RK4)
+        :param kwargs_solve_ivp: additional keyword arguments passed to scipy's solve_ivp
+        :return: the scipy OdeResult object returned by solve_ivp, where y only contains the 16 states and the
+        sensitivities of shape (16, 12, T) are stored under the key sensitivities
+        """
+        if method not in ode_solvers:
+            raise ValueError(f"ODE solver {method} not supported, should be one of {ode_solvers}")
+        self.set_params(params)
+        z_0 = np.concatenate([np.asarray(x_0, dtype=float), np.asarray(dx_0_dparams, dtype=float).ravel()])
+        if method in ode_solvers_fixed_step:
+            solution = integrate_fixed_step_rk4(
+                fun=self.rhs_with_sensitivities, y0=z_0, t_eval=t_eval, n_substeps=n_substeps
+            )
+        else:
+            solution = solve_ivp(
+                fun=self.rhs_with_sensitivities,
+                y0=z_0,
+                t_span=[t_eval[0], t_eval[-1]],
+                t_eval=t_eval,
+                method=method,
+                **kwargs_solve_ivp,
+            )
+        solution.sensitivities = solution.y[self.n_model_states:].reshape(self.n_model_states, n_params, -1)
+        solution.y = solution.y[:self.n_model_states]
+        return solution
+
+
+class DELPHIODEModelReduced(DELPHIODEModel):
+    """
+    Reduced version of the DELPHI ODE system used for fitting, which only integrates the core states needed by the
+    loss function: S, E, I, the detected deaths compartments DHD and DQD, and the cumulative DD and DT. None of the
+    other compartments feeds back into these 7 states, so the core system is closed. The other 9 compartments only
+    depend on the core states through linear ODEs with constant decay rates, and are reconstructed afterwards (for the
+    final predictions) by convolution of the core trajectories with their exponential kernels.
+    """
+    core_states = [S_, E_, I_, DHD_, DQD_, DD_, DT_]
+    derived_states = [AR_, DHR_, DQR_, AD_, R_, D_, TH_, DVR_, DVD_]
+
+    def __init__(self, N: float, n_substeps_reconstruction: int = 10, **kwargs):
+        """
+        :param N: population of the area
+        :param n_substeps_reconstruction: number of sub-steps per time step of t_eval on which the core states are
+        sampled for the convolution giving the derived states
+        :param kwargs: fixed percentages p_d, p_h, p_v and p_dth_floor, see DELPHIODEModel
+        """
+        super().__init__(N=N, **kwargs)
+        self.n_substeps_reconstruction = n_substeps_reconstruction
+        core, derived = self.core_states, self.derived_states
+        # Blocks of the linear part giving the derived states: constant decay between derived states, and forcing by
+        # the core states (the infection term only acts on S and E, which are core states)
+        self.A_fixed = self.M_fixed[np.ix_(derived, derived)]
+        self.A_dth = self.M_dth[np.ix_(derived, derived)]
+        self.B_fixed = self.M_fixed[np.ix_(derived, core)]
+        self.B_dth = self.M_dth[np.ix_(derived, core)]
+        self.B_pdth = self.M_pdth[np.ix_(derived, core)]
+        # The reduced system is the restriction of the full system to the core states
+        self.M_fixed = self.M_fixed[np.ix_(core, core)]
+        self.M_dth = self.M_dth[np.ix_(core, core)]
+        self.M_pdth = self.M_pdth[np.ix_(core, core)]
+        self.jac_sparsity = csc_matrix(self.jac_sparsity.toarray()[np.ix_(core, core)])
+        self.n_model_states = len(core)
+
+    def expand_states(self, x_core: np.ndarray) -> np.ndarray:
+        """
+        Places the core states in an array indexed like the full 16 states, the derived states being left to NaN
+        :param x_core: array whose first axis contains the 7 core states
+        :return: array whose first axis contains the 16 states of the model
+        """
+        x = np.full((n_states,) + x_core.shape[1:], np.nan)
+        x[self.core_states] = x_core
+        return x
+
+    def reconstruct_derived_states(self, t: np.ndarray, x_core: np.ndarray, x_0_derived: np.ndarray) -> np.ndarray:
+        """
+        Computes the derived states from the trajectories of the core states: on each time step, the forcing by the
+        core states is linearly interpolated and the linear system with constant matrix A is solved exactly
+        (y(t + h) = e^{A h} y(t) + integral of e^{A (t + h - s)} f(s) ds), using Van Loan's block matrix exponential
+        :param t: time steps on which the core states are sampled
+        :param x_core: core states on these time steps, of shape (7, T)
+        :param x_0_derived: initial conditions of the 9 derived states
+        :return: derived states on the same time steps, of shape (9, T)
+        """
+        A = self.A_fixed + self.r_dth * self.A_dth
+        p_dth_mod_t = self.p_dth_amplitude * (np.arctan(-t * self.r_dthdecay_20) + np.pi / 2) + self.p_dth_floor
+        forcing = (self.B_fixed + self.r_dth * self.B_dth) @ x_core + p_dth_mod_t * (self.B_pdth @ x_core)
+        n_derived = len(self.derived_states)
+        propagators = {}
+        x_derived = np.zeros((n_derived, len(t)))
+        x_derived[:, 0] = x_0_derived
+        for n, h in enumerate(np.diff(t)):
+            if h not in propagators:
+                van_loan_matrix = np.zeros((3 * n_derived, 3 * n_derived))
+                van_loan_matrix[:n_derived, :n_derived] = A * h
+                van_loan_matrix[:n_derived, n_derived:2 * n_derived] = np.eye(n_derived) * h
+                van_loan_matrix[n_derived:2 * n_derived, 2 * n_derived:] = np.eye(n_derived) * h
+                exponential = expm(van_loan_matrix)
+                propagators[h] = (
+                    exponential[:n_derived, :n_derived],
+                    exponential[:n_derived, n_derived:2 * n_derived],
+                    exponential[:n_derived, 2 * n_derived:] / h,
+                )
+            propagator_state, propagator_forcing, propagator_slope = propagators[h]
+            x_derived[:, n + 1] = (
+                propagator_state @ x_derived[:, n]
+                + propagator_forcing @ forcing[:, n]
+                + propagator_slope @ (forcing[:, n + 1] - forcing[:, n])
+            )
+        return x_derived
+
+    def solve(
+            self, params, x_0: list, t_eval: list, method: str = "RK45", sparse_jacobian: bool = False,
+            reconstruct: bool = False, **kwargs_solve_ivp
+    ):
+        """
+        Integrates the core states of the DELPHI ODE system with a given parameter vector on a daily time grid
+        :param params: the 12 DELPHI parameters
+        :param x_0: initial conditions for all 16 states
+        :param t_eval: time steps (days) at which the solution is stored, the integration goes from the first to the
+        last one
+        :param method: integration method, either one of solve_ivp or the fixed-step RK4
+        :param sparse_jacobian: whether to use the sparse variant of the Jacobian (only for Radau and BDF)
+        :param reconstruct: whether to reconstruct the derived states, otherwise they are left to NaN
+        :param kwargs_solve_ivp: additional keyword arguments passed to DELPHIODEModel.solve
+        :return: the scipy OdeResult object returned by solve_ivp, where y contains the 16 states
+        """
+        x_0 = np.asarray(x_0, dtype=float)
+        t_eval = np.asarray(t_eval, dtype=float)
+        if reconstruct:
+            # Sampling the core states on a finer grid for the convolution, keeping the points of t_eval
+            t_solve = np.append(
+                t_eval[:-1, None] + np.outer(np.diff(t_eval), np.arange(self.n_substeps_reconstruction))
+                / self.n_substeps_reconstruction,
+                t_eval[-1],
+            )
+        else:
+            t_solve = t_eval
+        solution = super().solve(
+            params, x_0=x_0[self.core_states], t_eval=t_solve, method=method, sparse_jacobian=sparse_jacobian,
+            **kwargs_solve_ivp
+        )
+        x_sol = self.expand_states(solution.y)
+        if reconstruct and solution.status == 0:
+            x_sol[self.derived_states] = self.reconstruct_derived_states(
+                t=t_solve, x_core=solution.y, x_0_derived=x_0[self.derived_states]
+            )
+            x_sol = x_sol[:, ::self.n_substeps_reconstruction]
+            solution.t = solution.t[::self.n_substeps_reconstruction]
+        solution.y = x_sol
+        return solution
+
+    def solve_with_sensitivities(
+            self, params, x_0: list, dx_0_dparams: np.ndarray, t_eval: list, method: str = "RK45",
+            **kwargs_solve_ivp
+    ):
+        """
+        Integrates the core states of the DELPHI ODE system together with their forward sensitivity equations
+        :param params: the 12 DELPHI parameters
+        :param x_0: initial conditions for all 16 states
+        :param dx_0_dparams: derivatives of the initial conditions with respect to the 12 parameters, shape (16, 12)
+        :param t_eval: time steps (days) at which the solution is stored
+        :param method: integration method, either one of solve_ivp or the fixed-step RK4
+        :param kwargs_solve_ivp: additional keyword arguments passed to DELPHIODEModel.solve_with_sensitivities
+        :return: the scipy OdeResult object returned by solve_ivp, where y contains the 16 states and the
+        sensitivities of shape (16, 12, T) are stored under the key sensitivities (NaN for the derived states)
+        """
+        solution = super().solve_with_sensitivities(
+            params, x_0=np.asarray(x_0, dtype=float)[self.core_states],
+            dx_0_dparams=np.asarray(dx_0_dparams, dtype=float)[self.core_states], t_eval=t_eval, method=method,
+            **kwargs_solve_ivp
+        )
+        solution.y = self.expand_states(solution.y)
+        solution.sensitivities = self.expand_states(solution.sensitivities)
+        return solution
+
+
+class DELPHIPolicyGammaSchedule:
+    """
+    Government response curve gamma(t) of one or several policy scenarios: after the enaction time of the future
+    policy, gamma(t) is shifted by a constant which only depends on the parameters, the enaction time and the
+    normalized gammas of the future and current policies. The shifts are computed once when the schedule is built
+    (i.e. once per set of parameters), so that evaluating gamma(t) in the right-hand side only adds the shift to the
+    response curve without policy
+    """
+    epsilon = 1e-4
+
+    def __init__(
+            self, gamma_t, t_future_policy, normalized_gamma_future_policy, normalized_gamma_current_policy
+    ):
+        """
+        :param gamma_t: response curve without policy, function of the time step returning a float or an array of
+        shape (K,) (e.g. gamma_t of a model whose parameters are set)
+        :param t_future_policy: time steps after which the future policies are enacted, float or array of shape (K,)
+        :param normalized_gamma_future_policy: normalized gamma shifts of the policies enacted in the future, float
+        or array of shape (K,)
+        :param normalized_gamma_current_policy: normalized gamma shift of the policy currently in place in the area,
+        float or array of shape (K,)
+        """
+        self.gamma_t = gamma_t
+        self.t_future_policy = t_future_policy
+        gamma_t_future = gamma_t(t_future_policy)
+        self.policy_shift = np.minimum(
+            (2 - gamma_t_future) / (1 - normalized_gamma_future_policy + self.epsilon),
+            (gamma_t_future / normalized_gamma_current_policy) *
+            (normalized_gamma_future_policy - normalized_gamma_current_policy)
+        )
+
+    def __call__(self, t):
+        """
+        :param t: time step
+        :return: value of gamma(t) for each scenario, including the shift of the future policy after its enaction time
+        """
+        if self.policy_shift.ndim == 0:  # Single scenario, as in DELPHIODEModelPolicy
+            return self.gamma_t(t) + (self.policy_shift if t > self.t_future_policy else 0)
+        return self.gamma_t(t) + np.where(t > self.t_future_policy, self.policy_shift, 0)
+
+
+class DELPHIODEModelPolicy(DELPHIODEModel):
+    """
+    DELPHI ODE system used for the policy predictions: after a given enaction time, gamma(t) is shifted according to
+    the normalized gamma of the policy implemented in the future compared to the current policy in the area
+    """
+    def __init__(
+            self, N: float, t_future_policy: float, normalized_gamma_future_policy: float,
+            normalized_gamma_current_policy: float, p_dth_floor: float = 0.01, **kwargs
+    ):
+        """
+        :param N: population of the area
+        :param t_future_policy: time step after which the future policy is enacted
+        :param normalized_gamma_future_policy: normalized gamma shift of the policy enacted in the future
+        :param normalized_gamma_current_policy: normalized gamma shift of the policy currently in place in the area
+        :param p_dth_floor: asymptotic value of the mortality percentage p_dth_mod(t)
+        """
+        super().__init__(N=N, p_dth_floor=p_dth_floor, **kwargs)
+        self.t_future_policy = t_future_policy
+        self.normalized_gamma_future_policy = normalized_gamma_future_policy
+        self.normalized_gamma_current_policy = normalized_gamma_current_policy
+        self.gamma_schedule = None
+
+    def set_params(self, params) -> "DELPHIODEModelPolicy":
+        super().set_params(params)
+        self.gamma_schedule = DELPHIPolicyGammaSchedule(
+            gamma_t=super().gamma_t, t_future_policy=self.t_future_policy,
+            normalized_gamma_future_policy=self.normalized_gamma_future_policy,
+            normalized_gamma_current_policy=self.normalized_gamma_current_policy,
+        )
+        return self
+
+    def gamma_t(self, t: float) -> float:
+        return self.gamma_schedule(t)
+
+    def gamma_t_grid(self, t: np.ndarray) -> np.ndarray:
+        return super().gamma_t_grid(t) + np.where(t > self.t_future_policy, self.gamma_schedule.policy_shift, 0)
+
+
+class DELPHIODEEnsemble(DELPHIODEModel):
+    """
+    Batched version of the DELPHI ODE system, integrating K parameter vectors (and K initial conditions) in a single
+    call: the K state vectors are stacked in a (16, K) array, flattened for solve_ivp, and every term of the right-hand
+    side is computed for the K members at once with vectorized NumPy arithmetic. This amortizes the Python overhead
+    of the integrator over the K members (policy scenarios, perturbed parameters, candidate solutions...).
+    Note that the K members share the same adaptive time steps, the step size control being done on the whole stack.
+    """
+    def __init__(self, N, p_dth_floor: float = 0.001, **kwargs):
+        """
+        :param N: population of the area, either a float shared by all members or an array of shape (K,)
+        :param p_dth_floor: asymptotic value of the mortality percentage p_dth_mod(t)
+        :param kwargs: fixed percentages p_d, p_h and p_v, see DELPHIODEModel
+        """
+        super().__init__(N=N, p_dth_floor=p_dth_floor, **kwargs)
+        # Single matrix product giving the constant part, the part scaled by r_dth and the part scaled by p_dth_mod(t)
+        self.M_all = np.vstack([self.M_fixed, self.M_dth, self.M_pdth])
+        jac_rows, jac_cols = self.jac_sparsity.nonzero()
+        self.jac_rows = jac_rows
+        self.jac_cols = jac_cols
+        pattern_position = {(i, j): n for n, (i, j) in enumerate(zip(jac_rows, jac_cols))}
+        self.jac_positions_infection = [
+            pattern_position[(S_, S_)], pattern_position[(S_, I_)], pattern_position[(E_, S_)],
+            pattern_position[(E_, I_)]
+        ]
+        self.n_members = None
+
+    def set_params(self, params) -> "DELPHIODEEnsemble":
+        """
+        Binds a matrix of parameter vectors to the ensemble and precomputes everything in the right-hand side that
+        only depends on the parameters, to be called once before each integration
+        :param params: array of shape (K, 12), each row being the 12 DELPHI parameters of one member
+        :return: the ensemble itself, so that calls can be chained
+        """
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        if params.shape[1] != n_params:
+            raise ValueError(f"Parameters should be of shape (K, {n_params}), got {params.shape}")
+        alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3 = params.T
+        self.params = params
+        self.n_members = params.shape[0]
+        self.alpha_over_N = alpha / self.N
+        self.days = days
+        self.r_s_20 = r_s / 20
+        self.jump = jump
+        self.t_jump = t_jump
+        self.two_var_normal = 2 * std_normal ** 2
+        self.r_dthdecay_20 = r_dthdecay / 20
+        self.p_dth_amplitude = (2 / np.pi) * (p_dth - self.p_dth_floor)
+        self.r_dth = r_dth
+        # Flattened (row-major) indices of the Jacobian's structural non-zeros for the stacked system
+        members = np.arange(self.n_members)
+        self.jac_rows_stacked = (self.jac_rows[:, None] * self.n_members + members).ravel()
+        self.jac_cols_stacked = (self.jac_cols[:, None] * self.n_members + members).ravel()
+        return self
+
+    def gamma_t(self, t) -> np.ndarray:
+        """
+        Government response curve (arctan) with the Gaussian jump modeling the resurgence in cases
+        :param t: time step, either a float or an array of shape (K,)
+        :return: array of shape (K,) with the value of gamma(t) for each member
+        """
+        return (
+            (2 / np.pi) * np.arctan(-(t - self.days) * self.r_s_20) + 1
+            + self.jump * np.exp(-(t - self.t_jump) ** 2 / self.two_var_normal)
+        )
+
+    def p_dth_mod(self, t: float) -> np.ndarray:
+        """
+        Mortality percentage, decaying from p_dth to p_dth_floor with an arctan curve
+        :param t: time step
+        :return: array of shape (K,) with the value of p_dth_mod(t) for each member
+        """
+        return self.p_dth_amplitude * (np.arctan(-t * self.r_dthdecay_20) + np.pi / 2) + self.p_dth_floor
+
+    def rhs(self, t: float, x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Right-hand side of the stacked DELPHI ODE system
+        :param t: time step
+        :param x: stacked states of the K members, either of shape (16, K) or flattened to (16 * K,)
+        :param out: optional preallocated array with the same shape as x in which the derivatives are written
+        :return: derivatives for all 16 states of the K members, with the same shape as x
+        """
+        x_stacked = x.reshape(n_states, self.n_members)
+        linear_parts = self.M_all @ x_stacked
+        derivatives = (
+            linear_parts[:n_states]
+            + self.r_dth * linear_parts[n_states:2 * n_states]
+            + self.p_dth_mod(t) * linear_parts[2 * n_states:]
+        )
+        infection = self.alpha_over_N * self.gamma_t(t) * x_stacked[S_] * x_stacked[I_]
+        derivatives[S_] -= infection
+        derivatives[E_] += infection
+        if out is None:
+            return derivatives.reshape(x.shape)
+        out[...] = derivatives.reshape(x.shape)
+        return out
+
+    def jac_sparse(self, t: float, x: np.ndarray) -> csc_matrix:
+        """
+        Analytic Jacobian of the flattened stacked system, which is block diagonal (one 16x16 block per member) up to
+        the interleaving of the members in the flattened state vector
+        :param t: time step
+        :param x: stacked states of the K members, flattened to (16 * K,)
+        :return: sparse CSC matrix of shape (16 * K, 16 * K)
+        """
+        x_stacked = x.reshape(n_states, self.n_members)
+        rows, cols = self.jac_rows, self.jac_cols
+        values = (
+            self.M_fixed[rows, cols][:, None]
+            + self.M_dth[rows, cols][:, None] * self.r_dth
+            + self.M_pdth[rows, cols][:, None] * self.p_dth_mod(t)
+        )
+        infection_rate = self.alpha_over_N * self.gamma_t(t)
+        d_infection_dS = infection_rate * x_stacked[I_]
+        d_infection_dI = infection_rate * x_stacked[S_]
+        position_SS, position_SI, position_ES, position_EI = self.jac_positions_infection
+        values[position_SS] -= d_infection_dS
+        values[position_SI] -= d_infection_dI
+        values[position_ES] += d_infection_dS
+        values[position_EI] += d_infection_dI
+        size = n_states * self.n_members
+        return csc_matrix(
+            (values.ravel(), (self.jac_rows_stacked, self.jac_cols_stacked)), shape=(size, size)
+        )
+
+    def jac(self, t: float, x: np.ndarray) -> np.ndarray:
+        """
+        Dense variant of the analytic Jacobian of the flattened stacked system (as required by LSODA)
+        :param t: time step
+        :param x: stacked states of the K members, flattened to (16 * K,)
+        :return: dense array of shape (16 * K, 16 * K)
+        """
+        return self.jac_sparse(t, x).toarray()
+
+    def solve(
+            self, params, x_0, t_eval: list, method: str = "RK45", sparse_jacobian: bool = True,
+            n_substeps: int = default_n_substeps, **kwargs_solve_ivp
+    ) -> np.ndarray:
+        """
+        Integrates the K members of the ensemble on a daily time grid in a single solve_ivp call
+        :param params: array of shape (K, 12) with the DELPHI parameters of each member
+        :param x_0: array of shape (K, 16) with the initial conditions of each member, or of shape (16,) if they
+        are shared by all members
+        :param t_eval: time steps (days) at which the solution is stored, the integration goes from the first to the
+        last one
+        :param method: integration method, either one of solve_ivp (the analytic Jacobian is passed along to the
+        implicit ones: Radau, BDF and LSODA) or the fixed-step RK4 on the grid of t_eval
+        :param sparse_jacobian: whether to use the sparse variant of the Jacobian (only for Radau and BDF, LSODA
+        requires a dense Jacobian)
+        :param n_substeps: number of fixed steps per time step of t_eval (only for RK4)
+        :param kwargs_solve_ivp: additional keyword arguments passed to scipy's solve_ivp
+        :return: array of shape (K, 16, T) with the trajectories of the K members on the T time steps of t_eval
+        """
+        if method not in ode_solvers:
+            raise ValueError(f"ODE solver {method} not supported, should be one of {ode_solvers}")
+        self.set_params(params)
+        x_0 = np.broadcast_to(np.asarray(x_0, dtype=float), (self.n_members, n_states))
+        if method in ode_solvers_fixed_step:
+            solution = integrate_fixed_step_rk4(
+                fun=self.rhs, y0=x_0.T.ravel(), t_eval=t_eval, n_substeps=n_substeps
+            )
+        else:
+            if method in ode_solvers_with_jacobian:
+                if sparse_jacobian and method != "LSODA":
+                    kwargs_solve_ivp["jac"] = self.jac_sparse
+                else:
+                    kwargs_solve_ivp["jac"] = self.jac
+            solution = solve_ivp(
+                fun=self.rhs,
+                y0=x_0.T.ravel(),
+                t_span=[t_eval[0], t_eval[-1]],
+                t_eval=t_eval,
+                method=method,
+                **kwargs_solve_ivp,
+            )
+        if not solution.success:
+            raise ValueError(f"Integration of the ensemble failed: {solution.message}")
+        return solution.y.reshape(n_states, self.n_members, -1).transpose(1, 0, 2)
+
+
+class DELPHIODEEnsemblePolicy(DELPHIODEEnsemble):
+    """
+    Batched version of DELPHIODEModelPolicy, where each member has its own policy enaction time and future policy
+    (e.g. the grid of policy scenarios for one area)
+    """
+    def __init__(
+            self, N, t_future_policy, normalized_gamma_future_policy, normalized_gamma_current_policy,
+            p_dth_floor: float = 0.01, **kwargs
+    ):
+        """
+        :param N: population of the area, either a float shared by all members or an array of shape (K,)
+        :param t_future_policy: time steps after which the future policies are enacted, float or array of shape (K,)
+        :param normalized_gamma_future_policy: normalized gamma shifts of the policies enacted in the future, float
+        or array of shape (K,)
+        :param normalized_gamma_current_policy: normalized gamma shift of the policy currently in place in the area,
+        float or array of shape (K,)
+        :param p_dth_floor: asymptotic value of the mortality percentage p_dth_mod(t)
+        """
+        super().__init__(N=N, p_dth_floor=p_dth_floor, **kwargs)
+        self.t_future_policy = np.asarray(t_future_policy, dtype=float)
+        self.normalized_gamma_future_policy = np.asarray(normalized_gamma_future_policy, dtype=float)
+        self.normalized_gamma_current_policy = np.asarray(normalized_gamma_current_policy, dtype=float)
+        self.gamma_schedule = None
+
+    def set_params(self, params) -> "DELPHIODEEnsemblePolicy":
+        super().set_params(params)
+        self.gamma_schedule = DELPHIPolicyGammaSchedule(
+            gamma_t=super().gamma_t, t_future_policy=self.t_future_policy,
+            normalized_gamma_future_policy=self.normalized_gamma_future_policy,
+            normalized_gamma_current_policy=self.normalized_gamma_current_policy,
+        )
+        return self
+
+    def gamma_t(self, t) -> np.ndarray:
+        return self.gamma_schedule(t)
+
+
+class DELPHIODEPolicyScenarios:
+    """
+    Scenario engine for the grid of policy scenarios of one area: all the scenarios share the same parameters and
+    the same dynamics up to their enaction time, so instead of integrating each scenario from the first day, the
+    common prefix is integrated once and the scenarios branch from it at their enaction time. The time grid is split
+    into segments ending at the successive enaction times, each integrated as a single DELPHIODEEnsemblePolicy whose
+    members are the prefix and the branches already enacted: at the end of a segment, the state of the prefix is
+    checkpointed and used as the initial state of the branches enacted at that time. Scenarios with the same enaction
+    time and normalized gammas (i.e. the same trajectory) share the same branch.
+    With the fixed-step RK4 the trajectories are the same as with DELPHIODEEnsemblePolicy; with the adaptive solvers
+    they are the same up to the tolerances of the solver (the integration restarts at each enaction time, where
+    gamma(t) is discontinuous, instead of stepping over it)
+    """
+    def __init__(
+            self, N: float, t_future_policy, normalized_gamma_future_policy, normalized_gamma_current_policy,
+            p_dth_floor: float = 0.01, **kwargs
+    ):
+        """
+        :param N: population of the area
+        :param t_future_policy: time steps after which the future policies are enacted, array of shape (K,)
+        :param normalized_gamma_future_policy: normalized gamma shifts of the policies enacted in the future, float
+        or array of shape (K,)
+        :param normalized_gamma_current_policy: normalized gamma shift of the policy currently in place in the area,
+        float or array of shape (K,)
+        :param p_dth_floor: asymptotic value of the mortality percentage p_dth_mod(t)
+        :param kwargs: fixed percentages p_d, p_h and p_v, see DELPHIODEModel
+        """
+        t_future_policy = np.atleast_1d(np.asarray(t_future_policy, dtype=float))
+        n_scenarios = len(t_future_policy)
+        # Each scenario is defined by its enaction time and normalized gammas, identical scenarios share one branch
+        self.branches, self.branch_scenarios = np.unique(
+            np.stack([
+                t_future_policy,
+                np.broadcast_to(np.asarray(normalized_gamma_future_policy, dtype=float), (n_scenarios,)),
+                np.broadcast_to(np.asarray(normalized_gamma_current_policy, dtype=float), (n_scenarios,)),
+            ], axis=1),
+            axis=0, return_inverse=True,
+        )
+        self.branch_scenarios = self.branch_scenarios.ravel()
+        self.N = N
+        self.p_dth_floor = p_dth_floor
+        self.kwargs = kwargs
+
+    def solve(
+            self, params, x_0, t_eval: list, method: str = "RK45", n_substeps: int = default_n_substeps,
+            **kwargs_solve_ivp
+    ) -> np.ndarray:
+        """
+        Integrates all the policy scenarios on a daily time grid, branching each of them from the common prefix at
+        its enaction time
+        :param params: the 12 DELPHI parameters, shared by all the scenarios
+        :param x_0: initial conditions for all 16 states, shared by all the scenarios
+        :param t_eval: time steps (days) at which the solution is stored, the integration goes from the first to the
+        last one
+        :param method: integration method, see DELPHIODEEnsemble.solve
+        :param n_substeps: number of fixed steps per time step of t_eval (only for RK4)
+        :param kwargs_solve_ivp: additional keyword arguments passed to scipy's solve_ivp
+        :return: array of shape (K, 16, T) with the trajectories of the K scenarios on the T time steps of t_eval
+        """
+        if method not in ode_solvers:
+            raise ValueError(f"ODE solver {method} not supported, should be one of {ode_solvers}")
+        params = np.asarray(params, dtype=float)
+        if params.shape != (n_params,):
+            raise ValueError(f"Parameters should be shared by all the scenarios, of shape ({n_params},)")
+        t_eval = np.asarray(t_eval, dtype=float)
+        n_branches = len(self.branches)
+        # Branches enacted before the first time step start from it, those enacted after the last one never branch
+        t_branches = np.clip(self.branches[:, 0], t_eval[0], t_eval[-1])
+        # Member n_branches is the prefix, without any policy shift as it is enacted at t=inf
+        members = np.vstack([self.branches, [np.inf, self.branches[0, 1], self.branches[0, 2]]])
+        x_sol_members = np.zeros((n_branches + 1, n_states, len(t_eval)))
+        x_sol_members[:, :, 0] = x_0
+        active_members = [n_branches] + list(np.flatnonzero(t_branches == t_eval[0]))
+        t_start = t_eval[0]
+        for t_end in np.unique(np.append(t_branches[t_branches > t_eval[0]], t_eval[-1])):
+            t_segment = np.concatenate([[t_start], t_eval[(t_eval > t_start) & (t_eval < t_end)], [t_end]])
+            x_sol_segment = DELPHIODEEnsemblePolicy(
+                N=self.N, t_future_policy=members[active_members, 0],
+                normalized_gamma_future_policy=members[active_members, 1],
+                normalized_gamma_current_policy=members[active_members, 2], p_dth_floor=self.p_dth_floor,
+                **self.kwargs
+            ).solve(
+                np.tile(params, (len(active_members), 1)), x_0=x_sol_segment[:, :, -1] if t_start > t_eval[0] else x_0,
+                t_eval=t_segment, method=method, n_substeps=n_substeps, **kwargs_solve_ivp
+            )
+            in_t_eval = np.isin(t_segment, t_eval) & (t_segment > t_start)
+            x_sol_members[np.ix_(active_members, range(n_states), np.searchsorted(t_eval, t_segment[in_t_eval]))] = (
+                x_sol_segment[:, :, in_t_eval]
+            )
+            # Checkpoint of the prefix at the enaction time, from which the new branches are integrated
+            new_branches = np.flatnonzero(t_branches == t_end)
+            x_sol_segment = np.concatenate([
+                x_sol_segment, np.repeat(x_sol_segment[:1], len(new_branches), axis=0)
+            ])
+            active_members = active_members + list(new_branches)
+            n_days_prefix = np.searchsorted(t_eval, t_end, side="right")
+            x_sol_members[new_branches, :, :n_days_prefix] = x_sol_members[n_branches, :, :n_days_prefix]
+            t_start = t_end
+        return x_sol_members[self.branch_scenarios]
+
+
+def get_fixed_step_accuracy_report(
+        delphi_model: DELPHIODEModel, params, x_0: list, t_eval: list, list_n_substeps: list = (1, 2, 4, 8),
+        method_solve_ivp: str = "RK45", **kwargs_reference
+) -> list:
+    """
+    Compares the fixed-step RK4 engine (for several numbers of sub-steps per day) and solve_ivp with its default
+    tolerances to a tight-tolerance solve_ivp reference, in terms of accuracy on the trajectories and of runtime
+    :param delphi_model: DELPHI ODE model to be integrated
+    :param params: the 12 DELPHI parameters
+    :param x_0: initial conditions for all 16 states
+    :param t_eval: time steps (days) at which the solutions are compared
+    :param list_n_substeps: numbers of fixed steps per time step of t_eval to be evaluated for RK4
+    :param method_solve_ivp: solve_ivp method used both for the reference and for the comparison at default tolerances
+    :param kwargs_reference: keyword arguments passed to solve_ivp for the reference (by default rtol=1e-10 and
+    atol=1e-6)
+    :return: list of dictionaries (one per engine configuration) with the maximum relative errors on total detected
+    cases (DT), total detected deaths (DD) and on all states, and the runtime in seconds
+    """
+    kwargs_reference.setdefault("rtol", 1e-10)
+    kwargs_reference.setdefault("atol", 1e-6)
+    x_reference = delphi_model.solve(params, x_0=x_0, t_eval=t_eval, method=method_solve_ivp, **kwargs_reference).y
+    list_configurations = [(method_solve_ivp, None)] + [("RK4", n_substeps) for n_substeps in list_n_substeps]
+    accuracy_report = []
+    for method, n_substeps in list_configurations:
+        time_start = time.time()
+        if n_substeps is None:
+            solution = delphi_model.solve(params, x_0=x_0, t_eval=t_eval, method=method)
+        else:
+            solution = delphi_model.solve(params, x_0=x_0, t_eval=t_eval, method=method, n_substeps=n_substeps)
+        runtime = time.time() - time_start
+        if solution.status == 0:
+            relative_errors = np.abs(solution.y - x_reference) / np.maximum(np.abs(x_reference), 1)
+        else:
+            relative_errors = np.full(x_reference.shape, np.inf)
+        accuracy_report.append({
+            "method": method,
+            "n_substeps": n_substeps,
+            "max_relative_error_cases": np.max(relative_errors[DT_]),
+            "max_relative_error_deaths": np.max(relative_errors[DD_]),
+            "max_relative_error_states": np.nanmax(relative_errors),
+            "runtime": runtime,
+        })
+    return accuracy_report
@@ -1,18 +1,31 @@
 # Authors: Hamza Tazi Bouardi (htazi@mit.edu), Michael L. Li (mlli@mit.edu), Omar Skali Lami (oskali@mit.edu)
 import os
+import time
+import hashlib
+import shutil
 import pandas as pd
 import numpy as np
 import scipy.stats
+import scipy.sparse
+from scipy.optimize import OptimizeResult
 from datetime import datetime, timedelta
 from typing import Union
+from types import MappingProxyType
 import json
+from collections import OrderedDict
 from logging import Logger
 from DELPHI_params_V4 import (
     TIME_DICT,
+    future_policies,
+    future_times,
     default_policy,
     default_policy_enaction_time,
+    loss_cache_relative_tolerance,
+    loss_cache_max_memory,
+    skip_refit_window,
+    skip_refit_mape_threshold,
+    skip_refit_mape_drift_threshold,
 )
-from DELPHI_utils_V4_dynamic import make_increasing
 
 
 class DELPHIDataSaver:
@@ -23,7 +36,8 @@ class DELPHIDataSaver:
             df_global_parameters: Union[pd.DataFrame, None],
             df_global_predictions_since_today: pd.DataFrame,
             df_global_predictions_since_100_cases: pd.DataFrame,
-            logger: Logger = None
+            logger: Logger = None,
+            scenario_cube: "DELPHIScenarioCube" = None,
     ):
         self.PATH_TO_FOLDER_DANGER_MAP = path_to_folder_danger_map
         self.PATH_TO_WEBSITE_PREDICTED = path_to_website_predicted
@@ -33,6 +47,8 @@ class DELPHIDataSaver:
             df_global_predictions_since_100_cases
         )
         self.logger = logger
+        # Policy predictions, built from df_global_predictions_since_100_cases if not given
+        self.scenario_cube = scenario_cube
 
     @staticmethod
     def save_dataframe(df, path, logger):
@@ -61,15 +77,17 @@ class DELPHIDataSaver:
         """
         Saves the parameters and predictions datasets (since 100 cases and since the day of running)
         based on the different flags and the inputs to the DELPHIDataSaver initializer
-        :param optimizer: needs to be in (tnc, trust-constr, annealing) and will save files differently accordingly; the
-        default name corresponds to tnc where we don't specify the optimizer because that's the default one
+        :param optimizer: needs to be in (tnc, trust-constr, annealing, race) and will save files differently
+        accordingly; the default name corresponds to tnc where we don't specify the optimizer because that's the default
+        one, and is also used for race whose best parameters per area are the ones read by the next runs (warm start
+        of the fitting, predictions and policy scripts)
         :param save_since_100_cases: boolean, whether or not we also want to save the predictions since 100 cases
         for all the areas (instead of since the day we actually ran the optimization)
         :param website: boolean, whether or not we want to save the files in the website repository as well
         :return:
         """
         today_date_str = "".join(str(datetime.now().date()).split("-"))
-        if optimizer == "tnc":
+        if optimizer in ["tnc", "race"]:
             subname_file = "Global_V4"
         elif optimizer == "annealing":
             subname_file = "Global_V4_annealing"
@@ -128,42 +146,25 @@ class DELPHIDataSaver:
 
     def save_policy_predictions_to_json(self, website: bool = False, local_delphi: bool = False):
         """
-        Saves the policy predictions as a JSON file based on the different flags
+        Saves the policy predictions as a JSON file based on the different flags, the JSON file is written once and
+        copied to the other locations
         :param website: boolean, whether or not we want to save the JSON file in the website repository as well
         :param local_delphi: boolean, whether or not we want to save the JSON file in the DELPHI repository as well
         :return:
         """
         today_date_str = "".join(str(datetime.now().date()).split("-"))
-        dict_predictions_policies_world_since_100_cases = DELPHIDataSaver.create_nested_dict_from_final_dataframe(
-            self.df_global_predictions_since_100_cases
-        )
-        with open(
-                self.PATH_TO_FOLDER_DANGER_MAP
-                + f"/predicted/world_Python_{today_date_str}_Scenarios_since_100_cases.json",
-                "w",
-        ) as handle:
-            json.dump(dict_predictions_policies_world_since_100_cases, handle)
-
-        with open(
-                self.PATH_TO_FOLDER_DANGER_MAP
-                + f"/predicted/world_Python_Scenarios_since_100_cases.json",
-                "w",
-        ) as handle:
-            json.dump(dict_predictions_policies_world_since_100_cases, handle)
-
+        scenario_cube = self.scenario_cube
+        if scenario_cube is None:
+            scenario_cube = DELPHIScenarioCube.from_dataframe(self.df_global_predictions_since_100_cases)
+        list_paths = [
+            self.PATH_TO_FOLDER_DANGER_MAP + f"/predicted/world_Python_{today_date_str}_Scenarios_since_100_cases.json",
+            self.PATH_TO_FOLDER_DANGER_MAP + f"/predicted/world_Python_Scenarios_since_100_cases.json",
+        ]
         if local_delphi:
-            with open(
-                    f"./world_Python_{today_date_str}_Scenarios_since_100_cases.json", "w"
-            ) as handle:
-                json.dump(dict_predictions_policies_world_since_100_cases, handle)
-
+            list_paths.append(f"./world_Python_{today_date_str}_Scenarios_since_100_cases.json")
         if website:
-            with open(
-                    self.PATH_TO_WEBSITE_PREDICTED
-                    + f"assets/policies/World_Scenarios.json",
-                    "w",
-            ) as handle:
-                json.dump(dict_predictions_policies_world_since_100_cases, handle)
+            list_paths.append(self.PATH_TO_WEBSITE_PREDICTED + f"assets/policies/World_Scenarios.json")
+        scenario_cube.save_json(list_paths)
 
     @staticmethod
     def create_nested_dict_from_final_dataframe(df_predictions: pd.DataFrame) -> dict:
@@ -173,75 +174,272 @@ class DELPHIDataSaver:
         :param df_predictions: dataframe with all policy predictions
         :return: dictionary with nested keys and policy predictions to be saved as a JSON file
         """
-        dict_all_results = {
-            continent: {} for continent in df_predictions.Continent.unique()
+        return DELPHIScenarioCube.from_dataframe(df_predictions).to_nested_dict()
+
+
+class DELPHIPredictionsBlock:
+    """
+    Compact block of the predictions of an area: the constant columns of the area, the first days of the predictions
+    and one array per output column since the day with 100 cases. The predictions since today are views of these
+    arrays (except for the columns that differ, e.g. the true values), and the blocks of all the areas are turned into
+    dataframes with a single concatenation by concatenate, instead of building two dataframes per area
+    """
+    def __init__(
+            self, dict_columns_area: dict, date_since_100: np.datetime64, date_since_today: np.datetime64,
+            n_days_btw_today_since_100: int, dict_values: dict, dict_values_since_today: dict = None,
+    ):
+        """
+        :param dict_columns_area: values of the constant columns of the area (Continent, Country, Province...)
+        :param date_since_100: first day of the predictions since 100 cases
+        :param date_since_today: first day of the predictions since today
+        :param n_days_btw_today_since_100: number of days between the two
+        :param dict_values: arrays of the output columns since 100 cases
+        :param dict_values_since_today: arrays of the output columns since today which are not the end of the arrays
+        since 100 cases
+        """
+        self.dict_columns_area = dict_columns_area
+        self.date_since_100 = date_since_100
+        self.date_since_today = date_since_today
+        self.n_days_btw_today_since_100 = n_days_btw_today_since_100
+        self.dict_values = dict_values
+        self.dict_values_since_today = dict_values_since_today if dict_values_since_today is not None else {}
+
+    def get_values(self, since_today: bool) -> dict:
+        """
+        :param since_today: whether to return the predictions since today or since 100 cases
+        :return: dictionary with the arrays of the output columns
+        """
+        if not since_today:
+            return self.dict_values
+        return {
+            column: self.dict_values_since_today.get(column, values[self.n_days_btw_today_since_100:])
+            for column, values in self.dict_values.items()
         }
-        for continent in dict_all_results.keys():
-            countries_in_continent = list(
-                df_predictions[df_predictions.Continent == continent].Country.unique()
-            )
-            dict_all_results[continent] = {
-                country: {} for country in countries_in_continent
-            }
 
-        keys_country_province = list(
-            set(
-                [
-                    (continent, country, province)
-                    for continent, country, province in zip(
-                    df_predictions.Continent.tolist(),
-                    df_predictions.Country.tolist(),
-                    df_predictions.Province.tolist(),
-                )
-                ]
-            )
+    @staticmethod
+    def concatenate(list_blocks: list, since_today: bool) -> pd.DataFrame:
+        """
+        :param list_blocks: list of DELPHIPredictionsBlock with the same columns
+        :param since_today: whether to create the dataframe with the predictions since today or since 100 cases
+        :return: dataframe with the predictions of all the blocks, the index restarting at 0 for each block
+        """
+        if len(list_blocks) == 0:
+            return pd.DataFrame()
+        list_dict_values = [block.get_values(since_today) for block in list_blocks]
+        columns_values = list(list_dict_values[0].keys())
+        n_days_blocks = np.array([len(dict_values[columns_values[0]]) for dict_values in list_dict_values])
+        days_in_block = np.arange(n_days_blocks.sum()) - np.repeat(np.cumsum(n_days_blocks) - n_days_blocks,
+                                                                    n_days_blocks)
+        first_days_blocks = np.array([
+            block.date_since_today if since_today else block.date_since_100 for block in list_blocks
+        ], dtype="datetime64[D]")
+        dict_df = {
+            column: np.repeat(np.array([block.dict_columns_area[column] for block in list_blocks], dtype=object),
+                              n_days_blocks)
+            for column in list_blocks[0].dict_columns_area
+        }
+        dict_df["Day"] = np.datetime_as_string(
+            np.repeat(first_days_blocks, n_days_blocks) + days_in_block.astype("timedelta64[D]")
+        ).astype(object)
+        for column in columns_values:
+            dict_df[column] = np.concatenate([dict_values[column] for dict_values in list_dict_values])
+        return pd.DataFrame(dict_df, index=days_in_block)
+
+    def to_dataframes(self) -> (pd.DataFrame, pd.DataFrame):
+        """
+        :return: tuple of dataframes with the predictions since today and since 100 cases of this block
+        """
+        return (
+            DELPHIPredictionsBlock.concatenate([self], since_today=True),
+            DELPHIPredictionsBlock.concatenate([self], since_today=False),
         )
-        for continent, country, province in keys_country_province:
-            df_predictions_province = df_predictions[
-                (df_predictions.Country == country)
-                & (df_predictions.Province == province)
-                ].reset_index(drop=True)
-            # The first part contains only ground truth value, so it doesn't matter which
-            # policy/enaction time we choose to report these values
-            dict_all_results[continent][country][province] = {
-                "Day": sorted(list(df_predictions_province.Day.unique())),
-                "Total Detected True": df_predictions_province[
-                    (df_predictions_province.Policy == default_policy)
-                    & (df_predictions_province.Time == default_policy_enaction_time)
-                    ]
-                    .sort_values("Day")["Total Detected True"]
-                    .tolist(),
-                "Total Detected Deaths True": df_predictions_province[
-                    (df_predictions_province.Policy == default_policy)
-                    & (df_predictions_province.Time == default_policy_enaction_time)
-                    ]
-                    .sort_values("Day")["Total Detected Deaths True"]
-                    .tolist(),
-            }
-            dict_all_results[continent][country][province].update(
-                {
-                    policy: {
-                        policy_enaction_time: {
-                            "Total Detected": df_predictions_province[
-                                (df_predictions_province.Policy == policy)
-                                & (df_predictions_province.Time == policy_enaction_time)
-                                ]
-                                .sort_values("Day")["Total Detected"]
-                                .tolist(),
-                            "Total Detected Deaths": df_predictions_province[
-                                (df_predictions_province.Policy == policy)
-                                & (df_predictions_province.Time == policy_enaction_time)
-                                ]
-                                .sort_values("Day")["Total Detected Deaths"]
-                                .tolist(),
-                        }
-                        for policy_enaction_time in df_predictions_province.Time.unique()
-                    }
-                    for policy in df_predictions_province.Policy.unique()
+
+
+class DELPHIScenarioCube:
+    """
+    Dense cube of the policy predictions of all the areas, with axes [area, policy, enaction time, day, metric] for
+    the predicted values and [area, day, metric] for the historical values (taken from the default policy scenario).
+    The day axis is shared by all areas, each area only spanning its own days. The nested JSON used by the website is
+    written from the cube in a single pass, area by area, instead of filtering a long dataframe for each area, policy
+    and enaction time
+    """
+    metrics = ["Total Detected", "Total Detected Deaths"]
+    metrics_true = ["Total Detected True", "Total Detected Deaths True"]
+
+    def __init__(
+            self, list_areas: list, policies: list, times: list, first_day: np.datetime64, area_days: np.ndarray,
+            values: np.ndarray, values_true: np.ndarray, is_available: np.ndarray = None,
+    ):
+        """
+        :param list_areas: list of tuples (continent, country, province), in the order of the JSON file
+        :param policies: labels of the policies
+        :param times: labels of the enaction times (as in TIME_DICT)
+        :param first_day: day of index 0 of the day axis
+        :param area_days: array of shape (n_areas, 2) with the first and last (excluded) indices of the days of each
+        area on the day axis
+        :param values: array of shape (n_areas, n_policies, n_times, n_days, 2) with the predicted values of the
+        metrics
+        :param values_true: array of shape (n_areas, n_days, 2) with the historical values of the metrics
+        :param is_available: boolean array of shape (n_areas, n_policies, n_times), whether each scenario was
+        predicted for each area (all of them by default)
+        """
+        self.list_areas = list_areas
+        self.policies = list(policies)
+        self.times = list(times)
+        self.first_day = first_day
+        self.area_days = area_days
+        self.values = values
+        self.values_true = values_true
+        if is_available is None:
+            is_available = np.ones(values.shape[:3], dtype=bool)
+        self.is_available = is_available
+
+    @classmethod
+    def from_area_blocks(
+            cls, list_areas: list, list_first_days: list, list_values: list, list_values_true: list,
+            policies: list = tuple(future_policies), times: list = tuple(TIME_DICT[time] for time in future_times),
+    ) -> "DELPHIScenarioCube":
+        """
+        :param list_areas: list of tuples (continent, country, province)
+        :param list_first_days: list of the first day of the predictions of each area
+        :param list_values: list of arrays of shape (n_policies, n_times, n_days_area, 2) with the predicted values of
+        each area
+        :param list_values_true: list of arrays of shape (n_days_area, 2) with the historical values of each area
+        :param policies: labels of the policies
+        :param times: labels of the enaction times
+        :return: cube with the policy predictions of all the areas
+        """
+        first_days = np.array(list_first_days, dtype="datetime64[D]")
+        n_days_areas = np.array([values_area.shape[2] for values_area in list_values], dtype=int)
+        first_day = first_days.min() if len(first_days) > 0 else np.datetime64("NaT", "D")
+        area_days = np.zeros((len(list_areas), 2), dtype=int)
+        area_days[:, 0] = (first_days - first_day).astype(int)
+        area_days[:, 1] = area_days[:, 0] + n_days_areas
+        n_days = int(area_days[:, 1].max(initial=0))
+        values = np.zeros((len(list_areas), len(policies), len(times), n_days, len(cls.metrics)), dtype=int)
+        values_true = np.full((len(list_areas), n_days, len(cls.metrics_true)), np.nan)
+        for i, (values_area, values_true_area) in enumerate(zip(list_values, list_values_true)):
+            values[i, :, :, area_days[i, 0]:area_days[i, 1]] = values_area
+            values_true[i, area_days[i, 0]:area_days[i, 1]] = values_true_area
+        return cls(
+            list_areas=list(list_areas), policies=policies, times=times, first_day=first_day, area_days=area_days,
+            values=values, values_true=values_true,
+        )
+
+    @classmethod
+    def from_dataframe(cls, df_predictions: pd.DataFrame) -> "DELPHIScenarioCube":
+        """
+        :param df_predictions: dataframe with all policy predictions since 100 cases (Policy, Time, Continent, Country,
+        Province, Day, the predicted and the historical values of the metrics)
+        :return: cube with the policy predictions of all the areas, in the order of their first row
+        """
+        area_codes, df_areas = DELPHIRollup.factorize_columns(df_predictions, ["Continent", "Country", "Province"])
+        # Areas ordered by their first row, as are the policies and the enaction times by factorize
+        _, index_first_rows = np.unique(area_codes, return_index=True)
+        order_areas = np.argsort(index_first_rows)
+        area_codes = np.argsort(order_areas)[area_codes]
+        policy_codes, policies = pd.factorize(df_predictions["Policy"])
+        time_codes, times = pd.factorize(df_predictions["Time"])
+        days = pd.to_datetime(df_predictions["Day"]).values.astype("datetime64[D]")
+        n_areas = len(df_areas)
+        first_day = days.min() if len(days) > 0 else np.datetime64("NaT", "D")
+        day_codes = (days - first_day).astype(int)
+        area_days = np.zeros((n_areas, 2), dtype=int)
+        area_days[:, 0] = np.iinfo(int).max
+        np.minimum.at(area_days[:, 0], area_codes, day_codes)
+        np.maximum.at(area_days[:, 1], area_codes, day_codes + 1)
+        n_days = int(area_days[:, 1].max(initial=0))
+        values = np.zeros((n_areas, len(policies), len(times), n_days, len(cls.metrics)), dtype=int)
+        values[area_codes, policy_codes, time_codes, day_codes] = df_predictions[cls.metrics].values
+        is_available = np.zeros((n_areas, len(policies), len(times)), dtype=bool)
+        is_available[area_codes, policy_codes, time_codes] = True
+        # The historical values don't depend on the scenario, they are reported from the default one
+        is_default = (
+            (df_predictions["Policy"] == default_policy) & (df_predictions["Time"] == default_policy_enaction_time)
+        ).values
+        values_true = np.full((n_areas, n_days, len(cls.metrics_true)), np.nan)
+        values_true[area_codes[is_default], day_codes[is_default]] = np.stack([
+            pd.to_numeric(df_predictions[column].values[is_default], errors="coerce")
+            for column in cls.metrics_true
+        ], axis=1)
+        return cls(
+            list_areas=[tuple(area) for area in df_areas.iloc[order_areas].values.tolist()],
+            policies=list(policies), times=list(times), first_day=first_day, area_days=area_days, values=values,
+            values_true=values_true, is_available=is_available,
+        )
+
+    def get_nested_keys(self) -> dict:
+        """
+        :return: nested dictionary continent -> country -> province -> index of the area in the cube
+        """
+        dict_nested_keys = {}
+        for i, (continent, country, province) in enumerate(self.list_areas):
+            dict_nested_keys.setdefault(continent, {}).setdefault(country, {})[province] = i
+        return dict_nested_keys
+
+    def get_area_items(self, i: int):
+        """
+        :param i: index of the area in the cube
+        :return: generator of the (key, value) pairs of the dictionary of that area in the nested JSON, the values
+        being lists
+        """
+        start, stop = self.area_days[i]
+        days = self.first_day + np.arange(start, stop).astype("timedelta64[D]")
+        yield "Day", np.datetime_as_string(days).tolist()
+        for j, column in enumerate(self.metrics_true):
+            yield column, self.values_true[i, start:stop, j].tolist()
+        policies_area = np.flatnonzero(self.is_available[i].any(axis=1))
+        times_area = np.flatnonzero(self.is_available[i].any(axis=0))
+        for p in policies_area:
+            yield self.policies[p], {
+                self.times[t]: {
+                    column: self.values[i, p, t, start:stop, j].tolist() if self.is_available[i, p, t] else []
+                    for j, column in enumerate(self.metrics)
                 }
-            )
+                for t in times_area
+            }
+
+    def to_nested_dict(self) -> dict:
+        """
+        :return: nested dictionary continent -> country -> province -> predictions, as saved in the JSON file
+        """
+        return {
+            continent: {
+                country: {province: dict(self.get_area_items(i)) for province, i in dict_provinces.items()}
+                for country, dict_provinces in dict_countries.items()
+            }
+            for continent, dict_countries in self.get_nested_keys().items()
+        }
 
-        return dict_all_results
+    def write_json(self, handle) -> None:
+        """
+        Writes the nested JSON to a file in a single pass over the areas, serializing one area at a time instead of
+        the whole nested dictionary, the output being the same as json.dump(self.to_nested_dict(), handle)
+        :param handle: file opened for writing
+        """
+        handle.write("{")
+        for n_continent, (continent, dict_countries) in enumerate(self.get_nested_keys().items()):
+            handle.write((", " if n_continent > 0 else "") + json.dumps(continent) + ": {")
+            for n_country, (country, dict_provinces) in enumerate(dict_countries.items()):
+                handle.write((", " if n_country > 0 else "") + json.dumps(country) + ": {")
+                for n_province, (province, i) in enumerate(dict_provinces.items()):
+                    handle.write(
+                        (", " if n_province > 0 else "") + json.dumps(province) + ": "
+                        + json.dumps(dict(self.get_area_items(i)))
+                    )
+                handle.write("}")
+            handle.write("}")
+        handle.write("}")
+
+    def save_json(self, list_paths: list) -> None:
+        """
+        Writes the nested JSON to the first path, and copies the file to the other paths
+        :param list_paths: list of paths of the JSON files to save
+        """
+        with open(list_paths[0], "w") as handle:
+            self.write_json(handle)
+        for path in list_paths[1:]:
+            shutil.copyfile(list_paths[0], path)
 
 
 class DELPHIDataCreator:
@@ -305,82 +503,73 @@ class DELPHIDataCreator:
         )
         return df_parameters
 
+    def get_dates_since_100_and_since_today(self) -> (np.datetime64, np.datetime64, int):
+        """
+        :return: a tuple with the first day of the predictions since 100 cases, the first day of the predictions since
+        today and the number of days between the two
+        """
+        n_days_btw_today_since_100 = (datetime.now() - self.date_day_since100).days
+        return (
+            np.datetime64(pd.to_datetime(self.date_day_since100).date(), "D"),
+            np.datetime64(datetime.now().date(), "D"),
+            n_days_btw_today_since_100,
+        )
+
+    def get_predictions_values(self) -> dict:
+        """
+        :return: dictionary with the rounded predictions since 100 cases for each output column, computed from the
+        states of the model
+        """
+        dict_predictions_values = {
+            "Total Detected": self.x_sol_final[15, :],  # DT
+            "Active": (
+                self.x_sol_final[4, :] + self.x_sol_final[5, :] + self.x_sol_final[7, :] + self.x_sol_final[8, :]
+            ),  # DHR + DQR + DHD + DQD
+            "Active Hospitalized": self.x_sol_final[4, :] + self.x_sol_final[7, :],  # DHR + DHD
+            "Cumulative Hospitalized": self.x_sol_final[11, :],  # TH
+            "Total Detected Deaths": self.x_sol_final[14, :],  # DD
+            "Active Ventilated": self.x_sol_final[12, :] + self.x_sol_final[13, :],  # DVR + DVD
+        }
+        return {column: np.round(values).astype(int) for column, values in dict_predictions_values.items()}
+
+    def create_block_predictions(self) -> DELPHIPredictionsBlock:
+        """
+        Creates the block with the predictions of the DELPHI model, since the day the area had 100 cases and since
+        the day of the prediction
+        :return: block with the predictions from DELPHI model
+        """
+        date_since_100, date_since_today, n_days_btw_today_since_100 = self.get_dates_since_100_and_since_today()
+        return DELPHIPredictionsBlock(
+            dict_columns_area={"Continent": self.continent, "Country": self.country, "Province": self.province},
+            date_since_100=date_since_100,
+            date_since_today=date_since_today,
+            n_days_btw_today_since_100=n_days_btw_today_since_100,
+            dict_values=self.get_predictions_values(),
+        )
+
     def create_datasets_predictions(self) -> (pd.DataFrame, pd.DataFrame):
         """
         Creates two dataframes with the predictions of the DELPHI model, the first one since the day of the prediction,
         the second since the day the area had 100 cases
         :return: tuple of dataframes with predictions from DELPHI model
         """
-        n_days_btw_today_since_100 = (datetime.now() - self.date_day_since100).days
-        n_days_since_today = self.x_sol_final.shape[1] - n_days_btw_today_since_100
-        all_dates_since_today = [
-            str((datetime.now() + timedelta(days=i)).date())
-            for i in range(n_days_since_today)
-        ]
-        # Predictions
-        total_detected = self.x_sol_final[15, :]  # DT
-        total_detected = [int(round(x, 0)) for x in total_detected]
-        active_cases = (
-                self.x_sol_final[4, :]
-                + self.x_sol_final[5, :]
-                + self.x_sol_final[7, :]
-                + self.x_sol_final[8, :]
-        )  # DHR + DQR + DHD + DQD
-        active_cases = [int(round(x, 0)) for x in active_cases]
-        active_hospitalized = (
-                self.x_sol_final[4, :] + self.x_sol_final[7, :]
-        )  # DHR + DHD
-        active_hospitalized = [int(round(x, 0)) for x in active_hospitalized]
-        cumulative_hospitalized = self.x_sol_final[11, :]  # TH
-        cumulative_hospitalized = [int(round(x, 0)) for x in cumulative_hospitalized]
-        total_detected_deaths = self.x_sol_final[14, :]  # DD
-        total_detected_deaths = [int(round(x, 0)) for x in total_detected_deaths]
-        active_ventilated = (
-                self.x_sol_final[12, :] + self.x_sol_final[13, :]
-        )  # DVR + DVD
-        active_ventilated = [int(round(x, 0)) for x in active_ventilated]
-        # Generation of the dataframe since today
-        df_predictions_since_today_cont_country_prov = pd.DataFrame(
-            {
-                "Continent": [self.continent for _ in range(n_days_since_today)],
-                "Country": [self.country for _ in range(n_days_since_today)],
-                "Province": [self.province for _ in range(n_days_since_today)],
-                "Day": all_dates_since_today,
-                "Total Detected": total_detected[n_days_btw_today_since_100:],
-                "Active": active_cases[n_days_btw_today_since_100:],
-                "Active Hospitalized": active_hospitalized[n_days_btw_today_since_100:],
-                "Cumulative Hospitalized": cumulative_hospitalized[
-                                           n_days_btw_today_since_100:
-                                           ],
-                "Total Detected Deaths": total_detected_deaths[
-                                         n_days_btw_today_since_100:
-                                         ],
-                "Active Ventilated": active_ventilated[n_days_btw_today_since_100:],
-            }
-        )
+        return self.create_block_predictions().to_dataframes()
 
-        # Generation of the dataframe from the day since 100th case
-        all_dates_since_100 = [
-            str((self.date_day_since100 + timedelta(days=i)).date())
-            for i in range(self.x_sol_final.shape[1])
-        ]
-        df_predictions_since_100_cont_country_prov = pd.DataFrame(
-            {
-                "Continent": [self.continent for _ in range(len(all_dates_since_100))],
-                "Country": [self.country for _ in range(len(all_dates_since_100))],
-                "Province": [self.province for _ in range(len(all_dates_since_100))],
-                "Day": all_dates_since_100,
-                "Total Detected": total_detected,
-                "Active": active_cases,
-                "Active Hospitalized": active_hospitalized,
-                "Cumulative Hospitalized": cumulative_hospitalized,
-                "Total Detected Deaths": total_detected_deaths,
-                "Active Ventilated": active_ventilated,
-            }
-        )
-        return (
-            df_predictions_since_today_cont_country_prov,
-            df_predictions_since_100_cont_country_prov,
+    def create_block_raw(self) -> DELPHIPredictionsBlock:
+        """
+        Creates the block with the values of all 16 states of the DELPHI model for the Optimal Vaccine Allocation team
+        """
+        date_since_100, date_since_today, n_days_btw_today_since_100 = self.get_dates_since_100_and_since_today()
+        return DELPHIPredictionsBlock(
+            dict_columns_area={"Continent": self.continent, "Country": self.country, "Province": self.province},
+            date_since_100=date_since_100,
+            date_since_today=date_since_today,
+            n_days_btw_today_since_100=n_days_btw_today_since_100,
+            dict_values={
+                state: self.x_sol_final[i, :] for i, state in enumerate([
+                    "S", "E", "I", "AR", "DHR", "DQR", "AD", "DHD", "DQD", "R", "D", "TH", "DVR", "DVD", "DD", "DT",
+                ])
+            },
         )
 
     def create_datasets_raw(self) -> (pd.DataFrame, pd.DataFrame):
@@ -388,88 +577,81 @@ class DELPHIDataCreator:
         Creates a dataset in the right format (with values for all 16 states of the DELPHI model)
         for the Optimal Vaccine Allocation team
         """
-        n_days_btw_today_since_100 = (datetime.now() - self.date_day_since100).days
-        n_days_since_today = self.x_sol_final.shape[1] - n_days_btw_today_since_100
-        all_dates_since_today = [
-            str((datetime.now() + timedelta(days=i)).date())
-            for i in range(n_days_since_today)
-        ]
+        return self.create_block_raw().to_dataframes()
 
-        df_predictions_since_today_cont_country_prov = pd.DataFrame(
-            {
-                "Continent": [self.continent for _ in range(n_days_since_today)],
-                "Country": [self.country for _ in range(n_days_since_today)],
-                "Province": [self.province for _ in range(n_days_since_today)],
-                "Day": all_dates_since_today,
-            }
-        )
-
-        intr_since_today = pd.DataFrame(
-            self.x_sol_final[:, n_days_btw_today_since_100:].transpose()
-        )
-        intr_since_today.columns = [
-            "S",
-            "E",
-            "I",
-            "AR",
-            "DHR",
-            "DQR",
-            "AD",
-            "DHD",
-            "DQD",
-            "R",
-            "D",
-            "TH",
-            "DVR",
-            "DVD",
-            "DD",
-            "DT",
-        ]
-        df_predictions_since_today_cont_country_prov = pd.concat(
-            [df_predictions_since_today_cont_country_prov, intr_since_today], axis=1
-        )
-        # Generation of the dataframe from the day since 100th case
-        all_dates_since_100 = [
-            str((self.date_day_since100 + timedelta(days=i)).date())
-            for i in range(self.x_sol_final.shape[1])
-        ]
-        df_predictions_since_100_cont_country_prov = pd.DataFrame(
-            {
-                "Continent": [self.continent for _ in range(len(all_dates_since_100))],
-                "Country": [self.country for _ in range(len(all_dates_since_100))],
-                "Province": [self.province for _ in range(len(all_dates_since_100))],
-                "Day": all_dates_since_100,
-            }
+    def create_block_with_confidence_intervals(
+            self,
+            cases_data_fit: list,
+            deaths_data_fit: list,
+            past_prediction_file: str = "I://covid19orc//danger_map//predicted//Global_V2_20200720.csv",
+            past_prediction_date: str = "2020-07-04",
+            q: float = 0.5,
+            past_predictions: pd.DataFrame = None,
+    ) -> DELPHIPredictionsBlock:
+        """
+        Creates the block with the predictions, including Confidence Intervals used in the website for cases and
+        deaths, see create_datasets_with_confidence_intervals for the parameters
+        :return: block with predictions and confidence intervals
+        """
+        date_since_100, date_since_today, n_days_btw_today_since_100 = self.get_dates_since_100_and_since_today()
+        n_days_since_100 = self.x_sol_final.shape[1]
+        dict_values = self.get_predictions_values()
+        dict_values["Total Detected True"] = np.array(
+            list(cases_data_fit) + [np.nan] * (n_days_since_100 - len(cases_data_fit))
         )
-
-        intr_since_100 = pd.DataFrame(self.x_sol_final.transpose())
-
-        intr_since_100.columns = [
-            "S",
-            "E",
-            "I",
-            "AR",
-            "DHR",
-            "DQR",
-            "AD",
-            "DHD",
-            "DQD",
-            "R",
-            "D",
-            "TH",
-            "DVR",
-            "DVD",
-            "DD",
-            "DT",
-        ]
-
-        df_predictions_since_100_cont_country_prov = pd.concat(
-            [df_predictions_since_100_cont_country_prov, intr_since_100], axis=1
+        dict_values["Total Detected Deaths True"] = np.array(
+            list(deaths_data_fit) + [np.nan] * (n_days_since_100 - len(deaths_data_fit))
         )
-
-        return (
-            df_predictions_since_today_cont_country_prov,
-            df_predictions_since_100_cont_country_prov,
+        # The true values are not part of the predictions since today
+        dict_values_since_today = {
+            "Total Detected True": np.full(max(n_days_since_100 - n_days_btw_today_since_100, 0), np.nan),
+            "Total Detected Deaths True": np.full(max(n_days_since_100 - n_days_btw_today_since_100, 0), np.nan),
+        }
+        if past_predictions is None:
+            past_predictions = DELPHIPastPredictions(
+                past_prediction_file, past_prediction_date
+            ).get_past_predictions(self.country, self.province)
+        if len(past_predictions) > 0:
+            known_dates_since_100 = np.datetime_as_string(
+                date_since_100 + np.arange(len(cases_data_fit)).astype("timedelta64[D]")
+            )
+            # Confidence intervals widen with the square root of the number of days since today
+            scale_days_since_today = np.sqrt(np.maximum(np.arange(n_days_since_100) - n_days_btw_today_since_100, 0))
+            for column, data_fit in [("Total Detected", cases_data_fit), ("Total Detected Deaths", deaths_data_fit)]:
+                data_fit_past = np.array(data_fit, dtype=float)[known_dates_since_100[:len(data_fit)] > past_prediction_date]
+                predictions_past = past_predictions[column].values[:len(data_fit_past)]
+                rmse = np.sqrt(np.mean((data_fit_past[:len(predictions_past)] - predictions_past) ** 2))
+                for bound, quantile in [("LB", 0.5 - q / 2), ("UB", 0.5 + q / 2)]:
+                    values_bound = np.maximum(np.round(
+                        dict_values[column] + rmse * scipy.stats.norm.ppf(quantile) * scale_days_since_today
+                    ), 0)
+                    if not np.isnan(values_bound).any():
+                        values_bound = values_bound.astype(int)
+                    if bound == "LB":
+                        # Lower bounds are made increasing, separately for the predictions since today
+                        dict_values_since_today[f"{column} {bound}"] = np.maximum.accumulate(
+                            values_bound[n_days_btw_today_since_100:]
+                        )
+                        values_bound = np.maximum.accumulate(values_bound)
+                    dict_values[f"{column} {bound}"] = values_bound
+        else:
+            for column in ["Total Detected", "Total Detected Deaths"]:
+                for bound in ["LB", "UB"]:
+                    dict_values[f"{column} {bound}"] = np.full(n_days_since_100, np.nan)
+        # Columns in the order of the datasets
+        dict_values = {
+            column: dict_values[column] for column in list(self.get_predictions_values().keys()) + [
+                "Total Detected True", "Total Detected Deaths True", "Total Detected LB", "Total Detected Deaths LB",
+                "Total Detected UB", "Total Detected Deaths UB",
+            ]
+        }
+        return DELPHIPredictionsBlock(
+            dict_columns_area={"Continent": self.continent, "Country": self.country, "Province": self.province},
+            date_since_100=date_since_100,
+            date_since_today=date_since_today,
+            n_days_btw_today_since_100=n_days_btw_today_since_100,
+            dict_values=dict_values,
+            dict_values_since_today=dict_values_since_today,
         )
 
     def create_datasets_with_confidence_intervals(
@@ -479,6 +661,7 @@ class DELPHIDataCreator:
             past_prediction_file: str = "I://covid19orc//danger_map//predicted//Global_V2_20200720.csv",
             past_prediction_date: str = "2020-07-04",
             q: float = 0.5,
+            past_predictions: pd.DataFrame = None,
     ) -> (pd.DataFrame, pd.DataFrame):
         """
         Generates the prediction datasets from the date with 100 cases and from the day of running, including columns
@@ -488,650 +671,50 @@ class DELPHIDataCreator:
         :param past_prediction_file: past prediction file's path for CI generation
         :param past_prediction_date: past prediction's date for CI generation
         :param q: quantile used for the CIs
+        :param past_predictions: past predictions of this area after past_prediction_date sorted by day, if already
+        loaded (e.g. from a DELPHIAreaDataStore), in which case the past prediction file isn't read
         :return: tuple of dataframes (since day of optimization & since 100 cases in the area) with predictions and
         confidence intervals
         """
-        n_days_btw_today_since_100 = (datetime.now() - self.date_day_since100).days
-        n_days_since_today = self.x_sol_final.shape[1] - n_days_btw_today_since_100
-        all_dates_since_today = [
-            str((datetime.now() + timedelta(days=i)).date())
-            for i in range(n_days_since_today)
-        ]
-        # Predictions
-        total_detected = self.x_sol_final[15, :]  # DT
-        total_detected = [int(round(x, 0)) for x in total_detected]
-        active_cases = (
-                self.x_sol_final[4, :]
-                + self.x_sol_final[5, :]
-                + self.x_sol_final[7, :]
-                + self.x_sol_final[8, :]
-        )  # DHR + DQR + DHD + DQD
-        active_cases = [int(round(x, 0)) for x in active_cases]
-        active_hospitalized = (
-                self.x_sol_final[4, :] + self.x_sol_final[7, :]
-        )  # DHR + DHD
-        active_hospitalized = [int(round(x, 0)) for x in active_hospitalized]
-        cumulative_hospitalized = self.x_sol_final[11, :]  # TH
-        cumulative_hospitalized = [int(round(x, 0)) for x in cumulative_hospitalized]
-        total_detected_deaths = self.x_sol_final[14, :]  # DD
-        total_detected_deaths = [int(round(x, 0)) for x in total_detected_deaths]
-        active_ventilated = (
-                self.x_sol_final[12, :] + self.x_sol_final[13, :]
-        )  # DVR + DVD
-        active_ventilated = [int(round(x, 0)) for x in active_ventilated]
-
-        past_predictions = pd.read_csv(past_prediction_file)
-        past_predictions = (
-            past_predictions[
-                (past_predictions["Day"] > past_prediction_date)
-                & (past_predictions["Country"] == self.country)
-                & (past_predictions["Province"] == self.province)
-                ]
-        ).sort_values("Day")
-        if len(past_predictions) > 0:
-            known_dates_since_100 = [
-                str((self.date_day_since100 + timedelta(days=i)).date())
-                for i in range(len(cases_data_fit))
-            ]
-            cases_data_fit_past = [
-                y
-                for x, y in zip(known_dates_since_100, cases_data_fit)
-                if x > past_prediction_date
-            ]
-            deaths_data_fit_past = [
-                y
-                for x, y in zip(known_dates_since_100, deaths_data_fit)
-                if x > past_prediction_date
-            ]
-            total_detected_past = past_predictions["Total Detected"].values[
-                                  : len(cases_data_fit_past)
-                                  ]
-            total_detected_deaths_past = past_predictions[
-                                             "Total Detected Deaths"
-                                         ].values[: len(deaths_data_fit_past)]
-            residual_cases_lb = np.sqrt(
-                np.mean(
-                    [(x - y) ** 2 for x, y in zip(cases_data_fit_past, total_detected_past)]
-                )
-            ) * scipy.stats.norm.ppf(0.5 - q / 2)
-            residual_cases_ub = np.sqrt(
-                np.mean(
-                    [(x - y) ** 2 for x, y in zip(cases_data_fit_past, total_detected_past)]
-                )
-            ) * scipy.stats.norm.ppf(0.5 + q / 2)
-            residual_deaths_lb = np.sqrt(
-                np.mean(
-                    [
-                        (x - y) ** 2
-                        for x, y in zip(deaths_data_fit_past, total_detected_deaths_past)
-                    ]
-                )
-            ) * scipy.stats.norm.ppf(0.5 - q / 2)
-            residual_deaths_ub = np.sqrt(
-                np.mean(
-                    [
-                        (x - y) ** 2
-                        for x, y in zip(deaths_data_fit_past, total_detected_deaths_past)
-                    ]
-                )
-            ) * scipy.stats.norm.ppf(0.5 + q / 2)
-
-            # Generation of the dataframe since today
-            df_predictions_since_today_cont_country_prov = pd.DataFrame(
-                {
-                    "Continent": [self.continent for _ in range(n_days_since_today)],
-                    "Country": [self.country for _ in range(n_days_since_today)],
-                    "Province": [self.province for _ in range(n_days_since_today)],
-                    "Day": all_dates_since_today,
-                    "Total Detected": total_detected[n_days_btw_today_since_100:],
-                    "Active": active_cases[n_days_btw_today_since_100:],
-                    "Active Hospitalized": active_hospitalized[
-                                           n_days_btw_today_since_100:
-                                           ],
-                    "Cumulative Hospitalized": cumulative_hospitalized[
-                                               n_days_btw_today_since_100:
-                                               ],
-                    "Total Detected Deaths": total_detected_deaths[
-                                             n_days_btw_today_since_100:
-                                             ],
-                    "Active Ventilated": active_ventilated[n_days_btw_today_since_100:],
-                    "Total Detected True": [np.nan for _ in range(n_days_since_today)],
-                    "Total Detected Deaths True": [
-                        np.nan for _ in range(n_days_since_today)
-                    ],
-                    "Total Detected LB": make_increasing([
-                        max(int(round(v + residual_cases_lb * np.sqrt(c), 0)), 0)
-                        for c, v in enumerate(
-                            total_detected[n_days_btw_today_since_100:]
-                        )
-                    ]),
-#                    "Active LB": [
-#                        max(
-#                            int(round(v + residual_cases_lb * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                active_cases[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-#                    "Active Hospitalized LB": [
-#                        max(
-#                            int(round(v + residual_cases_lb * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                active_hospitalized[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-#                    "Cumulative Hospitalized LB": make_increasing([
-#                        max(
-#                            int(round(v + residual_cases_lb * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                cumulative_hospitalized[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ]),
-                    "Total Detected Deaths LB": make_increasing([
-                        max(int(round(v + residual_deaths_lb * np.sqrt(c), 0)), 0)
-                        for c, v in enumerate(
-                            total_detected_deaths[n_days_btw_today_since_100:]
-                        )
-                    ]),
-#                    "Active Ventilated LB": [
-#                        max(
-#                            int(round(v + residual_cases_lb * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                active_ventilated[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-                    "Total Detected UB": [
-                        max(int(round(v + residual_cases_ub * np.sqrt(c), 0)), 0)
-                        for c, v in enumerate(
-                            total_detected[n_days_btw_today_since_100:]
-                        )
-                    ],
-#                    "Active UB": [
-#                        max(
-#                            int(round(v + residual_cases_ub * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                active_cases[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-#                    "Active Hospitalized UB": [
-#                        max(
-#                            int(round(v + residual_cases_ub * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                active_hospitalized[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-#                    "Cumulative Hospitalized UB": [
-#                        max(
-#                            int(round(v + residual_cases_ub * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                cumulative_hospitalized[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-                    "Total Detected Deaths UB": [
-                        max(int(round(v + residual_deaths_ub * np.sqrt(c), 0)), 0)
-                        for c, v in enumerate(
-                            total_detected_deaths[n_days_btw_today_since_100:]
-                        )
-                    ],
-#                    "Active Ventilated UB": [
-#                        max(
-#                            int(round(v + residual_cases_ub * np.sqrt(c) * v / u, 0)), 0
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(
-#                                active_ventilated[n_days_btw_today_since_100:],
-#                                total_detected[n_days_btw_today_since_100:],
-#                            )
-#                        )
-#                    ],
-                }
-            )
-            # Generation of the dataframe from the day since 100th case
-            all_dates_since_100 = [
-                str((self.date_day_since100 + timedelta(days=i)).date())
-                for i in range(self.x_sol_final.shape[1])
-            ]
-            df_predictions_since_100_cont_country_prov = pd.DataFrame(
-                {
-                    "Continent": [
-                        self.continent for _ in range(len(all_dates_since_100))
-                    ],
-                    "Country": [self.country for _ in range(len(all_dates_since_100))],
-                    "Province": [
-                        self.province for _ in range(len(all_dates_since_100))
-                    ],
-                    "Day": all_dates_since_100,
-                    "Total Detected": total_detected,
-                    "Active": active_cases,
-                    "Active Hospitalized": active_hospitalized,
-                    "Cumulative Hospitalized": cumulative_hospitalized,
-                    "Total Detected Deaths": total_detected_deaths,
-                    "Active Ventilated": active_ventilated,
-                    "Total Detected True": cases_data_fit
-                                           + [
-                                               np.nan
-                                               for _ in range(len(all_dates_since_100) - len(cases_data_fit))
-                                           ],
-                    "Total Detected Deaths True": deaths_data_fit
-                                                  + [
-                                                      np.nan for _ in range(len(all_dates_since_100) - len(deaths_data_fit))
-                                                  ],
-                    "Total Detected LB": make_increasing([
-                        max(
-                            int(
-                                round(
-                                    v
-                                    + residual_cases_lb
-                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0)),
-                                    0,
-                                    )
-                            ),
-                            0,
-                        )
-                        for c, v in enumerate(total_detected)
-                    ]),
-#                    "Active LB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_lb
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(zip(active_cases, total_detected))
-#                    ],
-#                    "Active Hospitalized LB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_lb
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(active_hospitalized, total_detected)
-#                        )
-#                    ],
-#                    "Cumulative Hospitalized LB": make_increasing([
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_lb
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(cumulative_hospitalized, total_detected)
-#                        )
-#                    ]),
-                    "Total Detected Deaths LB": make_increasing([
-                        max(
-                            int(
-                                round(
-                                    v
-                                    + residual_deaths_lb
-                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0)),
-                                    0,
-                                    )
-                            ),
-                            0,
-                        )
-                        for c, v in enumerate(total_detected_deaths)
-                    ]),
-#                    "Active Ventilated LB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_lb
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(active_ventilated, total_detected)
-#                        )
-#                    ],
-                    "Total Detected UB": [
-                        max(
-                            int(
-                                round(
-                                    v
-                                    + residual_cases_ub
-                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0)),
-                                    0,
-                                    )
-                            ),
-                            0,
-                        )
-                        for c, v in enumerate(total_detected)
-                    ],
-#                    "Active UB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_ub
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(zip(active_cases, total_detected))
-#                    ],
-#                    "Active Hospitalized UB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_ub
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(active_hospitalized, total_detected)
-#                        )
-#                    ],
-#                    "Cumulative Hospitalized UB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_ub
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(cumulative_hospitalized, total_detected)
-#                        )
-#                    ],
-                    "Total Detected Deaths UB": [
-                        max(
-                            int(
-                                round(
-                                    v
-                                    + residual_deaths_ub
-                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0)),
-                                    0,
-                                    )
-                            ),
-                            0,
-                        )
-                        for c, v in enumerate(total_detected_deaths)
-                    ],
-#                    "Active Ventilated UB": [
-#                        max(
-#                            int(
-#                                round(
-#                                    v
-#                                    + residual_cases_ub
-#                                    * np.sqrt(max(c - n_days_btw_today_since_100, 0))
-#                                    * v
-#                                    / u,
-#                                    0,
-#                                    )
-#                            ),
-#                            0,
-#                        )
-#                        for c, (v, u) in enumerate(
-#                            zip(active_ventilated, total_detected)
-#                        )
-#                    ],
-                }
-            )
-        else:
-            df_predictions_since_today_cont_country_prov = pd.DataFrame(
-                {
-                    "Continent": [self.continent for _ in range(n_days_since_today)],
-                    "Country": [self.country for _ in range(n_days_since_today)],
-                    "Province": [self.province for _ in range(n_days_since_today)],
-                    "Day": all_dates_since_today,
-                    "Total Detected": total_detected[n_days_btw_today_since_100:],
-                    "Active": active_cases[n_days_btw_today_since_100:],
-                    "Active Hospitalized": active_hospitalized[
-                                           n_days_btw_today_since_100:
-                                           ],
-                    "Cumulative Hospitalized": cumulative_hospitalized[
-                                               n_days_btw_today_since_100:
-                                               ],
-                    "Total Detected Deaths": total_detected_deaths[
-                                             n_days_btw_today_since_100:
-                                             ],
-                    "Active Ventilated": active_ventilated[n_days_btw_today_since_100:],
-                    "Total Detected True": [np.nan for _ in range(n_days_since_today)],
-                    "Total Detected Deaths True": [
-                        np.nan for _ in range(n_days_since_today)
-                    ],
-                    "Total Detected LB": [np.nan for _ in range(n_days_since_today)],
-#                    "Active LB": [np.nan for _ in range(n_days_since_today)],
-#                    "Active Hospitalized LB": [
-#                        np.nan for _ in range(n_days_since_today)
-#                    ],
-#                    "Cumulative Hospitalized LB": [
-#                        np.nan for _ in range(n_days_since_today)
-#                    ],
-                    "Total Detected Deaths LB": [
-                        np.nan for _ in range(n_days_since_today)
-                    ],
-#                    "Active Ventilated LB": [np.nan for _ in range(n_days_since_today)],
-                    "Total Detected UB": [np.nan for _ in range(n_days_since_today)],
-#                    "Active UB": [np.nan for _ in range(n_days_since_today)],
-#                    "Active Hospitalized UB": [
-#                        np.nan for _ in range(n_days_since_today)
-#                    ],
-#                    "Cumulative Hospitalized UB": [
-#                        np.nan for _ in range(n_days_since_today)
-#                    ],
-                    "Total Detected Deaths UB": [
-                        np.nan for _ in range(n_days_since_today)
-                    ]
-#                    "Active Ventilated UB": [np.nan for _ in range(n_days_since_today)],
-                }
-            )
-            # Generation of the dataframe from the day since 100th case
-            all_dates_since_100 = [
-                str((self.date_day_since100 + timedelta(days=i)).date())
-                for i in range(self.x_sol_final.shape[1])
-            ]
-            df_predictions_since_100_cont_country_prov = pd.DataFrame(
-                {
-                    "Continent": [
-                        self.continent for _ in range(len(all_dates_since_100))
-                    ],
-                    "Country": [self.country for _ in range(len(all_dates_since_100))],
-                    "Province": [
-                        self.province for _ in range(len(all_dates_since_100))
-                    ],
-                    "Day": all_dates_since_100,
-                    "Total Detected": total_detected,
-                    "Active": active_cases,
-                    "Active Hospitalized": active_hospitalized,
-                    "Cumulative Hospitalized": cumulative_hospitalized,
-                    "Total Detected Deaths": total_detected_deaths,
-                    "Active Ventilated": active_ventilated,
-                    "Total Detected True": cases_data_fit
-                                           + [
-                                               np.nan
-                                               for _ in range(len(all_dates_since_100) - len(cases_data_fit))
-                                           ],
-                    "Total Detected Deaths True": deaths_data_fit
-                                                  + [
-                                                      np.nan for _ in range(len(all_dates_since_100) - len(deaths_data_fit))
-                                                  ],
-                    "Total Detected LB": [
-                        np.nan for _ in range(len(all_dates_since_100))
-                    ],
-#                    "Active LB": [np.nan for _ in range(len(all_dates_since_100))],
-#                    "Active Hospitalized LB": [
-#                        np.nan for _ in range(len(all_dates_since_100))
-#                    ],
-#                    "Cumulative Hospitalized LB": [
-#                        np.nan for _ in range(len(all_dates_since_100))
-#                    ],
-                    "Total Detected Deaths LB": [
-                        np.nan for _ in range(len(all_dates_since_100))
-                    ],
-#                    "Active Ventilated LB": [
-#                        np.nan for _ in range(len(all_dates_since_100))
-#                    ],
-                    "Total Detected UB": [
-                        np.nan for _ in range(len(all_dates_since_100))
-                    ],
-#                    "Active UB": [np.nan for _ in range(len(all_dates_since_100))],
-#                    "Active Hospitalized UB": [
-#                        np.nan for _ in range(len(all_dates_since_100))
-#                    ],
-#                    "Cumulative Hospitalized UB": [
-#                        np.nan for _ in range(len(all_dates_since_100))
-#                    ],
-                    "Total Detected Deaths UB": [
-                        np.nan for _ in range(len(all_dates_since_100))
-                    ],
-#                    "Active Ventilated UB": [
-#                        np.nan for _ in range(len(all_dates_since_100))
-#                    ],
-                }
-            )
+        return self.create_block_with_confidence_intervals(
+            cases_data_fit, deaths_data_fit, past_prediction_file=past_prediction_file,
+            past_prediction_date=past_prediction_date, q=q, past_predictions=past_predictions,
+        ).to_dataframes()
+
+    def create_historical_values_scenario(self, totalcases: pd.DataFrame) -> np.ndarray:
+        """
+        :param totalcases: case history of the area
+        :return: array of shape (n_days, 2) with the historical cases and deaths on the days of the predictions since
+        100 cases (NaN when not available), as merged with the predictions in create_datasets_predictions_scenario
+        """
+        date_since_100, _, _ = self.get_dates_since_100_and_since_today()
+        days_since_100 = np.datetime_as_string(
+            date_since_100 + np.arange(self.x_sol_final.shape[1]).astype("timedelta64[D]")
+        )
+        is_area = (
+            (totalcases["country"].fillna("None") == self.country)
+            & (totalcases["province"].fillna("None") == self.province)
+        )
         return (
-            df_predictions_since_today_cont_country_prov,
-            df_predictions_since_100_cont_country_prov,
+            totalcases.loc[is_area, ["date", "case_cnt", "death_cnt"]].drop_duplicates("date").set_index("date")
+            .reindex(days_since_100).values.astype(float)
         )
 
     def create_datasets_predictions_scenario(
             self, policy: str = "Lockdown", time: int = 0, totalcases=None
     ) -> (pd.DataFrame, pd.DataFrame):
-        n_days_btw_today_since_100 = (datetime.now() - self.date_day_since100).days
-        n_days_since_today = self.x_sol_final.shape[1] - n_days_btw_today_since_100
-        all_dates_since_today = [
-            str((datetime.now() + timedelta(days=i)).date())
-            for i in range(n_days_since_today)
-        ]
-        # Predictions
-        total_detected = self.x_sol_final[15, :]  # DT
-        total_detected = [int(round(x, 0)) for x in total_detected]
-        active_cases = (
-                self.x_sol_final[4, :]
-                + self.x_sol_final[5, :]
-                + self.x_sol_final[7, :]
-                + self.x_sol_final[8, :]
-        )  # DHR + DQR + DHD + DQD
-        active_cases = [int(round(x, 0)) for x in active_cases]
-        active_hospitalized = (
-                self.x_sol_final[4, :] + self.x_sol_final[7, :]
-        )  # DHR + DHD
-        active_hospitalized = [int(round(x, 0)) for x in active_hospitalized]
-        cumulative_hospitalized = self.x_sol_final[11, :]  # TH
-        cumulative_hospitalized = [int(round(x, 0)) for x in cumulative_hospitalized]
-        total_detected_deaths = self.x_sol_final[14, :]  # DD
-        total_detected_deaths = [int(round(x, 0)) for x in total_detected_deaths]
-        active_ventilated = (
-                self.x_sol_final[12, :] + self.x_sol_final[13, :]
-        )  # DVR + DVD
-        active_ventilated = [int(round(x, 0)) for x in active_ventilated]
-        # Generation of the dataframe since today
-        df_predictions_since_today_cont_country_prov = pd.DataFrame(
-            {
-                "Policy": [policy for _ in range(n_days_since_today)],
-                "Time": [TIME_DICT[time] for _ in range(n_days_since_today)],
-                "Continent": [self.continent for _ in range(n_days_since_today)],
-                "Country": [self.country for _ in range(n_days_since_today)],
-                "Province": [self.province for _ in range(n_days_since_today)],
-                "Day": all_dates_since_today,
-                "Total Detected": total_detected[n_days_btw_today_since_100:],
-                "Active": active_cases[n_days_btw_today_since_100:],
-                "Active Hospitalized": active_hospitalized[n_days_btw_today_since_100:],
-                "Cumulative Hospitalized": cumulative_hospitalized[
-                                           n_days_btw_today_since_100:
-                                           ],
-                "Total Detected Deaths": total_detected_deaths[
-                                         n_days_btw_today_since_100:
-                                         ],
-                "Active Ventilated": active_ventilated[n_days_btw_today_since_100:],
-            }
-        )
-
-        # Generation of the dataframe from the day since 100th case
-        all_dates_since_100 = [
-            str((self.date_day_since100 + timedelta(days=i)).date())
-            for i in range(self.x_sol_final.shape[1])
-        ]
-        df_predictions_since_100_cont_country_prov = pd.DataFrame(
-            {
-                "Policy": [policy for _ in range(len(all_dates_since_100))],
-                "Time": [TIME_DICT[time] for _ in range(len(all_dates_since_100))],
-                "Continent": [self.continent for _ in range(len(all_dates_since_100))],
-                "Country": [self.country for _ in range(len(all_dates_since_100))],
-                "Province": [self.province for _ in range(len(all_dates_since_100))],
-                "Day": all_dates_since_100,
-                "Total Detected": total_detected,
-                "Active": active_cases,
-                "Active Hospitalized": active_hospitalized,
-                "Cumulative Hospitalized": cumulative_hospitalized,
-                "Total Detected Deaths": total_detected_deaths,
-                "Active Ventilated": active_ventilated,
-            }
+        date_since_100, date_since_today, n_days_btw_today_since_100 = self.get_dates_since_100_and_since_today()
+        df_predictions_since_today_cont_country_prov, df_predictions_since_100_cont_country_prov = (
+            DELPHIPredictionsBlock(
+                dict_columns_area={
+                    "Policy": policy, "Time": TIME_DICT[time], "Continent": self.continent, "Country": self.country,
+                    "Province": self.province,
+                },
+                date_since_100=date_since_100,
+                date_since_today=date_since_today,
+                n_days_btw_today_since_100=n_days_btw_today_since_100,
+                dict_values=self.get_predictions_values(),
+            ).to_dataframes()
         )
         if (
                 totalcases is not None
@@ -1178,6 +761,167 @@ class DELPHIDataCreator:
         )
 
 
+class DELPHIPastPredictions:
+    """
+    Past predictions used to compute the residuals of the confidence intervals, loaded once from the past prediction
+    file and indexed by area, with the predictions of each area after the past prediction date sorted by day. It serves
+    both the workers (DELPHIDataCreator) and the aggregations (DELPHIAggregations), which otherwise each read the whole
+    file and filter it for every area
+    """
+    columns_area = ["Continent", "Country", "Province"]
+
+    def __init__(self, path_to_past_predictions: str, past_prediction_date: str):
+        """
+        :param path_to_past_predictions: past prediction file's path for CI generation, if None or if it doesn't exist
+        no past predictions are available for any area
+        :param past_prediction_date: past prediction's date for CI generation, only the predictions strictly after that
+        date (format 'YYYY-MM-DD') are kept
+        """
+        self.past_prediction_date = past_prediction_date
+        dict_past_predictions = {}
+        if path_to_past_predictions is not None and os.path.exists(path_to_past_predictions):
+            # Area names are read as raw strings, otherwise "None" is parsed as NaN and can't be looked up
+            past_predictions = pd.read_csv(
+                path_to_past_predictions, converters={column: str for column in self.columns_area}
+            )
+            past_predictions = past_predictions[past_predictions["Day"] > past_prediction_date].sort_values(
+                "Day", kind="stable"
+            )
+            for tuple_area, past_predictions_area in past_predictions.groupby(self.columns_area, sort=False):
+                dict_past_predictions[tuple_area] = past_predictions_area.reset_index(drop=True)
+        self.dict_past_predictions = MappingProxyType(dict_past_predictions)
+        # Countries and provinces are identified by (Country, Province), continents and world all have Country "None"
+        self.dict_past_predictions_country_province = MappingProxyType({
+            (country, province): past_predictions_area
+            for (continent, country, province), past_predictions_area in dict_past_predictions.items()
+            if country != "None"
+        })
+
+    def get_past_predictions(self, country: str, province: str, continent: str = None) -> pd.DataFrame:
+        """
+        :param country: country of the area, "None" for continents and world
+        :param province: province of the area, "None" for countries, continents and world
+        :param continent: continent of the area, only needed for continents and world ("None" for the world)
+        :return: the past predictions of that area after the past prediction date, sorted by day (empty DataFrame if
+        there are none)
+        """
+        if continent is None:
+            past_predictions_area = self.dict_past_predictions_country_province.get((country, province))
+        else:
+            past_predictions_area = self.dict_past_predictions.get((continent, country, province))
+        if past_predictions_area is None:
+            return pd.DataFrame(columns=["Day", "Total Detected", "Total Detected Deaths"])
+        return past_predictions_area
+
+
+class DELPHIRollup:
+    """
+    Hierarchical rollup of predictions: the predictions are held as a dense [area, day, metric] array, and the
+    aggregations at the country, continent and world levels are all obtained with a single product with a sparse
+    membership matrix from the areas to the aggregated areas. The long dataframe layout is only rebuilt for the output
+    """
+    columns_area = ["Continent", "Country", "Province"]
+    levels = ["country", "continent", "world"]
+
+    def __init__(self, df_predictions: pd.DataFrame, columns_keys: list = (), columns_output: list = None):
+        """
+        :param df_predictions: dataframe with the predictions of the areas, in the long layout (one row per area and
+        day), all the columns other than the keys, the area and the day being numeric metrics
+        :param columns_keys: columns aggregated separately in addition to the area (e.g. Policy and Time)
+        :param columns_output: columns of the output dataframes, by default the columns of df_predictions
+        """
+        self.columns_keys = list(columns_keys)
+        self.columns_output = list(columns_output) if columns_output is not None else list(df_predictions.columns)
+        columns_keys_area = self.columns_keys + self.columns_area
+        self.columns_metrics = [
+            column for column in df_predictions.columns if column not in columns_keys_area + ["Day"]
+        ]
+        self.dtypes_metrics = df_predictions[self.columns_metrics].dtypes
+        id_area, self.df_areas = DELPHIRollup.factorize_columns(df_predictions, columns_keys_area)
+        id_day, self.days = pd.factorize(df_predictions["Day"], sort=True)
+        # Missing values count as 0 in the sums, as in a groupby sum
+        id_area_day = id_area * len(self.days) + id_day
+        n_areas_days = len(self.df_areas) * len(self.days)
+        self.values = np.stack([
+            np.bincount(id_area_day, weights=df_predictions[column].fillna(0).values, minlength=n_areas_days)
+            for column in self.columns_metrics
+        ], axis=-1).reshape(len(self.df_areas), len(self.days), len(self.columns_metrics))
+        self.is_predicted = (np.bincount(id_area_day, minlength=n_areas_days) > 0).astype(float).reshape(
+            len(self.df_areas), len(self.days)
+        )
+
+    @staticmethod
+    def factorize_columns(df: pd.DataFrame, columns: list) -> (np.ndarray, pd.DataFrame):
+        """
+        :param df: dataframe to factorize
+        :param columns: columns whose combinations of values are factorized
+        :return: a tuple with the code of the combination of each row, and the dataframe with the distinct
+        combinations in the order of the codes
+        """
+        list_codes, list_n_values = zip(*[
+            (codes, len(values)) for codes, values in (pd.factorize(df[column]) for column in columns)
+        ])
+        codes_combined = np.ravel_multi_index(list_codes, [max(n_values, 1) for n_values in list_n_values])
+        _, index_first_rows, codes = np.unique(codes_combined, return_index=True, return_inverse=True)
+        return codes.reshape(-1), df[columns].iloc[index_first_rows].reset_index(drop=True)
+
+    def get_membership_matrix(self, level: str) -> (scipy.sparse.csr_matrix, pd.DataFrame):
+        """
+        :param level: aggregation level, one of country (only areas with a province), continent or world
+        :return: a tuple with the sparse membership matrix from the areas to the aggregated areas of that level, and
+        the dataframe with the keys of the aggregated areas
+        """
+        if level == "country":
+            is_member = (self.df_areas["Province"] != "None").values
+            columns_aggregation = self.columns_keys + ["Continent", "Country"]
+        elif level == "continent":
+            is_member = np.ones(len(self.df_areas), dtype=bool)
+            columns_aggregation = self.columns_keys + ["Continent"]
+        elif level == "world":
+            is_member = np.ones(len(self.df_areas), dtype=bool)
+            columns_aggregation = self.columns_keys
+        else:
+            raise ValueError(f"Aggregation level {level} not supported, should be one of {self.levels}")
+        df_members = self.df_areas[is_member]
+        if len(columns_aggregation) > 0:
+            id_aggregated_area, df_aggregated_areas = DELPHIRollup.factorize_columns(df_members, columns_aggregation)
+        else:
+            id_aggregated_area = np.zeros(len(df_members), dtype=int)
+            df_aggregated_areas = pd.DataFrame(index=range(min(len(df_members), 1)))
+        for column in self.columns_area:
+            if column not in columns_aggregation:
+                df_aggregated_areas[column] = "None"
+        membership_matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(df_members)), (id_aggregated_area, np.flatnonzero(is_member))),
+            shape=(len(df_aggregated_areas), len(self.df_areas)),
+        )
+        return membership_matrix, df_aggregated_areas
+
+    def get_aggregations(self, levels: list = None) -> pd.DataFrame:
+        """
+        :param levels: aggregation levels to compute, by default all of them (country, continent and world)
+        :return: dataframe with the aggregated predictions of all the requested levels, in the long layout
+        """
+        list_membership_matrices, list_df_aggregated_areas = zip(*[
+            self.get_membership_matrix(level) for level in (levels if levels is not None else self.levels)
+        ])
+        membership_matrix = scipy.sparse.vstack(list_membership_matrices).tocsr()
+        df_aggregated_areas = pd.concat(list_df_aggregated_areas).reset_index(drop=True)
+        values_aggregated = membership_matrix @ self.values.reshape(len(self.df_areas), -1)
+        values_aggregated = values_aggregated.reshape(-1, len(self.days), len(self.columns_metrics))
+        # An aggregated area has a prediction on a day if any of its areas has one
+        id_aggregated_area, id_day = np.nonzero(membership_matrix @ self.is_predicted)
+        df_aggregations = df_aggregated_areas.iloc[id_aggregated_area].reset_index(drop=True)
+        df_aggregations["Day"] = self.days[id_day]
+        values_aggregated = values_aggregated[id_aggregated_area, id_day, :]
+        for i, column in enumerate(self.columns_metrics):
+            if np.issubdtype(self.dtypes_metrics[column], np.integer):
+                df_aggregations[column] = np.round(values_aggregated[:, i]).astype(self.dtypes_metrics[column])
+            else:
+                df_aggregations[column] = values_aggregated[:, i]
+        return df_aggregations[self.columns_output]
+
+
 class DELPHIAggregations:
     @staticmethod
     def get_aggregation_per_country(df_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1186,11 +930,7 @@ class DELPHIAggregations:
         :param df_predictions: DELPHI predictions dataframe
         :return: DELPHI predictions dataframe aggregated at the country level
         """
-        df_predictions = df_predictions[df_predictions["Province"] != "None"]
-        df_agg_country = df_predictions.groupby(["Continent", "Country", "Day"]).sum().reset_index()
-        df_agg_country["Province"] = "None"
-        df_agg_country = df_agg_country[df_predictions.columns]
-        return df_agg_country
+        return DELPHIRollup(df_predictions).get_aggregations(["country"])
 
     @staticmethod
     def get_aggregation_per_continent(df_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1199,11 +939,7 @@ class DELPHIAggregations:
         :param df_predictions: DELPHI predictions dataframe
         :return: DELPHI predictions dataframe aggregated at the continent level
         """
-        df_agg_continent = df_predictions.groupby(["Continent", "Day"]).sum().reset_index()
-        df_agg_continent["Country"] = "None"
-        df_agg_continent["Province"] = "None"
-        df_agg_continent = df_agg_continent[df_predictions.columns]
-        return df_agg_continent
+        return DELPHIRollup(df_predictions).get_aggregations(["continent"])
 
     @staticmethod
     def get_aggregation_world(df_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1212,12 +948,7 @@ class DELPHIAggregations:
         :param df_predictions: DELPHI predictions dataframe
         :return: DELPHI predictions dataframe aggregated at the world level (only one row in this dataframe)
         """
-        df_agg_world = df_predictions.groupby("Day").sum().reset_index()
-        df_agg_world["Continent"] = "None"
-        df_agg_world["Country"] = "None"
-        df_agg_world["Province"] = "None"
-        df_agg_world = df_agg_world[df_predictions.columns]
-        return df_agg_world
+        return DELPHIRollup(df_predictions).get_aggregations(["world"])
 
     @staticmethod
     def append_all_aggregations(df_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1226,28 +957,103 @@ class DELPHIAggregations:
         :param df_predictions: dataframe with the raw predictions from DELPHI
         :return: dataframe with raw predictions from DELPHI and aggregated ones at the country, continent & world levels
         """
-        df_agg_since_today_per_country = DELPHIAggregations.get_aggregation_per_country(df_predictions)
-        df_agg_since_today_per_continent = DELPHIAggregations.get_aggregation_per_continent(
-            df_predictions
-        )
-        df_agg_since_today_world = DELPHIAggregations.get_aggregation_world(df_predictions)
-        df_predictions = pd.concat(
-            [
-                df_predictions,
-                df_agg_since_today_per_country,
-                df_agg_since_today_per_continent,
-                df_agg_since_today_world,
-            ]
-        )
+        # All the levels are aggregated at once by the rollup
+        df_agg_since_today = DELPHIRollup(df_predictions).get_aggregations()
+        df_predictions = pd.concat([df_predictions, df_agg_since_today])
         df_predictions.sort_values(["Continent", "Country", "Province", "Day"], inplace=True)
         return df_predictions
 
+    @staticmethod
+    def get_confidence_intervals_aggregations(
+            df_agg: pd.DataFrame,
+            past_predictions: DELPHIPastPredictions,
+            past_prediction_date: str,
+            q: float = 0.5,
+            match_continent: bool = True,
+    ) -> pd.DataFrame:
+        """
+        Computes the confidence intervals of the aggregated predictions of all the aggregated areas at once: the
+        residuals (RMSE between the true values after the past prediction date and the past predictions) are computed
+        with grouped array operations, and the bounds are scaled by the square root of the number of days since today,
+        the lower bounds being made increasing with a cumulative maximum per area
+        :param df_agg: dataframe with the aggregated predictions (without bounds) of one or several areas
+        :param past_predictions: past predictions used for the residuals
+        :param past_prediction_date: past prediction's date for CI generation
+        :param q: quantile used for the CIs
+        :param match_continent: whether the past predictions of an area are looked up with its continent (for the
+        continents and the world) or only with its country and province
+        :return: dataframe with the aggregated predictions and the associated confidence intervals, sorted by area and
+        day, with the index restarting at 0 for each area
+        """
+        columns_area = ["Continent", "Country", "Province"]
+        df_agg = df_agg.sort_values(columns_area + ["Day"], kind="stable").reset_index(drop=True)
+        is_first_day_area = (df_agg[columns_area] != df_agg[columns_area].shift()).any(axis=1).values
+        id_area = np.cumsum(is_first_day_area) - 1
+        index_first_day_area = np.flatnonzero(is_first_day_area)
+        day_in_area = np.arange(len(df_agg)) - index_first_day_area[id_area]
+        # The CIs widen with the number of days since today, counted from the first day of each area
+        n_days_btw_today_since_100 = np.array([
+            (datetime.now() - first_day).days
+            for first_day in pd.to_datetime(df_agg["Day"].values[index_first_day_area])
+        ])[id_area]
+        scale_days_since_today = np.sqrt(np.maximum(day_in_area - n_days_btw_today_since_100, 0))
+        list_past_predictions_areas = [
+            past_predictions.get_past_predictions(country, province, continent=continent if match_continent else None)
+            for continent, country, province in df_agg.loc[is_first_day_area, columns_area].values
+        ]
+        n_past_predictions_areas = np.array([len(past_predictions_area) for past_predictions_area in
+                                             list_past_predictions_areas])
+        offset_past_predictions_areas = np.cumsum(n_past_predictions_areas) - n_past_predictions_areas
+        has_past_predictions = n_past_predictions_areas[id_area] > 0
+        dict_bounds = {}
+        for column, column_fit in [
+            ("Total Detected", "Total Detected True"), ("Total Detected Deaths", "Total Detected Deaths True")
+        ]:
+            values_past_predictions = np.concatenate(
+                [np.zeros(0)] + [past_predictions_area[column].values.astype(float)
+                                 for past_predictions_area in list_past_predictions_areas]
+            )
+            values_fit = df_agg[column_fit].values.astype(float)
+            is_fit_past = (df_agg["Day"].values > past_prediction_date) & ~np.isnan(values_fit)
+            # The k-th true value after the past prediction date is compared to the k-th past prediction of the area
+            rank_fit_past = pd.Series(is_fit_past).groupby(id_area).cumsum().values - 1
+            is_paired = is_fit_past & (rank_fit_past < n_past_predictions_areas[id_area])
+            squared_errors = (
+                values_fit[is_paired]
+                - values_past_predictions[offset_past_predictions_areas[id_area[is_paired]] + rank_fit_past[is_paired]]
+            ) ** 2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rmse_areas = np.sqrt(
+                    np.bincount(id_area[is_paired], weights=squared_errors, minlength=len(index_first_day_area))
+                    / np.bincount(id_area[is_paired], minlength=len(index_first_day_area))
+                )
+            for bound, quantile in [("LB", 0.5 - q / 2), ("UB", 0.5 + q / 2)]:
+                values_bound = np.maximum(np.round(
+                    df_agg[column].values + rmse_areas[id_area] * scipy.stats.norm.ppf(quantile)
+                    * scale_days_since_today
+                ), 0)
+                values_bound[~has_past_predictions] = np.nan
+                if bound == "LB":
+                    values_bound = pd.Series(values_bound).groupby(id_area).cummax().values
+                dict_bounds[f"{column} {bound}"] = values_bound
+        df_bounds = pd.DataFrame({
+            column_bound: dict_bounds[column_bound] for column_bound in [
+                "Total Detected LB", "Total Detected Deaths LB", "Total Detected UB", "Total Detected Deaths UB"
+            ]
+        })
+        if not df_bounds.isnull().values.any():
+            df_bounds = df_bounds.astype(int)
+        df_agg_with_cf = pd.concat([df_agg, df_bounds], axis=1)
+        df_agg_with_cf.index = day_in_area
+        return df_agg_with_cf
+
     @staticmethod
     def get_aggregation_per_country_with_cf(
             df_predictions: pd.DataFrame,
             past_prediction_file: str = "I://covid19orc//danger_map//predicted//Global_V2_20200720.csv",
             past_prediction_date: str = "2020-07-04",
-            q: float = 0.5
+            q: float = 0.5,
+            past_predictions: DELPHIPastPredictions = None,
     ) -> pd.DataFrame:
         """
         Creates aggregations at the country level as well as associated confidence intervals
@@ -1255,6 +1061,7 @@ class DELPHIAggregations:
         :param past_prediction_file: past prediction file's path for CI generation
         :param past_prediction_date: past prediction's date for CI generation
         :param q: quantile used for the CIs
+        :param past_predictions: past predictions already loaded, in which case the past prediction file isn't read
         :return: dataframe with country level aggregated predictions & associated confidence intervals
         """
         df_predictions = df_predictions[df_predictions["Province"] != "None"]
@@ -1262,78 +1069,21 @@ class DELPHIAggregations:
         df_agg_country = df_predictions[columns_without_bounds].groupby(["Continent", "Country", "Day"]).sum(min_count = 1).reset_index()
         df_agg_country["Province"] = "None"
         df_agg_country = df_agg_country[columns_without_bounds]
-        aggregated_countries = set(zip(df_agg_country["Country"],df_agg_country["Province"]))
-        past_predictions = pd.read_csv(past_prediction_file)
-        if len(aggregated_countries)>0:
-            list_df_aggregated_countries = []
-            for country, province in aggregated_countries:
-                past_predictions_temp = (past_predictions[(past_predictions['Day'] > past_prediction_date) & (past_predictions['Country'] == country) & (past_predictions['Province'] == province)]).sort_values("Day")
-                df_agg_country_temp = (df_agg_country[(df_agg_country['Country'] == country) & (df_agg_country['Province'] == province)]).sort_values("Day").reset_index(drop=True)
-                total_detected = df_agg_country_temp['Total Detected'] 
-                total_detected_deaths = df_agg_country_temp['Total Detected Deaths'] 
-    #            active_cases = df_agg_country_temp['Active'] 
-    #            active_hospitalized = df_agg_country_temp['Active Hospitalized'] 
-    #            cumulative_hospitalized = df_agg_country_temp['Cumulative Hospitalized'] 
-    #            active_ventilated = df_agg_country_temp['Active Ventilated'] 
-                cases_fit_data = df_agg_country_temp['Total Detected True'] 
-                deaths_fit_data = df_agg_country_temp['Total Detected Deaths True'] 
-                since_100_dates = df_agg_country_temp['Day'] 
-                n_days_btw_today_since_100 = (datetime.now() - pd.to_datetime(min(since_100_dates))).days
-                if len(past_predictions_temp) > 0:
-                    cases_fit_data_past = [y for x, y in zip(since_100_dates,cases_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
-                    deaths_fit_data_past = [y for x, y in zip(since_100_dates,deaths_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
-                    total_detected_past = past_predictions_temp["Total Detected"].values[:len(cases_fit_data_past)]
-                    total_detected_deaths_past = past_predictions_temp["Total Detected Deaths"].values[:len(deaths_fit_data_past)]
-                    residual_cases_lb = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(cases_fit_data_past,total_detected_past)])) * scipy.stats.norm.ppf(0.5 - q /2)
-                    residual_cases_ub = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(cases_fit_data_past,total_detected_past)])) * scipy.stats.norm.ppf(0.5 + q /2)
-                    residual_deaths_lb = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(deaths_fit_data_past,total_detected_deaths_past)])) * scipy.stats.norm.ppf(0.5 - q /2)
-                    residual_deaths_ub = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(deaths_fit_data_past,total_detected_deaths_past)])) *  scipy.stats.norm.ppf(0.5 + q /2)
-            
-                    # Generation of the dataframe from the day since 100th case
-                    df_predictions_since_100_cont_country_prov = pd.DataFrame({
-                        "Total Detected LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected)]),
-    #                    "Active LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_cases, total_detected))],
-    #                    "Active Hospitalized LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_hospitalized, total_detected))],
-    #                    "Cumulative Hospitalized LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(cumulative_hospitalized, total_detected))]),
-                        "Total Detected Deaths LB": make_increasing([max(int(round(v + residual_deaths_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected_deaths)]),
-    #                    "Active Ventilated LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_ventilated, total_detected))],
-                        "Total Detected UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected)],
-    #                    "Active UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_cases, total_detected))],
-    #                    "Active Hospitalized UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_hospitalized, total_detected))],
-    #                    "Cumulative Hospitalized UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(cumulative_hospitalized, total_detected))],
-                        "Total Detected Deaths UB": [max(int(round(v + residual_deaths_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected_deaths)],
-    #                    "Active Ventilated UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_ventilated, total_detected))],
-                    })
-                    df_agg_country_temp = pd.concat([df_agg_country_temp, df_predictions_since_100_cont_country_prov], axis = 1)
-                else:
-                    df_predictions_since_100_cont_country_prov = pd.DataFrame({
-                        "Total Detected LB": [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Active LB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Active Hospitalized LB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Cumulative Hospitalized LB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-                        "Total Detected Deaths LB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Active Ventilated LB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-                        "Total Detected UB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Active UB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Active Hospitalized UB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Cumulative Hospitalized UB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-                        "Total Detected Deaths UB":  [np.nan for _ in range(len(df_agg_country_temp))],  
-    #                    "Active Ventilated UB": [np.nan for _ in range(len(df_agg_country_temp))]
-                    })
-                    df_agg_country_temp = pd.concat([df_agg_country_temp, df_predictions_since_100_cont_country_prov], axis = 1)
-    
-                list_df_aggregated_countries.append(df_agg_country_temp)
-            df_agg_country_final = pd.concat(list_df_aggregated_countries)
-            return df_agg_country_final 
-        else:
+        if len(df_agg_country) == 0:
             return None
+        if past_predictions is None:
+            past_predictions = DELPHIPastPredictions(past_prediction_file, past_prediction_date)
+        return DELPHIAggregations.get_confidence_intervals_aggregations(
+            df_agg_country, past_predictions, past_prediction_date, q=q, match_continent=False
+        )
 
     @staticmethod
     def get_aggregation_per_continent_with_cf(
             df_predictions: pd.DataFrame,
             past_prediction_file: str = "I://covid19orc//danger_map//predicted//Global_V2_20200720.csv",
             past_prediction_date: str = "2020-07-04",
-            q: float = 0.5
+            q: float = 0.5,
+            past_predictions: DELPHIPastPredictions = None,
     ) -> pd.DataFrame:
         """
         Creates aggregations at the continent level as well as associated confidence intervals
@@ -1341,6 +1091,7 @@ class DELPHIAggregations:
         :param past_prediction_file: past prediction file's path for CI generation
         :param past_prediction_date: past prediction's date for CI generation
         :param q: quantile used for the CIs
+        :param past_predictions: past predictions already loaded, in which case the past prediction file isn't read
         :return: dataframe with continent level aggregated predictions & associated confidence intervals
         """
         columns_without_bounds = [x for x in df_predictions.columns if ("LB" not in x) and ("UB" not in x)]
@@ -1348,74 +1099,19 @@ class DELPHIAggregations:
         df_agg_continent["Country"] = "None"
         df_agg_continent["Province"] = "None"
         df_agg_continent = df_agg_continent[columns_without_bounds]
-        aggregated_continents = set(zip(df_agg_continent["Continent"], df_agg_continent["Country"],df_agg_continent["Province"]))
-        past_predictions = pd.read_csv(past_prediction_file)
-        list_df_aggregated_continents = []
-        for continent, country, province in aggregated_continents:
-            past_predictions_temp = (past_predictions[(past_predictions['Day'] > past_prediction_date) & (past_predictions['Continent'] == continent) & (past_predictions['Country'] == country) & (past_predictions['Country'] == province)]).sort_values("Day")
-            df_agg_continent_temp = (df_agg_continent[(df_agg_continent['Continent'] == continent)]).sort_values("Day").reset_index(drop=True)
-            total_detected = df_agg_continent_temp['Total Detected'] 
-            total_detected_deaths = df_agg_continent_temp['Total Detected Deaths'] 
-#            active_cases = df_agg_continent_temp['Active'] 
-#            active_hospitalized = df_agg_continent_temp['Active Hospitalized'] 
-#            cumulative_hospitalized = df_agg_continent_temp['Cumulative Hospitalized'] 
-#            active_ventilated = df_agg_continent_temp['Active Ventilated'] 
-            cases_fit_data = df_agg_continent_temp['Total Detected True'] 
-            deaths_fit_data = df_agg_continent_temp['Total Detected Deaths True'] 
-            since_100_dates = df_agg_continent_temp['Day']   
-            n_days_btw_today_since_100 = (datetime.now() - pd.to_datetime(min(since_100_dates))).days
-            if len(past_predictions_temp) > 0:
-                cases_fit_data_past = [y for x, y in zip(since_100_dates,cases_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
-                deaths_fit_data_past = [y for x, y in zip(since_100_dates,deaths_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
-                total_detected_past = past_predictions_temp["Total Detected"].values[:len(cases_fit_data_past)]
-                total_detected_deaths_past = past_predictions_temp["Total Detected Deaths"].values[:len(deaths_fit_data_past)]
-                residual_cases_lb = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(cases_fit_data_past,total_detected_past)])) * scipy.stats.norm.ppf(0.5 - q /2)
-                residual_cases_ub = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(cases_fit_data_past,total_detected_past)])) * scipy.stats.norm.ppf(0.5 + q /2)
-                residual_deaths_lb = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(deaths_fit_data_past,total_detected_deaths_past)])) * scipy.stats.norm.ppf(0.5 - q /2)
-                residual_deaths_ub = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(deaths_fit_data_past,total_detected_deaths_past)])) *  scipy.stats.norm.ppf(0.5 + q /2)
-                # Generation of the dataframe from the day since 100th case
-                df_predictions_since_100_cont_country_prov = pd.DataFrame({
-                    "Total Detected LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected)]),
-#                    "Active LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_cases, total_detected))],
-#                    "Active Hospitalized LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_hospitalized, total_detected))],
-#                    "Cumulative Hospitalized LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(cumulative_hospitalized, total_detected))]),
-                    "Total Detected Deaths LB": make_increasing([max(int(round(v + residual_deaths_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected_deaths)]),
-#                    "Active Ventilated LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_ventilated, total_detected))],
-                    "Total Detected UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected)],
-#                    "Active UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_cases, total_detected))],
-#                    "Active Hospitalized UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_hospitalized, total_detected))],
-#                    "Cumulative Hospitalized UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(cumulative_hospitalized, total_detected))],
-                    "Total Detected Deaths UB": [max(int(round(v + residual_deaths_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected_deaths)],
-#                    "Active Ventilated UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_ventilated, total_detected))],
-                })
-                df_agg_continent_temp = pd.concat([df_agg_continent_temp, df_predictions_since_100_cont_country_prov], axis = 1)
-            else:
-                df_predictions_since_100_cont_country_prov = pd.DataFrame({
-                    "Total Detected LB": [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Active LB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Active Hospitalized LB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Cumulative Hospitalized LB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-                    "Total Detected Deaths LB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Active Ventilated LB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-                    "Total Detected UB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Active UB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Active Hospitalized UB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Cumulative Hospitalized UB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-                    "Total Detected Deaths UB":  [np.nan for _ in range(len(df_agg_continent_temp))],  
-#                    "Active Ventilated UB": [np.nan for _ in range(len(df_agg_continent_temp))]
-                })
-                df_agg_continent_temp = pd.concat([df_agg_continent_temp, df_predictions_since_100_cont_country_prov], axis = 1)
-
-            list_df_aggregated_continents.append(df_agg_continent_temp)
-        df_agg_continent_final = pd.concat(list_df_aggregated_continents)
-        return df_agg_continent_final 
+        if past_predictions is None:
+            past_predictions = DELPHIPastPredictions(past_prediction_file, past_prediction_date)
+        return DELPHIAggregations.get_confidence_intervals_aggregations(
+            df_agg_continent, past_predictions, past_prediction_date, q=q
+        )
 
     @staticmethod
     def get_aggregation_world_with_cf(
             df_predictions: pd.DataFrame,
             past_prediction_file: str = "I://covid19orc//danger_map//predicted//Global_V2_20200720.csv",
             past_prediction_date: str = "2020-07-04",
-            q: float = 0.5
+            q: float = 0.5,
+            past_predictions: DELPHIPastPredictions = None,
     ) -> pd.DataFrame:
         """
         Creates aggregations at the world level as well as associated confidence intervals
@@ -1423,6 +1119,7 @@ class DELPHIAggregations:
         :param past_prediction_file: past prediction file's path for CI generation
         :param past_prediction_date: past prediction's date for CI generation
         :param q: quantile used for the CIs
+        :param past_predictions: past predictions already loaded, in which case the past prediction file isn't read
         :return: dataframe with continent world aggregated predictions & associated confidence intervals
         """
         columns_without_bounds = [x for x in df_predictions.columns if ("LB" not in x) and ("UB" not in x)]
@@ -1431,68 +1128,19 @@ class DELPHIAggregations:
         df_agg_world["Country"] = "None"
         df_agg_world["Province"] = "None"
         df_agg_world = df_agg_world[columns_without_bounds]
-        past_predictions = pd.read_csv(past_prediction_file)
-        past_predictions_temp = (past_predictions[(past_predictions['Day'] > past_prediction_date) & (past_predictions['Continent'] == "None") & (past_predictions['Country'] == "None") & (past_predictions['Province'] == "None")]).sort_values("Day")
-        total_detected = df_agg_world['Total Detected'] 
-        total_detected_deaths = df_agg_world['Total Detected Deaths'] 
-#        active_cases = df_agg_world['Active'] 
-#        active_hospitalized = df_agg_world['Active Hospitalized'] 
-#        cumulative_hospitalized = df_agg_world['Cumulative Hospitalized'] 
-#        active_ventilated = df_agg_world['Active Ventilated'] 
-        cases_fit_data = df_agg_world['Total Detected True'] 
-        deaths_fit_data = df_agg_world['Total Detected Deaths True'] 
-        since_100_dates = df_agg_world['Day']   
-        n_days_btw_today_since_100 = (datetime.now() - pd.to_datetime(min(since_100_dates))).days
-        if len(past_predictions_temp) > 0:
-            cases_fit_data_past = [y for x, y in zip(since_100_dates,cases_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
-            deaths_fit_data_past = [y for x, y in zip(since_100_dates,deaths_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
-            total_detected_past = past_predictions_temp["Total Detected"].values[:len(cases_fit_data_past)]
-            total_detected_deaths_past = past_predictions_temp["Total Detected Deaths"].values[:len(deaths_fit_data_past)]
-            residual_cases_lb = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(cases_fit_data_past,total_detected_past)])) * scipy.stats.norm.ppf(0.5 - q /2)
-            residual_cases_ub = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(cases_fit_data_past,total_detected_past)])) * scipy.stats.norm.ppf(0.5 + q /2)
-            residual_deaths_lb = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(deaths_fit_data_past,total_detected_deaths_past)])) * scipy.stats.norm.ppf(0.5 - q /2)
-            residual_deaths_ub = np.sqrt(np.mean([(x- y) ** 2 for x,y in zip(deaths_fit_data_past,total_detected_deaths_past)])) *  scipy.stats.norm.ppf(0.5 + q /2)
-    
-            # Generation of the dataframe from the day since 100th case
-            df_predictions_since_100_cont_country_prov = pd.DataFrame({
-                "Total Detected LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected)]),
-#                "Active LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_cases, total_detected))],
-#                "Active Hospitalized LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_hospitalized, total_detected))],
-#                "Cumulative Hospitalized LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(cumulative_hospitalized, total_detected))]),
-                "Total Detected Deaths LB": make_increasing([max(int(round(v + residual_deaths_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected_deaths)]),
-#                "Active Ventilated LB": [max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_ventilated, total_detected))],
-                "Total Detected UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected)],
-#                "Active UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_cases, total_detected))],
-#                "Active Hospitalized UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_hospitalized, total_detected))],
-#                "Cumulative Hospitalized UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(cumulative_hospitalized, total_detected))],
-                "Total Detected Deaths UB": [max(int(round(v + residual_deaths_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)),0)),0) for c, v in enumerate(total_detected_deaths)],
-#                "Active Ventilated UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)) * v / u,0)),0) for c, (v, u) in enumerate(zip(active_ventilated, total_detected))],
-            })
-            df_agg_world_final = pd.concat([df_agg_world, df_predictions_since_100_cont_country_prov], axis = 1)
-        else:
-            df_predictions_since_100_cont_country_prov = pd.DataFrame({
-                "Total Detected LB": [np.nan for _ in range(len(df_agg_world))],  
-#                "Active LB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Active Hospitalized LB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Cumulative Hospitalized LB":  [np.nan for _ in range(len(df_agg_world))],  
-                "Total Detected Deaths LB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Active Ventilated LB":  [np.nan for _ in range(len(df_agg_world))],  
-                "Total Detected UB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Active UB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Active Hospitalized UB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Cumulative Hospitalized UB":  [np.nan for _ in range(len(df_agg_world))],  
-                "Total Detected Deaths UB":  [np.nan for _ in range(len(df_agg_world))],  
-#                "Active Ventilated UB": [np.nan for _ in range(len(df_agg_world))]
-            })
-            df_agg_world_final = pd.concat([df_agg_world, df_predictions_since_100_cont_country_prov], axis = 1)
-        return df_agg_world_final 
+        if past_predictions is None:
+            past_predictions = DELPHIPastPredictions(past_prediction_file, past_prediction_date)
+        return DELPHIAggregations.get_confidence_intervals_aggregations(
+            df_agg_world, past_predictions, past_prediction_date, q=q
+        )
 
     @staticmethod
     def append_all_aggregations_cf(
             df_predictions: pd.DataFrame,
             past_prediction_file: str = "I://covid19orc//danger_map//predicted//Global_V2_20200720.csv",
             past_prediction_date: str = "2020-07-04",
-            q: float = 0.5
+            q: float = 0.5,
+            past_predictions: DELPHIPastPredictions = None,
     ) -> pd.DataFrame:
         """
         Creates and appends all the predictions' aggregations & Confidnece Intervals at the country, continent and
@@ -1501,26 +1149,33 @@ class DELPHIAggregations:
         :param past_prediction_file: past prediction file's path for CI generation
         :param past_prediction_date: past prediction's date for CI generation
         :param q: quantile used for the CIs
+        :param past_predictions: past predictions already loaded, otherwise the past prediction file is read once for
+        all the aggregations
         :return: dataframe with predictions raw from DELPHI and aggregated ones, as well as associated confidence
         intervals at the country, continent & world levels
         """
+        if past_predictions is None:
+            past_predictions = DELPHIPastPredictions(past_prediction_file, past_prediction_date)
         df_agg_since_today_per_country = DELPHIAggregations.get_aggregation_per_country_with_cf(
             df_predictions=df_predictions,
             past_prediction_file=past_prediction_file,
             past_prediction_date=past_prediction_date,
-            q=q
+            q=q,
+            past_predictions=past_predictions,
         )
         df_agg_since_today_per_continent = DELPHIAggregations.get_aggregation_per_continent_with_cf(
             df_predictions=df_predictions,
             past_prediction_file=past_prediction_file,
             past_prediction_date=past_prediction_date,
-            q=q
+            q=q,
+            past_predictions=past_predictions,
         )
         df_agg_since_today_world = DELPHIAggregations.get_aggregation_world_with_cf(
             df_predictions=df_predictions,
             past_prediction_file=past_prediction_file,
             past_prediction_date=past_prediction_date,
-            q=q
+            q=q,
+            past_predictions=past_predictions,
         )
         df_predictions = pd.concat([
             df_predictions, df_agg_since_today_per_country,
@@ -1532,6 +1187,22 @@ class DELPHIAggregations:
 
 
 class DELPHIAggregationsPolicies:
+    @staticmethod
+    def get_rollup(df_policy_predictions: pd.DataFrame) -> DELPHIRollup:
+        """
+        :param df_policy_predictions: DELPHI policy predictions dataframe
+        :return: the rollup of the policy predictions, aggregated separately for each policy and time
+        """
+        return DELPHIRollup(
+            df_policy_predictions[
+                [
+                    "Policy", "Time", "Continent", "Country", "Province", "Day", "Total Detected", "Active",
+                    "Active Hospitalized", "Cumulative Hospitalized", "Total Detected Deaths", "Active Ventilated",
+                ]
+            ],
+            columns_keys=["Policy", "Time"],
+        )
+
     @staticmethod
     def get_aggregation_per_country(df_policy_predictions: pd.DataFrame) -> pd.DataFrame:
         """
@@ -1539,18 +1210,7 @@ class DELPHIAggregationsPolicies:
         :param df_policy_predictions: DELPHI policy predictions dataframe
         :return: DELPHI policy predictions dataframe aggregated at the country level
         """
-        df_policy_predictions = df_policy_predictions[df_policy_predictions["Province"] != "None"]
-        df_agg_country = df_policy_predictions.groupby(
-            ["Policy", "Time", "Continent", "Country", "Day"]
-        ).sum().reset_index()
-        df_agg_country["Province"] = "None"
-        df_agg_country = df_agg_country[
-            [
-                "Policy", "Time", "Continent", "Country", "Province", "Day", "Total Detected", "Active",
-                "Active Hospitalized", "Cumulative Hospitalized", "Total Detected Deaths", "Active Ventilated",
-            ]
-        ]
-        return df_agg_country
+        return DELPHIAggregationsPolicies.get_rollup(df_policy_predictions).get_aggregations(["country"])
 
     @staticmethod
     def get_aggregation_per_continent(df_policy_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1559,18 +1219,7 @@ class DELPHIAggregationsPolicies:
         :param df_policy_predictions: DELPHI policy predictions dataframe
         :return: DELPHI policy predictions dataframe aggregated at the continent level
         """
-        df_agg_continent = (
-            df_policy_predictions.groupby(["Policy", "Time", "Continent", "Day"]).sum().reset_index()
-        )
-        df_agg_continent["Country"] = "None"
-        df_agg_continent["Province"] = "None"
-        df_agg_continent = df_agg_continent[
-            [
-                "Policy", "Time", "Continent", "Country", "Province", "Day", "Total Detected", "Active",
-                "Active Hospitalized", "Cumulative Hospitalized", "Total Detected Deaths", "Active Ventilated",
-            ]
-        ]
-        return df_agg_continent
+        return DELPHIAggregationsPolicies.get_rollup(df_policy_predictions).get_aggregations(["continent"])
 
     @staticmethod
     def get_aggregation_world(df_policy_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1579,17 +1228,7 @@ class DELPHIAggregationsPolicies:
         :param df_policy_predictions: DELPHI policy predictions dataframe
         :return: DELPHI policy predictions dataframe aggregated at the world level
         """
-        df_agg_world = df_policy_predictions.groupby(["Policy", "Time", "Day"]).sum().reset_index()
-        df_agg_world["Continent"] = "None"
-        df_agg_world["Country"] = "None"
-        df_agg_world["Province"] = "None"
-        df_agg_world = df_agg_world[
-            [
-                "Policy", "Time", "Continent", "Country", "Province", "Day", "Total Detected", "Active",
-                "Active Hospitalized", "Cumulative Hospitalized", "Total Detected Deaths", "Active Ventilated",
-            ]
-        ]
-        return df_agg_world
+        return DELPHIAggregationsPolicies.get_rollup(df_policy_predictions).get_aggregations(["world"])
 
     @staticmethod
     def append_all_aggregations(df_policy_predictions: pd.DataFrame) -> pd.DataFrame:
@@ -1599,17 +1238,9 @@ class DELPHIAggregationsPolicies:
         :return: dataframe with raw policy predictions from DELPHI and aggregated ones at the country,
         continent & world levels
         """
-        df_agg_since_today_per_country = DELPHIAggregations.get_aggregation_per_country(df_policy_predictions)
-        df_agg_since_today_per_continent = DELPHIAggregations.get_aggregation_per_continent(df_policy_predictions)
-        df_agg_since_today_world = DELPHIAggregations.get_aggregation_world(df_policy_predictions)
-        df_policy_predictions = pd.concat(
-            [
-                df_policy_predictions,
-                df_agg_since_today_per_country,
-                df_agg_since_today_per_continent,
-                df_agg_since_today_world,
-            ]
-        )
+        # All the levels are aggregated at once by the rollup, separately for each policy and time
+        df_agg_since_today = DELPHIAggregationsPolicies.get_rollup(df_policy_predictions).get_aggregations()
+        df_policy_predictions = pd.concat([df_policy_predictions, df_agg_since_today])
         df_policy_predictions.sort_values(
             ["Policy", "Time", "Continent", "Country", "Province", "Day"], inplace=True
         )
@@ -1635,16 +1266,7 @@ class DELPHIBacktest:
         starting from the prediction date given by the user, and keeping only relevant columns
         :return: a dataframe with all relevant historical data
         """
-        list_historical_data_filepaths = [
-            self.historical_data_path + filename
-            for filename in os.listdir(self.historical_data_path)
-            if "Cases_" in filename
-        ]
-        df_historical = []
-        for filepath_historical in list_historical_data_filepaths:
-            df_historical.append(pd.read_csv(filepath_historical))
-
-        df_historical = pd.concat(df_historical).sort_values(
+        df_historical = load_case_history_store(self.historical_data_path).get_all_cases().sort_values(
             ["country", "province", "date"]
         ).reset_index(drop=True)[
             ["country", "province", "date", "day_since100", "case_cnt", "death_cnt"]
@@ -1770,6 +1392,651 @@ class DELPHIBacktest:
 
         return dict_df_backtest_metrics
 
+class DELPHILossCache:
+    """
+    Memoization of the loss functions of one area during the fitting process, as optimizers (line searches, simulated
+    annealing) evaluate the same or numerically identical parameter vectors several times, and as the fits of an area
+    (e.g. tnc and annealing in race mode) share the same loss function. Entries are keyed on the name of the loss
+    function and on the parameter vector quantized to a relative tolerance, and hold the value of the loss with its
+    gradient if it was computed. The least recently used entries are evicted when the memory taken by the cache exceeds
+    a given cap, and the number of hits and misses is tracked for the run logs
+    """
+    entry_overhead = 200  # Approximate memory in bytes taken by the dictionary entry, key tuple and value objects
+
+    def __init__(
+            self, relative_tolerance: float = loss_cache_relative_tolerance, max_memory: int = loss_cache_max_memory
+    ):
+        """
+        :param relative_tolerance: relative quantization step of the parameters, two parameter vectors whose
+        parameters have the same binary exponents and mantissas rounding to the same multiples of the tolerance share
+        the same entry (0 for exact matches only, on the raw bytes of the parameter vectors)
+        :param max_memory: memory cap of the cache in bytes
+        """
+        self.relative_tolerance = relative_tolerance
+        self.max_memory = max_memory
+        self.cache = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, params, loss_name: str) -> tuple:
+        """
+        :param params: parameter vector
+        :param loss_name: name of the loss function, entries of different loss functions are kept apart
+        :return: hashable key of the parameter vector, quantized to the relative tolerance of the cache
+        """
+        params = np.asarray(params, dtype=float)
+        if self.relative_tolerance > 0 and np.all(np.isfinite(params)):
+            mantissas, exponents = np.frexp(params)
+            quantized_params = np.concatenate([np.round(mantissas / self.relative_tolerance), exponents])
+            return loss_name, quantized_params.astype(np.int64).tobytes()
+        return loss_name, params.tobytes()
+
+    def get(self, params, loss_name: str, with_gradient: bool = False):
+        """
+        :param params: parameter vector
+        :param loss_name: name of the loss function
+        :param with_gradient: whether the gradient of the loss is needed, entries without it are then missed
+        :return: the value of the loss and its gradient (None if it wasn't computed) stored for this parameter vector
+        if any (marked as the most recently used), None otherwise
+        """
+        key = self.get_key(params, loss_name)
+        if key in self.cache and (not with_gradient or self.cache[key][1] is not None):
+            self.hits += 1
+            self.cache.move_to_end(key)
+            value, gradient, _ = self.cache[key]
+            return value, gradient
+        self.misses += 1
+        return None
+
+    def set(self, params, loss_name: str, value: float, gradient: np.ndarray = None) -> None:
+        """
+        Stores the value of the loss (and its gradient) for this parameter vector, an entry without gradient being
+        replaced when the gradient is given, and evicts the least recently used entries above the memory cap
+        :param params: parameter vector
+        :param loss_name: name of the loss function
+        :param value: value of the loss function for these parameters
+        :param gradient: gradient of the loss function for these parameters, if computed
+        """
+        key = self.get_key(params, loss_name)
+        if key in self.cache:
+            if gradient is None or self.cache[key][1] is not None:
+                return
+            self.memory -= self.cache.pop(key)[2]
+        size = self.entry_overhead + len(key[1]) + 8 + (np.asarray(gradient).nbytes if gradient is not None else 0)
+        self.cache[key] = (value, gradient, size)
+        self.memory += size
+        while self.memory > self.max_memory and len(self.cache) > 1:
+            _, (_, _, size_evicted) = self.cache.popitem(last=False)
+            self.memory -= size_evicted
+            self.evictions += 1
+
+    def get_summary(self) -> str:
+        """
+        :return: description of the usage of the cache for the run logs
+        """
+        n_calls = self.hits + self.misses
+        hit_rate = 100 * self.hits / n_calls if n_calls > 0 else 0
+        return (
+            f"{self.hits} hits and {self.misses} misses out of {n_calls} evaluations ({round(hit_rate, 2)}% hit rate), "
+            + f"{len(self.cache)} entries taking {round(self.memory / 1024 ** 2, 2)} MB, {self.evictions} evictions"
+        )
+
+
+class DELPHICaseHistoryStore:
+    """
+    Columnar store of the case histories of all the areas of a processed folder (the Cases_{country}_{province}.csv
+    files), built once in a case_history_store/ subfolder: each column is a single .npy file (memory-mapped when loaded
+    for the numeric ones), the dates are stored as integer day offsets from a reference date, and an area index gives
+    the rows of each area. Reading the history of an area is then a dictionary lookup and slices of the columns,
+    instead of parsing its csv file
+    """
+    folder_name = "case_history_store/"
+    instance = None  # Store of the current process, set by initialize
+
+    def __init__(self, path_to_processed_folder: str):
+        """
+        :param path_to_processed_folder: path to the processed folder containing the Cases_*.csv files, the store has
+        to be built already (see build)
+        """
+        self.path_to_store = path_to_processed_folder + self.folder_name
+        with open(self.path_to_store + "metadata.json", "r") as f:
+            metadata = json.load(f)
+        self.dict_columns = {
+            column: np.load(self.path_to_store + f"{column}.npy", mmap_mode="r").view(np.ndarray)
+            for column in metadata["columns_values"]
+        }
+        # Text columns (country, province...) can't be memory-mapped as objects, missing values are stored as ""
+        for column in metadata["columns_text"]:
+            values_column = np.load(self.path_to_store + f"{column}.npy").astype(object)
+            values_column[values_column == ""] = np.nan
+            self.dict_columns[column] = values_column
+        day_offsets = np.load(self.path_to_store + "day_offset.npy", mmap_mode="r")
+        # Dates are served as the strings of the csv files, as the readers compare them with string dates
+        self.dict_columns["date"] = np.datetime_as_string(
+            np.datetime64(metadata["reference_date"], "D") + day_offsets.astype("timedelta64[D]")
+        ).astype(object)
+        df_index = pd.read_csv(self.path_to_store + "index.csv", keep_default_na=False)
+        self.dict_area_index = {
+            area: (start, stop, columns.split(";"), columns_missing.split(";") if columns_missing else [])
+            for area, start, stop, columns, columns_missing in zip(
+                df_index.area, df_index.start, df_index.stop, df_index["columns"], df_index.columns_missing
+            )
+        }
+
+    @classmethod
+    def initialize(cls, path_to_processed_folder: str) -> None:
+        """
+        Loads the store of the current process, to be used as initializer of the multiprocessing pool
+        :param path_to_processed_folder: path to the processed folder containing the Cases_*.csv files
+        """
+        cls.instance = cls(path_to_processed_folder)
+
+    @classmethod
+    def build(cls, path_to_processed_folder: str) -> None:
+        """
+        Ingests all the Cases_*.csv files of the processed folder into the columnar store. The store is built in a
+        temporary folder next to it and then swapped in place, so that an interrupted build never leaves a partial
+        store behind
+        :param path_to_processed_folder: path to the processed folder containing the Cases_*.csv files
+        """
+        path_to_store = path_to_processed_folder + cls.folder_name
+        path_to_store_tmp = path_to_processed_folder + cls.folder_name.rstrip("/") + f"_{os.getpid()}.tmp/"
+        if os.path.exists(path_to_store_tmp):
+            shutil.rmtree(path_to_store_tmp)
+        os.mkdir(path_to_store_tmp)
+        list_source_files = cls.get_list_source_files(path_to_processed_folder)
+        list_areas = [filename[len("Cases_"):-len(".csv")] for filename in list_source_files]
+        list_df_areas = [pd.read_csv(path_to_processed_folder + filename) for filename in list_source_files]
+        list_dates_areas = [pd.to_datetime(df_area.date).values.astype("datetime64[D]") for df_area in list_df_areas]
+        reference_date = min(dates_area.min() for dates_area in list_dates_areas)
+        # Columns entirely missing in an area (e.g. province for countries) are served as NaN and not stored
+        list_columns_missing_areas = [
+            [column for column in df_area.columns if df_area[column].isnull().all()] for df_area in list_df_areas
+        ]
+        columns_values, columns_text = [], []
+        for df_area, columns_missing in zip(list_df_areas, list_columns_missing_areas):
+            for column in df_area.columns:
+                if column == "date" or column in columns_missing or column in columns_values + columns_text:
+                    continue
+                if pd.api.types.is_numeric_dtype(df_area[column]):
+                    columns_values.append(column)
+                else:
+                    columns_text.append(column)
+        for column in columns_values + columns_text:
+            list_values_column = []
+            for df_area in list_df_areas:
+                if column in df_area:
+                    list_values_column.append(df_area[column].values)
+                else:
+                    list_values_column.append(np.full(len(df_area), np.nan))
+            if column in columns_values:
+                dtype_column = np.result_type(*[
+                    df_area[column].dtype for df_area, columns_missing in zip(list_df_areas, list_columns_missing_areas)
+                    if column in df_area and column not in columns_missing
+                ])
+                values_column = np.concatenate([values.astype(dtype_column) for values in list_values_column])
+            else:
+                values_column = np.concatenate([
+                    np.where(pd.isnull(values), "", values).astype(str) for values in list_values_column
+                ])
+            np.save(path_to_store_tmp + f"{column}.npy", values_column)
+        np.save(path_to_store_tmp + "day_offset.npy", np.concatenate([
+            (dates_area - reference_date).astype(np.int32) for dates_area in list_dates_areas
+        ]))
+        list_n_rows_areas = [len(df_area) for df_area in list_df_areas]
+        pd.DataFrame({
+            "area": list_areas,
+            "start": np.cumsum(list_n_rows_areas) - list_n_rows_areas,
+            "stop": np.cumsum(list_n_rows_areas),
+            "columns": [";".join(df_area.columns) for df_area in list_df_areas],
+            "columns_missing": [";".join(columns_missing) for columns_missing in list_columns_missing_areas],
+        }).to_csv(path_to_store_tmp + "index.csv", index=False)
+        # Metadata is written last, its modification time is the build time of the store
+        with open(path_to_store_tmp + "metadata.json", "w") as f:
+            json.dump({
+                "reference_date": str(reference_date), "columns_values": columns_values, "columns_text": columns_text,
+                "source_files": list_source_files,
+            }, f)
+        # A folder can only replace an empty one, the previous store is moved aside before being removed
+        path_to_store_old = path_to_processed_folder + cls.folder_name.rstrip("/") + f"_{os.getpid()}.old/"
+        if os.path.exists(path_to_store):
+            os.replace(path_to_store, path_to_store_old)
+        os.replace(path_to_store_tmp, path_to_store)
+        if os.path.exists(path_to_store_old):
+            shutil.rmtree(path_to_store_old)
+
+    @staticmethod
+    def get_list_source_files(path_to_processed_folder: str) -> list:
+        """
+        :param path_to_processed_folder: path to the processed folder containing the Cases_*.csv files
+        :return: sorted list of the names of the Cases_*.csv files of the processed folder
+        """
+        return sorted(
+            filename for filename in os.listdir(path_to_processed_folder)
+            if filename.startswith("Cases_") and filename.endswith(".csv")
+        )
+
+    @classmethod
+    def is_up_to_date(cls, path_to_processed_folder: str) -> bool:
+        """
+        :param path_to_processed_folder: path to the processed folder containing the Cases_*.csv files
+        :return: a boolean, True if the store exists, was built from the csv files currently in the folder (none was
+        added, deleted or renamed since) and after their last modification
+        """
+        path_to_metadata = path_to_processed_folder + cls.folder_name + "metadata.json"
+        if not os.path.exists(path_to_metadata):
+            return False
+        with open(path_to_metadata, "r") as f:
+            metadata = json.load(f)
+        list_source_files = cls.get_list_source_files(path_to_processed_folder)
+        if metadata.get("source_files") != list_source_files:
+            return False
+        time_build = os.path.getmtime(path_to_metadata)
+        return all(
+            os.path.getmtime(path_to_processed_folder + filename) <= time_build for filename in list_source_files
+        )
+
+    def get_cases(self, country_sub: str, province_sub: str) -> Union[pd.DataFrame, None]:
+        """
+        :param country_sub: country as in the name of the csv file of the area (spaces replaced by underscores)
+        :param province_sub: province as in the name of the csv file of the area
+        :return: the same DataFrame as reading Cases_{country_sub}_{province_sub}.csv, with numeric columns that are
+        read-only views of the store, or None if there is no history for that area
+        """
+        return self.get_area_cases(f"{country_sub}_{province_sub}")
+
+    def get_area_cases(self, area: str) -> Union[pd.DataFrame, None]:
+        """
+        :param area: area as in the name of its csv file, i.e. Cases_{area}.csv
+        :return: the case history of that area, or None if there is none (see get_cases)
+        """
+        area_index = self.dict_area_index.get(area)
+        if area_index is None:
+            return None
+        start, stop, columns, columns_missing = area_index
+        return pd.DataFrame({
+            column: np.full(stop - start, np.nan) if column in columns_missing
+            else self.dict_columns[column][start:stop]
+            for column in columns
+        }, copy=False)
+
+    def get_all_cases(self) -> pd.DataFrame:
+        """
+        :return: the concatenation of the case histories of all the areas of the store
+        """
+        return pd.concat([self.get_area_cases(area) for area in self.dict_area_index]).reset_index(drop=True)
+
+
+def load_case_history_store(path_to_processed_folder: str) -> DELPHICaseHistoryStore:
+    """
+    Loads the case history store of a processed folder, (re)building it first if it doesn't exist or if some
+    Cases_*.csv file was added, deleted, renamed or modified since it was built
+    :param path_to_processed_folder: path to the processed folder containing the Cases_*.csv files
+    :return: the DELPHICaseHistoryStore of that folder
+    """
+    if not DELPHICaseHistoryStore.is_up_to_date(path_to_processed_folder):
+        DELPHICaseHistoryStore.build(path_to_processed_folder)
+    return DELPHICaseHistoryStore(path_to_processed_folder)
+
+
+class DELPHIAreaDataStore:
+    """
+    Read-only store of the per-area inputs of the fitting process (population, past parameters, initial states and
+    past predictions, case histories), indexed by area. It is loaded once per worker process by the pool initializer, so that the
+    tasks sent to the workers only carry the area key instead of pickling whole DataFrames for each task, and so that
+    workers look the inputs of an area up instead of filtering the DataFrames with boolean masks
+    """
+    instance = None  # Store of the current process, set by initialize
+    # Area names are read as raw strings, otherwise provinces such as "None" are parsed as NaN and can't be looked up
+    converters_area = {column: str for column in ["Continent", "Country", "Province"]}
+
+    def __init__(
+            self, path_to_population: str, path_to_initial_states: str, path_to_past_parameters: str = None,
+            path_to_past_predictions: str = None, past_prediction_date: str = None,
+            path_to_case_history_store: str = None,
+    ):
+        """
+        :param path_to_population: path to the population file (Population_Global.csv)
+        :param path_to_initial_states: path to the file with the predicted model states at the fitting start date
+        :param path_to_past_parameters: path to the past parameters file, if it doesn't exist no past parameters are
+        available for any area
+        :param path_to_past_predictions: path to the past predictions file used for the confidence intervals, if None
+        or if it doesn't exist no past predictions are available for any area
+        :param past_prediction_date: only the past predictions strictly after that date (format 'YYYY-MM-DD') are kept
+        :param path_to_case_history_store: path to the processed folder whose DELPHICaseHistoryStore (already built)
+        serves the case histories, if None no case history is available for any area
+        """
+        popcountries = pd.read_csv(path_to_population, converters=self.converters_area)
+        # Dictionaries built from the rows in file order, so that the last row of an area is kept as before
+        self.dict_population = MappingProxyType({
+            (country, province): population
+            for country, province, population in zip(popcountries.Country, popcountries.Province, popcountries.pop2016)
+        })
+        df_initial_states = pd.read_csv(
+            path_to_initial_states, converters={column.lower(): str for column in self.converters_area}
+        )
+        dict_initial_states = {}
+        for _, row in df_initial_states.iterrows():
+            initial_state = None
+            if not pd.isna(row.S):
+                initial_state = np.array(row.values[:16], dtype=float)
+                initial_state.flags.writeable = False
+            dict_initial_states[(row.continent, row.country, row.province)] = initial_state
+        self.dict_initial_states = MappingProxyType(dict_initial_states)
+        self.list_areas = list(dict_initial_states.keys())
+        dict_past_parameters = {}
+        if path_to_past_parameters is not None and os.path.exists(path_to_past_parameters):
+            past_parameters = pd.read_csv(path_to_past_parameters, converters=self.converters_area)
+            for country, province, parameter_list_line in zip(
+                    past_parameters.Country, past_parameters.Province, past_parameters.values.tolist()
+            ):
+                dict_past_parameters[(country, province)] = tuple(parameter_list_line)
+        self.dict_past_parameters = MappingProxyType(dict_past_parameters)
+        self.past_predictions = DELPHIPastPredictions(path_to_past_predictions, past_prediction_date)
+        self.case_history_store = None
+        if path_to_case_history_store is not None:
+            self.case_history_store = DELPHICaseHistoryStore(path_to_case_history_store)
+
+    @classmethod
+    def initialize(cls, **kwargs) -> None:
+        """
+        Loads the store of the current process, to be used as initializer of the multiprocessing pool. The store isn't
+        reloaded if it was already loaded with the same arguments, e.g. when inherited from the parent process by fork
+        :param kwargs: paths to the input files, see the constructor
+        """
+        if cls.instance is None or cls.instance.kwargs != kwargs:
+            cls.instance = cls(**kwargs)
+            cls.instance.kwargs = kwargs
+
+    def get_population(self, country: str, province: str) -> Union[float, None]:
+        return self.dict_population.get((country, province))
+
+    def get_initial_state(self, continent: str, country: str, province: str) -> Union[np.ndarray, None]:
+        return self.dict_initial_states.get((continent, country, province))
+
+    def get_past_parameters(self, country: str, province: str) -> Union[list, None]:
+        """
+        :return: the last line of the past parameters file for that area (Continent, Country, Province, Data Start
+        Date, MAPE and the 12 parameters) as a list, or None if there is none
+        """
+        parameter_list_line = self.dict_past_parameters.get((country, province))
+        return list(parameter_list_line) if parameter_list_line is not None else None
+
+    def get_cases(self, country_sub: str, province_sub: str) -> Union[pd.DataFrame, None]:
+        """
+        :return: the case history of that area (see DELPHICaseHistoryStore.get_cases), or None if there is none
+        """
+        if self.case_history_store is None:
+            return None
+        return self.case_history_store.get_cases(country_sub, province_sub)
+
+    def get_past_predictions(self, country: str, province: str) -> pd.DataFrame:
+        """
+        :return: the past predictions of that area after the past prediction date, sorted by day (empty DataFrame if
+        there are none)
+        """
+        return self.past_predictions.get_past_predictions(country, province)
+
+
+class DELPHIAreaScheduler:
+    """
+    Longest-job-first scheduling of the areas fitted in parallel: areas are dispatched by decreasing historical fitting
+    time (areas without history first, as their runtime is unknown), so that the slowest areas don't end up at the
+    tail of the run. The runtimes are smoothed over runs and persisted in a csv file between runs
+    """
+    def __init__(self, path_to_runtimes: str, smoothing: float = 0.5):
+        """
+        :param path_to_runtimes: path to the csv file where the runtimes of the areas are persisted
+        :param smoothing: weight of the latest runtime in the exponential smoothing of the runtimes of an area
+        """
+        self.path_to_runtimes = path_to_runtimes
+        self.smoothing = smoothing
+        self.dict_runtimes = {}
+        if os.path.exists(path_to_runtimes):
+            df_runtimes = pd.read_csv(path_to_runtimes, keep_default_na=False)
+            self.dict_runtimes = {
+                (continent, country, province): runtime
+                for continent, country, province, runtime in zip(
+                    df_runtimes.Continent, df_runtimes.Country, df_runtimes.Province, df_runtimes.Runtime
+                )
+            }
+
+    def sort_longest_first(self, list_tuples: list) -> list:
+        """
+        :param list_tuples: list of tuples whose first 3 elements are (continent, country, province)
+        :return: the same tuples, sorted by decreasing historical runtime of the areas
+        """
+        return sorted(list_tuples, key=lambda x: -self.dict_runtimes.get(tuple(x[:3]), np.inf))
+
+    def update(self, tuple_area: tuple, runtime: float) -> None:
+        """
+        :param tuple_area: tuple (continent, country, province)
+        :param runtime: runtime in seconds of the latest fitting process for that area
+        """
+        if tuple_area in self.dict_runtimes:
+            runtime = self.smoothing * runtime + (1 - self.smoothing) * self.dict_runtimes[tuple_area]
+        self.dict_runtimes[tuple_area] = runtime
+
+    def save(self) -> None:
+        df_runtimes = pd.DataFrame(
+            [(continent, country, province, runtime)
+             for (continent, country, province), runtime in self.dict_runtimes.items()],
+            columns=["Continent", "Country", "Province", "Runtime"],
+        ).sort_values("Runtime", ascending=False)
+        df_runtimes.to_csv(self.path_to_runtimes, index=False)
+
+
+class DELPHIAreaFitTracker:
+    """
+    Tracks how the fit of each area of a run was obtained, for the run logs: read from the fit cache, carried forward
+    from yesterday's parameters in skip-refit mode, or refit by the optimizer. Each area is counted in exactly one of
+    these, e.g. an area whose carried forward fit was read from the fit cache is only counted as read from the cache
+    """
+    list_origins = ["fit_cached", "carried_forward", "refit"]
+
+    def __init__(self):
+        self.dict_areas_origin = {origin: [] for origin in self.list_origins}
+
+    @staticmethod
+    def get_origin(output: OptimizeResult) -> str:
+        """
+        :param output: OptimizeResult returned for the area, with the fit_cached and carried_forward flags if any
+        :return: the origin of the fit, one of fit_cached, carried_forward or refit
+        """
+        if output.get("fit_cached", False):
+            return "fit_cached"
+        elif output.get("carried_forward", False):
+            return "carried_forward"
+        else:
+            return "refit"
+
+    def update(self, tuple_area: tuple, output: OptimizeResult) -> str:
+        """
+        :param tuple_area: tuple identifying the area, e.g. (country, province)
+        :param output: OptimizeResult returned for the area
+        :return: the origin of the fit of the area, see get_origin
+        """
+        origin = self.get_origin(output)
+        self.dict_areas_origin[origin].append(tuple_area)
+        return origin
+
+    def get_areas(self, origin: str) -> list:
+        """
+        :param origin: one of fit_cached, carried_forward or refit
+        :return: the areas whose fit has that origin, in the order they were tracked
+        """
+        if origin not in self.dict_areas_origin:
+            raise ValueError(f"Origin {origin} not supported, should be one of {self.list_origins}")
+        return self.dict_areas_origin[origin]
+
+
+class DELPHIFitCache:
+    """
+    Content-addressed cache of the fit outputs of the areas, persisted in a fit_cache/ folder with one .npz file per
+    entry: the key of an entry is a hash of everything the fit of an area depends on (case history slice, warm start
+    parameters, bounds, optimizer settings and version of the model code), so that rerunning the model on the same
+    inputs (e.g. after a crash, or with different saving options) reads the fits instead of running the optimizers
+    again. An entry holds the outcome of the optimizer (best parameters, loss and flags of the run such as
+    carried_forward or race) and the trajectory of the model states with the best parameters
+    """
+    folder_name = "fit_cache/"
+
+    def __init__(self, path_to_folder: str):
+        """
+        :param path_to_folder: path to the folder in which the fit_cache/ folder is (or will be) created
+        """
+        self.path_to_cache = path_to_folder + self.folder_name
+
+    @staticmethod
+    def get_code_version(list_paths_code: list) -> str:
+        """
+        :param list_paths_code: paths to the source files of the model code the fits depend on
+        :return: hash of the content of these files, so that entries are invalidated by any change of the model code
+        """
+        hash_code = hashlib.sha256()
+        for path_code in list_paths_code:
+            with open(path_code, "rb") as f:
+                hash_code.update(f.read())
+        return hash_code.hexdigest()[:16]
+
+    @staticmethod
+    def get_key(dict_inputs: dict) -> str:
+        """
+        :param dict_inputs: dictionary with the inputs of the fit of an area, values are either numpy arrays (e.g. the
+        case history slice), DataFrames or objects with a deterministic repr (numbers, strings, lists, tuples, dicts)
+        :return: key of the entry of the fit, hash of the names and values of the inputs
+        """
+        hash_inputs = hashlib.sha256()
+        for name_input in sorted(dict_inputs):
+            value_input = dict_inputs[name_input]
+            hash_inputs.update(name_input.encode())
+            if isinstance(value_input, pd.DataFrame):
+                hash_inputs.update(repr(list(value_input.columns)).encode())
+                value_input = value_input.values
+            if isinstance(value_input, np.ndarray):
+                hash_inputs.update(f"{value_input.dtype}{value_input.shape}".encode())
+                hash_inputs.update(np.ascontiguousarray(value_input).tobytes())
+            else:
+                hash_inputs.update(repr(value_input).encode())
+        return hash_inputs.hexdigest()[:32]
+
+    def get_path_entry(self, key: str) -> str:
+        return self.path_to_cache + f"{key}.npz"
+
+    def get(self, key: str) -> Union[tuple, None]:
+        """
+        :param key: key of the entry, see get_key
+        :return: None if there is no entry for that key, otherwise a tuple with the OptimizeResult of the fit (flagged
+        with fit_cached) and the trajectory of the model states with its best parameters (None for failed fits)
+        """
+        path_entry = self.get_path_entry(key)
+        if not os.path.exists(path_entry):
+            return None
+        with np.load(path_entry, allow_pickle=False) as entry:
+            dict_output = json.loads(str(entry["output"]))
+            dict_output["x"] = entry["x"]
+            x_sol = entry["x_sol"] if "x_sol" in entry.files else None
+        output = OptimizeResult(**dict_output)
+        output["fit_cached"] = True
+        return output, x_sol
+
+    def set(self, key: str, output: OptimizeResult, x_sol: Union[np.ndarray, None], metadata: dict) -> None:
+        """
+        Stores the outputs of the fit of an area, the entry is written in a temporary file first so that concurrent
+        workers or an interrupted run never leave a partial entry
+        :param key: key of the entry, see get_key
+        :param output: OptimizeResult of the fit, only its parameters and its scalar (or tuples of scalars) fields are
+        stored
+        :param x_sol: trajectory of the model states with the best parameters, None for failed fits
+        :param metadata: dictionary describing the fit (area, optimizer...), used to inspect the cache
+        """
+        if not os.path.exists(self.path_to_cache):
+            os.makedirs(self.path_to_cache, exist_ok=True)
+
+        def is_stored(value) -> bool:
+            if isinstance(value, (tuple, list)):
+                return all(is_stored(element) for element in value)
+            return isinstance(value, (bool, int, float, str, np.generic))
+
+        def to_json(value):
+            if isinstance(value, (tuple, list)):
+                return [to_json(element) for element in value]
+            return value.item() if isinstance(value, np.generic) else value
+
+        dict_output = {
+            name: to_json(value) for name, value in output.items()
+            if name not in ["x", "fit_cached"] and is_stored(value)
+        }
+        metadata = dict(metadata, key=key, created=datetime.now().isoformat(timespec="seconds"))
+        dict_arrays = dict(
+            x=np.asarray(output.x, dtype=float), output=np.array(json.dumps(dict_output)),
+            metadata=np.array(json.dumps({name: to_json(value) for name, value in metadata.items()})),
+        )
+        if x_sol is not None:
+            dict_arrays["x_sol"] = np.asarray(x_sol)
+        path_entry_tmp = self.path_to_cache + f"{key}_{os.getpid()}.tmp.npz"
+        np.savez(path_entry_tmp, **dict_arrays)
+        os.replace(path_entry_tmp, self.get_path_entry(key))
+
+    def get_list_keys(self) -> list:
+        """
+        :return: the keys of all the entries of the cache
+        """
+        if not os.path.exists(self.path_to_cache):
+            return []
+        return sorted(
+            filename[:-len(".npz")] for filename in os.listdir(self.path_to_cache)
+            if filename.endswith(".npz") and not filename.endswith(".tmp.npz")
+        )
+
+    def get_metadata(self, key: str) -> dict:
+        """
+        :param key: key of the entry
+        :return: the metadata of the entry, along with the loss, success and size on disk of the entry
+        """
+        path_entry = self.get_path_entry(key)
+        with np.load(path_entry, allow_pickle=False) as entry:
+            metadata = json.loads(str(entry["metadata"]))
+            dict_output = json.loads(str(entry["output"]))
+        metadata.update(
+            fun=dict_output.get("fun"), success=dict_output.get("success"), size=os.path.getsize(path_entry)
+        )
+        return metadata
+
+    def get_entries(self) -> pd.DataFrame:
+        """
+        :return: a DataFrame with the metadata of all the entries of the cache (see get_metadata), one row per entry
+        """
+        return pd.DataFrame([self.get_metadata(key) for key in self.get_list_keys()])
+
+    def evict(self, list_keys: list) -> int:
+        """
+        :param list_keys: keys of the entries to remove from the cache
+        :return: the number of entries removed
+        """
+        n_evicted = 0
+        for key in list_keys:
+            if os.path.exists(self.get_path_entry(key)):
+                os.remove(self.get_path_entry(key))
+                n_evicted += 1
+        return n_evicted
+
+
+def run_timed_on_area(function, tuple_area_: tuple) -> (tuple, float, object):
+    """
+    Runs the function on one area and measures its runtime, to be used with an unordered pool.imap so that the area
+    each result corresponds to is known
+    :param function: function taking the area tuple as only argument
+    :param tuple_area_: tuple whose first 3 elements are (continent, country, province)
+    :return: tuple with (continent, country, province), the runtime in seconds and the result of the function
+    """
+    time_start = time.time()
+    result = function(tuple_area_)
+    return tuple(tuple_area_[:3]), time.time() - time_start, result
+
+
 def get_initial_conditions(params_fitted: tuple, global_params_fixed: tuple) -> list:
     """
     Generates the initial conditions for the DELPHI model based on global fixed parameters (mostly populations and some
@@ -1812,6 +2079,37 @@ def get_initial_conditions(params_fitted: tuple, global_params_fixed: tuple) ->
     return x_0_cases
 
 
+def get_initial_conditions_derivatives(params_fitted: tuple, global_params_fixed: tuple) -> np.ndarray:
+    """
+    Generates the derivatives of the initial conditions given by get_initial_conditions with respect to the fitted
+    parameters, used as starting point of the forward sensitivity equations (only k1, k2, k3 and p_dth are involved)
+    :param params_fitted: tuple of parameters being fitted, mostly interested in k1, k2, k3 and p_dth here
+    :param global_params_fixed: tuple of fixed and constant parameters for the model defined a while ago
+    :return: a numpy array of shape (16, 12) with the derivative of initial state i with respect to parameter j
+    """
+    alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3 = params_fitted
+    N, R_upperbound, R_heuristic, R_0, PopulationD, PopulationI, p_d, p_h, p_v = global_params_fixed
+
+    PopulationR = min(R_upperbound - 1, min(int(R_0*p_d), R_heuristic))
+    PopulationCI_over_k3 = PopulationI - PopulationD - PopulationR
+    PopulationCI = PopulationCI_over_k3*k3
+    # Every initial state is an affine function of PopulationCI, with the following coefficients
+    coefficients_CI = np.array([
+        -(1 + k1 + k2) / p_d, k1 / p_d, k2 / p_d, (1 / p_d - 1) * (1 - p_dth), p_h * (1 - p_dth),
+        (1 - p_h) * (1 - p_dth), (1 / p_d - 1) * p_dth, p_h * p_dth, (1 - p_h) * p_dth, 0, 0, p_h,
+        p_h * p_v * (1 - p_dth), p_h * p_v * p_dth, 0, 0,
+    ])
+    d_coefficients_CI_d_p_dth = np.array([
+        0, 0, 0, -(1 / p_d - 1), -p_h, -(1 - p_h), 1 / p_d - 1, p_h, 1 - p_h, 0, 0, 0, -p_h * p_v, p_h * p_v, 0, 0,
+    ])
+    dx_0_dparams = np.zeros((16, 12))
+    dx_0_dparams[:, 4] = PopulationCI * d_coefficients_CI_d_p_dth
+    dx_0_dparams[[0, 1], 6] = -PopulationCI / p_d, PopulationCI / p_d
+    dx_0_dparams[[0, 2], 7] = -PopulationCI / p_d, PopulationCI / p_d
+    dx_0_dparams[:, 11] = PopulationCI_over_k3 * coefficients_CI
+    return dx_0_dparams
+
+
 def get_initial_conditions_with_testing(params_fitted: tuple, global_params_fixed: tuple) -> list:
     """
     Generates the initial conditions for the DELPHI model based on global fixed parameters (mostly populations and some
@@ -1914,6 +2212,48 @@ def get_residuals_value(
     return residuals_value
 
 
+def get_residuals_gradient(
+        optimizer: str, balance: float, x_sol: list, x_sensitivities: np.ndarray, cases_data_fit: list,
+        deaths_data_fit: list, weights: list, balance_total_difference: float
+) -> np.ndarray:
+    """
+    Obtain the exact gradient of the loss function given by get_residuals_value with respect to the fitted parameters,
+    from the sensitivities of the solution obtained with the forward sensitivity equations
+    :param optimizer: String, for now either tnc, trust-constr or annealing
+    :param balance: Regularization coefficient between cases and deaths
+    :param x_sol: Solution previously fitted by the optimizer containing fitted values for all 16 states
+    :param x_sensitivities: derivatives of the solution with respect to the 12 parameters, of shape (16, 12, T)
+    :param cases_data_fit: cases data to be fitted on
+    :param deaths_data_fit: deaths data to be fitted on
+    :param weights: time-related weights to give more importance to recent data points in the fit (in the loss function)
+    :param balance_total_difference: Regularization coefficient between the loss on the 7-day differences and the loss
+    on the cumulative values (only for tnc and annealing)
+    :return: numpy array of shape (12,), corresponding to the gradient of the loss function
+    """
+    cases_data_fit = np.array(cases_data_fit)
+    deaths_data_fit = np.array(deaths_data_fit)
+    weights = np.array(weights)
+    gradient_total = (
+        x_sensitivities[15] @ (2 * weights * (x_sol[15, :] - cases_data_fit))
+        + balance * balance * x_sensitivities[14] @ (2 * weights * (x_sol[14, :] - deaths_data_fit))
+    )
+    if optimizer in ["trust-constr"]:
+        residuals_gradient = gradient_total
+    elif optimizer in ["tnc", "annealing"]:
+        residuals_gradient = (
+            (x_sensitivities[15, :, 7:] - x_sensitivities[15, :, :-7]) @ (2 * weights[7:] * (
+                x_sol[15, 7:] - x_sol[15, :-7] - cases_data_fit[7:] + cases_data_fit[:-7]
+            ))
+            + balance * balance * (x_sensitivities[14, :, 7:] - x_sensitivities[14, :, :-7]) @ (2 * weights[7:] * (
+                x_sol[14, 7:] - x_sol[14, :-7] - deaths_data_fit[7:] + deaths_data_fit[:-7]
+            ))
+        ) + gradient_total * balance_total_difference * balance_total_difference
+    else:
+        raise ValueError("Optimizer not in 'tnc', 'trust-constr' or 'annealing' so not supported")
+
+    return residuals_gradient
+
+
 def get_mape_data_fitting(cases_data_fit: list, deaths_data_fit: list, x_sol_final: np.array) -> float:
     """
     Computes MAPE on cases & deaths (averaged) either on last 15 days of historical data (if there are more than 15)
@@ -1943,6 +2283,81 @@ def get_mape_data_fitting(cases_data_fit: list, deaths_data_fit: list, x_sol_fin
     return mape_data
 
 
+def get_carried_forward_fit(
+        delphi_model, parameter_list_line: list, start_date_fitting: str, t_cases: list, global_params_fixed: tuple,
+        optimizer: str, balance: float, cases_data_fit: list, deaths_data_fit: list, weights: list,
+        balance_total_difference: float, ode_solver: str, n_substeps: int, reinitialize_params=None,
+        window: int = skip_refit_window, mape_threshold: float = skip_refit_mape_threshold,
+        mape_drift_threshold: float = skip_refit_mape_drift_threshold,
+) -> (Union[OptimizeResult, None], Union[float, None], Union[float, None]):
+    """
+    Decides in skip-refit mode whether yesterday's fitted parameters of an area are carried forward instead of being
+    refitted: they are evaluated on the extended window of data, with the jump shifted to the start date of the
+    fitting, and are carried forward if their MAPE on the most recent days is small enough and their in-sample MAPE
+    didn't drift too much from yesterday's
+    :param delphi_model: DELPHI ODE model of the area used for the fitting
+    :param parameter_list_line: yesterday's parameters line of the area (continent, country, province, start date,
+    MAPE and the 12 fitted parameters)
+    :param start_date_fitting: start date of today's fitting (format 'YYYY-MM-DD'), or None if it is yesterday's
+    :param t_cases: time steps of the data to be fitted on
+    :param global_params_fixed: fixed parameters of the area used for the initial conditions
+    :param optimizer: optimizer of the area, used for the value of the loss function
+    :param balance: regularization coefficient between cases and deaths
+    :param cases_data_fit: cases data to be fitted on
+    :param deaths_data_fit: deaths data to be fitted on
+    :param weights: time-related weights of the loss function
+    :param balance_total_difference: regularization coefficient of the total differences in the loss function
+    :param ode_solver: ODE solver used for the fitting
+    :param n_substeps: number of steps per day of the fixed-step ODE solvers
+    :param reinitialize_params: function clipping the parameters to their re-initialization values before solving, if
+    any, as in the loss function of the fitting
+    :param window: number of most recent days on which yesterday's parameters are evaluated
+    :param mape_threshold: maximum MAPE (%) on that recent window to carry yesterday's parameters forward
+    :param mape_drift_threshold: maximum increase of the in-sample MAPE (% points) to carry them forward
+    :return: a tuple with the OptimizeResult of the carried forward parameters (None if they must be refitted), and
+    the MAPE on the recent window and the in-sample MAPE drift (both None if yesterday's parameters couldn't be solved)
+    """
+    # Yesterday's fitted parameters as they are (the warm start of the optimizers may reset some of them), only with
+    # the jump shifted to the start date of the fitting
+    parameter_list_past = list(parameter_list_line[5:])
+    past_start_date = pd.to_datetime(parameter_list_line[3])
+    if start_date_fitting is not None and pd.to_datetime(start_date_fitting) > past_start_date:
+        parameter_list_past[9] = parameter_list_past[9] - (pd.to_datetime(start_date_fitting) - past_start_date).days
+    params_past = reinitialize_params(parameter_list_past) if reinitialize_params is not None else parameter_list_past
+    x_sol_past = delphi_model.solve(
+        params_past, x_0=get_initial_conditions(params_past, global_params_fixed), t_eval=t_cases, method=ode_solver,
+        n_substeps=n_substeps
+    )
+    if x_sol_past.status != 0:
+        return None, None, None
+    mape_recent_window = (
+        compute_mape(cases_data_fit[-window:], x_sol_past.y[15, -window:])
+        + compute_mape(deaths_data_fit[-window:], x_sol_past.y[14, -window:])
+    ) / 2
+    mape_drift = get_mape_data_fitting(
+        cases_data_fit=cases_data_fit, deaths_data_fit=deaths_data_fit, x_sol_final=x_sol_past.y
+    ) - parameter_list_line[4]
+    if mape_recent_window > mape_threshold or mape_drift > mape_drift_threshold:
+        return None, mape_recent_window, mape_drift
+    output = OptimizeResult(
+        x=np.array(parameter_list_past),
+        fun=get_residuals_value(
+            optimizer=optimizer,
+            balance=balance,
+            x_sol=x_sol_past.y,
+            cases_data_fit=cases_data_fit,
+            deaths_data_fit=deaths_data_fit,
+            weights=weights,
+            balance_total_difference=balance_total_difference
+        ),
+        success=True,
+        nit=0,
+        message="Parameters carried forward from yesterday",
+        carried_forward=True,
+    )
+    return output, mape_recent_window, mape_drift
+
+
 def compute_sign_mape(y_true: list, y_pred: list) -> float:
     """
     Compute the sign of the Mean Percentage Error, mainly to know if we're constantly over or undershooting
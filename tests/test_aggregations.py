@@ -0,0 +1,303 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+from datetime import datetime
+from DELPHI_utils_V4_dynamic import make_increasing
+from DELPHI_utils_V4_static import DELPHIAggregations, DELPHIAggregationsPolicies, DELPHIRollup
+
+columns_area = ["Continent", "Country", "Province"]
+columns_metrics_policies = [
+    "Total Detected", "Active", "Active Hospitalized", "Cumulative Hospitalized", "Total Detected Deaths",
+    "Active Ventilated",
+]
+columns_bounds = ["Total Detected LB", "Total Detected Deaths LB", "Total Detected UB", "Total Detected Deaths UB"]
+list_areas = [
+    ("Europe", "France", "None"),
+    ("Europe", "Spain", "Madrid"),
+    ("Europe", "Spain", "Catalonia"),
+    ("North America", "US", "New York"),
+    ("North America", "US", "Texas"),
+    ("North America", "Canada", "Ontario"),
+    ("Asia", "Japan", "None"),
+]
+# Areas with past predictions on all the days after the past prediction date, on only a few of them, or on none:
+# Canada, Asia and any continent or country not listed have no past predictions, so that their bounds are NaN
+n_days_past_predictions_areas = {
+    ("North America", "US", "None"): 30,
+    ("Europe", "Spain", "None"): 4,
+    ("Europe", "None", "None"): 30,
+    ("North America", "None", "None"): 7,
+    ("None", "None", "None"): 30,
+}
+
+
+def get_df_predictions(seed: int) -> pd.DataFrame:
+    """
+    Predictions since 100 cases as saved by the model runs, around today so that the bounds widen with the days since
+    today: areas start on different days, the true values are missing after today and on a few days before
+    """
+    random_state = np.random.RandomState(seed)
+    today = pd.Timestamp(datetime.now().date())
+    list_df = []
+    for continent, country, province in list_areas:
+        first_day = today - pd.Timedelta(days=int(random_state.randint(15, 25)))
+        days = pd.date_range(first_day, today + pd.Timedelta(days=20))
+        total_detected = np.cumsum(random_state.randint(0, 1000, len(days)))
+        total_detected_deaths = np.cumsum(random_state.randint(0, 50, len(days)))
+        is_true = (days <= today) & (random_state.uniform(0, 1, len(days)) > 0.1)
+        noise = random_state.uniform(0.8, 1.2, (2, len(days)))
+        df_area = pd.DataFrame({
+            "Continent": continent, "Country": country, "Province": province, "Day": days.strftime("%Y-%m-%d"),
+            "Total Detected": total_detected,
+            "Active": random_state.randint(0, 1000, len(days)),
+            "Total Detected Deaths": total_detected_deaths,
+            "Total Detected True": np.where(is_true, np.round(total_detected * noise[0]), np.nan),
+            "Total Detected Deaths True": np.where(is_true, np.round(total_detected_deaths * noise[1]), np.nan),
+        })
+        for column_bound in columns_bounds:
+            df_area[column_bound] = df_area[column_bound.replace(" LB", "").replace(" UB", "")]
+        list_df.append(df_area)
+    return pd.concat(list_df).reset_index(drop=True)
+
+
+def get_past_predictions(past_prediction_date: str, seed: int) -> pd.DataFrame:
+    random_state = np.random.RandomState(seed)
+    list_df = []
+    for (continent, country, province), n_days in n_days_past_predictions_areas.items():
+        # Predictions up to the past prediction date are ignored
+        days = pd.date_range(pd.Timestamp(past_prediction_date) - pd.Timedelta(days=3), periods=n_days + 4)
+        list_df.append(pd.DataFrame({
+            "Continent": continent, "Country": country, "Province": province, "Day": days.strftime("%Y-%m-%d"),
+            "Total Detected": np.cumsum(random_state.randint(0, 5000, len(days))),
+            "Total Detected Deaths": np.cumsum(random_state.randint(0, 200, len(days))),
+        }))
+    return pd.concat(list_df).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def get_bounds_area_loop(
+        df_agg_area: pd.DataFrame, past_predictions_area: pd.DataFrame, past_prediction_date: str, q: float
+) -> pd.DataFrame:
+    """
+    Confidence intervals of one aggregated area as computed in the loops of the *_with_cf functions before
+    get_confidence_intervals_aggregations
+    """
+    total_detected = df_agg_area['Total Detected']
+    total_detected_deaths = df_agg_area['Total Detected Deaths']
+    cases_fit_data = df_agg_area['Total Detected True']
+    deaths_fit_data = df_agg_area['Total Detected Deaths True']
+    since_100_dates = df_agg_area['Day']
+    n_days_btw_today_since_100 = (datetime.now() - pd.to_datetime(min(since_100_dates))).days
+    if len(past_predictions_area) == 0:
+        return pd.DataFrame({
+            column_bound: [np.nan for _ in range(len(df_agg_area))] for column_bound in columns_bounds
+        })
+    cases_fit_data_past = [y for x, y in zip(since_100_dates, cases_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
+    deaths_fit_data_past = [y for x, y in zip(since_100_dates, deaths_fit_data) if ((x > past_prediction_date) and (not np.isnan(y)))]
+    total_detected_past = past_predictions_area["Total Detected"].values[:len(cases_fit_data_past)]
+    total_detected_deaths_past = past_predictions_area["Total Detected Deaths"].values[:len(deaths_fit_data_past)]
+    residual_cases_lb = np.sqrt(np.mean([(x - y) ** 2 for x, y in zip(cases_fit_data_past, total_detected_past)])) * scipy.stats.norm.ppf(0.5 - q / 2)
+    residual_cases_ub = np.sqrt(np.mean([(x - y) ** 2 for x, y in zip(cases_fit_data_past, total_detected_past)])) * scipy.stats.norm.ppf(0.5 + q / 2)
+    residual_deaths_lb = np.sqrt(np.mean([(x - y) ** 2 for x, y in zip(deaths_fit_data_past, total_detected_deaths_past)])) * scipy.stats.norm.ppf(0.5 - q / 2)
+    residual_deaths_ub = np.sqrt(np.mean([(x - y) ** 2 for x, y in zip(deaths_fit_data_past, total_detected_deaths_past)])) * scipy.stats.norm.ppf(0.5 + q / 2)
+    return pd.DataFrame({
+        "Total Detected LB": make_increasing([max(int(round(v + residual_cases_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)), 0)), 0) for c, v in enumerate(total_detected)]),
+        "Total Detected Deaths LB": make_increasing([max(int(round(v + residual_deaths_lb * np.sqrt(max(c - n_days_btw_today_since_100, 0)), 0)), 0) for c, v in enumerate(total_detected_deaths)]),
+        "Total Detected UB": [max(int(round(v + residual_cases_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)), 0)), 0) for c, v in enumerate(total_detected)],
+        "Total Detected Deaths UB": [max(int(round(v + residual_deaths_ub * np.sqrt(max(c - n_days_btw_today_since_100, 0)), 0)), 0) for c, v in enumerate(total_detected_deaths)],
+    })
+
+
+def append_all_aggregations_cf_loop(
+        df_predictions: pd.DataFrame, past_predictions: pd.DataFrame, past_prediction_date: str, q: float
+) -> pd.DataFrame:
+    """
+    Per-area loops of append_all_aggregations_cf before get_confidence_intervals_aggregations, the past predictions
+    being filtered for each aggregated area: by country and province for the countries, and by continent for the
+    continents and the world
+    """
+    past_predictions = past_predictions[past_predictions["Day"] > past_prediction_date]
+    columns_without_bounds = [x for x in df_predictions.columns if ("LB" not in x) and ("UB" not in x)]
+    list_df_aggregated = []
+    for columns_groupby, df_predictions_level in [
+        (["Continent", "Country", "Day"], df_predictions[df_predictions["Province"] != "None"]),
+        (["Continent", "Day"], df_predictions),
+        (["Day"], df_predictions),
+    ]:
+        df_agg = df_predictions_level[columns_without_bounds].groupby(columns_groupby).sum(min_count=1).reset_index()
+        for column in columns_area:
+            if column not in columns_groupby:
+                df_agg[column] = "None"
+        df_agg = df_agg[columns_without_bounds]
+        for continent, country, province in set(zip(df_agg["Continent"], df_agg["Country"], df_agg["Province"])):
+            is_past_predictions_area = (
+                (past_predictions["Country"] == country) & (past_predictions["Province"] == province)
+            )
+            if country == "None":
+                is_past_predictions_area &= past_predictions["Continent"] == continent
+            past_predictions_area = past_predictions[is_past_predictions_area].sort_values("Day")
+            df_agg_area = df_agg[
+                (df_agg["Continent"] == continent) & (df_agg["Country"] == country) & (df_agg["Province"] == province)
+            ].sort_values("Day").reset_index(drop=True)
+            list_df_aggregated.append(pd.concat([
+                df_agg_area, get_bounds_area_loop(df_agg_area, past_predictions_area, past_prediction_date, q)
+            ], axis=1))
+    df_predictions = pd.concat([df_predictions] + list_df_aggregated, sort=False)
+    df_predictions.sort_values(["Continent", "Country", "Province", "Day"], inplace=True)
+    return df_predictions
+
+
+def get_df_aggregated(df_predictions: pd.DataFrame) -> pd.DataFrame:
+    # Areas other than the countries without provinces in list_areas are the aggregated ones
+    return df_predictions[(df_predictions["Province"] == "None") & ~df_predictions["Country"].isin(["France", "Japan"])]
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("q", [0.5, 0.9])
+def test_append_all_aggregations_cf_matches_per_area_loop(tmp_path, seed, q):
+    past_prediction_date = str((pd.Timestamp(datetime.now().date()) - pd.Timedelta(days=10)).date())
+    df_predictions = get_df_predictions(seed)
+    past_predictions = get_past_predictions(past_prediction_date, seed)
+    past_prediction_file = str(tmp_path / "Global_V2_past.csv")
+    past_predictions.to_csv(past_prediction_file, index=False)
+    _, df_predictions_all = DELPHIAggregations.append_all_aggregations_cf(
+        df_predictions, past_prediction_file=past_prediction_file, past_prediction_date=past_prediction_date, q=q
+    )
+    df_predictions_loop = append_all_aggregations_cf_loop(df_predictions, past_predictions, past_prediction_date, q)
+
+    pd.testing.assert_frame_equal(
+        df_predictions_all.reset_index(drop=True), df_predictions_loop.reset_index(drop=True), check_dtype=False
+    )
+    # Aggregated areas without past predictions have no bounds, the others all have theirs
+    df_aggregated = get_df_aggregated(df_predictions_all)
+    has_bounds = df_aggregated.groupby(columns_area)[columns_bounds].apply(lambda df: df.notnull().values.all())
+    has_no_bounds = df_aggregated.groupby(columns_area)[columns_bounds].apply(lambda df: df.isnull().values.all())
+    assert (has_bounds | has_no_bounds).all()
+    assert sorted(has_bounds[has_bounds].index) == sorted(n_days_past_predictions_areas)
+
+
+def test_confidence_intervals_without_past_predictions_are_missing(tmp_path):
+    past_prediction_date = str((pd.Timestamp(datetime.now().date()) - pd.Timedelta(days=10)).date())
+    df_predictions = get_df_predictions(0)
+    _, df_predictions_all = DELPHIAggregations.append_all_aggregations_cf(
+        df_predictions, past_prediction_file=str(tmp_path / "missing.csv"), past_prediction_date=past_prediction_date
+    )
+    df_predictions_loop = append_all_aggregations_cf_loop(
+        df_predictions, get_past_predictions(past_prediction_date, 0).iloc[:0], past_prediction_date, 0.5
+    )
+
+    pd.testing.assert_frame_equal(
+        df_predictions_all.reset_index(drop=True), df_predictions_loop.reset_index(drop=True), check_dtype=False
+    )
+    assert df_predictions_all.shape[0] > df_predictions.shape[0]
+    assert get_df_aggregated(df_predictions_all)[columns_bounds].isnull().values.all()
+
+
+def get_df_predictions_rollup(seed: int, columns_keys: dict = None) -> pd.DataFrame:
+    """
+    Predictions of the areas with integer and float metrics, areas starting and ending on different days with a few
+    days missing, and missing values in the float metrics, for each combination of the values of columns_keys
+    """
+    random_state = np.random.RandomState(seed)
+    columns_keys = columns_keys if columns_keys is not None else {}
+    list_keys = pd.MultiIndex.from_product(list(columns_keys.values())) if columns_keys else [()]
+    list_df = []
+    for keys in list_keys:
+        for continent, country, province in list_areas:
+            days = pd.date_range(
+                pd.Timestamp("2020-10-01") + pd.Timedelta(days=int(random_state.randint(0, 5))),
+                periods=int(random_state.randint(8, 15)),
+            )
+            days = days[random_state.uniform(0, 1, len(days)) > 0.2]
+            df_area = pd.DataFrame({
+                **dict(zip(columns_keys, keys)),
+                "Continent": continent, "Country": country, "Province": province, "Day": days.strftime("%Y-%m-%d"),
+            })
+            for i, column in enumerate(columns_metrics_policies):
+                if i % 2 == 0:
+                    df_area[column] = random_state.randint(0, 100000, len(days))
+                else:
+                    df_area[column] = np.where(
+                        random_state.uniform(0, 1, len(days)) > 0.1, random_state.uniform(0, 1000, len(days)), np.nan
+                    )
+            list_df.append(df_area)
+    return pd.concat(list_df).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def get_aggregations_groupby(df_predictions: pd.DataFrame, columns_keys: list = ()) -> list:
+    """
+    Aggregations at the country, continent and world levels with the groupby sums of DELPHIAggregations and
+    DELPHIAggregationsPolicies before DELPHIRollup
+    """
+    columns_keys = list(columns_keys)
+    list_df_agg = []
+    for columns_groupby, df_predictions_level in [
+        (["Continent", "Country", "Day"], df_predictions[df_predictions["Province"] != "None"]),
+        (["Continent", "Day"], df_predictions),
+        (["Day"], df_predictions),
+    ]:
+        df_agg = df_predictions_level.groupby(columns_keys + columns_groupby).sum().reset_index()
+        for column in columns_area:
+            if column not in columns_groupby:
+                df_agg[column] = "None"
+        list_df_agg.append(df_agg[df_predictions.columns])
+    return list_df_agg
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_rollup_matches_groupby_aggregations(seed):
+    df_predictions = get_df_predictions_rollup(seed)
+    rollup = DELPHIRollup(df_predictions)
+    list_df_agg = get_aggregations_groupby(df_predictions)
+
+    for level, df_agg_groupby in zip(DELPHIRollup.levels, list_df_agg):
+        df_agg = rollup.get_aggregations([level])
+        df_agg_groupby = df_agg_groupby.sort_values(columns_area + ["Day"]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(df_agg.sort_values(columns_area + ["Day"]).reset_index(drop=True), df_agg_groupby)
+    # Integer metrics stay integers
+    assert (rollup.get_aggregations().dtypes == df_predictions.dtypes).all()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_append_all_aggregations_matches_groupby_aggregations(seed):
+    df_predictions = get_df_predictions_rollup(seed)
+    df_predictions_all = DELPHIAggregations.append_all_aggregations(df_predictions)
+    df_predictions_groupby = pd.concat([df_predictions] + get_aggregations_groupby(df_predictions))
+    df_predictions_groupby.sort_values(columns_area + ["Day"], inplace=True)
+
+    pd.testing.assert_frame_equal(
+        df_predictions_all.reset_index(drop=True), df_predictions_groupby.reset_index(drop=True)
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_append_all_aggregations_policies_matches_groupby_aggregations(seed):
+    columns_keys = {"Policy": ["No_Measure", "Lockdown"], "Time": ["Now", "One Month"]}
+    df_policy_predictions = get_df_predictions_rollup(seed, columns_keys)
+    df_policy_predictions_all = DELPHIAggregationsPolicies.append_all_aggregations(df_policy_predictions)
+    df_policy_predictions_groupby = pd.concat(
+        [df_policy_predictions] + get_aggregations_groupby(df_policy_predictions, columns_keys)
+    )
+    df_policy_predictions_groupby.sort_values(list(columns_keys) + columns_area + ["Day"], inplace=True)
+
+    pd.testing.assert_frame_equal(
+        df_policy_predictions_all.reset_index(drop=True), df_policy_predictions_groupby.reset_index(drop=True)
+    )
+
+
+def test_policy_aggregations_are_separate_for_each_policy_and_time():
+    # The aggregations used to sum the predictions of all the policies and times together
+    columns_keys = {"Policy": ["No_Measure", "Lockdown"], "Time": ["Now", "One Month"]}
+    df_policy_predictions = get_df_predictions_rollup(0, columns_keys)
+    df_agg_world = DELPHIAggregationsPolicies.get_aggregation_world(df_policy_predictions)
+
+    assert len(df_agg_world) == len(df_agg_world[["Policy", "Time", "Day"]].drop_duplicates())
+    assert set(zip(df_agg_world["Policy"], df_agg_world["Time"])) == set(pd.MultiIndex.from_product(
+        list(columns_keys.values())
+    ))
+    df_policy_predictions_lockdown = df_policy_predictions.query('Policy == "Lockdown" and Time == "Now"')
+    df_agg_world_lockdown = df_agg_world.query('Policy == "Lockdown" and Time == "Now"').set_index("Day")
+    pd.testing.assert_series_equal(
+        df_agg_world_lockdown["Total Detected"],
+        df_policy_predictions_lockdown.groupby("Day")["Total Detected"].sum(),
+    )
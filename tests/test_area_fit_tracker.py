@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from scipy.optimize import OptimizeResult
+from DELPHI_utils_V4_static import DELPHIAreaFitTracker, DELPHIFitCache
+
+
+def get_output(**flags) -> OptimizeResult:
+    return OptimizeResult(x=np.arange(12, dtype=float), fun=1.0, success=True, nit=0, **flags)
+
+
+def test_cached_areas_are_only_counted_as_cached(tmp_path):
+    # Fits as stored in the fit cache by a previous run, one carried forward and one refit
+    fit_cache = DELPHIFitCache(str(tmp_path) + "/")
+    metadata = dict(continent="Europe", country="France", province="None", optimizer="tnc")
+    fit_cache.set("carried", get_output(carried_forward=True), np.zeros((16, 3)), metadata)
+    fit_cache.set("refit", get_output(), np.zeros((16, 3)), metadata)
+    list_results = [
+        (("France", "None"), fit_cache.get("carried")[0]),
+        (("Italy", "None"), fit_cache.get("refit")[0]),
+        (("Spain", "None"), get_output(carried_forward=True)),
+        (("Greece", "None"), get_output()),
+    ]
+    area_fit_tracker = DELPHIAreaFitTracker()
+    for tuple_area, output in list_results:
+        area_fit_tracker.update(tuple_area, output)
+
+    assert area_fit_tracker.get_areas("fit_cached") == [("France", "None"), ("Italy", "None")]
+    assert area_fit_tracker.get_areas("carried_forward") == [("Spain", "None")]
+    assert area_fit_tracker.get_areas("refit") == [("Greece", "None")]
+
+
+def test_unknown_origin():
+    with pytest.raises(ValueError):
+        DELPHIAreaFitTracker().get_areas("annealing")
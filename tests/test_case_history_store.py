@@ -0,0 +1,43 @@
+import os
+import pandas as pd
+from DELPHI_utils_V4_static import DELPHICaseHistoryStore
+
+
+def write_cases(path_to_processed_folder: str, country: str, n_days: int) -> None:
+    pd.DataFrame({
+        "country": country,
+        "province": None,
+        "date": pd.date_range("2020-03-01", periods=n_days).strftime("%Y-%m-%d"),
+        "day_since100": range(n_days),
+        "case_cnt": range(100, 100 + n_days),
+        "death_cnt": range(n_days),
+    }).to_csv(path_to_processed_folder + f"Cases_{country}_None.csv", index=False)
+
+
+def test_deleted_or_renamed_cases_file_outdates_the_store(tmp_path):
+    path_to_processed_folder = str(tmp_path) + "/"
+    write_cases(path_to_processed_folder, "France", 5)
+    write_cases(path_to_processed_folder, "Italy", 3)
+    DELPHICaseHistoryStore.build(path_to_processed_folder)
+    assert DELPHICaseHistoryStore.is_up_to_date(path_to_processed_folder)
+
+    os.rename(path_to_processed_folder + "Cases_Italy_None.csv", path_to_processed_folder + "Cases_Spain_None.csv")
+    assert not DELPHICaseHistoryStore.is_up_to_date(path_to_processed_folder)
+    DELPHICaseHistoryStore.build(path_to_processed_folder)
+    assert DELPHICaseHistoryStore.is_up_to_date(path_to_processed_folder)
+    assert DELPHICaseHistoryStore(path_to_processed_folder).get_cases("Italy", "None") is None
+
+    os.remove(path_to_processed_folder + "Cases_Spain_None.csv")
+    assert not DELPHICaseHistoryStore.is_up_to_date(path_to_processed_folder)
+
+
+def test_build_replaces_the_store_without_leftovers(tmp_path):
+    path_to_processed_folder = str(tmp_path) + "/"
+    write_cases(path_to_processed_folder, "France", 5)
+    DELPHICaseHistoryStore.build(path_to_processed_folder)
+    write_cases(path_to_processed_folder, "France", 7)
+    DELPHICaseHistoryStore.build(path_to_processed_folder)
+
+    assert sorted(os.listdir(path_to_processed_folder)) == ["Cases_France_None.csv", "case_history_store"]
+    df_cases = DELPHICaseHistoryStore(path_to_processed_folder).get_cases("France", "None")
+    assert df_cases.case_cnt.tolist() == list(range(100, 107))
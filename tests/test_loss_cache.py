@@ -0,0 +1,73 @@
+import numpy as np
+from DELPHI_utils_V4_static import DELPHILossCache
+
+params = np.array([0.6, 10, 3, 0.1, 0.05, 0.5, 1.5, 1.5, 0.2, 40, 10, 1.0])
+
+
+def test_hits_and_misses_are_counted():
+    loss_cache = DELPHILossCache()
+    assert loss_cache.get(params, "tnc") is None
+    loss_cache.set(params, "tnc", 1.5)
+    assert loss_cache.get(params, "tnc") == (1.5, None)
+    assert loss_cache.get(list(params), "tnc") == (1.5, None)
+    assert loss_cache.get(params * 1.01, "tnc") is None
+
+    assert (loss_cache.hits, loss_cache.misses) == (2, 2)
+    assert loss_cache.get_summary().startswith("2 hits and 2 misses out of 4 evaluations (50.0% hit rate), 1 entries")
+
+
+def test_keys_are_relative_to_the_scale_of_the_parameters():
+    loss_cache = DELPHILossCache(relative_tolerance=1e-12)
+    # Small parameters that an absolute quantization would merge are kept apart
+    params_small = np.full(3, 1e-6)
+    loss_cache.set(params_small, "tnc", 1.0)
+    assert loss_cache.get(params_small * (1 + 1e-9), "tnc") is None
+    # Large parameters equal up to rounding errors share the same entry
+    params_large = np.array([300.0, -200.0, 1e8])
+    loss_cache.set(params_large, "tnc", 2.0)
+    assert loss_cache.get(params_large * (1 + 1e-15), "tnc") == (2.0, None)
+
+
+def test_exact_keys_without_tolerance():
+    loss_cache = DELPHILossCache(relative_tolerance=0)
+    loss_cache.set(params, "tnc", 1.0)
+    assert loss_cache.get(params.copy(), "tnc") == (1.0, None)
+    assert loss_cache.get(np.nextafter(params, np.inf), "tnc") is None
+
+
+def test_loss_functions_are_kept_apart():
+    loss_cache = DELPHILossCache()
+    loss_cache.set(params, "tnc", 1.0)
+    loss_cache.set(params, "trust-constr", 2.0)
+    assert loss_cache.get(params, "tnc") == (1.0, None)
+    assert loss_cache.get(params, "trust-constr") == (2.0, None)
+
+
+def test_entries_are_shared_between_loss_and_gradient():
+    loss_cache = DELPHILossCache()
+    loss_cache.set(params, "tnc", 1.0)
+    # Entry without gradient is missed when the gradient is needed, then replaced by the one with gradient
+    assert loss_cache.get(params, "tnc", with_gradient=True) is None
+    gradient = np.arange(len(params), dtype=float)
+    loss_cache.set(params, "tnc", 1.0, gradient)
+    value, gradient_cached = loss_cache.get(params, "tnc", with_gradient=True)
+    assert value == 1.0
+    np.testing.assert_array_equal(gradient_cached, gradient)
+    # Storing the loss alone keeps the gradient, and the loss is served from the entry with gradient
+    loss_cache.set(params, "tnc", 1.0)
+    assert loss_cache.get(params, "tnc")[1] is gradient_cached
+    assert len(loss_cache.cache) == 1
+    assert loss_cache.memory == loss_cache.cache[loss_cache.get_key(params, "tnc")][2]
+
+
+def test_least_recently_used_entries_are_evicted_above_the_memory_cap():
+    loss_cache = DELPHILossCache(max_memory=3 * (DELPHILossCache.entry_overhead + 16 * len(params) + 8))
+    for i in range(3):
+        loss_cache.set(params + i, "tnc", float(i))
+    assert loss_cache.get(params, "tnc") == (0.0, None)
+    loss_cache.set(params + 3, "tnc", 3.0)
+
+    assert loss_cache.evictions == 1
+    assert loss_cache.get(params + 1, "tnc") is None
+    assert [loss_cache.get(params + i, "tnc")[0] for i in [0, 2, 3]] == [0.0, 2.0, 3.0]
+    assert loss_cache.memory <= loss_cache.max_memory
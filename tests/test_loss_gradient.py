@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import minimize
+from DELPHI_params_V4 import default_bounds_params, p_d, p_h, p_v
+from DELPHI_utils_V4_ode import DELPHIODEModel
+from DELPHI_utils_V4_static import (
+    get_initial_conditions, get_initial_conditions_derivatives, get_residuals_value, get_residuals_gradient,
+    create_fitting_data_from_validcases
+)
+
+# Small synthetic area whose case history is generated by the model itself
+N = 1e6
+GLOBAL_PARAMS_FIXED = (N, 4000, 3000, 1000, 100, 5000, p_d, p_h, p_v)
+t_cases = np.arange(40)
+# Fixed number of RK4 steps per day rather than the default of the engine, with which the finite difference fit
+# below stops short of the optimum
+n_substeps = 2
+true_params = np.array([0.6, 10, 3, 0.1, 0.05, 0.5, 1.5, 1.5, 0.2, 40, 10, 1.0])
+delphi_model = DELPHIODEModel(N=N)
+x_sol_true = delphi_model.solve(
+    true_params, x_0=get_initial_conditions(true_params, GLOBAL_PARAMS_FIXED), t_eval=t_cases, method="RK4",
+    n_substeps=n_substeps,
+).y
+balance, balance_total_difference, cases_data_fit, deaths_data_fit, weights = create_fitting_data_from_validcases(
+    pd.DataFrame({"case_cnt": x_sol_true[15], "death_cnt": x_sol_true[14]})
+)
+
+
+def get_loss(params, optimizer: str = "tnc") -> float:
+    x_sol = delphi_model.solve(
+        params, x_0=get_initial_conditions(params, GLOBAL_PARAMS_FIXED), t_eval=t_cases, method="RK4",
+        n_substeps=n_substeps,
+    ).y
+    return get_residuals_value(
+        optimizer=optimizer, balance=balance, x_sol=x_sol, cases_data_fit=cases_data_fit,
+        deaths_data_fit=deaths_data_fit, weights=weights, balance_total_difference=balance_total_difference,
+    )
+
+
+def get_loss_and_gradient(params, optimizer: str = "tnc") -> (float, np.ndarray):
+    solution = delphi_model.solve_with_sensitivities(
+        params, x_0=get_initial_conditions(params, GLOBAL_PARAMS_FIXED),
+        dx_0_dparams=get_initial_conditions_derivatives(params, GLOBAL_PARAMS_FIXED), t_eval=t_cases, method="RK4",
+        n_substeps=n_substeps,
+    )
+    kwargs_residuals = dict(
+        optimizer=optimizer, balance=balance, x_sol=solution.y, cases_data_fit=cases_data_fit,
+        deaths_data_fit=deaths_data_fit, weights=weights, balance_total_difference=balance_total_difference,
+    )
+    return (
+        get_residuals_value(**kwargs_residuals),
+        get_residuals_gradient(x_sensitivities=solution.sensitivities, **kwargs_residuals),
+    )
+
+
+@pytest.mark.parametrize("optimizer", ["tnc", "trust-constr"])
+def test_analytic_gradient_matches_central_finite_differences(optimizer):
+    params = true_params * np.random.RandomState(0).uniform(0.9, 1.1, len(true_params))
+    loss, gradient = get_loss_and_gradient(params, optimizer)
+    gradient_finite_differences = np.zeros(len(params))
+    for j in range(len(params)):
+        step = np.zeros(len(params))
+        step[j] = 1e-6 * max(abs(params[j]), 1)
+        gradient_finite_differences[j] = (
+            get_loss(params + step, optimizer) - get_loss(params - step, optimizer)
+        ) / (2 * step[j])
+
+    assert loss == pytest.approx(get_loss(params, optimizer))
+    np.testing.assert_allclose(gradient, gradient_finite_differences, rtol=1e-5, atol=1e-6 * np.abs(gradient).max())
+
+
+def test_tnc_with_analytic_gradient_reaches_the_finite_difference_optimum():
+    # Fitting a few parameters, the others being fixed to their true values, so that both fits converge
+    free_params = [0, 2, 3, 4]
+
+    def get_params(free_values) -> np.ndarray:
+        params = true_params.copy()
+        params[free_params] = free_values
+        return params
+
+    x0 = true_params[free_params] * np.array([1.2, 0.8, 1.2, 0.8])
+    bounds = [default_bounds_params[j] for j in free_params]
+    output_baseline = minimize(lambda free_values: get_loss(get_params(free_values)), x0, method="tnc", bounds=bounds)
+
+    def get_loss_and_gradient_free_params(free_values) -> (float, np.ndarray):
+        loss, gradient = get_loss_and_gradient(get_params(free_values))
+        return loss, gradient[free_params]
+
+    output_gradient = minimize(get_loss_and_gradient_free_params, x0, method="tnc", jac=True, bounds=bounds)
+
+    assert output_gradient.nfev < output_baseline.nfev
+    assert output_gradient.fun <= output_baseline.fun + 1e-6 * get_loss(get_params(x0))
+    np.testing.assert_allclose(output_gradient.x, output_baseline.x, rtol=1e-4)
+    np.testing.assert_allclose(output_gradient.x, true_params[free_params], rtol=1e-4)
@@ -0,0 +1,161 @@
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+from DELPHI_utils_V4_dynamic import DELPHIModelComparison
+
+logger = logging.getLogger("CompareLogger")
+list_areas = [
+    ("Europe", "France", "None"),
+    ("North America", "US", "New York"),
+    ("North America", "US", "Texas"),
+    ("Europe", "Italy", "None"),
+    ("Asia", "Japan", "None"),
+]
+
+
+class CaseHistoryStore:
+    """
+    Case histories served in memory as by DELPHICaseHistoryStore, keyed by the names of the Cases_*.csv files
+    """
+    def __init__(self, dict_cases: dict):
+        self.dict_cases = dict_cases
+
+    def get_cases(self, country: str, province: str) -> pd.DataFrame:
+        return self.dict_cases[(country, province)].copy()
+
+
+def get_comparison_inputs(seed: int) -> (CaseHistoryStore, pd.DataFrame, pd.DataFrame):
+    """
+    Case histories and predictions since 100 cases with annealing and tnc of a few areas, the annealing predictions
+    being either closer or further from the actual cases than the tnc ones depending on the area. Areas start and end
+    on different days, and the predictions have duplicate days as in the files of the model runs
+    """
+    random_state = np.random.RandomState(seed)
+    dict_cases = {}
+    list_df_predictions = {"annealing": [], "tnc": []}
+    for continent, country, province in list_areas:
+        first_day = pd.Timestamp("2020-09-01") + pd.Timedelta(days=random_state.randint(0, 10))
+        n_days = random_state.randint(25, 45)
+        days = pd.date_range(first_day, periods=n_days)
+        case_cnt = 50 + np.cumsum(random_state.randint(0, 500, n_days))
+        dict_cases[("_".join(country.split()), "_".join(province.split()))] = pd.DataFrame({
+            "country": country, "province": province, "date": days.strftime("%Y-%m-%d"), "case_cnt": case_cnt,
+        })
+        noise_annealing, noise_tnc = random_state.uniform(0, 0.5, 2)
+        for name, noise in [("annealing", noise_annealing), ("tnc", noise_tnc)]:
+            shift = random_state.randint(-3, 4)
+            total_detected = case_cnt * (1 + noise * random_state.uniform(-1, 1, n_days))
+            df_predictions = pd.DataFrame({
+                "Continent": continent, "Country": country, "Province": province,
+                "Day": days + pd.Timedelta(days=shift), "Total Detected": np.maximum.accumulate(total_detected),
+            })
+            list_df_predictions[name].append(pd.concat([df_predictions, df_predictions.sample(5, random_state=seed)]))
+    df_annealing, df_tnc = [
+        pd.concat(list_df_predictions[name]).sample(frac=1, random_state=seed).reset_index(drop=True)
+        for name in ["annealing", "tnc"]
+    ]
+    return CaseHistoryStore(dict_cases), df_annealing, df_tnc
+
+
+def read_provinces_as_missing(df: pd.DataFrame) -> pd.DataFrame:
+    # Provinces "None" are read as missing values from the files of the model runs
+    return df.assign(Province=df["Province"].replace("None", np.nan))
+
+
+def get_parameters(list_areas_parameters: list, seed: int) -> pd.DataFrame:
+    random_state = np.random.RandomState(seed)
+    return pd.DataFrame({
+        "Continent": [continent for continent, _, _ in list_areas_parameters],
+        "Country": [country for _, country, _ in list_areas_parameters],
+        "Province": [province for _, _, province in list_areas_parameters],
+        "Infection Rate": random_state.uniform(0, 1, len(list_areas_parameters)),
+        "Median Day of Action": random_state.uniform(0, 100, len(list_areas_parameters)),
+    })
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("threshold", [10.0, 0.2])
+def test_compare_metric_all_areas_matches_per_area_loop(seed, threshold):
+    case_history_store, df_annealing, df_tnc = get_comparison_inputs(seed)
+    # Batch comparison on the predictions as read, the loop on the predictions with the provinces "None" restored
+    model_compare_batch = DELPHIModelComparison(
+        "", "", read_provinces_as_missing(df_annealing), read_provinces_as_missing(df_tnc), logger,
+        case_history_store=case_history_store,
+    )
+    model_compare_loop = DELPHIModelComparison(
+        "", "", df_annealing, df_tnc, logger, case_history_store=case_history_store
+    )
+    df_comparison = model_compare_batch.compare_metric_all_areas(list_areas, threshold=threshold)
+    list_results_loop = [
+        model_compare_loop.compare_metric(province_tuple, threshold=threshold)
+        for province_tuple in list_areas
+    ]
+
+    assert df_comparison["region"].tolist() == list_areas
+    assert df_comparison["annealing_selected"].tolist() == [result[0] for result in list_results_loop]
+    for i, column in enumerate(["annealing_metric", "tnc_metric", "annealing_max_ape"], start=1):
+        np.testing.assert_allclose(df_comparison[column].values, [result[i] for result in list_results_loop])
+
+
+def test_compare_metric_all_areas_selects_both_models():
+    # The seeds used above exercise both branches of the selection
+    list_selected = []
+    for seed in range(5):
+        case_history_store, df_annealing, df_tnc = get_comparison_inputs(seed)
+        list_selected.extend(DELPHIModelComparison(
+            "", "", df_annealing, df_tnc, logger, case_history_store=case_history_store
+        ).compare_metric_all_areas(list_areas)["annealing_selected"].tolist())
+
+    assert any(list_selected) and not all(list_selected)
+
+
+def test_areas_without_annealing_parameters_are_skipped(caplog):
+    global_parameters_tnc = read_provinces_as_missing(get_parameters(list_areas, seed=0))
+    global_parameters_annealing = read_provinces_as_missing(
+        get_parameters([area for area in list_areas if area[1] != "Italy"], seed=1)
+    )
+    with caplog.at_level(logging.WARNING, logger="CompareLogger"):
+        list_province_tuples = DELPHIModelComparison.get_areas_to_compare(
+            global_parameters_tnc, global_parameters_annealing, logger
+        )
+
+    # Provinces "None" are restored, in the order of the tnc parameters
+    assert list_province_tuples == [area for area in list_areas if area[1] != "Italy"]
+    assert [record.getMessage() for record in caplog.records] == ["Annealing parameters not present for Italy - None"]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_select_best_parameters_matches_per_area_loop(seed):
+    list_areas_tnc = list_areas + [("Oceania", "Australia", "None")]
+    global_parameters_tnc = get_parameters(list_areas_tnc, seed=seed)
+    # Annealing parameters in another order, without Italy, and with an area not fitted with tnc
+    global_parameters_annealing = get_parameters(
+        [area for area in list_areas_tnc[::-1] if area[1] != "Italy"] + [("Africa", "Egypt", "None")], seed=seed + 1
+    )
+    list_province_tuples = DELPHIModelComparison.get_areas_to_compare(
+        global_parameters_tnc, global_parameters_annealing, logger
+    )
+    df_comparison = pd.DataFrame({
+        "region": list_province_tuples,
+        "annealing_selected": np.random.RandomState(seed).uniform(0, 1, len(list_province_tuples)) < 0.5,
+    })
+    global_parameters_best = DELPHIModelComparison.select_best_parameters(
+        global_parameters_tnc, global_parameters_annealing, df_comparison
+    )
+
+    # Loop of DELPHI_compare_V4 before the batch comparison, over the tnc parameters
+    dict_selected = dict(zip(df_comparison["region"], df_comparison["annealing_selected"]))
+    list_parameters_loop = []
+    for i in range(global_parameters_tnc.shape[0]):
+        tnc_params = global_parameters_tnc.iloc[[i]]
+        continent, country, province = tnc_params[["Continent", "Country", "Province"]].values[0]
+        annealing_params = global_parameters_annealing.query(
+            'Continent == @continent and Country == @country and Province == @province'
+        )
+        if annealing_params.shape[0] == 0:
+            continue
+        list_parameters_loop.append(annealing_params if dict_selected[(continent, country, province)] else tnc_params)
+    global_parameters_loop = pd.concat(list_parameters_loop).reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(global_parameters_best, global_parameters_loop)
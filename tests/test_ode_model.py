@@ -0,0 +1,228 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+from DELPHI_params_V4 import IncubeD, RecoverID, RecoverHD, DetectD, VentilatedD, default_bounds_params, p_d, p_h, p_v
+from DELPHI_utils_V4_ode import (
+    DELPHIODEModel, DELPHIODEModelReduced, DELPHIODEModelPolicy, DELPHIODEEnsemble, get_fixed_step_accuracy_report,
+    integrate_fixed_step_rk4, ode_solvers_with_jacobian, n_states
+)
+from DELPHI_utils_V4_static import get_initial_conditions
+
+N = 1e7
+GLOBAL_PARAMS_FIXED = (N, 4000, 3000, 1000, 100, 5000, p_d, p_h, p_v)
+t_eval = np.arange(150)
+
+
+def model_covid_baseline(t, x, alpha, days, r_s, r_dth, p_dth, r_dthdecay, k1, k2, jump, t_jump, std_normal, k3):
+    """
+    Right-hand side of the DELPHI ODE system as written in the nested closure of DELPHI_model_V4 before the shared
+    DELPHIODEModel, used as reference
+    """
+    r_i = np.log(2) / IncubeD
+    r_d = np.log(2) / DetectD
+    r_ri = np.log(2) / RecoverID
+    r_rh = np.log(2) / RecoverHD
+    r_rv = np.log(2) / VentilatedD
+    gamma_t = (
+        (2 / np.pi) * np.arctan(-(t - days) / 20 * r_s) + 1
+        + jump * np.exp(-(t - t_jump) ** 2 / (2 * std_normal ** 2))
+    )
+    p_dth_mod = (2 / np.pi) * (p_dth - 0.001) * (np.arctan(-t / 20 * r_dthdecay) + np.pi / 2) + 0.001
+    S, E, I, AR, DHR, DQR, AD, DHD, DQD, R, D, TH, DVR, DVD, DD, DT = x
+    return [
+        -alpha * gamma_t * S * I / N,
+        alpha * gamma_t * S * I / N - r_i * E,
+        r_i * E - r_d * I,
+        r_d * (1 - p_dth_mod) * (1 - p_d) * I - r_ri * AR,
+        r_d * (1 - p_dth_mod) * p_d * p_h * I - r_rh * DHR,
+        r_d * (1 - p_dth_mod) * p_d * (1 - p_h) * I - r_ri * DQR,
+        r_d * p_dth_mod * (1 - p_d) * I - r_dth * AD,
+        r_d * p_dth_mod * p_d * p_h * I - r_dth * DHD,
+        r_d * p_dth_mod * p_d * (1 - p_h) * I - r_dth * DQD,
+        r_ri * (AR + DQR) + r_rh * DHR,
+        r_dth * (AD + DQD + DHD),
+        r_d * p_d * p_h * I,
+        r_d * (1 - p_dth_mod) * p_d * p_h * p_v * I - r_rv * DVR,
+        r_d * p_dth_mod * p_d * p_h * p_v * I - r_dth * DVD,
+        r_dth * (DHD + DQD),
+        r_d * p_d * I,
+    ]
+
+
+def get_random_params(random_state: np.random.RandomState) -> np.ndarray:
+    lower_bounds, upper_bounds = np.array(default_bounds_params).T
+    return random_state.uniform(lower_bounds, upper_bounds)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_analytic_jacobian_matches_finite_differences(seed):
+    random_state = np.random.RandomState(seed)
+    delphi_model = DELPHIODEModel(N=N).set_params(get_random_params(random_state))
+    x = np.concatenate([[N * random_state.uniform(0.5, 1)], random_state.uniform(0, 1e4, n_states - 1)])
+    t = random_state.uniform(0, 150)
+    jac_finite_differences = np.zeros((n_states, n_states))
+    for j in range(n_states):
+        step = 1e-6 * max(abs(x[j]), 1)
+        x_plus, x_minus = x.copy(), x.copy()
+        x_plus[j] += step
+        x_minus[j] -= step
+        jac_finite_differences[:, j] = (delphi_model.rhs(t, x_plus) - delphi_model.rhs(t, x_minus)) / (2 * step)
+
+    np.testing.assert_allclose(delphi_model.jac(t, x), jac_finite_differences, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(delphi_model.jac_sparse(t, x).toarray(), delphi_model.jac(t, x))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_rhs_matches_baseline(seed):
+    random_state = np.random.RandomState(seed)
+    params = get_random_params(random_state)
+    x = np.concatenate([[N * random_state.uniform(0.5, 1)], random_state.uniform(0, 1e4, n_states - 1)])
+    t = random_state.uniform(0, 150)
+    np.testing.assert_allclose(
+        DELPHIODEModel(N=N).set_params(params).rhs(t, x), model_covid_baseline(t, x, *params), rtol=1e-12, atol=1e-9
+    )
+
+
+@pytest.mark.parametrize("method", ode_solvers_with_jacobian)
+@pytest.mark.parametrize("sparse_jacobian", [False, True])
+def test_stiff_solvers_match_baseline_rk45(method, sparse_jacobian):
+    params = [1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    # Tight tolerances on both sides, so that the difference reflects the solvers and not their default tolerances
+    x_sol_baseline = solve_ivp(
+        fun=model_covid_baseline, y0=x_0, t_span=[t_eval[0], t_eval[-1]], t_eval=t_eval, args=tuple(params),
+        rtol=1e-8, atol=1e-6,
+    ).y
+    solution = DELPHIODEModel(N=N).solve(
+        params, x_0=x_0, t_eval=t_eval, method=method, sparse_jacobian=sparse_jacobian, rtol=1e-8, atol=1e-6
+    )
+
+    assert solution.status == 0
+    np.testing.assert_allclose(solution.y, x_sol_baseline, rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize("method", ["RK45", "RK4"])
+def test_reduced_state_reconstruction_matches_full_solve(method):
+    params = [1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    kwargs_solve = dict(rtol=1e-8, atol=1e-6) if method == "RK45" else dict(n_substeps=8)
+    x_sol_full = DELPHIODEModel(N=N).solve(params, x_0=x_0, t_eval=t_eval, method=method, **kwargs_solve).y
+    solution = DELPHIODEModelReduced(N=N).solve(
+        params, x_0=x_0, t_eval=t_eval, method=method, reconstruct=True, **kwargs_solve
+    )
+
+    assert solution.status == 0
+    assert solution.y.shape == x_sol_full.shape
+    assert np.all(np.isfinite(solution.y))
+    np.testing.assert_allclose(solution.y, x_sol_full, rtol=1e-4, atol=1e-2)
+
+
+def test_reduced_state_without_reconstruction_leaves_derived_states_to_nan():
+    params = [1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    x_sol = DELPHIODEModelReduced(N=N).solve(params, x_0=x_0, t_eval=t_eval).y
+
+    assert np.all(np.isnan(x_sol[DELPHIODEModelReduced.derived_states]))
+    assert np.all(np.isfinite(x_sol[DELPHIODEModelReduced.core_states]))
+
+
+@pytest.mark.parametrize("n_substeps", [1, 2])
+@pytest.mark.parametrize("delphi_model", [
+    DELPHIODEModel(N=N),
+    DELPHIODEModelReduced(N=N),
+    DELPHIODEModelPolicy(N=N, t_future_policy=50, normalized_gamma_future_policy=-0.4,
+                         normalized_gamma_current_policy=0.1),
+], ids=["full", "reduced", "policy"])
+def test_structured_rk4_matches_generic_rk4(delphi_model, n_substeps):
+    random_state = np.random.RandomState(n_substeps)
+    for _ in range(3):
+        params = get_random_params(random_state)
+        x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+        solution = delphi_model.solve(params, x_0=x_0, t_eval=t_eval, method="RK4", n_substeps=n_substeps)
+        x_0_model = np.array(x_0)[getattr(delphi_model, "core_states", slice(None))]
+        solution_generic = integrate_fixed_step_rk4(delphi_model.rhs, x_0_model, t_eval, n_substeps)
+
+        assert solution.status == 0
+        assert solution.nfev == solution_generic.nfev
+        np.testing.assert_allclose(
+            solution.y[getattr(delphi_model, "core_states", slice(None))], solution_generic.y, rtol=1e-10, atol=1e-6
+        )
+
+
+def test_structured_rk4_truncates_diverged_solutions_as_generic_rk4():
+    params = [1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    delphi_model = DELPHIODEModel(N=N).set_params(params)
+    t_eval_diverging = np.arange(0, 3000, 100)
+    with np.errstate(all="ignore"):
+        solution = delphi_model.solve(params, x_0=x_0, t_eval=t_eval_diverging, method="RK4", n_substeps=1)
+        solution_generic = integrate_fixed_step_rk4(delphi_model.rhs, x_0, t_eval_diverging, n_substeps=1)
+
+    assert solution.status == solution_generic.status == -1
+    assert solution.message == solution_generic.message
+    np.testing.assert_array_equal(solution.t, solution_generic.t)
+    np.testing.assert_allclose(solution.y, solution_generic.y, rtol=1e-8)
+
+
+def test_rk4_converges_to_tight_tolerance_solve_ivp():
+    params = [1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    delphi_model = DELPHIODEModel(N=N)
+    x_reference = delphi_model.solve(params, x_0=x_0, t_eval=t_eval, method="RK45", rtol=1e-12, atol=1e-8).y
+    list_errors = []
+    for n_substeps in [1, 2, 4, 8]:
+        x_sol = delphi_model.solve(params, x_0=x_0, t_eval=t_eval, method="RK4", n_substeps=n_substeps).y
+        list_errors.append(np.max(np.abs(x_sol - x_reference) / np.maximum(np.abs(x_reference), 1)))
+
+    # 4th order scheme: the error is divided by about 2^4 each time the step size is halved
+    assert all(error_next < error / 8 for error, error_next in zip(list_errors, list_errors[1:]))
+    assert list_errors[-1] < 1e-6
+
+
+def test_fixed_step_accuracy_report_fields():
+    params = [1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    accuracy_report = get_fixed_step_accuracy_report(DELPHIODEModel(N=N), params, x_0=x_0, t_eval=t_eval)
+
+    assert [(row["method"], row["n_substeps"]) for row in accuracy_report] == [
+        ("RK45", None), ("RK4", 1), ("RK4", 2), ("RK4", 4), ("RK4", 8)
+    ]
+    for row in accuracy_report:
+        assert set(row) == {
+            "method", "n_substeps", "max_relative_error_cases", "max_relative_error_deaths",
+            "max_relative_error_states", "runtime",
+        }
+        errors = [row["max_relative_error_cases"], row["max_relative_error_deaths"], row["max_relative_error_states"]]
+        assert np.all(np.isfinite(errors)) and min(errors) >= 0
+        # Errors on all the states bound the ones on cases and deaths
+        assert row["max_relative_error_states"] >= max(errors[:2])
+        assert row["runtime"] >= 0
+    for key in ["max_relative_error_cases", "max_relative_error_deaths", "max_relative_error_states"]:
+        errors_rk4 = [row[key] for row in accuracy_report[1:]]
+        assert all(error_next < error for error, error_next in zip(errors_rk4, errors_rk4[1:]))
+
+
+@pytest.mark.parametrize("method, kwargs_solve, rtol", [
+    ("RK4", dict(n_substeps=4), 1e-10),
+    ("RK45", dict(rtol=1e-9, atol=1e-6), 1e-5),
+    ("BDF", dict(rtol=1e-9, atol=1e-6), 1e-5),
+])
+def test_ensemble_matches_independent_solves(method, kwargs_solve, rtol):
+    random_state = np.random.RandomState(0)
+    params = np.array([get_random_params(random_state) for _ in range(4)])
+    x_0 = np.array([get_initial_conditions(params_member, GLOBAL_PARAMS_FIXED) for params_member in params])
+    x_sol_ensemble = DELPHIODEEnsemble(N=N).solve(params, x_0=x_0, t_eval=t_eval, method=method, **kwargs_solve)
+
+    assert x_sol_ensemble.shape == (len(params), n_states, len(t_eval))
+    for k in range(len(params)):
+        solution = DELPHIODEModel(N=N).solve(params[k], x_0=x_0[k], t_eval=t_eval, method=method, **kwargs_solve)
+        assert solution.status == 0
+        np.testing.assert_allclose(x_sol_ensemble[k], solution.y, rtol=rtol, atol=1e-3)
+
+
+def test_ensemble_raises_when_the_integration_fails():
+    params = np.array([[1, 0, 2, 0.2, 0.05, 0.2, 3, 3, 0.1, 60, 10, 1]] * 2)
+    x_0 = get_initial_conditions(params[0], GLOBAL_PARAMS_FIXED)
+    # Fixed steps of 100 days are far outside the stability region of RK4
+    with pytest.raises(ValueError, match="Integration of the ensemble failed"), np.errstate(all="ignore"):
+        DELPHIODEEnsemble(N=N).solve(params, x_0=x_0, t_eval=np.arange(0, 3000, 100), method="RK4", n_substeps=1)
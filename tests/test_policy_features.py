@@ -0,0 +1,352 @@
+import os
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from DELPHI_params_V4 import future_policies
+from DELPHI_utils_V4_dynamic import (
+    DELPHIPolicyFeaturesCache, create_final_policy_features_us, get_mapping_table_final_policies_us,
+    read_oxford_international_policy_data, read_policy_data_us_only
+)
+
+policies_us = [
+    "travel_limit", "stay_home", "educational_fac", "any_gathering_restrict", "any_business", "all_non-ess_business",
+]
+columns_intermediary_policies_us = [
+    "Travel_severely_limited", "Stay_at_home_order", "Educational_Facilities_Closed", "Mass_Gathering_Restrictions",
+    "Initial_Business_Closure", "Non_Essential_Services_Closed",
+]
+
+states_us = ["Alabama", "California", "New York", "Texas", "Wyoming"]
+# Oxford measures with their flags and the minimum level for the measure to be considered in place
+msr_flags_thresholds_oxford = [
+    ("C1M_School closing", "C1M_Flag", 2),
+    ("C2M_Workplace closing", "C2M_Flag", 2),
+    ("C3M_Cancel public events", "C3M_Flag", 2),
+    ("C4M_Restrictions on gatherings", "C4M_Flag", 1),
+    ("C5M_Close public transport", "C5M_Flag", 2),
+    ("C6M_Stay at home requirements", "C6M_Flag", 2),
+    ("C7M_Restrictions on internal movement", "C7M_Flag", 2),
+    ("C8M_International travel controls", None, 3),
+    ("H1_Public information campaigns", "H1_Flag", 1),
+]
+
+
+def create_final_policy_features_us_rows(df_policies_US: pd.DataFrame) -> pd.DataFrame:
+    """
+    Final MECE policies in the US as computed row by row before get_mapping_table_final_policies_us, from the
+    intermediary policies dataframe
+    """
+    df_policies_US_final = df_policies_US.copy()
+    msr = future_policies
+    df_policies_US_final[msr[0]] = (df_policies_US.eq(0).any(axis=1)).astype(str)
+    df_policies_US_final[msr[1]] = [
+        int(a and b)
+        for a, b in zip(df_policies_US.eq(0).any(axis=1), df_policies_US["Mass_Gathering_Restrictions"] == 1)
+    ]
+    df_policies_US_final[msr[2]] = [
+        int(a and b and c)
+        for a, b, c in zip(
+            df_policies_US.eq(0).any(axis=1) > 0,
+            df_policies_US["Mass_Gathering_Restrictions"] == 0,
+            df_policies_US["Stay_at_home_order"] == 0,
+        )
+    ]
+    df_policies_US_final[msr[3]] = [
+        int(a and b and c)
+        for a, b, c in zip(
+            df_policies_US.eq(0).any(axis=1) == 2,
+            df_policies_US["Educational_Facilities_Closed"] == 1,
+            df_policies_US["Mass_Gathering_Restrictions"] == 1,
+        )
+    ]
+    df_policies_US_final[msr[4]] = [
+        int(a and b and c and d)
+        for a, b, c, d in zip(
+            df_policies_US.eq(0).any(axis=1) > 1,
+            df_policies_US["Educational_Facilities_Closed"] == 0,
+            df_policies_US["Mass_Gathering_Restrictions"] == 1,
+            df_policies_US["Stay_at_home_order"] == 0,
+        )
+    ]
+    df_policies_US_final[msr[5]] = [
+        int(a and b and c and d)
+        for a, b, c, d in zip(
+            df_policies_US.eq(0).any(axis=1) > 2,
+            df_policies_US["Educational_Facilities_Closed"] == 1,
+            df_policies_US["Mass_Gathering_Restrictions"] == 1,
+            df_policies_US["Stay_at_home_order"] == 0,
+        )
+    ]
+    df_policies_US_final[msr[6]] = (df_policies_US["Stay_at_home_order"] == 1).apply(lambda x: int(x))
+    df_policies_US_final["country"] = "US"
+    return df_policies_US_final.loc[:, ["country", "province", "date"] + msr]
+
+
+def read_policy_data_us_only_rows(path_to_policy_data: str, list_US_states: list) -> pd.DataFrame:
+    """
+    US policies as processed state by state and row by row before create_intermediary_policy_tensor_us and the lookup
+    table of the final policies, a missing start date meaning that the policy was never implemented and a missing end
+    date that it is still in place
+    """
+    df = pd.read_csv(path_to_policy_data)
+    df = df[df.location_name.isin(list_US_states)]
+    n_dates = (datetime.now() - datetime(2020, 3, 1)).days + 1
+    date_range = [datetime(2020, 3, 1) + timedelta(days=i) for i in range(n_dates)]
+    list_df_concat = []
+    for location in df.location_name.unique():
+        df_location = df[df.location_name == location].reset_index(drop=True)
+        df_temp = pd.DataFrame({
+            "continent": "North America", "country": "US", "province": location, "date": date_range,
+        })
+        for policy in policies_us:
+            start_date_policy_location = df_location.loc[0, f"{policy}_start_date"]
+            start_date_policy_location = (
+                start_date_policy_location if start_date_policy_location is not np.nan else "2030-01-02"
+            )
+            end_date_policy_location = df_location.loc[0, f"{policy}_end_date"]
+            end_date_policy_location = (
+                end_date_policy_location if end_date_policy_location is not np.nan else "2030-01-01"
+            )
+            df_temp[policy] = 0
+            df_temp.loc[
+                (df_temp.date >= start_date_policy_location) & (df_temp.date <= end_date_policy_location), policy
+            ] = 1
+        list_df_concat.append(df_temp)
+    df_policies_US = pd.concat(list_df_concat).reset_index(drop=True)
+    df_policies_US.rename(columns=dict(zip(policies_us, columns_intermediary_policies_us)), inplace=True)
+    return create_final_policy_features_us_rows(df_policies_US)
+
+
+def get_raw_policy_data_us(seed: int) -> pd.DataFrame:
+    """
+    IHME policies of a few states, with policies never implemented (no start date), still in place (no end date) or
+    lifted, and a duplicate row of a state of which only the first row is used
+    """
+    random_state = np.random.RandomState(seed)
+    list_rows = []
+    for state in states_us + ["Texas"]:
+        row = {"location_name": state}
+        for policy in policies_us:
+            start_date = pd.Timestamp("2020-03-01") + pd.Timedelta(days=int(random_state.randint(0, 90)))
+            end_date = start_date + pd.Timedelta(days=int(random_state.randint(0, 120)))
+            status = random_state.choice(["never", "in place", "lifted"], p=[0.3, 0.3, 0.4])
+            row[f"{policy}_start_date"] = str(start_date.date()) if status != "never" else np.nan
+            row[f"{policy}_end_date"] = str(end_date.date()) if status == "lifted" else np.nan
+        list_rows.append(row)
+    # States of other countries are ignored
+    list_rows.append({"location_name": "Ontario", **{
+        f"{policy}_{bound}_date": "2020-04-01" for policy in policies_us for bound in ["start", "end"]
+    }})
+    return pd.DataFrame(list_rows)
+
+
+def test_final_policies_us_table_matches_row_by_row_features():
+    # All the combinations of intermediary policies, in the order of the bits of the lookup table
+    combinations = (np.arange(2 ** 6).reshape(-1, 1) >> np.arange(6)) & 1
+    df_policies_US = pd.DataFrame(combinations, columns=columns_intermediary_policies_us)
+    df_policies_US.insert(0, "continent", "North America")
+    df_policies_US.insert(1, "country", "US")
+    df_policies_US.insert(2, "province", "Texas")
+    df_policies_US.insert(3, "date", pd.Timestamp("2020-04-01"))
+    df_policies_US_final_rows = create_final_policy_features_us_rows(df_policies_US)
+    table_final_policies = get_mapping_table_final_policies_us()
+
+    np.testing.assert_array_equal(
+        table_final_policies[:, 0].astype(bool).astype(str), df_policies_US_final_rows[future_policies[0]].values
+    )
+    np.testing.assert_array_equal(table_final_policies[:, 1:], df_policies_US_final_rows[future_policies[1:]].values)
+    # Quirks of the comparisons of the boolean "any policy not in place" with 0, 1 and 2: it is compared as 0 or 1, so
+    # that the third policy only depends on it, and the fourth, fifth and sixth ones are never in place
+    is_any_not_in_place = (combinations == 0).any(axis=1)
+    assert (table_final_policies[is_any_not_in_place, 0] == 1).all() and table_final_policies[-1, 0] == 0
+    assert not table_final_policies[~is_any_not_in_place, 2].any()
+    assert not table_final_policies[:, 3:6].any()
+
+
+def test_create_final_policy_features_us_matches_row_by_row_features():
+    random_state = np.random.RandomState(0)
+    states = ["Alabama", "California", "Texas"]
+    date_range = np.datetime64("2020-03-01", "us") + np.arange(20).astype("timedelta64[D]")
+    policy_tensor = random_state.uniform(0, 1, (len(states), len(date_range), 6)) < 0.6
+    df_policies_US = pd.DataFrame({
+        "continent": "North America",
+        "country": "US",
+        "province": np.repeat(states, len(date_range)),
+        "date": np.tile(date_range, len(states)),
+    })
+    for i, column in enumerate(columns_intermediary_policies_us):
+        df_policies_US[column] = policy_tensor[:, :, i].flatten().astype(int)
+    df_policies_US_final = create_final_policy_features_us(states, date_range, policy_tensor)
+
+    pd.testing.assert_frame_equal(df_policies_US_final, create_final_policy_features_us_rows(df_policies_US))
+    assert set(df_policies_US_final[future_policies[0]]) <= {"True", "False"}
+
+
+def test_read_policy_data_us_only_matches_row_by_row_features(tmp_path):
+    for seed in range(3):
+        get_raw_policy_data_us(seed).to_csv(tmp_path / f"raw_policy_data_us_only_{seed}.csv", index=False)
+        df_policies_US_final = read_policy_data_us_only(
+            str(tmp_path) + "/", filename_policy_data=f"raw_policy_data_us_only_{seed}.csv", use_cache=False
+        )
+        df_policies_US_final_rows = read_policy_data_us_only_rows(
+            str(tmp_path / f"raw_policy_data_us_only_{seed}.csv"), states_us
+        )
+
+        pd.testing.assert_frame_equal(df_policies_US_final, df_policies_US_final_rows, check_dtype=False)
+        assert df_policies_US_final[future_policies[0]].map(type).eq(str).all()
+
+
+def read_oxford_international_policy_data_rows(yesterday: str, path_to_oxford_data: str) -> pd.DataFrame:
+    """
+    International policies as processed row by row before create_final_policy_features_international
+    """
+    measures = pd.read_csv(path_to_oxford_data)
+    filtr = ["CountryName", "CountryCode", "Date"]
+    target = ["ConfirmedCases", "ConfirmedDeaths"]
+    msr = [measure for measure, _, _ in msr_flags_thresholds_oxford]
+    flags = ["C" + str(i) + "M" + "_Flag" for i in range(1, 8)] + ["H1_Flag"]
+    measures = measures.loc[:, filtr + msr + flags + target]
+    measures["Date"] = measures["Date"].apply(lambda x: datetime.strptime(str(x), "%Y%m%d"))
+    for col in target:
+        measures[col] = measures.groupby("CountryName")[col].ffill()
+    for measure, flag, _ in msr_flags_thresholds_oxford:
+        if flag is not None:
+            measures[flag] = [0 if x <= 0 else y for (x, y) in zip(measures[measure], measures[flag])]
+    for measure, flag, threshold in msr_flags_thresholds_oxford:
+        if flag is not None:
+            measures[measure] = [int(a and b) for a, b in zip(measures[measure] >= threshold, measures[flag] == 1)]
+        else:
+            measures[measure] = [int(a) for a in (measures[measure] >= threshold)]
+    msr = set(measures.columns).intersection(set(msr))
+    measures = measures.dropna()
+    for col in msr:
+        measures[col] = measures[col].apply(lambda x: int(x > 0))
+    measures = measures[["CountryName", "Date"] + list(sorted(msr))]
+    measures["CountryName"] = measures.CountryName.replace({
+        "United States": "US",
+        "South Korea": "Korea, South",
+        "Democratic Republic of Congo": "Congo (Kinshasa)",
+        "Czech Republic": "Czechia",
+        "Slovak Republic": "Slovakia",
+    })
+    measures = measures.fillna(0)
+    msr = future_policies
+    measures["Restrict_Mass_Gatherings"] = [
+        int(a or b or c) for a, b, c in zip(
+            measures["C3M_Cancel public events"], measures["C4M_Restrictions on gatherings"],
+            measures["C5M_Close public transport"],
+        )
+    ]
+    measures["Others"] = [
+        int(a or b or c) for a, b, c in zip(
+            measures["C2M_Workplace closing"], measures["C7M_Restrictions on internal movement"],
+            measures["C8M_International travel controls"],
+        )
+    ]
+    for col in [
+        "C2M_Workplace closing", "C3M_Cancel public events", "C4M_Restrictions on gatherings",
+        "C5M_Close public transport", "C7M_Restrictions on internal movement", "C8M_International travel controls",
+    ]:
+        del measures[col]
+    output = measures.copy()
+    any_not_in_place = measures.iloc[:, 2:].eq(0).any(axis=1)
+    output[msr[0]] = (any_not_in_place == 0).apply(lambda x: int(x))
+    output[msr[1]] = [
+        int(a and b) for a, b in zip(any_not_in_place == 1, measures["Restrict_Mass_Gatherings"] == 1)
+    ]
+    output[msr[2]] = [
+        int(a and b and c) for a, b, c in zip(
+            any_not_in_place > 0, measures["Restrict_Mass_Gatherings"] == 0,
+            measures["C6M_Stay at home requirements"] == 0,
+        )
+    ]
+    output[msr[3]] = [
+        int(a and b and c) for a, b, c in zip(
+            any_not_in_place == 2, measures["C1M_School closing"] == 1, measures["Restrict_Mass_Gatherings"] == 1,
+        )
+    ]
+    output[msr[4]] = [
+        int(a and b and c and d) for a, b, c, d in zip(
+            any_not_in_place > 1, measures["C1M_School closing"] == 0, measures["Restrict_Mass_Gatherings"] == 1,
+            measures["C6M_Stay at home requirements"] == 0,
+        )
+    ]
+    output[msr[5]] = [
+        int(a and b and c and d) for a, b, c, d in zip(
+            any_not_in_place > 2, measures["C1M_School closing"] == 1, measures["Restrict_Mass_Gatherings"] == 1,
+            measures["C6M_Stay at home requirements"] == 0,
+        )
+    ]
+    output[msr[6]] = (measures["C6M_Stay at home requirements"] == 1).apply(lambda x: int(x))
+    output.rename(columns={"CountryName": "country", "Date": "date"}, inplace=True)
+    output["province"] = "None"
+    output = output.loc[:, ["country", "province", "date"] + msr]
+    output = output[output.date <= yesterday].reset_index(drop=True)
+    return output
+
+
+def get_raw_oxford_data(seed: int) -> pd.DataFrame:
+    """
+    Small OxCGRT table, with missing measures, flags (the rows with a missing flag of a measure in place are dropped)
+    and cases and deaths before the first report of a country, C8M having no flag
+    """
+    random_state = np.random.RandomState(seed)
+    list_df = []
+    for country_name, country_code in [
+        ("United States", "USA"), ("France", "FRA"), ("South Korea", "KOR"), ("Namibia", "NAM"),
+    ]:
+        dates = pd.date_range("2020-03-01", periods=40)
+        df_country = pd.DataFrame({
+            "CountryName": country_name, "CountryCode": country_code, "Date": dates.strftime("%Y%m%d").astype(int),
+        })
+        for measure, flag, _ in msr_flags_thresholds_oxford:
+            df_country[measure] = np.where(
+                random_state.uniform(0, 1, len(dates)) > 0.1, random_state.randint(0, 5, len(dates)), np.nan
+            )
+            if flag is not None:
+                df_country[flag] = np.where(
+                    random_state.uniform(0, 1, len(dates)) > 0.1, random_state.randint(0, 2, len(dates)), np.nan
+                )
+        for target in ["ConfirmedCases", "ConfirmedDeaths"]:
+            values_target = np.cumsum(random_state.randint(0, 100, len(dates))).astype(float)
+            values_target[:random_state.randint(0, 5)] = np.nan
+            values_target[random_state.uniform(0, 1, len(dates)) < 0.1] = np.nan
+            df_country[target] = values_target
+        list_df.append(df_country)
+    return pd.concat(list_df).reset_index(drop=True)
+
+
+def test_read_oxford_international_policy_data_matches_row_by_row_features(tmp_path):
+    for seed in range(3):
+        path_to_oxford_data = str(tmp_path / f"OxCGRT_nat_latest_{seed}.csv")
+        get_raw_oxford_data(seed).to_csv(path_to_oxford_data, index=False)
+        output = read_oxford_international_policy_data("2020-04-05", path_to_oxford_data, use_cache=False)
+        output_rows = read_oxford_international_policy_data_rows("2020-04-05", path_to_oxford_data)
+
+        assert 0 < len(output) < 4 * 36
+        pd.testing.assert_frame_equal(output, output_rows, check_dtype=False)
+
+
+def test_policy_features_cache_round_trip(tmp_path):
+    path_to_oxford_data = str(tmp_path / "OxCGRT_nat_latest.csv")
+    get_raw_oxford_data(0).to_csv(path_to_oxford_data, index=False)
+    output = read_oxford_international_policy_data("2020-04-05", path_to_oxford_data)
+    policy_features_cache = DELPHIPolicyFeaturesCache(path_to_oxford_data, "policies_international", "2020-04-05")
+    output_cached = policy_features_cache.load()
+
+    pd.testing.assert_frame_equal(output_cached, output, check_dtype=False)
+    pd.testing.assert_frame_equal(
+        read_oxford_international_policy_data("2020-04-05", path_to_oxford_data), output_cached
+    )
+    # Provinces "None" are read back as strings and not as missing values
+    assert (output_cached["province"] == "None").all()
+
+    get_raw_policy_data_us(0).to_csv(tmp_path / "raw_policy_data_us_only.csv", index=False)
+    df_policies_US_final = read_policy_data_us_only(str(tmp_path) + "/", "raw_policy_data_us_only.csv")
+    df_policies_US_final_cached = read_policy_data_us_only(str(tmp_path) + "/", "raw_policy_data_us_only.csv")
+
+    assert len(os.listdir(tmp_path / DELPHIPolicyFeaturesCache.folder_name)) == 2
+    pd.testing.assert_frame_equal(df_policies_US_final_cached, df_policies_US_final, check_dtype=False)
+    # The first policy is read back as the strings "True"/"False" and not as booleans
+    assert df_policies_US_final_cached[future_policies[0]].map(type).eq(str).all()
+    assert set(df_policies_US_final_cached[future_policies[0]]) <= {"True", "False"}
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from DELPHI_params_V4 import future_policies, future_times, default_dict_normalized_policy_gamma, p_d, p_h, p_v
+from DELPHI_utils_V4_ode import DELPHIODEModelPolicy, DELPHIODEPolicyScenarios
+from DELPHI_utils_V4_static import get_initial_conditions
+
+# Small area with its grid of (future policy, enaction time) scenarios, enacted after the last day of data
+N = 1e6
+GLOBAL_PARAMS_FIXED = (N, 4000, 3000, 1000, 100, 5000, p_d, p_h, p_v)
+params = [0.6, 10, 3, 0.1, 0.05, 0.5, 1.5, 1.5, 0.2, 40, 10, 1.0]
+t_last_case = 30
+t_predictions = np.arange(120)
+list_scenarios = [(future_policy, future_time) for future_policy in future_policies for future_time in future_times]
+normalized_gamma_current_policy = default_dict_normalized_policy_gamma["Restrict_Mass_Gatherings_and_Schools"]
+
+
+@pytest.mark.parametrize("method, kwargs_solve, rtol", [
+    ("RK4", dict(n_substeps=2), 1e-10),
+    ("RK45", dict(rtol=1e-9, atol=1e-6), 1e-5),
+])
+def test_branching_scenarios_match_independent_solves(method, kwargs_solve, rtol):
+    x_0 = get_initial_conditions(params, GLOBAL_PARAMS_FIXED)
+    t_future_policy = [t_last_case + future_time for _, future_time in list_scenarios]
+    normalized_gamma_future_policy = [
+        default_dict_normalized_policy_gamma[future_policy] for future_policy, _ in list_scenarios
+    ]
+    x_sol_scenarios = DELPHIODEPolicyScenarios(
+        N=N, t_future_policy=t_future_policy, normalized_gamma_future_policy=normalized_gamma_future_policy,
+        normalized_gamma_current_policy=normalized_gamma_current_policy,
+    ).solve(params, x_0=x_0, t_eval=t_predictions, method=method, **kwargs_solve)
+
+    assert x_sol_scenarios.shape == (len(list_scenarios), 16, len(t_predictions))
+    for i in range(len(list_scenarios)):
+        x_sol_scenario = DELPHIODEModelPolicy(
+            N=N, t_future_policy=t_future_policy[i],
+            normalized_gamma_future_policy=normalized_gamma_future_policy[i],
+            normalized_gamma_current_policy=normalized_gamma_current_policy,
+        ).solve(params, x_0=x_0, t_eval=t_predictions, method=method, **kwargs_solve).y
+        np.testing.assert_allclose(x_sol_scenarios[i], x_sol_scenario, rtol=rtol, atol=1e-6)
@@ -0,0 +1,139 @@
+import io
+import json
+import numpy as np
+import pandas as pd
+from DELPHI_params_V4 import default_policy, default_policy_enaction_time
+from DELPHI_utils_V4_static import DELPHIScenarioCube
+
+policies = [default_policy, "No_Measure", "Restrict_Mass_Gatherings"]
+times = [default_policy_enaction_time, "One Week", "Two Weeks"]
+
+
+def get_df_policy_predictions() -> pd.DataFrame:
+    """
+    Small set of policy predictions since 100 cases as built by the policy scripts: areas with different first days,
+    historical values that are missing after the last day of data
+    """
+    random_state = np.random.RandomState(0)
+    list_df = []
+    for continent, country, province, first_day, n_days in [
+        ("Europe", "France", "None", "2020-10-01", 6),
+        ("North America", "US", "New York", "2020-09-28", 8),
+        ("North America", "US", "Texas", "2020-10-02", 5),
+        ("Europe", "Italy", "None", "2020-10-01", 6),
+    ]:
+        days = pd.date_range(first_day, periods=n_days).strftime("%Y-%m-%d")
+        values_true = random_state.randint(0, 1000, (n_days, 2)).astype(float)
+        values_true[-2:] = np.nan
+        for policy in policies:
+            for time in times:
+                list_df.append(pd.DataFrame({
+                    "Policy": policy, "Time": time, "Continent": continent, "Country": country, "Province": province,
+                    "Day": days,
+                    "Total Detected": random_state.randint(0, 10000, n_days),
+                    "Total Detected Deaths": random_state.randint(0, 1000, n_days),
+                    "Total Detected True": values_true[:, 0],
+                    "Total Detected Deaths True": values_true[:, 1],
+                }))
+    # Rows of the areas are not necessarily sorted by day
+    return pd.concat(list_df).sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def create_nested_dict_baseline(df_predictions: pd.DataFrame) -> dict:
+    """
+    Nested dictionary of the policy predictions as built by DELPHIDataSaver before the scenario cube, used as reference
+    """
+    dict_all_results = {continent: {} for continent in df_predictions.Continent.unique()}
+    for continent in dict_all_results.keys():
+        countries_in_continent = list(df_predictions[df_predictions.Continent == continent].Country.unique())
+        dict_all_results[continent] = {country: {} for country in countries_in_continent}
+    keys_country_province = set(zip(df_predictions.Continent, df_predictions.Country, df_predictions.Province))
+    for continent, country, province in keys_country_province:
+        df_predictions_province = df_predictions[
+            (df_predictions.Country == country) & (df_predictions.Province == province)
+        ].reset_index(drop=True)
+        df_default = df_predictions_province[
+            (df_predictions_province.Policy == default_policy)
+            & (df_predictions_province.Time == default_policy_enaction_time)
+        ].sort_values("Day")
+        dict_all_results[continent][country][province] = {
+            "Day": sorted(list(df_predictions_province.Day.unique())),
+            "Total Detected True": df_default["Total Detected True"].tolist(),
+            "Total Detected Deaths True": df_default["Total Detected Deaths True"].tolist(),
+        }
+        dict_all_results[continent][country][province].update({
+            policy: {
+                time: {
+                    column: df_predictions_province[
+                        (df_predictions_province.Policy == policy) & (df_predictions_province.Time == time)
+                    ].sort_values("Day")[column].tolist()
+                    for column in ["Total Detected", "Total Detected Deaths"]
+                }
+                for time in df_predictions_province.Time.unique()
+            }
+            for policy in df_predictions_province.Policy.unique()
+        })
+    return dict_all_results
+
+
+def load_json(json_string: str) -> dict:
+    # NaN are kept as strings so that the historical values missing in both files compare equal
+    return json.loads(json_string, parse_constant=lambda constant: constant)
+
+
+def test_streamed_json_matches_baseline_json_dump():
+    df_predictions = get_df_policy_predictions()
+    handle = io.StringIO()
+    DELPHIScenarioCube.from_dataframe(df_predictions).write_json(handle)
+
+    assert load_json(handle.getvalue()) == load_json(json.dumps(create_nested_dict_baseline(df_predictions)))
+
+
+def test_streamed_json_matches_nested_dict():
+    scenario_cube = DELPHIScenarioCube.from_dataframe(get_df_policy_predictions())
+    handle = io.StringIO()
+    scenario_cube.write_json(handle)
+
+    assert handle.getvalue() == json.dumps(scenario_cube.to_nested_dict())
+
+
+def test_save_json_writes_identical_files(tmp_path):
+    scenario_cube = DELPHIScenarioCube.from_dataframe(get_df_policy_predictions())
+    list_paths = [str(tmp_path / "world_Scenarios.json"), str(tmp_path / "World_Scenarios_copy.json")]
+    scenario_cube.save_json(list_paths)
+
+    with open(list_paths[0]) as handle:
+        json_saved = handle.read()
+    with open(list_paths[1]) as handle:
+        assert handle.read() == json_saved
+    assert json_saved == json.dumps(scenario_cube.to_nested_dict())
+
+
+def test_cube_from_area_blocks_matches_baseline_json_dump():
+    # Blocks as returned by solve_and_predict_area_policies, and the same predictions as a dataframe
+    random_state = np.random.RandomState(1)
+    list_areas = [("Europe", "France", "None"), ("North America", "US", "New York")]
+    list_first_days = [np.datetime64("2020-10-01"), np.datetime64("2020-09-28")]
+    list_values = [random_state.randint(0, 10000, (len(policies), len(times), n_days, 2)) for n_days in [6, 8]]
+    list_values_true = [random_state.randint(0, 1000, (n_days, 2)).astype(float) for n_days in [6, 8]]
+    list_df = []
+    for (continent, country, province), first_day, values_area, values_true_area in zip(
+            list_areas, list_first_days, list_values, list_values_true
+    ):
+        days = np.datetime_as_string(first_day + np.arange(values_area.shape[2]))
+        for p, policy in enumerate(policies):
+            for t, time in enumerate(times):
+                list_df.append(pd.DataFrame({
+                    "Policy": policy, "Time": time, "Continent": continent, "Country": country,
+                    "Province": province, "Day": days,
+                    "Total Detected": values_area[p, t, :, 0], "Total Detected Deaths": values_area[p, t, :, 1],
+                    "Total Detected True": values_true_area[:, 0],
+                    "Total Detected Deaths True": values_true_area[:, 1],
+                }))
+    handle = io.StringIO()
+    DELPHIScenarioCube.from_area_blocks(
+        list_areas=list_areas, list_first_days=list_first_days, list_values=list_values,
+        list_values_true=list_values_true, policies=policies, times=times,
+    ).write_json(handle)
+
+    assert load_json(handle.getvalue()) == load_json(json.dumps(create_nested_dict_baseline(pd.concat(list_df))))
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import OptimizeResult
+from DELPHI_params_V4 import p_d, p_h, p_v
+from DELPHI_utils_V4_ode import DELPHIODEModel
+from DELPHI_utils_V4_static import (
+    create_fitting_data_from_validcases, get_carried_forward_fit, get_initial_conditions, get_mape_data_fitting,
+    get_residuals_value
+)
+
+N = 1e6
+GLOBAL_PARAMS_FIXED = (N, 4000, 3000, 1000, 100, 5000, p_d, p_h, p_v)
+t_cases = np.arange(40)
+past_params = np.array([0.6, 10, 3, 0.1, 0.05, 0.5, 1.5, 1.5, 0.2, 40, 10, 1.0])
+past_start_date = "2020-10-01"
+delphi_model = DELPHIODEModel(N=N)
+
+
+def get_fitting_data(params, perturbation_days: slice = slice(0, 0), perturbation: float = 0) -> dict:
+    """
+    Cases and deaths generated by the model itself with the given parameters, multiplied by 1 + perturbation on some
+    days
+    """
+    x_sol = delphi_model.solve(
+        params, x_0=get_initial_conditions(params, GLOBAL_PARAMS_FIXED), t_eval=t_cases, method="RK4"
+    ).y
+    cases, deaths = x_sol[15].copy(), x_sol[14].copy()
+    cases[perturbation_days] *= 1 + perturbation
+    deaths[perturbation_days] *= 1 + perturbation
+    balance, balance_total_difference, cases_data_fit, deaths_data_fit, weights = create_fitting_data_from_validcases(
+        pd.DataFrame({"case_cnt": cases, "death_cnt": deaths})
+    )
+    return dict(
+        balance=balance, balance_total_difference=balance_total_difference, cases_data_fit=cases_data_fit,
+        deaths_data_fit=deaths_data_fit, weights=weights,
+    )
+
+
+def get_carried_forward_fit_area(past_mape: float, start_date_fitting: str, fitting_data: dict):
+    parameter_list_line = ["Europe", "France", "None", past_start_date, past_mape] + list(past_params)
+    return get_carried_forward_fit(
+        delphi_model, parameter_list_line, start_date_fitting=start_date_fitting, t_cases=t_cases,
+        global_params_fixed=GLOBAL_PARAMS_FIXED, optimizer="tnc", ode_solver="RK4", n_substeps=1, **fitting_data
+    )
+
+
+@pytest.mark.parametrize("start_date_fitting, shift_jump", [(None, 0), ("2020-09-25", 0), ("2020-10-06", 5)])
+def test_parameters_carried_forward_with_the_jump_shifted(start_date_fitting, shift_jump):
+    # The data of today's window follow yesterday's parameters, once the jump is expressed from today's start date
+    params_shifted = past_params.copy()
+    params_shifted[9] -= shift_jump
+    fitting_data = get_fitting_data(params_shifted)
+    output, mape_recent_window, mape_drift = get_carried_forward_fit_area(
+        past_mape=0.0, start_date_fitting=start_date_fitting, fitting_data=fitting_data
+    )
+
+    assert isinstance(output, OptimizeResult)
+    assert output.carried_forward and output.success and output.nit == 0
+    np.testing.assert_array_equal(output.x, params_shifted)
+    x_sol = delphi_model.solve(
+        params_shifted, x_0=get_initial_conditions(params_shifted, GLOBAL_PARAMS_FIXED), t_eval=t_cases,
+        method="RK4", n_substeps=1
+    ).y
+    assert output.fun == pytest.approx(get_residuals_value(optimizer="tnc", x_sol=x_sol, **fitting_data))
+    assert mape_recent_window == pytest.approx(0, abs=1e-9)
+    assert mape_drift == pytest.approx(0, abs=1e-9)
+
+
+def test_parameters_refitted_when_the_recent_window_is_off():
+    # Last 7 days 20% above yesterday's parameters
+    fitting_data = get_fitting_data(past_params, perturbation_days=slice(-7, None), perturbation=0.2)
+    output, mape_recent_window, mape_drift = get_carried_forward_fit_area(
+        past_mape=100.0, start_date_fitting=None, fitting_data=fitting_data
+    )
+
+    assert output is None
+    assert mape_recent_window == pytest.approx(100 * 0.2 / 1.2)
+    assert mape_drift < 0
+
+
+@pytest.mark.parametrize("past_mape, is_carried_forward", [(0.0, False), (5.0, True)])
+def test_parameters_refitted_when_the_in_sample_mape_drifts(past_mape, is_carried_forward):
+    # Days before the recent window, but in the 15 days of the in-sample MAPE, 10% above yesterday's parameters
+    fitting_data = get_fitting_data(past_params, perturbation_days=slice(-15, -7), perturbation=0.1)
+    output, mape_recent_window, mape_drift = get_carried_forward_fit_area(
+        past_mape=past_mape, start_date_fitting=None, fitting_data=fitting_data
+    )
+    x_sol = delphi_model.solve(
+        past_params, x_0=get_initial_conditions(past_params, GLOBAL_PARAMS_FIXED), t_eval=t_cases, method="RK4"
+    ).y
+
+    assert mape_recent_window == pytest.approx(0, abs=1e-9)
+    mape_in_sample = get_mape_data_fitting(
+        cases_data_fit=fitting_data["cases_data_fit"], deaths_data_fit=fitting_data["deaths_data_fit"], x_sol_final=x_sol
+    )
+    assert mape_drift == pytest.approx(mape_in_sample - past_mape)
+    assert (output is not None) == is_carried_forward
+
+
+def test_parameters_refitted_when_they_cannot_be_solved():
+    class FailingModel:
+        def solve(self, params, x_0, t_eval, method, n_substeps):
+            return OptimizeResult(t=t_eval[:1], y=np.zeros((16, 1)), status=-1, success=False)
+
+    parameter_list_line = ["Europe", "France", "None", past_start_date, 1.0] + list(past_params)
+    output, mape_recent_window, mape_drift = get_carried_forward_fit(
+        FailingModel(), parameter_list_line, start_date_fitting=None, t_cases=t_cases,
+        global_params_fixed=GLOBAL_PARAMS_FIXED, optimizer="tnc", ode_solver="RK4", n_substeps=1,
+        **get_fitting_data(past_params)
+    )
+
+    assert (output, mape_recent_window, mape_drift) == (None, None, None)